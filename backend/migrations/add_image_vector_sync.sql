@@ -0,0 +1,26 @@
+-- 向量增量同步（backend/services/clip_sync_vectors.py）所需的索引、删除记录表和触发器
+-- 作用: 同步任务按 (updatedAt, id) 键集分页读取变化的图片，按自增id读取删除记录，
+--       每次运行只读取变化的行，开销与变化量成正比
+
+-- 变化的图片按 (updatedAt, id) 分页读取，没有该索引时每页都要全表扫描并排序
+CREATE INDEX idx_images_updated_id ON images(updatedAt, id);
+
+-- 删除记录表：images表删除一行时由触发器写入，同步任务读取后删除对应的向量point
+CREATE TABLE IF NOT EXISTS image_deletions (
+  id BIGINT AUTO_INCREMENT PRIMARY KEY,
+  imageId INT NOT NULL COMMENT '被删除的图片ID',
+  deletedAt DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP COMMENT '删除时间',
+  INDEX idx_image_deletions_deleted_at (deletedAt)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='图片删除记录（向量增量同步用）';
+
+DROP TRIGGER IF EXISTS trg_images_after_delete;
+CREATE TRIGGER trg_images_after_delete
+AFTER DELETE ON images
+FOR EACH ROW
+  INSERT INTO image_deletions (imageId) VALUES (OLD.id);
+
+-- 已同步过的删除记录可以定期清理，例如:
+-- DELETE FROM image_deletions WHERE deletedAt < NOW() - INTERVAL 30 DAY;
+
+-- 输出确认信息
+SELECT '✅ 向量增量同步索引、删除记录表和触发器创建成功' as status;
@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+"""
+CLIP向量化服务（异步模式，ASGI）
+与 clip_vectorize_service.py 提供相同的编码接口，但请求不占用线程等待前向计算：
+  - 推理在有界队列上执行（文本、图片各一个微批处理器），排队数达到 CLIP_MAX_QUEUE 时立即返回429和Retry-After；
+    单个批量请求的条数超过 CLIP_MAX_QUEUE 时永远无法准入，直接返回413
+  - 模型未就绪时返回503和Retry-After
+  - 请求可携带截止时间（X-Request-Timeout-Ms 头或请求体 timeout_ms），排队期间超时的请求在计算前丢弃，返回504
+模型加载、缓存、请求解析和响应体构建与同步服务共用（clip_utils/service_core.py），这里只有准入控制、截止时间和ASGI传输层
+
+用法:
+  uvicorn clip_async_service:app --host 0.0.0.0 --port 5001
+  或 CLIP_SERVER_MODE=async ./start_clip_service.sh
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import functools
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('clip_async_service')
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(CURRENT_DIR, 'clip_utils'))
+
+from config import CLIP_CONFIG, ASYNC_CONFIG, METRICS_CONFIG  # noqa: E402
+from micro_batcher import MicroBatcher, QueueFullError, BatchTooLargeError, DeadlineExceeded, merge_future_stages  # noqa: E402
+import service_core as core  # noqa: E402
+from service_core import ServiceError  # noqa: E402
+import vector_codec  # noqa: E402
+import metrics  # noqa: E402
+
+# 读取/解码图片等阻塞操作使用的线程池（推理不在这里执行）
+_io_executor = ThreadPoolExecutor(max_workers=ASYNC_CONFIG['io_workers'], thread_name_prefix='clip-io')
+
+# 有界推理队列（延迟创建）
+# 推理队列（延迟创建；加锁保证即使从多个线程同时第一次调用也只创建一个）
+_text_batcher = None
+_image_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_text_batcher():
+    """文本推理队列：排队数有上限，过期请求在计算前丢弃"""
+    global _text_batcher
+    with _batcher_lock:
+        if _text_batcher is None:
+            _text_batcher = MicroBatcher(
+                lambda texts: core.init_clip_encoder().encode_texts_batch(texts),
+                max_batch_size=CLIP_CONFIG['batch_size'],
+                window_ms=CLIP_CONFIG['batch_window_ms'] if CLIP_CONFIG['micro_batching'] else 0,
+                name='async-text',
+                max_queue=ASYNC_CONFIG['max_queue'],
+                kind='text'
+            )
+    return _text_batcher
+
+
+def get_image_batcher():
+    """图片推理队列"""
+    global _image_batcher
+    with _batcher_lock:
+        if _image_batcher is None:
+            _image_batcher = MicroBatcher(
+                lambda images: core.init_clip_encoder().encode_images_batch(images),
+                max_batch_size=CLIP_CONFIG['batch_size'],
+                window_ms=CLIP_CONFIG['batch_window_ms'] if CLIP_CONFIG['micro_batching'] else 0,
+                name='async-image',
+                max_queue=ASYNC_CONFIG['max_queue'],
+                kind='image'
+            )
+    return _image_batcher
+
+
+def error_response(message, status_code, retry_after=None, details=None):
+    """错误响应；需要客户端退避时带Retry-After头"""
+    headers = {'Retry-After': str(int(retry_after))} if retry_after else None
+    return JSONResponse({'error': message, **(details or {})}, status_code=status_code, headers=headers)
+
+
+def request_deadline(request, data=None):
+    """截止时间（time.monotonic()）：X-Request-Timeout-Ms 头或请求体 timeout_ms，否则使用默认值，都没有时为None"""
+    value = request.headers.get('X-Request-Timeout-Ms')
+    if value is None and isinstance(data, dict):
+        value = data.get('timeout_ms')
+    try:
+        timeout_ms = float(value) if value is not None else ASYNC_CONFIG['default_deadline_ms']
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid timeout "{value}"')
+    return time.monotonic() + timeout_ms / 1000.0 if timeout_ms > 0 else None
+
+
+def batch_too_large(count, max_queue):
+    """批量请求超过排队上限（413，不带Retry-After：原样重试永远不会成功）"""
+    return ServiceError(f'Too many items in one request: {count} exceeds the queue limit {max_queue}, '
+                        f'split the request into batches of at most {max_queue}', 413,
+                        details={'max_items': max_queue})
+
+
+def admit(kind, batcher, count=1):
+    """进入推理前的准入检查：编码器模式（501）、模型就绪（503）、条数超过排队上限（413）、队列容量（429）"""
+    core.require_encoder(kind)
+    if not core.is_ready():
+        raise ServiceError('Model is warming up', 503, retry_after=5)
+    try:
+        batcher.ensure_capacity(count)
+    except BatchTooLargeError as e:
+        raise batch_too_large(count, e.max_queue)
+    except QueueFullError as e:
+        raise ServiceError('Server is overloaded', 429, retry_after=e.retry_after)
+
+
+async def run_io(fn, *args):
+    """在IO线程池中执行阻塞操作（带上当前上下文，线程中记录的阶段耗时计入本请求）"""
+    call = functools.partial(contextvars.copy_context().run, fn, *args)
+    return await asyncio.get_running_loop().run_in_executor(_io_executor, call)
+
+
+async def compute(batcher, items, deadline):
+    """把一组条目放入推理队列并等待结果；超过截止时间时取消尚未计算的条目"""
+    try:
+        futures = batcher.submit_many(items, deadline)
+    except BatchTooLargeError as e:
+        raise batch_too_large(len(items), e.max_queue)
+    except QueueFullError as e:
+        raise ServiceError('Server is overloaded', 429, retry_after=e.retry_after)
+    timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+    try:
+        results = await asyncio.wait_for(asyncio.gather(*[asyncio.wrap_future(f) for f in futures]), timeout)
+        merge_future_stages(futures)
+        return results
+    except asyncio.TimeoutError:
+        for future in futures:
+            future.cancel()
+        raise DeadlineExceeded('Deadline exceeded')
+
+
+async def encode_texts(texts, deadline):
+    """编码一组文本：先查缓存，只把未命中的放入推理队列，失败返回None"""
+    vectors = core.cached_text_vectors(texts)
+    missing = [i for i, v in enumerate(vectors) if v is None]
+    if missing:
+        computed = await compute(get_text_batcher(), [texts[i] for i in missing], deadline)
+        if any(vector is None for vector in computed):
+            return None
+        for i, vector in zip(missing, computed):
+            vectors[i] = vector
+        core.cache_text_vectors([texts[i] for i in missing], computed)
+    return vectors
+
+
+async def encode_image_contents(contents, errors, deadline, dedup=None):
+    """
+    编码一组图片字节（None表示读取失败，已记录在errors中）：查存储、解码在IO线程池，推理在有界队列
+    dedup（DedupBatch）不为None时做近重复检测（同同步服务的 encode_image_bytes_batch），结果写入dedup.duplicates
+    """
+    digests, vectors = await run_io(core.lookup_images, contents)
+    # 近重复检测时命中存储的图片也要解码计算感知哈希
+    pending = [i for i, c in enumerate(contents) if c is not None and (vectors[i] is None or dedup is not None)]
+    results = await asyncio.gather(*[run_io(core.decode_image, contents[i], dedup is not None) for i in pending],
+                                   return_exceptions=True)
+    decoded = []
+    for index, result in zip(pending, results):
+        if isinstance(result, Exception):
+            errors[index] = str(result)
+        else:
+            decoded.append((index, result))
+
+    if dedup is not None and decoded:
+        decoded = await run_io(core.filter_hash_duplicates, dedup, decoded, vectors)
+
+    if decoded:
+        computed = await compute(get_image_batcher(), [image for _, image in decoded], deadline)
+        done = []
+        for (index, _), vector in zip(decoded, computed):
+            if vector is None:
+                errors[index] = 'Failed to encode image'
+            else:
+                vectors[index] = vector
+                done.append(index)
+        await run_io(core.store_images, [digests[i] for i in done], [vectors[i] for i in done])
+    if dedup is not None:
+        await run_io(core.flag_vector_duplicates, dedup, vectors)
+    return vectors
+
+
+def negotiate_vector_format(request, data=None):
+    """确定向量响应格式和数据类型（规则见 service_core.negotiate_vector_format）"""
+    return core.negotiate_vector_format(request.query_params, request.headers.get('Accept'), data)
+
+
+# 当前请求在阶段指标中的类型标签（text / image）
+request_kind = contextvars.ContextVar('clip_request_kind', default='')
+
+
+def vector_response(body, vectors, fmt, dtype, single=False):
+    """按协商的格式输出向量"""
+    with metrics.stage('serialize', request_kind.get()):
+        body, payload, headers = vector_codec.pack_vectors(body, vectors, fmt, dtype, single)
+        if payload is None:
+            return JSONResponse(body)
+        return Response(payload, media_type=vector_codec.BINARY_MIMETYPE, headers=headers)
+
+
+async def read_json(request):
+    """解析JSON请求体（计入parse阶段），失败返回None"""
+    try:
+        # 先读完请求体，parse阶段只计JSON解析
+        await request.body()
+        with metrics.stage('parse', request_kind.get()):
+            return await request.json()
+    except Exception:
+        return None
+
+
+def handles_errors(view):
+    """
+    把参数错误（400）、ServiceError（准入拒绝、服务端错误等）、截止时间（504）转换为对应的HTTP响应，并记录请求指标：
+    耗时、状态码、并发数；请求带 X-Debug-Timing: 1 时在 Server-Timing 头中返回各阶段耗时
+    """
+    async def handle(request):
+        try:
+            return await view(request)
+        except ServiceError as e:
+            return error_response(str(e), e.status_code, e.retry_after, e.details)
+        except ValueError as e:
+            return error_response(str(e), 400)
+        except DeadlineExceeded:
+            return error_response('Deadline exceeded', 504)
+        except Exception as e:
+            logger.error(f"{request.url.path} 处理失败: {e}")
+            return error_response(str(e), 500)
+
+    async def wrapper(request):
+        if not METRICS_CONFIG['enabled']:
+            return await handle(request)
+        endpoint = request.url.path
+        request_kind.set(core.ENDPOINT_KINDS.get(endpoint, ''))
+        stages = metrics.begin_trace()
+        metrics.IN_FLIGHT.inc(endpoint=endpoint)
+        started = time.perf_counter()
+        try:
+            response = await handle(request)
+        finally:
+            metrics.IN_FLIGHT.dec(endpoint=endpoint)
+        elapsed = time.perf_counter() - started
+        metrics.REQUEST_SECONDS.observe(elapsed, endpoint=endpoint)
+        metrics.REQUESTS_TOTAL.inc(endpoint=endpoint, status=response.status_code)
+        if METRICS_CONFIG['debug_timing'] and metrics.debug_requested(request.headers.get(metrics.DEBUG_HEADER)):
+            response.headers['Server-Timing'] = metrics.server_timing(stages, elapsed)
+        return response
+    return wrapper
+
+
+@handles_errors
+async def encode_text(request):
+    """将文本编码为向量"""
+    data = await read_json(request)
+    text = core.parse_text(data)
+    fmt, dtype = negotiate_vector_format(request, data)
+    deadline = request_deadline(request, data)
+    admit('text', get_text_batcher())
+
+    vectors = await encode_texts([text], deadline)
+    body = core.text_body(text, vectors[0] if vectors else None)
+    return vector_response(body, vectors, fmt, dtype, single=True)
+
+
+@handles_errors
+async def encode_texts_endpoint(request):
+    """批量将文本编码为向量（异步模式不支持NDJSON流式输出）"""
+    data = await read_json(request)
+    texts = core.parse_texts(data)
+    if core.is_true(data.get('stream', '')) or core.NDJSON_MIMETYPE in (request.headers.get('Accept') or ''):
+        raise ValueError('Streaming is not supported in async mode')
+    fmt, dtype = negotiate_vector_format(request, data)
+    deadline = request_deadline(request, data)
+    admit('text', get_text_batcher(), len(texts))
+
+    vectors = await encode_texts(texts, deadline)
+    return vector_response(core.texts_body(data, texts, vectors), vectors, fmt, dtype)
+
+
+async def read_image_sources(request):
+    """
+    读取请求中的图片: JSON {"image": ...} / {"images": [...]}、multipart文件或原始图片字节
+    返回 (JSON请求体, [(来源, 字节或None)])，JSON中的URL/路径稍后在IO线程池中读取
+    """
+    content_type = request.headers.get('content-type', '')
+    if content_type.startswith('multipart/form-data'):
+        form = await request.form()
+        uploads = [value for _, value in form.multi_items() if hasattr(value, 'read')]
+        return None, [(upload.filename, await upload.read()) for upload in uploads]
+    if 'json' in content_type:
+        data = await read_json(request) or {}
+        if 'images' in data:
+            return data, [(source, None) for source in core.parse_image_sources(data)]
+        return data, [(core.parse_image_source(data), None)]
+    body = await request.body()
+    if not body:
+        raise ValueError('Empty request body')
+    return None, [(None, body)]
+
+
+@handles_errors
+async def encode_image(request):
+    """将单张图片编码为向量（URL、本地路径或上传的图片内容）"""
+    data, images = await read_image_sources(request)
+    fmt, dtype = negotiate_vector_format(request, data)
+    deadline = request_deadline(request, data)
+    admit('vision', get_image_batcher())
+
+    contents, errors = await run_io(core.fetch_contents, images[:1])
+    vectors = await encode_image_contents(contents, errors, deadline)
+    if 0 in errors:
+        raise core.image_error(errors)
+    return vector_response({
+        'status': 'success',
+        'dimension': len(vectors[0])
+    }, vectors, fmt, dtype, single=True)
+
+
+@handles_errors
+async def encode_images(request):
+    """
+    批量将图片编码为向量；单张失败不会中断整个批次，对应位置返回null并在errors中说明
+    近重复检测参数（dedup、image_ids）与同步服务相同，通过检查的图片写入成功后用 /register-images 登记
+    """
+    data, images = await read_image_sources(request)
+    if len(images) == 0:
+        raise ValueError('Images must be a non-empty list')
+    options = data
+    if options is None and request.headers.get('content-type', '').startswith('multipart/form-data'):
+        form = await request.form()
+        options = {key: value for key, value in form.multi_items() if isinstance(value, str)}
+    fmt, dtype = negotiate_vector_format(request, data)
+    dedup = core.parse_dedup(options or {}, len(images))
+    fmt = core.images_format(fmt, dedup)
+    deadline = request_deadline(request, data)
+    admit('vision', get_image_batcher(), len(images))
+
+    contents, errors = await run_io(core.fetch_contents, images)
+    vectors = await encode_image_contents(contents, errors, deadline, dedup)
+    body, vectors = core.images_body(vectors, errors, dedup)
+    if vectors is None:
+        return JSONResponse(body)
+    return vector_response(body, vectors, fmt, dtype)
+
+
+@handles_errors
+async def search(request):
+    """在本地向量索引中搜索（参数与结果格式同同步服务的 /search）"""
+    data = await read_json(request)
+    return JSONResponse(await run_io(core.search_local_index, data))
+
+
+@handles_errors
+async def search_text(request):
+    """编码查询文本并直接搜索（参数与结果格式同同步服务的 /search-text）"""
+    data = await read_json(request)
+    plan = core.parse_text_search(data)
+    deadline = request_deadline(request, data)
+    admit('text', get_text_batcher())
+
+    started = time.perf_counter()
+    vectors = await encode_texts([plan['text']], deadline)
+    vector = vectors[0] if vectors else None
+    return JSONResponse(await run_io(core.search_text_body, plan, vector, time.perf_counter() - started))
+
+
+@handles_errors
+async def register_images(request):
+    """把已写入向量库的图片登记到近重复检测器（参数同同步服务的 /register-images）"""
+    data = await read_json(request)
+    entries = core.parse_register_request(data)
+    return JSONResponse(await run_io(core.register_images, entries))
+
+
+@handles_errors
+async def tag_images(request):
+    """
+    零样本打标签（参数与结果格式同同步服务的 /tag-images）
+    图片编码经有界推理队列，标签矩阵加载和打分（一次矩阵乘）在IO线程池中执行
+    """
+    labels = await run_io(core.get_labels)
+
+    content_type = request.headers.get('content-type', '')
+    if 'json' in content_type:
+        data = await read_json(request) or {}
+        images = [(source, None) for source in core.parse_image_sources(data)] if 'images' in data else []
+    else:
+        _, images = await read_image_sources(request)
+        data = {}
+        if content_type.startswith('multipart/form-data'):
+            form = await request.form()
+            data = {key: value for key, value in form.multi_items() if isinstance(value, str)}
+    options = core.parse_tag_options(data)
+    vectors = core.parse_tag_vectors(data, labels.dimension)
+
+    errors = {}
+    if vectors is None:
+        if len(images) == 0:
+            raise ValueError('Missing "images" field in request body')
+        deadline = request_deadline(request, data)
+        admit('vision', get_image_batcher(), len(images))
+        contents, errors = await run_io(core.fetch_contents, images)
+        vectors = await encode_image_contents(contents, errors, deadline)
+    return JSONResponse(await run_io(core.tag_body, labels, vectors, errors, options))
+
+
+def admission_stats():
+    """推理队列统计（排队数、拒绝数、过期丢弃数等）"""
+    return {
+        'max_queue': ASYNC_CONFIG['max_queue'],
+        'default_deadline_ms': ASYNC_CONFIG['default_deadline_ms'],
+        'text': _text_batcher.stats() if _text_batcher is not None else None,
+        'image': _image_batcher.stats() if _image_batcher is not None else None
+    }
+
+
+async def health(request):
+    """健康检查（存活探针，不依赖模型是否加载完成）"""
+    return JSONResponse(core.health_body(server_mode='async', admission=admission_stats()))
+
+
+async def ready(request):
+    """就绪检查：模型加载并完成预热前返回503"""
+    body = core.ready_body()
+    return JSONResponse(body, status_code=200 if body['ready'] else 503)
+
+
+async def cache_stats(request):
+    """文本向量缓存统计"""
+    return JSONResponse(core.cache_stats())
+
+
+async def metrics_endpoint(request):
+    """Prometheus指标（与同步服务相同，另含异步推理队列的深度、拒绝数和过期丢弃数）"""
+    if not METRICS_CONFIG['enabled']:
+        return error_response('Metrics are disabled (CLIP_METRICS=false)', 404)
+    return PlainTextResponse(metrics.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """启动时按 CLIP_WARMUP 预热模型"""
+    logger.info("启动CLIP向量化服务（异步模式）")
+    core.start_warmup()
+    yield
+    _io_executor.shutdown(wait=False)
+
+
+app = Starlette(routes=[
+    Route('/health', health, methods=['GET']),
+    Route('/ready', ready, methods=['GET']),
+    Route('/cache-stats', cache_stats, methods=['GET']),
+    Route('/metrics', metrics_endpoint, methods=['GET']),
+    Route('/encode-text', encode_text, methods=['POST']),
+    Route('/encode-texts', encode_texts_endpoint, methods=['POST']),
+    Route('/encode-image', encode_image, methods=['POST']),
+    Route('/encode-images', encode_images, methods=['POST']),
+    Route('/search', search, methods=['POST']),
+    Route('/search-text', search_text, methods=['POST']),
+    Route('/register-images', register_images, methods=['POST']),
+    Route('/tag-images', tag_images, methods=['POST'])
+], lifespan=lifespan)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host=os.getenv('CLIP_SERVICE_HOST', '0.0.0.0'), port=int(os.getenv('CLIP_SERVICE_PORT', 5001)))
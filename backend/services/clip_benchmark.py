@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+"""
+CLIP编码基准测试
+在固定的本地样本上测量 CLIPEncoder.encode_text / encode_texts_batch / encode_images_batch 以及 /encode-text HTTP接口的
+延迟分位数（p50/p95/p99）、吞吐量和峰值内存，结果输出为JSON，可与保存的基线对比（用于容量规划和性能回归检查）
+
+用法:
+  python3 clip_benchmark.py -o baseline.json                                   # 默认设置跑一遍并保存为基线
+  python3 clip_benchmark.py --batch-sizes 1,8,32 --threads 1,2,4 --backends torch,torch-int8,onnx
+  python3 clip_benchmark.py --scenarios http --url http://localhost:5001 --concurrency 1,8,32 --server-pid 1234
+  python3 clip_benchmark.py -o current.json --baseline baseline.json --tolerance 0.1   # 有回归时退出码为1
+
+场景:
+  text         encode_text 单条编码（每次调用1条）
+  text-batch   encode_texts_batch 按 --batch-sizes 分批
+  image-batch  encode_images_batch 按 --batch-sizes 分批（图片预先解码，只计推理）
+  http         POST /encode-text 端到端（按 --concurrency 并发，默认每条文本唯一，不命中服务端文本缓存）
+样本:
+  文本取自 benchmark_fixtures/queries.txt，按 --text-lengths 拼接为 short（单条查询）、medium（约3条）、long（超过77个token，会被截断）
+  图片默认按固定种子生成常见尺寸的JPEG（也可用 --images 指定真实图片）
+每个 设备 × 后端 × 线程数 组合在独立子进程中运行，峰值内存（ru_maxrss）互不影响
+"""
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import logging
+import threading
+import subprocess
+from itertools import count
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    stream=sys.stderr
+)
+logger = logging.getLogger('clip_benchmark')
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(CURRENT_DIR, 'clip_utils'))
+
+import numpy as np  # noqa: E402
+
+from config import CLIP_CONFIG  # noqa: E402
+
+FIXTURE_DIR = os.path.join(CURRENT_DIR, 'benchmark_fixtures')
+LOCAL_SCENARIOS = ('text', 'text-batch', 'image-batch')
+SCENARIOS = LOCAL_SCENARIOS + ('http',)
+# 每种文本长度拼接的查询条数（long超过CLIP的77个token上限，用于测量截断后的最长输入）
+TEXT_LENGTHS = {'short': 1, 'medium': 3, 'long': 12}
+# 生成样本图片的尺寸（爬取图片常见的横图、宽屏、小图和方图）
+IMAGE_SIZES = [(1280, 853), (1920, 1080), (800, 600), (1024, 1024)]
+
+
+# ---------- 样本 ----------
+
+def load_corpus(path):
+    """读取文本样本（每行一条）"""
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def build_texts(corpus, length, size, seed):
+    """按长度档位拼接出size条文本（固定种子，多次运行结果相同）"""
+    rng = random.Random(f"{seed}-{length}")
+    parts = TEXT_LENGTHS[length]
+    return [', '.join(rng.sample(corpus, min(parts, len(corpus)))) for _ in range(size)]
+
+
+def synthetic_images(size, seed):
+    """按固定种子生成JPEG样本（渐变背景 + 随机色块 + 噪声，接近照片的压缩率）"""
+    from io import BytesIO
+    from PIL import Image, ImageDraw
+
+    rng = np.random.default_rng(seed)
+    images = []
+    for i in range(size):
+        width, height = IMAGE_SIZES[i % len(IMAGE_SIZES)]
+        start, end = rng.integers(0, 256, 3), rng.integers(0, 256, 3)
+        ramp = np.linspace(0.0, 1.0, width, dtype=np.float32)[None, :, None]
+        pixels = start + (end - start) * ramp + rng.normal(0, 12, (height, 1, 3))
+        pixels = np.broadcast_to(pixels, (height, width, 3)) + rng.normal(0, 6, (height, width, 3))
+        image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+        draw = ImageDraw.Draw(image)
+        for _ in range(12):
+            x0, y0 = int(rng.integers(0, width)), int(rng.integers(0, height))
+            box = (x0, y0, x0 + int(rng.integers(20, width // 2)), y0 + int(rng.integers(20, height // 2)))
+            color = tuple(int(c) for c in rng.integers(0, 256, 3))
+            (draw.ellipse if rng.random() < 0.5 else draw.rectangle)(box, fill=color)
+        buffer = BytesIO()
+        image.save(buffer, format='JPEG', quality=90)
+        images.append(buffer.getvalue())
+    return images
+
+
+def take(pool, call, size):
+    """第call次调用使用的样本（按顺序循环取size条）"""
+    start = call * size
+    return [pool[(start + i) % len(pool)] for i in range(size)]
+
+
+# ---------- 统计 ----------
+
+def peak_rss_mb():
+    """当前进程的峰值常驻内存（MB）"""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux单位为KB，macOS为字节
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def process_memory_mb(pid):
+    """读取其他进程（如服务进程）的当前和峰值常驻内存（仅Linux）"""
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/status", encoding='utf-8') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'VmHWM'):
+                    fields[key] = round(int(value.split()[0]) / 1024, 1)
+    except (OSError, ValueError):
+        return None
+    return {'rss_mb': fields.get('VmRSS'), 'peak_rss_mb': fields.get('VmHWM')}
+
+
+def summarize(latencies, items, elapsed):
+    """延迟分位数（毫秒）和吞吐量（条/秒）"""
+    values = np.asarray(latencies, dtype=np.float64) * 1000
+    return {
+        'calls': len(values),
+        'items': items,
+        'latency_ms': {
+            'p50': round(float(np.percentile(values, 50)), 3),
+            'p95': round(float(np.percentile(values, 95)), 3),
+            'p99': round(float(np.percentile(values, 99)), 3),
+            'mean': round(float(values.mean()), 3),
+            'max': round(float(values.max()), 3)
+        },
+        'throughput': round(items / elapsed, 2) if elapsed > 0 else None
+    }
+
+
+def measure(call, batches, warmup, iterations):
+    """先预热warmup次，再计时iterations次；batches为每次调用的输入"""
+    for i in range(warmup):
+        call(batches[i % len(batches)])
+    latencies = []
+    items = 0
+    started = time.perf_counter()
+    for i in range(iterations):
+        batch = batches[i % len(batches)]
+        call_started = time.perf_counter()
+        call(batch)
+        latencies.append(time.perf_counter() - call_started)
+        items += len(batch) if isinstance(batch, list) else 1
+    return summarize(latencies, items, time.perf_counter() - started)
+
+
+def case_key(case):
+    """用于和基线对应的用例标识"""
+    fields = ('scenario', 'device', 'backend', 'threads', 'batch_size', 'concurrency', 'text_length', 'http_cache')
+    return '|'.join(f"{field}={case[field]}" for field in fields if case.get(field) is not None)
+
+
+# ---------- 本地编码（子进程） ----------
+
+def run_group(spec):
+    """在当前进程加载一个 设备 × 后端 × 线程数 组合的编码器并运行该组的所有用例"""
+    from clip_encoder import CLIPEncoder, set_num_threads
+
+    scenarios = spec['scenarios']
+    wants_text = any(s in scenarios for s in ('text', 'text-batch'))
+    wants_image = 'image-batch' in scenarios
+    mode = 'both' if wants_text and wants_image else ('text' if wants_text else 'vision')
+
+    set_num_threads(spec['threads'])
+    started = time.perf_counter()
+    encoder = CLIPEncoder(mode=mode, backend=spec['backend'])
+    group = {
+        'device': encoder.device,
+        'backend': encoder.backend,
+        'threads': spec['threads'],
+        'load_seconds': round(time.perf_counter() - started, 2),
+        'model_peak_rss_mb': peak_rss_mb()
+    }
+
+    def checked(fn):
+        # 编码器失败时返回None而不是抛出异常
+        def call(batch):
+            if fn(batch) is None:
+                raise RuntimeError('编码失败，详见日志')
+        return call
+
+    cases = []
+
+    def run_case(scenario, fn, batches, **params):
+        case = {'scenario': scenario, 'device': group['device'], 'backend': group['backend'],
+                'threads': group['threads'], **params}
+        case['key'] = case_key(case)
+        try:
+            stats = measure(checked(fn), batches, warmup, iterations)
+        except Exception as e:
+            # 单个用例失败（如显存不足）不影响同组其他用例
+            logger.error(f"❌ {case['key']}: {e}")
+            cases.append({**case, 'error': str(e)})
+            return
+        cases.append({**case, **stats, 'peak_rss_mb': peak_rss_mb()})
+        logger.info(f"{case['key']}: p50 {stats['latency_ms']['p50']}ms，p95 {stats['latency_ms']['p95']}ms，"
+                    f"p99 {stats['latency_ms']['p99']}ms，{stats['throughput']} 条/秒")
+
+    corpus = load_corpus(spec['corpus'])
+    warmup, iterations = spec['warmup'], spec['iterations']
+    for length in spec['text_lengths'] if wants_text else []:
+        texts = build_texts(corpus, length, max(spec['batch_sizes'] + [iterations]) * 2, spec['seed'])
+        if 'text' in scenarios:
+            run_case('text', encoder.encode_text, texts, batch_size=1, text_length=length)
+        if 'text-batch' in scenarios:
+            for batch_size in spec['batch_sizes']:
+                batches = [take(texts, i, batch_size) for i in range(warmup + iterations)]
+                run_case('text-batch', encoder.encode_texts_batch, batches, batch_size=batch_size, text_length=length)
+
+    if wants_image:
+        from image_loader import read_image_bytes, load_image_from_bytes
+        if spec['images']:
+            contents = [read_image_bytes(source) for source in spec['images']]
+        else:
+            contents = synthetic_images(max(spec['batch_sizes']), spec['seed'])
+        images = [load_image_from_bytes(data) for data in contents]
+        for batch_size in spec['batch_sizes']:
+            batches = [take(images, i, batch_size) for i in range(warmup + iterations)]
+            run_case('image-batch', encoder.encode_images_batch, batches, batch_size=batch_size)
+
+    group['peak_rss_mb'] = peak_rss_mb()
+    return {'group': group, 'cases': cases}
+
+
+def spawn_group(spec, device):
+    """在子进程中运行一个组合（DEVICE环境变量决定设备），返回其结果"""
+    env = dict(os.environ)
+    env['DEVICE'] = device
+    label = f"device={device} backend={spec['backend']} threads={spec['threads']}"
+    logger.info(f"▶️ {label}")
+    process = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-group', json.dumps(spec)],
+                             env=env, stdout=subprocess.PIPE, text=True)
+    if process.returncode != 0:
+        logger.error(f"❌ {label} 运行失败（退出码 {process.returncode}）")
+        return {'group': {'device': device, 'backend': spec['backend'], 'threads': spec['threads'],
+                          'error': f"exit code {process.returncode}"}, 'cases': []}
+    return json.loads(process.stdout)
+
+
+# ---------- HTTP ----------
+
+def run_http(args, corpus):
+    """对 /encode-text 做端到端测试，按并发数扫描"""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    url = args.url.rstrip('/') + '/encode-text'
+    unique = count()
+    cases = []
+    for concurrency in args.concurrency:
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_maxsize=concurrency))
+        session.mount('https://', HTTPAdapter(pool_maxsize=concurrency))
+        for length in args.text_lengths:
+            texts = build_texts(corpus, length, max(args.iterations, 1), args.seed)
+            lock = threading.Lock()
+            status_counts = {}
+
+            def send(index):
+                text = texts[index % len(texts)]
+                if args.http_cache == 'miss':
+                    # 每条文本唯一，请求都会走模型推理
+                    text = f"{text} {next(unique)}"
+                started = time.perf_counter()
+                try:
+                    status = session.post(url, json={'text': text}, timeout=args.http_timeout).status_code
+                except requests.RequestException:
+                    status = 'error'
+                elapsed = time.perf_counter() - started
+                with lock:
+                    status_counts[str(status)] = status_counts.get(str(status), 0) + 1
+                return elapsed, status == 200
+
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                list(executor.map(send, range(args.warmup * concurrency)))
+                status_counts.clear()
+                started = time.perf_counter()
+                outcomes = list(executor.map(send, range(args.iterations)))
+                elapsed = time.perf_counter() - started
+
+            latencies = [latency for latency, ok in outcomes if ok]
+            case = {'scenario': 'http', 'url': args.url, 'concurrency': concurrency, 'text_length': length,
+                    'http_cache': args.http_cache, 'status_counts': status_counts,
+                    'errors': len(outcomes) - len(latencies)}
+            if latencies:
+                case.update(summarize(latencies, len(latencies), elapsed))
+            if args.server_pid:
+                case['server_memory'] = process_memory_mb(args.server_pid)
+            case['key'] = case_key(case)
+            cases.append(case)
+            if latencies:
+                logger.info(f"{case['key']}: p50 {case['latency_ms']['p50']}ms，p95 {case['latency_ms']['p95']}ms，"
+                            f"p99 {case['latency_ms']['p99']}ms，{case['throughput']} 请求/秒，失败 {case['errors']}")
+            else:
+                logger.error(f"❌ {case['key']}: 所有请求均失败 {status_counts}")
+        session.close()
+    return cases
+
+
+# ---------- 基线对比 ----------
+
+def compare(cases, baseline, tolerance):
+    """与基线中相同key的用例对比：吞吐量下降或p95/峰值内存上升超过tolerance视为回归"""
+    reference = {case['key']: case for case in baseline.get('cases', []) if case.get('throughput')}
+    regressions = []
+    compared = 0
+    for case in cases:
+        base = reference.get(case['key'])
+        if not base or not case.get('throughput'):
+            continue
+        compared += 1
+        ratios = {
+            'throughput': case['throughput'] / base['throughput'],
+            'p95': case['latency_ms']['p95'] / base['latency_ms']['p95'] if base['latency_ms']['p95'] else None
+        }
+        if case.get('peak_rss_mb') and base.get('peak_rss_mb'):
+            ratios['peak_rss'] = case['peak_rss_mb'] / base['peak_rss_mb']
+        regressed = []
+        if ratios['throughput'] < 1 - tolerance:
+            regressed.append('throughput')
+        for metric in ('p95', 'peak_rss'):
+            if ratios.get(metric) is not None and ratios[metric] > 1 + tolerance:
+                regressed.append(metric)
+        case['baseline'] = {
+            'throughput': base['throughput'],
+            'p95_ms': base['latency_ms']['p95'],
+            'peak_rss_mb': base.get('peak_rss_mb'),
+            'ratios': {metric: round(value, 3) for metric, value in ratios.items() if value is not None},
+            'regressed': regressed
+        }
+        if regressed:
+            regressions.append({'key': case['key'], 'metrics': regressed})
+            logger.warning(f"⚠️ 回归: {case['key']} {', '.join(regressed)} {case['baseline']['ratios']}")
+    return {
+        'tolerance': tolerance,
+        'compared': compared,
+        'missing': sorted(set(reference) - {case['key'] for case in cases}),
+        'regressions': regressions
+    }
+
+
+def environment():
+    """运行环境（写入结果，便于判断两次结果是否可比）"""
+    from importlib import metadata
+
+    info = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'model': CLIP_CONFIG['model_name'],
+        'model_path': CLIP_CONFIG['model_path']
+    }
+    for package in ('numpy', 'torch', 'transformers', 'onnxruntime', 'Pillow'):
+        try:
+            info[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            info[package] = None
+    try:
+        info['git_commit'] = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=CURRENT_DIR,
+                                            capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        info['git_commit'] = None
+    return info
+
+
+def csv_list(value, cast=str):
+    """逗号分隔的参数"""
+    return [cast(item.strip()) for item in value.split(',') if item.strip()]
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='CLIP编码基准测试')
+    parser.add_argument('--scenarios', type=csv_list, default=list(LOCAL_SCENARIOS),
+                        help=f"要运行的场景，逗号分隔（{', '.join(SCENARIOS)}），默认 {','.join(LOCAL_SCENARIOS)}")
+    parser.add_argument('--batch-sizes', type=lambda v: csv_list(v, int), default=[1, 8, 32],
+                        help='text-batch/image-batch 的批大小，默认1,8,32')
+    parser.add_argument('--threads', type=lambda v: csv_list(v, int), default=[os.cpu_count() or 1],
+                        help='推理线程数，默认CPU核数')
+    parser.add_argument('--backends', type=csv_list, default=[CLIP_CONFIG['backend']],
+                        help='推理后端（torch, torch-int8, onnx），默认CLIP_BACKEND')
+    parser.add_argument('--devices', type=csv_list, default=[CLIP_CONFIG['device']],
+                        help='设备（cpu, cuda），默认DEVICE')
+    parser.add_argument('--text-lengths', type=csv_list, default=list(TEXT_LENGTHS),
+                        help='文本长度档位（short, medium, long），默认全部')
+    parser.add_argument('--corpus', default=os.path.join(FIXTURE_DIR, 'queries.txt'), help='文本样本文件（每行一条）')
+    parser.add_argument('--images', nargs='*', help='图片样本（URL或本地路径），默认使用固定种子生成的JPEG')
+    parser.add_argument('--warmup', type=int, default=3, help='每个用例的预热调用次数，默认3')
+    parser.add_argument('--iterations', type=int, default=20, help='每个用例计时的调用次数（http为请求数），默认20')
+    parser.add_argument('--seed', type=int, default=0, help='样本随机种子，默认0')
+    parser.add_argument('--url', default=os.getenv('CLIP_SERVICE_URL', 'http://localhost:5001'),
+                        help='http场景的服务地址，默认CLIP_SERVICE_URL或http://localhost:5001')
+    parser.add_argument('--concurrency', type=lambda v: csv_list(v, int), default=[1, 8],
+                        help='http场景的并发请求数，默认1,8')
+    parser.add_argument('--http-cache', choices=('miss', 'hit'), default='miss',
+                        help='miss: 每条文本唯一，绕过服务端文本缓存（默认）；hit: 重复文本')
+    parser.add_argument('--http-timeout', type=float, default=30, help='http请求超时（秒），默认30')
+    parser.add_argument('--server-pid', type=int, help='服务进程PID，http场景记录其常驻内存（仅Linux）')
+    parser.add_argument('-o', '--output', help='结果JSON的输出路径（同时输出到stdout）')
+    parser.add_argument('--baseline', help='基线结果JSON，对比吞吐量、p95和峰值内存')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='回归判定的相对阈值，默认0.1（10%%）')
+    parser.add_argument('--run-group', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_group:
+        print(json.dumps(run_group(json.loads(args.run_group)), ensure_ascii=False))
+        return
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知场景: {', '.join(sorted(unknown))}（可选 {', '.join(SCENARIOS)}）")
+    unknown = set(args.text_lengths) - set(TEXT_LENGTHS)
+    if unknown:
+        parser.error(f"未知文本长度: {', '.join(sorted(unknown))}（可选 {', '.join(TEXT_LENGTHS)}）")
+
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': environment(),
+        'settings': {key: value for key, value in vars(args).items()
+                     if key not in ('output', 'baseline', 'run_group')},
+        'groups': [],
+        'cases': []
+    }
+    local = [scenario for scenario in args.scenarios if scenario in LOCAL_SCENARIOS]
+    if local:
+        for device in args.devices:
+            for backend in args.backends:
+                for threads in args.threads:
+                    spec = {'scenarios': local, 'backend': backend, 'threads': threads,
+                            'batch_sizes': args.batch_sizes, 'text_lengths': args.text_lengths,
+                            'corpus': args.corpus, 'images': args.images, 'warmup': args.warmup,
+                            'iterations': args.iterations, 'seed': args.seed}
+                    result = spawn_group(spec, device)
+                    report['groups'].append(result['group'])
+                    report['cases'].extend(result['cases'])
+    if 'http' in args.scenarios:
+        report['cases'].extend(run_http(args, load_corpus(args.corpus)))
+
+    regressed = False
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            report['comparison'] = compare(report['cases'], json.load(f), args.tolerance)
+        report['comparison']['baseline'] = args.baseline
+        regressed = bool(report['comparison']['regressions'])
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+        logger.info(f"💾 结果已保存: {args.output}")
+    print(output)
+    if regressed:
+        logger.error(f"❌ {len(report['comparison']['regressions'])} 个用例相对基线回归超过 {args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+本地向量索引构建工具
+从Qdrant集合或 clip_bulk_vectorize.py 的JSONL输出读取图片向量，构建 vector_index.py 使用的索引目录（默认 VECTOR_INDEX_DIR）
+服务端 /search 在索引目录被重新构建后自动加载新索引
+
+用法:
+  python3 clip_build_index.py --from-qdrant                      # 导出QDRANT_CONFIG配置的集合
+  python3 clip_build_index.py vectors.jsonl [more.jsonl ...]     # 使用批量向量化的输出
+  python3 clip_build_index.py vectors.jsonl --ivf-lists 1024 --verify 200
+  python3 clip_build_index.py vectors.jsonl --compression pq --pq-subspaces 64   # 压缩码粗排 + 原始向量精排
+  python3 clip_build_index.py --existing --compression-report 200                # 在已有索引的向量上评估各压缩方式
+
+输入格式（JSONL，每行一条）:
+  {"image_id": 123, "vector": [...], "payload": {"brand_id": 1, "model_id": 2, ...}}   （也接受 id 字段，payload可选）
+--verify N 用N条已有向量作为查询，对比索引搜索与精确搜索的top-k召回率和耗时
+--compression-report N 对float16/int8/PQ分别报告每条字节数、压缩比、仅压缩码和精排后的recall@k
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    stream=sys.stderr
+)
+logger = logging.getLogger('clip_build_index')
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(CURRENT_DIR, 'clip_utils'))
+
+import numpy as np  # noqa: E402
+
+from config import INDEX_CONFIG  # noqa: E402
+from vector_index import VectorIndex, build_index  # noqa: E402
+from vector_compression import QUANTIZERS, compression_report  # noqa: E402
+
+
+def read_jsonl_records(paths):
+    """逐条读取JSONL向量文件，返回 (point_id, vector, payload) 迭代器"""
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    logger.warning(f"{path} 第{line_no}行不是合法JSON，已跳过: {e}")
+                    continue
+                point_id = record.get('image_id', record.get('id'))
+                if point_id is None or not record.get('vector'):
+                    continue
+                yield point_id, record['vector'], record.get('payload')
+
+
+def read_qdrant_records(batch_size):
+    """分页导出Qdrant集合中的point"""
+    from qdrant_rest import QdrantRest
+    client = QdrantRest()
+    logger.info(f"从Qdrant导出向量: {client.url}/collections/{client.collection}")
+    for point in client.scroll_points(batch_size=batch_size):
+        vector = point.get('vector')
+        if isinstance(vector, dict):
+            # 命名向量集合：取第一个向量
+            vector = next(iter(vector.values()), None)
+        if vector:
+            yield point['id'], vector, point.get('payload')
+
+
+def verify(directory, queries, limit):
+    """用索引中的已有向量作为查询，对比默认搜索与精确搜索"""
+    index = VectorIndex(directory, nprobe=INDEX_CONFIG['nprobe'], ann_threshold=INDEX_CONFIG['ann_threshold'],
+                        rerank_factor=INDEX_CONFIG['rerank_factor'])
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(index), min(queries, len(index)), replace=False)
+    recall, timings = [], {'default': 0.0, 'exact': 0.0}
+    methods = set()
+    for row in rows:
+        query = np.asarray(index.matrix[row])
+        started = time.perf_counter()
+        found, method = index.search(query, limit=limit)
+        timings['default'] += time.perf_counter() - started
+        started = time.perf_counter()
+        truth, _ = index.search(query, limit=limit, exact=True)
+        timings['exact'] += time.perf_counter() - started
+        methods.add(method)
+        expected = {item['id'] for item in truth}
+        recall.append(len(expected & {item['id'] for item in found}) / len(expected))
+    return {
+        'queries': len(rows),
+        'limit': limit,
+        'methods': sorted(methods),
+        'nprobe': index.nprobe,
+        f'recall@{limit}': round(float(np.mean(recall)), 4),
+        'avg_ms': round(timings['default'] / len(rows) * 1000, 3),
+        'exact_avg_ms': round(timings['exact'] / len(rows) * 1000, 3)
+    }
+
+
+def report_compression(directory, queries, limit, rows, pq_subspaces):
+    """在索引的向量（超过rows条时随机抽样）上评估各压缩方式"""
+    matrix = np.load(os.path.join(directory, 'vectors.npy'), mmap_mode='r')
+    if len(matrix) > rows:
+        rng = np.random.default_rng(0)
+        matrix = matrix[np.sort(rng.choice(len(matrix), rows, replace=False))]
+    subspaces = sorted({pq_subspaces, 64, 128})
+    return compression_report(np.asarray(matrix), queries=queries, k=limit,
+                              rerank_factor=INDEX_CONFIG['rerank_factor'], subspaces=subspaces)
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='构建本地向量索引（/search 使用）')
+    parser.add_argument('inputs', nargs='*', help='JSONL向量文件（clip_bulk_vectorize.py 的输出）')
+    parser.add_argument('--from-qdrant', action='store_true', help='从QDRANT_CONFIG配置的集合导出')
+    parser.add_argument('-o', '--output', default=INDEX_CONFIG['directory'], help='索引目录，默认VECTOR_INDEX_DIR')
+    parser.add_argument('--filter-fields', default=','.join(INDEX_CONFIG['filter_fields']),
+                        help='支持过滤的payload字段，逗号分隔，默认VECTOR_INDEX_FILTER_FIELDS')
+    parser.add_argument('--ivf-lists', type=int, default=0,
+                        help='IVF列表数：0自动（超过VECTOR_INDEX_ANN_THRESHOLD条时构建），-1不构建')
+    parser.add_argument('--scroll-size', type=int, default=1000, help='从Qdrant导出时每页的point数，默认1000')
+    parser.add_argument('--verify', type=int, default=0, help='构建后用N条向量验证召回率和耗时（0表示不验证）')
+    parser.add_argument('--limit', type=int, default=10, help='验证时的top-k，默认10')
+    parser.add_argument('--compression', choices=('none',) + QUANTIZERS, default=INDEX_CONFIG['compression'],
+                        help='压缩方式，默认VECTOR_INDEX_COMPRESSION')
+    parser.add_argument('--pq-subspaces', type=int, default=INDEX_CONFIG['pq_subspaces'],
+                        help='PQ分段数（每条字节数），默认VECTOR_INDEX_PQ_SUBSPACES')
+    parser.add_argument('--compression-report', type=int, default=0,
+                        help='用N条向量作为查询评估各压缩方式的内存和召回率（0表示不评估）')
+    parser.add_argument('--report-rows', type=int, default=200000, help='压缩评估最多使用的向量数，默认200000')
+    parser.add_argument('--existing', action='store_true', help='不重新构建，直接验证/评估已有索引')
+    args = parser.parse_args()
+
+    if args.existing:
+        with open(os.path.join(args.output, 'meta.json'), encoding='utf-8') as f:
+            report = json.load(f)
+    else:
+        if args.from_qdrant == bool(args.inputs):
+            parser.error('需要指定JSONL文件或 --from-qdrant（二选一）')
+        records = read_qdrant_records(args.scroll_size) if args.from_qdrant else read_jsonl_records(args.inputs)
+        filter_fields = [field.strip() for field in args.filter_fields.split(',') if field.strip()]
+        report = build_index(records, args.output, filter_fields=filter_fields, ivf_lists=args.ivf_lists,
+                             ann_threshold=INDEX_CONFIG['ann_threshold'], compression=args.compression,
+                             pq_subspaces=args.pq_subspaces)
+    if args.verify:
+        report['verify'] = verify(args.output, args.verify, args.limit)
+    if args.compression_report:
+        report['compression_report'] = report_compression(args.output, args.compression_report, args.limit,
+                                                          args.report_rows, args.pq_subspaces)
+    # 最终统计输出到stdout，便于脚本解析
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+"""
+CLIP图片批量向量化工具（离线回填用）
+读取清单文件（JSONL或CSV，包含image_id和图片URL/路径），流水线处理：
+  线程池并发下载+解码 -> 按batch_size批量推理 -> 写入输出文件
+支持断点续跑（跳过输出文件中已有的image_id），并按阶段统计吞吐量
+
+用法:
+  python3 clip_bulk_vectorize.py manifest.jsonl -o vectors.jsonl
+  python3 clip_bulk_vectorize.py manifest.csv -o vectors.jsonl --workers 16 --batch-size 64
+  python3 clip_bulk_vectorize.py manifest.jsonl -o done.jsonl --qdrant   # 直接批量写入Qdrant
+  python3 clip_bulk_vectorize.py manifest.jsonl -o vectors.jsonl --dedup  # 入库前跳过近重复图片
+
+清单格式:
+  JSONL: {"image_id": 123, "url": "https://...", "payload": {...}}   （也接受 id / path / source 字段，payload可选）
+  CSV:   表头包含 image_id 和 url（或 path）列
+输出格式（JSONL，每行一条）:
+  {"image_id": 123, "vector": [...], "payload": {...}}   （清单中有payload时原样输出，可直接用 clip_build_index.py 构建本地索引）
+  使用 --qdrant 时向量直接写入Qdrant集合，输出文件只记录写入成功的 {"image_id": 123}（用于续跑）
+加载或编码失败的记录写入 <output>.errors.jsonl，续跑时会重新尝试；image_id不是无符号整数或UUID（Qdrant的point ID）的记录直接写入errors
+使用 --dedup 时近重复图片（感知哈希或向量余弦相似度命中，见 clip_utils/image_dedup.py）不写入输出/Qdrant，
+改为写入 <output>.duplicates.jsonl: {"image_id": 124, "duplicate_of": 123, "method": "phash", "distance": 2}
+"""
+import os
+import sys
+import csv
+import json
+import time
+import uuid
+import argparse
+import logging
+import threading
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    stream=sys.stderr
+)
+logger = logging.getLogger('clip_bulk_vectorize')
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(CURRENT_DIR, 'clip_utils'))
+
+from config import CLIP_CONFIG, FETCH_CONFIG  # noqa: E402
+from clip_encoder import get_clip_encoder  # noqa: E402
+from image_loader import read_image_bytes, load_image_from_bytes  # noqa: E402
+from image_fetcher import fetcher_stats  # noqa: E402
+from image_embedding_store import get_image_embedding_store, content_digest  # noqa: E402
+from qdrant_rest import QdrantRest, QdrantBatchWriter, build_point  # noqa: E402
+from image_dedup import DedupBatch, get_duplicate_detector, perceptual_hash  # noqa: E402
+
+
+def read_manifest(path, on_invalid=None):
+    """
+    逐条读取清单，返回 (image_id, source, payload) 迭代器
+    image_id不合法的记录跳过，并调用 on_invalid(image_id, source, 错误信息)（未提供时只记日志）
+    """
+    for image_id, source, payload in _read_manifest_rows(path):
+        try:
+            yield _parse_id(image_id), source, payload
+        except ValueError as e:
+            if on_invalid is None:
+                logger.warning(f"{e}，已跳过")
+            else:
+                on_invalid(image_id, source, str(e))
+
+
+def _read_manifest_rows(path):
+    """逐条读取清单的原始字段"""
+    if path.lower().endswith('.csv'):
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                image_id = row.get('image_id') or row.get('id')
+                source = row.get('url') or row.get('path') or row.get('source')
+                if image_id and source:
+                    yield image_id, source.strip(), None
+        return
+
+    with open(path, encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning(f"清单第{line_no}行不是合法JSON，已跳过: {e}")
+                continue
+            image_id = record.get('image_id', record.get('id'))
+            source = record.get('url') or record.get('path') or record.get('source')
+            if image_id is not None and source:
+                yield image_id, str(source).strip(), record.get('payload')
+
+
+def _parse_id(value):
+    """image_id转为Qdrant接受的point ID：无符号整数（数字字符串转为int）或UUID（转为标准格式），否则抛出ValueError"""
+    if isinstance(value, int) and not isinstance(value, bool) and 0 <= value < 2 ** 64:
+        return value
+    if isinstance(value, str):
+        text = value.strip()
+        if text.isascii() and text.isdigit() and int(text) < 2 ** 64:
+            return int(text)
+        try:
+            return str(uuid.UUID(text))
+        except ValueError:
+            pass
+    raise ValueError(f"image_id必须是无符号整数或UUID: {value!r}")
+
+
+def load_done_ids(*paths):
+    """读取已完成的image_id（断点续跑；已判为重复的图片同样视为完成）"""
+    done = set()
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)['image_id'])
+                except (json.JSONDecodeError, KeyError):
+                    # 上次中断时可能留下半行，忽略
+                    continue
+    return done
+
+
+class StageStats:
+    """各阶段累计耗时与处理数量"""
+
+    def __init__(self):
+        self.busy = {'fetch': 0.0, 'decode': 0.0, 'encode': 0.0, 'write': 0.0}
+        self.count = {'fetch': 0, 'decode': 0, 'encode': 0, 'write': 0}
+        self.store_hits = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.started = time.perf_counter()
+
+    def add(self, stage, seconds, items=1):
+        self.busy[stage] += seconds
+        self.count[stage] += items
+
+    def report(self, parallelism):
+        """各阶段吞吐量（张/秒，按阶段并行度折算）和整体吞吐量"""
+        elapsed = time.perf_counter() - self.started
+        stages = {}
+        for stage, busy in self.busy.items():
+            workers = parallelism.get(stage, 1)
+            rate = self.count[stage] / (busy / workers) if busy > 0 else 0.0
+            stages[stage] = {
+                'items': self.count[stage],
+                'busy_seconds': round(busy, 2),
+                'images_per_second': round(rate, 2)
+            }
+        return {
+            'elapsed_seconds': round(elapsed, 2),
+            'written': self.count['write'],
+            'store_hits': self.store_hits,
+            'failed': self.failed,
+            'duplicates': self.duplicates,
+            'images_per_second': round(self.count['write'] / elapsed, 2) if elapsed > 0 else 0.0,
+            'stages': stages
+        }
+
+
+class JsonlSink:
+    """输出到JSONL文件（追加写入，每批刷新一次；on_written在写入并刷新后收到这批image_id）"""
+
+    def __init__(self, path, with_vectors=True, on_written=None):
+        self.path = path
+        self.with_vectors = with_vectors
+        self.on_written = on_written
+        self.file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def write(self, records):
+        lines = []
+        for image_id, vector, payload in records:
+            record = {'image_id': image_id}
+            if self.with_vectors:
+                record['vector'] = vector.tolist()
+            if payload:
+                record['payload'] = payload
+            lines.append(json.dumps(record) + '\n')
+        with self._lock:
+            self.file.write(''.join(lines))
+            self.file.flush()
+        if self.on_written is not None:
+            self.on_written([image_id for image_id, _, _ in records])
+
+    def close(self):
+        self.file.close()
+
+
+class QdrantSink:
+    """批量写入Qdrant；写入成功后才记录到检查点文件（并通知on_written），保证续跑不会漏写"""
+
+    def __init__(self, checkpoint_path, record_error, chunk_size, max_in_flight, on_written=None):
+        self.checkpoint = JsonlSink(checkpoint_path, with_vectors=False, on_written=on_written)
+        client = QdrantRest()
+        client.ensure_collection()
+        self.writer = QdrantBatchWriter(
+            client,
+            chunk_size=chunk_size,
+            max_in_flight=max_in_flight,
+            on_success=lambda points: self.checkpoint.write([(p['id'], None, None) for p in points]),
+            on_error=lambda points, e: [record_error({'image_id': p['id'], 'source': None}, f'Qdrant写入失败: {e}')
+                                        for p in points]
+        )
+
+    def write(self, records):
+        self.writer.add([build_point(image_id, vector, payload) for image_id, vector, payload in records])
+
+    def close(self):
+        self.writer.close()
+        self.checkpoint.close()
+        logger.info(f"Qdrant写入统计: {json.dumps(self.writer.stats)}")
+
+
+def fetch_and_decode(image_id, source, payload, store, with_hash=False):
+    """
+    线程池任务：读取图片字节，查存储，未命中则解码（with_hash: 同时计算感知哈希）
+    计算感知哈希时命中存储的图片也要解码（内容相同的图片同样要判重），但不保留解码结果
+    """
+    result = {'image_id': image_id, 'source': source, 'payload': payload, 'fetch': 0.0, 'decode': 0.0}
+    try:
+        started = time.perf_counter()
+        data = read_image_bytes(source)
+        result['fetch'] = time.perf_counter() - started
+
+        result['digest'] = content_digest(data)
+        if store is not None:
+            vector = store.get(result['digest'])
+            if vector is not None:
+                result['vector'] = vector
+                if not with_hash:
+                    return result
+
+        started = time.perf_counter()
+        image = load_image_from_bytes(data, with_hash=with_hash)
+        result['decode'] = time.perf_counter() - started
+        if with_hash:
+            result['phash'] = perceptual_hash(image)
+        if 'vector' not in result:
+            result['image'] = image
+    except Exception as e:
+        result['error'] = str(e)
+    return result
+
+
+def run(args):
+    """执行批量向量化"""
+    duplicates_path = f"{args.output}.duplicates.jsonl"
+    errors_path = f"{args.output}.errors.jsonl"
+    if args.no_resume:
+        # 不续跑时从头开始：清空上次的输出、错误和重复记录，否则追加写入会让同一image_id出现多行
+        for path in (args.output, errors_path, duplicates_path):
+            if os.path.exists(path):
+                open(path, 'w').close()
+                logger.info(f"--no-resume: 已清空 {path}")
+    done = load_done_ids(args.output, duplicates_path) if not args.no_resume else set()
+    if done:
+        logger.info(f"断点续跑: 跳过已完成的 {len(done)} 条")
+
+    # 每个下载线程都能拿到同一主机的空闲连接（下载器在第一次下载时按此配置创建）
+    FETCH_CONFIG['pool_size'] = max(FETCH_CONFIG['pool_size'], args.workers)
+    store = None if args.no_store else get_image_embedding_store()
+    encoder = get_clip_encoder('vision')
+    errors_file = open(errors_path, 'a', encoding='utf-8')
+    errors_lock = threading.Lock()
+    detector = get_duplicate_detector() if args.dedup else None
+    duplicates_file = open(duplicates_path, 'a', encoding='utf-8') if args.dedup else None
+    stats = StageStats()
+    parallelism = {'fetch': args.workers, 'decode': args.workers}
+    prefetch = max(args.batch_size * 2, args.workers * 2)
+
+    def record_error(item, message):
+        with errors_lock:
+            stats.failed += 1
+            errors_file.write(json.dumps({'image_id': item['image_id'], 'source': item['source'], 'error': message},
+                                         ensure_ascii=False) + '\n')
+
+    def record_duplicates(pending, batch, indices):
+        for index in indices:
+            item = pending[index]
+            stats.duplicates += 1
+            duplicates_file.write(json.dumps({'image_id': item['image_id'], **batch.duplicates[index]},
+                                             ensure_ascii=False) + '\n')
+            item.pop('image', None)
+            item['duplicate'] = True
+
+    # 通过近重复检查、尚未确认写入的图片: image_id -> (DedupBatch, 下标)，写入成功后才登记到检测器
+    awaiting = {}
+    awaiting_lock = threading.Lock()
+
+    def register_written(image_ids):
+        with awaiting_lock:
+            entries = [awaiting.pop(image_id) for image_id in image_ids if image_id in awaiting]
+        for batch, index in entries:
+            batch.register([index])
+
+    on_written = register_written if detector is not None else None
+    if args.qdrant:
+        sink = QdrantSink(args.output, record_error, args.qdrant_chunk_size, args.qdrant_in_flight, on_written)
+    else:
+        sink = JsonlSink(args.output, on_written=on_written)
+
+    def flush(pending):
+        """批量编码待处理图片，连同命中存储的向量一起写出"""
+        batch = None
+        if detector is not None:
+            # 感知哈希命中（已登记的图片或本批中前面的图片）的直接判为重复，不做编码
+            batch = DedupBatch(detector, [item['image_id'] for item in pending])
+            hashes = {index: item['phash'] for index, item in enumerate(pending) if 'phash' in item}
+            kept = set(batch.filter_hashes(hashes))
+            record_duplicates(pending, batch, [index for index in hashes if index not in kept])
+        to_encode = [item for item in pending if 'image' in item]
+        if to_encode:
+            started = time.perf_counter()
+            vectors = encoder.encode_images_batch([item['image'] for item in to_encode])
+            stats.add('encode', time.perf_counter() - started, len(to_encode))
+            for offset, item in enumerate(to_encode):
+                if vectors is None:
+                    record_error(item, '批量编码失败')
+                else:
+                    item['vector'] = vectors[offset]
+                item.pop('image', None)
+            if store is not None and vectors is not None:
+                store.put_many([item['digest'] for item in to_encode], list(vectors))
+
+        if batch is not None:
+            # 按顺序检查向量余弦相似度（本批后面的图片也会与前面的比较）
+            flagged = set(batch.duplicates)
+            batch.check_vectors([item.get('vector') for item in pending])
+            record_duplicates(pending, batch, [index for index in batch.duplicates if index not in flagged])
+            duplicates_file.flush()
+            with awaiting_lock:
+                for index in batch.accepted():
+                    awaiting[pending[index]['image_id']] = (batch, index)
+        records = [(item['image_id'], item['vector'], item['payload']) for item in pending
+                   if 'vector' in item and not item.get('duplicate')]
+        started = time.perf_counter()
+        sink.write(records)
+        with errors_lock:
+            errors_file.flush()
+        stats.add('write', time.perf_counter() - started, len(records))
+
+    def record_invalid(image_id, source, message):
+        record_error({'image_id': image_id, 'source': source}, message)
+
+    manifest = (entry for entry in read_manifest(args.manifest, record_invalid) if entry[0] not in done)
+    if args.limit:
+        manifest = islice(manifest, args.limit)
+
+    last_report = time.perf_counter()
+    pending = []
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        manifest_iter = iter(manifest)
+        exhausted = False
+        while True:
+            # 保持固定数量的下载/解码任务在途，内存占用有上限
+            while not exhausted and len(in_flight) < prefetch:
+                try:
+                    image_id, source, payload = next(manifest_iter)
+                except StopIteration:
+                    exhausted = True
+                    break
+                in_flight.append(executor.submit(fetch_and_decode, image_id, source, payload, store,
+                                                 args.dedup))
+            if not in_flight:
+                break
+
+            item = in_flight.popleft().result()
+            stats.add('fetch', item['fetch'])
+            if 'error' in item:
+                record_error(item, item['error'])
+                continue
+            if 'vector' in item:
+                stats.store_hits += 1
+            else:
+                stats.add('decode', item['decode'])
+            pending.append(item)
+
+            if len(pending) >= args.batch_size:
+                flush(pending)
+                pending = []
+
+            if time.perf_counter() - last_report >= args.report_interval:
+                last_report = time.perf_counter()
+                logger.info(f"📊 进度: {json.dumps(stats.report(parallelism), ensure_ascii=False)}")
+
+        if pending:
+            flush(pending)
+
+    sink.close()
+    errors_file.close()
+    if detector is not None:
+        duplicates_file.close()
+        detector.save()
+        logger.info(f"近重复检测统计: {json.dumps(detector.stats(), ensure_ascii=False)}")
+    report = stats.report(parallelism)
+    logger.info(f"✅ 批量向量化完成: {json.dumps(report, ensure_ascii=False)}")
+    if fetcher_stats():
+        logger.info(f"图片下载统计: {json.dumps(fetcher_stats(), ensure_ascii=False)}")
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='CLIP图片批量向量化（离线回填）')
+    parser.add_argument('manifest', help='清单文件（.jsonl 或 .csv）')
+    parser.add_argument('-o', '--output', required=True, help='输出JSONL文件（追加写入，用于断点续跑）')
+    parser.add_argument('--workers', type=int, default=8, help='下载/解码线程数，默认8')
+    parser.add_argument('--batch-size', type=int, default=CLIP_CONFIG['batch_size'], help='推理批大小')
+    parser.add_argument('--limit', type=int, default=0, help='最多处理的条数（0表示不限制）')
+    parser.add_argument('--report-interval', type=float, default=30, help='进度报告间隔（秒）')
+    parser.add_argument('--no-resume', action='store_true', help='从头开始：清空输出文件及其errors/duplicates记录后重新处理全部记录')
+    parser.add_argument('--no-store', action='store_true', help='不使用图片向量存储')
+    parser.add_argument('--qdrant', action='store_true', help='直接批量写入QDRANT_CONFIG配置的集合')
+    parser.add_argument('--qdrant-chunk-size', type=int, default=256, help='每次upsert的point数，默认256')
+    parser.add_argument('--qdrant-in-flight', type=int, default=4, help='最多同时进行的upsert请求数，默认4')
+    parser.add_argument('--dedup', action='store_true',
+                        help='跳过近重复图片（阈值见IMAGE_DEDUP_*），重复记录写入 <output>.duplicates.jsonl')
+    return parser.parse_args(argv)
+
+
+def main():
+    """主函数"""
+    report = run(parse_args())
+    # 最终统计输出到stdout，便于脚本解析
+    print(json.dumps(report, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,10 @@ CLIP图片向量化独立脚本
 
 用法:
   python3 clip_image_encoder_standalone.py <image_url_or_path>
+  python3 clip_image_encoder_standalone.py --worker   # 常驻模式，stdin逐行读取请求
+  
+常驻模式请求: {"id": "1", "image": "<image_url_or_path>"}，每行一个
+常驻模式结果: {"id": "1", "status": "success", "vector": [...], "dimension": 512}，每行一个
   
 输出: JSON格式的向量数据
   {"status": "success", "vector": [...], "dimension": 512}
@@ -14,9 +18,6 @@ CLIP图片向量化独立脚本
 import sys
 import json
 import logging
-from PIL import Image
-import requests
-from io import BytesIO
 import os
 
 # 配置日志（输出到stderr，避免污染stdout的JSON结果）
@@ -33,53 +34,15 @@ try:
     current_dir = os.path.dirname(os.path.abspath(__file__))
     sys.path.insert(0, os.path.join(current_dir, 'clip_utils'))
     from clip_encoder import get_clip_encoder
+    from image_loader import load_image_from_bytes, read_image_bytes
+    from image_embedding_store import get_image_embedding_store, content_digest
+    from worker_loop import run_worker
 except Exception as e:
     logger.error(f"导入CLIP编码器失败: {e}")
     print(json.dumps({"status": "error", "error": f"导入CLIP编码器失败: {str(e)}"}), file=sys.stdout)
     sys.exit(1)
 
 
-def load_image_from_url(url, timeout=10):
-    """从URL加载图片"""
-    try:
-        logger.info(f"从URL加载图片: {url}")
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
-        response = requests.get(url, headers=headers, timeout=timeout)
-        response.raise_for_status()
-        
-        image = Image.open(BytesIO(response.content))
-        # 转换为RGB模式（CLIP要求）
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        logger.info(f"图片加载成功: {image.size}, 模式: {image.mode}")
-        return image
-    except Exception as e:
-        logger.error(f"从URL加载图片失败: {e}")
-        raise
-
-
-def load_image_from_path(path):
-    """从本地路径加载图片"""
-    try:
-        logger.info(f"从本地加载图片: {path}")
-        if not os.path.exists(path):
-            raise FileNotFoundError(f"图片文件不存在: {path}")
-        
-        image = Image.open(path)
-        # 转换为RGB模式（CLIP要求）
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        logger.info(f"图片加载成功: {image.size}, 模式: {image.mode}")
-        return image
-    except Exception as e:
-        logger.error(f"从本地加载图片失败: {e}")
-        raise
-
-
 def encode_image(image_source):
     """
     编码图片为向量
@@ -92,22 +55,30 @@ def encode_image(image_source):
               或 {"status": "error", "error": "错误信息"}
     """
     try:
-        # 判断是URL还是本地路径
-        if image_source.startswith('http://') or image_source.startswith('https://'):
-            image = load_image_from_url(image_source)
-        else:
-            image = load_image_from_path(image_source)
-        
-        # 初始化CLIP编码器
-        logger.info("初始化CLIP编码器...")
-        encoder = get_clip_encoder()
+        # 读取原始字节，先按内容摘要查本地向量存储
+        data = read_image_bytes(image_source)
+        store = get_image_embedding_store()
+        digest = content_digest(data)
+        vector = store.get(digest) if store is not None else None
         
-        # 编码图片
-        logger.info("开始编码图片...")
-        vector = encoder.encode_image(image)
-        
-        if vector is None:
-            raise Exception("CLIP编码返回None")
+        if vector is not None:
+            logger.info("命中图片向量存储，跳过模型计算")
+        else:
+            image = load_image_from_bytes(data)
+            
+            # 初始化CLIP编码器
+            logger.info("初始化CLIP编码器...")
+            encoder = get_clip_encoder('vision')
+            
+            # 编码图片
+            logger.info("开始编码图片...")
+            vector = encoder.encode_image(image)
+            
+            if vector is None:
+                raise Exception("CLIP编码返回None")
+            
+            if store is not None:
+                store.put(digest, vector)
         
         # 转换为Python列表
         vector_list = vector.tolist()
@@ -130,8 +101,19 @@ def encode_image(image_source):
         }
 
 
+def handle_request(request):
+    """处理常驻模式下的单个请求"""
+    image_source = request.get('image')
+    if not image_source or not str(image_source).strip():
+        return {"status": "error", "error": "图片URL或路径不能为空"}
+    return encode_image(str(image_source).strip())
+
+
 def main():
     """主函数"""
+    if len(sys.argv) >= 2 and sys.argv[1] == '--worker':
+        sys.exit(run_worker(handle_request, warmup=lambda: get_clip_encoder('vision')))
+    
     if len(sys.argv) < 2:
         print(json.dumps({
             "status": "error",
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+CLIP模型维护工具
+
+用法:
+  python3 clip_model_tools.py convert-safetensors [模型目录]
+    把 pytorch_model.bin 转换为 model.safetensors（加载时内存映射，多进程共享页缓存）
+    不指定目录时使用服务解析到的本地模型目录
+  python3 clip_model_tools.py export-onnx [模型目录] [--towers text,vision]
+    导出文本/视觉塔的ONNX图到 CLIP_ONNX_DIR，供 CLIP_BACKEND=onnx 使用
+  python3 clip_model_tools.py verify --backend onnx [--images a.jpg b.jpg ...] [--texts queries.txt]
+    用样本对比fp32与指定后端的输出，报告余弦相似度和吞吐量；最低余弦低于 --threshold 时退出码为1
+  python3 clip_model_tools.py verify-preprocess --images a.jpg b.jpg ...
+    对比快速预处理（JPEG draft解码 + 合并缩放裁剪）与CLIPProcessor全分辨率路径的像素差、向量余弦和耗时
+  python3 clip_model_tools.py memory-report <gunicorn master PID>
+    读取master及各worker的 /proc/<pid>/smaps_rollup，报告RSS、PSS和共享内存，验证pre-fork的写时复制共享效果
+"""
+import os
+import sys
+import json
+import time
+import inspect
+import argparse
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    stream=sys.stderr
+)
+logger = logging.getLogger('clip_model_tools')
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(CURRENT_DIR, 'clip_utils'))
+
+
+def resolve_model_dir(path):
+    """确定要处理的模型目录（未指定时使用编码器的解析逻辑，不加载模型）"""
+    if path:
+        return os.path.abspath(path)
+    from config import CLIP_CONFIG
+    from clip_encoder import CLIPEncoder
+    encoder = CLIPEncoder.__new__(CLIPEncoder)
+    encoder.config = CLIP_CONFIG
+    model_dir = encoder._resolve_model_path(CLIP_CONFIG['model_name'])
+    if not model_dir:
+        raise SystemExit('未找到本地模型目录，请通过参数或 CLIP_MODEL_PATH 指定')
+    return model_dir
+
+
+def convert_safetensors(args):
+    """pytorch_model.bin -> model.safetensors"""
+    import torch
+    from safetensors.torch import save_file
+
+    model_dir = resolve_model_dir(args.model_dir)
+    source = os.path.join(model_dir, 'pytorch_model.bin')
+    target = os.path.join(model_dir, 'model.safetensors')
+    if os.path.exists(target) and not args.force:
+        logger.info(f"✅ 已存在 {target}，无需转换（使用 --force 覆盖）")
+        return
+    if not os.path.exists(source):
+        raise SystemExit(f"没有找到 {source}")
+
+    logger.info(f"读取 {source} ...")
+    state_dict = torch.load(source, map_location='cpu')
+    # safetensors不允许共享存储的张量，逐个复制为连续内存
+    state_dict = {name: tensor.contiguous().clone() for name, tensor in state_dict.items()}
+    tmp_path = f"{target}.tmp"
+    save_file(state_dict, tmp_path, metadata={'format': 'pt'})
+    os.replace(tmp_path, target)
+    logger.info(f"✅ 已写入 {target}（{os.path.getsize(target) / 1024 / 1024:.1f} MB）")
+    logger.info("   确认服务能正常加载后，可删除 pytorch_model.bin 节省磁盘空间")
+
+
+def export_onnx(args):
+    """导出文本塔和视觉塔（各自带投影层，输出未归一化的向量）"""
+    import torch
+    from transformers import CLIPTextModelWithProjection, CLIPVisionModelWithProjection
+    from config import CLIP_CONFIG
+    from clip_encoder import onnx_model_path
+
+    class TextTower(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask).text_embeds
+
+    class VisionTower(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, pixel_values):
+            return self.model(pixel_values=pixel_values).image_embeds
+
+    model_dir = resolve_model_dir(args.model_dir)
+    export_kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # 使用TorchScript导出器，动态维度的处理更稳定
+        export_kwargs['dynamo'] = False
+
+    for tower in args.towers.split(','):
+        path = onnx_model_path(CLIP_CONFIG['model_name'], tower)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        started = time.perf_counter()
+        if tower == 'text':
+            model = CLIPTextModelWithProjection.from_pretrained(model_dir, local_files_only=True).eval()
+            length = model.config.max_position_embeddings
+            wrapper = TextTower(model)
+            inputs = (torch.ones(2, length, dtype=torch.long), torch.ones(2, length, dtype=torch.long))
+            names = ['input_ids', 'attention_mask']
+            dynamic_axes = {'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'}}
+        elif tower == 'vision':
+            model = CLIPVisionModelWithProjection.from_pretrained(model_dir, local_files_only=True).eval()
+            size = model.config.image_size
+            wrapper = VisionTower(model)
+            inputs = (torch.zeros(2, 3, size, size),)
+            names = ['pixel_values']
+            dynamic_axes = {'pixel_values': {0: 'batch'}}
+        else:
+            raise SystemExit(f"未知的塔: {tower}（可选 text / vision）")
+
+        output_name = 'text_embeds' if tower == 'text' else 'image_embeds'
+        dynamic_axes[output_name] = {0: 'batch'}
+        tmp_path = f"{path}.tmp"
+        with torch.no_grad():
+            torch.onnx.export(wrapper, inputs, tmp_path, input_names=names, output_names=[output_name],
+                              dynamic_axes=dynamic_axes, opset_version=args.opset, **export_kwargs)
+        os.replace(tmp_path, path)
+        logger.info(f"✅ 已导出{tower}塔: {path}（{os.path.getsize(path) / 1024 / 1024:.1f} MB，"
+                    f"{time.perf_counter() - started:.1f} 秒）")
+    logger.info("   运行 verify --backend onnx 确认余弦相似度后，再设置 CLIP_BACKEND=onnx")
+
+
+DEFAULT_SAMPLE_TEXTS = [
+    '红色SUV', '白色轿车', '黑色跑车', '蓝色皮卡', '银色越野车', '黄色出租车',
+    '停在路边的汽车', '夜晚的城市街道', '雪地里的吉普车', '汽车内饰方向盘',
+    'a red sports car', 'a white sedan parked on the street', 'an off-road vehicle in the mountains',
+    'the dashboard of a car', 'a vintage convertible', 'a truck on the highway'
+]
+
+
+def _timed_encode(encode, items, batch_size, repeat):
+    """分批编码，返回 (向量矩阵, 每秒条数)；先跑一遍预热，再计时repeat遍"""
+    import numpy as np
+
+    def run():
+        return np.concatenate([encode(items[i:i + batch_size]) for i in range(0, len(items), batch_size)])
+    vectors = run()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        run()
+    elapsed = time.perf_counter() - started
+    return vectors, (len(items) * repeat / elapsed if elapsed > 0 else 0.0)
+
+
+def verify(args):
+    """对比fp32与指定后端在样本上的输出"""
+    import numpy as np
+    from config import CLIP_CONFIG
+    from clip_encoder import CLIPEncoder
+    from image_loader import load_image
+
+    texts = DEFAULT_SAMPLE_TEXTS
+    if args.texts:
+        with open(args.texts, encoding='utf-8') as f:
+            texts = [line.strip() for line in f if line.strip()]
+    images = [load_image(source) for source in args.images or []]
+    mode = 'both' if images else 'text'
+    if not images:
+        logger.warning("⚠️ 未提供 --images，只验证文本塔")
+
+    reference = CLIPEncoder(mode=mode, backend='torch')
+    candidate = CLIPEncoder(mode=mode, backend=args.backend)
+
+    samples = {'text': (texts, lambda encoder: encoder.encode_texts_batch)}
+    if images:
+        samples['vision'] = (images, lambda encoder: encoder.encode_images_batch)
+
+    report = {'model': CLIP_CONFIG['model_name'], 'backend': args.backend, 'threshold': args.threshold}
+    passed = True
+    for tower, (items, method) in samples.items():
+        expected, reference_rate = _timed_encode(method(reference), items, args.batch_size, args.repeat)
+        actual, candidate_rate = _timed_encode(method(candidate), items, args.batch_size, args.repeat)
+        cosine = np.sum(expected * actual, axis=1)
+        report[tower] = {
+            'samples': len(items),
+            'cosine_min': round(float(cosine.min()), 6),
+            'cosine_mean': round(float(cosine.mean()), 6),
+            'fp32_per_second': round(reference_rate, 2),
+            'backend_per_second': round(candidate_rate, 2),
+            'speedup': round(candidate_rate / reference_rate, 2) if reference_rate > 0 else None
+        }
+        passed = passed and float(cosine.min()) >= args.threshold
+    report['passed'] = passed
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if passed:
+        logger.info(f"✅ 最低余弦相似度不低于 {args.threshold}")
+    else:
+        logger.error(f"❌ 最低余弦相似度低于 {args.threshold}，不建议切换到 {args.backend}")
+        sys.exit(1)
+
+
+def verify_preprocess(args):
+    """快速预处理与CLIPProcessor（全分辨率解码）的输出对比"""
+    import io
+    import numpy as np
+    import torch
+    from PIL import Image
+    from clip_encoder import CLIPEncoder
+    from image_loader import read_image_bytes, draft_size
+    from image_preprocess import ImagePreprocessor, apply_draft
+
+    contents = [read_image_bytes(source) for source in args.images]
+    encoder = CLIPEncoder(mode='vision', backend='torch')
+    preprocessor = encoder.preprocessor or ImagePreprocessor.from_processor(encoder.processor.image_processor)
+    if preprocessor is None:
+        raise SystemExit('当前模型的处理器配置不支持快速预处理')
+
+    def reference():
+        images = [Image.open(io.BytesIO(data)).convert('RGB') for data in contents]
+        return encoder.processor(images=images, return_tensors='np')['pixel_values'].astype(np.float32)
+
+    def fast():
+        images = [apply_draft(Image.open(io.BytesIO(data)), draft_size()).convert('RGB') for data in contents]
+        return preprocessor(images)
+
+    timings = {}
+    outputs = {}
+    for name, fn in (('processor', reference), ('fast', fast)):
+        fn()
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            outputs[name] = fn()
+        timings[name] = (time.perf_counter() - started) / args.repeat
+
+    with torch.no_grad():
+        vectors = {}
+        for name, pixel_values in outputs.items():
+            features = encoder.model(pixel_values=torch.from_numpy(pixel_values)).image_embeds
+            vectors[name] = (features / features.norm(dim=-1, keepdim=True)).numpy()
+    cosine = np.sum(vectors['processor'] * vectors['fast'], axis=1)
+    report = {
+        'samples': len(contents),
+        'draft_size': draft_size(),
+        'pixel_max_abs_diff': round(float(np.abs(outputs['processor'] - outputs['fast']).max()), 4),
+        'pixel_mean_abs_diff': round(float(np.abs(outputs['processor'] - outputs['fast']).mean()), 5),
+        'cosine_min': round(float(cosine.min()), 6),
+        'cosine_mean': round(float(cosine.mean()), 6),
+        'processor_images_per_second': round(len(contents) / timings['processor'], 2),
+        'fast_images_per_second': round(len(contents) / timings['fast'], 2),
+        'speedup': round(timings['processor'] / timings['fast'], 2),
+        'threshold': args.threshold,
+        'passed': float(cosine.min()) >= args.threshold
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if not report['passed']:
+        logger.error(f"❌ 最低余弦相似度低于 {args.threshold}，可调大 IMAGE_DRAFT_FACTOR 或关闭 IMAGE_FAST_PREPROCESS")
+        sys.exit(1)
+
+
+def _children(pid):
+    """进程的直接子进程（/proc/<pid>/task/*/children）"""
+    children = []
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children") as f:
+            children.extend(int(child) for child in f.read().split())
+    return children
+
+
+def _smaps_rollup(pid):
+    """/proc/<pid>/smaps_rollup 中的内存统计（单位KB）"""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                values[parts[0].rstrip(':')] = int(parts[1])
+    return values
+
+
+def memory_report(args):
+    """pre-fork部署的实际内存占用：PSS把共享页按共享进程数平摊，各进程PSS之和就是整个实例的物理内存"""
+    if not os.path.exists(f"/proc/{args.pid}/smaps_rollup"):
+        raise SystemExit(f"无法读取 /proc/{args.pid}/smaps_rollup（需要Linux 4.14+，且有权限读取该进程）")
+
+    def megabytes(kb):
+        return round(kb / 1024, 1)
+
+    processes = []
+    for pid in [args.pid] + _children(args.pid):
+        values = _smaps_rollup(pid)
+        shared = values.get('Shared_Clean', 0) + values.get('Shared_Dirty', 0)
+        processes.append({
+            'pid': pid,
+            'role': 'master' if pid == args.pid else 'worker',
+            'rss_mb': megabytes(values.get('Rss', 0)),
+            'pss_mb': megabytes(values.get('Pss', 0)),
+            'shared_mb': megabytes(shared),
+            'private_mb': megabytes(values.get('Private_Clean', 0) + values.get('Private_Dirty', 0))
+        })
+
+    rss = sum(p['rss_mb'] for p in processes)
+    pss = sum(p['pss_mb'] for p in processes)
+    report = {
+        'processes': processes,
+        'workers': len(processes) - 1,
+        'total_rss_mb': round(rss, 1),
+        'total_pss_mb': round(pss, 1),
+        # RSS之和重复计算了共享页，与PSS之和的差值就是写时复制共享省下的内存
+        'shared_savings_mb': round(rss - pss, 1)
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='CLIP模型维护工具')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert = subparsers.add_parser('convert-safetensors', help='把pytorch_model.bin转换为model.safetensors')
+    convert.add_argument('model_dir', nargs='?', help='模型目录（默认使用服务解析到的本地模型）')
+    convert.add_argument('--force', action='store_true', help='覆盖已存在的model.safetensors')
+    convert.set_defaults(handler=convert_safetensors)
+
+    export = subparsers.add_parser('export-onnx', help='导出ONNX图（CLIP_BACKEND=onnx使用）')
+    export.add_argument('model_dir', nargs='?', help='模型目录（默认使用服务解析到的本地模型）')
+    export.add_argument('--towers', default='text,vision', help='要导出的塔，逗号分隔，默认text,vision')
+    export.add_argument('--opset', type=int, default=17, help='ONNX opset版本，默认17')
+    export.set_defaults(handler=export_onnx)
+
+    check = subparsers.add_parser('verify', help='对比fp32与指定后端的输出余弦相似度和吞吐量')
+    check.add_argument('--backend', required=True, choices=['torch-int8', 'onnx'], help='要验证的后端')
+    check.add_argument('--images', nargs='*', help='样本图片（URL或本地路径）')
+    check.add_argument('--texts', help='样本文本文件（每行一条），默认使用内置的查询样本')
+    check.add_argument('--threshold', type=float, default=0.99, help='最低可接受的余弦相似度，默认0.99')
+    check.add_argument('--batch-size', type=int, default=16, help='编码批大小，默认16')
+    check.add_argument('--repeat', type=int, default=3, help='计时重复次数，默认3')
+    check.set_defaults(handler=verify)
+
+    pre = subparsers.add_parser('verify-preprocess', help='对比快速预处理与CLIPProcessor的输出和耗时')
+    pre.add_argument('--images', nargs='+', required=True, help='样本图片（URL或本地路径）')
+    pre.add_argument('--threshold', type=float, default=0.99, help='最低可接受的余弦相似度，默认0.99')
+    pre.add_argument('--repeat', type=int, default=3, help='计时重复次数，默认3')
+    pre.set_defaults(handler=verify_preprocess)
+
+    memory = subparsers.add_parser('memory-report', help='统计gunicorn master及各worker的RSS/PSS，验证权重共享')
+    memory.add_argument('pid', type=int, help='gunicorn master进程PID')
+    memory.set_defaults(handler=memory_report)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+MySQL -> Qdrant 向量增量同步
+按保存的水位线只读取上次同步后变化的行，每次运行的开销与变化量成正比，而不是与图库大小成正比：
+  - images表: 按 (updatedAt, id) 分页读取新增/修改的图片
+  - models/brands表: 车型或品牌改名等变化，同步其下图片的payload
+  - 每页先按ID读取Qdrant中已有的point，比较后分三类处理:
+      新图片或图片URL变化 -> 重新编码并upsert（相同内容命中图片向量存储时不做前向计算）
+      只有元数据（品牌、车型、分类、标题等）变化 -> 只更新payload，不重写向量
+      没有变化 -> 跳过
+  - 已从images表删除的图片: 按自增id读取触发器写入的 image_deletions 表，删除对应point
+    （--reconcile-deletes 另外按ID扫描整个集合，删除数据库中不存在的point，开销与集合大小成正比，只在需要对账时使用）
+索引、删除记录表和触发器见 backend/migrations/add_image_vector_sync.sql
+水位线在每页写入成功后保存，中断后重新运行从中断处继续；下载/编码失败的图片记入待重试列表，下次运行先重试
+
+用法:
+  python3 clip_sync_vectors.py                      # 增量同步（首次运行相当于全量检查）
+  python3 clip_sync_vectors.py --dry-run            # 只统计需要编码/更新/删除的数量，不写入
+  python3 clip_sync_vectors.py --reconcile-deletes  # 另外全量对账已删除的图片
+  python3 clip_sync_vectors.py --reset              # 忽略水位线重新检查全部行（未变化的行不会写入）
+  VECTOR_SYNC_DATABASE_URL=sqlite:///catalog.db python3 clip_sync_vectors.py   # 使用本地SQLite替身
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    stream=sys.stderr
+)
+logger = logging.getLogger('clip_sync_vectors')
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(CURRENT_DIR, 'clip_utils'))
+
+from config import CLIP_CONFIG, VECTOR_SYNC_CONFIG  # noqa: E402
+from image_catalog import ImageCatalog, image_payload, format_timestamp, shift_timestamp  # noqa: E402
+from image_embedding_store import get_image_embedding_store  # noqa: E402
+from qdrant_rest import QdrantRest, build_point  # noqa: E402
+from clip_bulk_vectorize import fetch_and_decode  # noqa: E402
+
+
+def empty_state():
+    return {'images': {'updated_at': None, 'id': 0}, 'models': None, 'brands': None, 'deletions': 0, 'retry_ids': []}
+
+
+def load_state(path):
+    """读取水位线文件，不存在时返回空状态"""
+    state = empty_state()
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            state.update(json.load(f))
+    return state
+
+
+def save_state(path, state):
+    """写入临时文件后替换，中断时不会留下写了一半的水位线"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+class VectorSync:
+    """一次同步运行：分类变化的行，批量编码/upsert、只更新payload、删除point"""
+
+    def __init__(self, catalog, client, workers=8, dry_run=False, encoder=None):
+        self.catalog = catalog
+        self.client = client
+        self.dry_run = dry_run
+        self.store = get_image_embedding_store()
+        self.encoder = encoder
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.failed_ids = set()
+        self.stats = {'scanned': 0, 'encoded': 0, 'store_hits': 0, 'payload_updates': 0, 'unchanged': 0,
+                      'failed': 0, 'deleted': 0}
+
+    def _encode(self, items):
+        """items: [(row, payload)]，并发下载/解码后按batch_size批量编码，返回 [(image_id, vector, payload)]"""
+        results = list(self.executor.map(
+            lambda item: fetch_and_decode(item[0]['id'], item[0]['url'], item[1], self.store), items))
+        encoded = []
+        to_encode = []
+        for result in results:
+            if 'error' in result:
+                logger.warning(f"图片加载失败 (image_id={result['image_id']}): {result['error']}")
+                self.failed_ids.add(result['image_id'])
+            elif 'vector' in result:
+                self.stats['store_hits'] += 1
+                encoded.append((result['image_id'], result['vector'], result['payload']))
+            else:
+                to_encode.append(result)
+
+        batch_size = CLIP_CONFIG['batch_size']
+        for start in range(0, len(to_encode), batch_size):
+            batch = to_encode[start:start + batch_size]
+            if self.encoder is None:
+                from clip_encoder import get_clip_encoder
+                self.encoder = get_clip_encoder('vision')
+            vectors = self.encoder.encode_images_batch([item.pop('image') for item in batch])
+            if vectors is None:
+                logger.warning(f"批量编码失败（{len(batch)}张），下次运行重试")
+                self.failed_ids.update(item['image_id'] for item in batch)
+                continue
+            if self.store is not None:
+                self.store.put_many([item['digest'] for item in batch], list(vectors))
+            self.stats['encoded'] += len(batch)
+            encoded.extend((item['image_id'], vector, item['payload']) for item, vector in zip(batch, vectors))
+        return encoded
+
+    def sync_rows(self, rows):
+        """同步一页图片行：与Qdrant中已有的payload比较，只编码URL变化的图片，只有元数据变化的只更新payload"""
+        if not rows:
+            return
+        self.stats['scanned'] += len(rows)
+        existing = {point['id']: point.get('payload') or {}
+                    for point in self.client.retrieve_points([row['id'] for row in rows])}
+        to_encode = []
+        payloads = {}
+        for row in rows:
+            payload = image_payload(row)
+            old = existing.get(row['id'])
+            if old is None or ('image_url' in old and old['image_url'] != payload['image_url']):
+                to_encode.append((row, payload))
+            elif any(old.get(key) != value for key, value in payload.items()):
+                # 包括Node端写入的没有image_url的point：沿用已有向量，只补写payload
+                payloads[row['id']] = {**payload, 'updated_at': datetime.now(timezone.utc).isoformat()}
+            else:
+                self.stats['unchanged'] += 1
+
+        self.stats['payload_updates'] += len(payloads)
+        if self.dry_run:
+            self.stats['encoded'] += len(to_encode)
+            return
+        if payloads:
+            self.client.set_payloads(payloads)
+        if to_encode:
+            points = [build_point(image_id, vector, payload) for image_id, vector, payload in self._encode(to_encode)]
+            if points:
+                self.client.upsert_points(points)
+            # 之前失败、这次写入成功的图片不再需要重试
+            self.failed_ids.difference_update(point['id'] for point in points)
+
+    def delete_ids(self, ids):
+        if ids and not self.dry_run:
+            self.client.delete_points(ids)
+        self.stats['deleted'] += len(ids)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def sync_images(sync, state, args, save):
+    """images表中水位线之后新增/修改的行，每页写入成功后推进并保存水位线"""
+    mark = state['images']
+    since = mark['updated_at']
+    after_id = mark['id']
+    if since is not None and args.overlap > 0:
+        # 回退一段时间重新检查（未变化的行不会写入），避免漏掉提交较晚、updatedAt却更早的行
+        since, after_id = shift_timestamp(since, args.overlap), 0
+    while True:
+        rows = sync.catalog.changed_images(since, after_id, args.page_size)
+        if not rows:
+            return
+        sync.sync_rows(rows)
+        last = rows[-1]
+        since, after_id = format_timestamp(last['updated_at']), last['id']
+        if since is not None and (mark['updated_at'] is None or since > mark['updated_at']
+                                  or (since == mark['updated_at'] and after_id > mark['id'])):
+            state['images'] = mark = {'updated_at': since, 'id': after_id}
+        save()
+        logger.info(f"📊 进度: {json.dumps(sync.stats, ensure_ascii=False)}")
+
+
+def sync_related(sync, state, args, save, initial):
+    """models/brands表变化（如车型、品牌改名）时同步其下图片的payload；首次运行只记录水位线（图片已全部检查）"""
+    changed = {}
+    for table in ['models', 'brands']:
+        rows = sync.catalog.changed_rows(table, state[table])
+        changed[table] = [row[0] for row in rows]
+        latest = max((format_timestamp(row[1]) for row in rows if row[1] is not None), default=None)
+        if latest is not None:
+            changed[f'{table}_latest'] = latest
+
+    if not initial:
+        model_ids = sorted(set(changed['models']) | set(sync.catalog.model_ids_for_brands(changed['brands'])))
+        if model_ids:
+            logger.info(f"车型/品牌变化: {len(changed['models'])} 个车型、{len(changed['brands'])} 个品牌，"
+                        f"涉及 {len(model_ids)} 个车型的图片")
+        # IN列表按块查询，每块内按id分页
+        for start in range(0, len(model_ids), 500):
+            chunk = model_ids[start:start + 500]
+            after_id = 0
+            while True:
+                rows = sync.catalog.images_by_models(chunk, after_id, args.page_size)
+                if not rows:
+                    break
+                sync.sync_rows(rows)
+                after_id = rows[-1]['id']
+
+    for table in ['models', 'brands']:
+        if f'{table}_latest' in changed:
+            state[table] = changed[f'{table}_latest']
+    save()
+
+
+def sync_deletions(sync, state, args, save):
+    """按自增id读取image_deletions表中水位线之后的删除记录，删除对应point（开销与删除数成正比）"""
+    if not sync.catalog.has_table('image_deletions'):
+        logger.warning('⚠️  image_deletions表不存在，跳过删除同步（见 backend/migrations/add_image_vector_sync.sql）')
+        return
+    while True:
+        rows = sync.catalog.deleted_images(state['deletions'], args.page_size)
+        if not rows:
+            return
+        ids = sorted({row[1] for row in rows})
+        # 同一ID已重新插入时保留point
+        sync.delete_ids(sorted(set(ids) - sync.catalog.existing_ids(ids)))
+        sync.failed_ids.difference_update(ids)
+        state['deletions'] = rows[-1][0]
+        save()
+
+
+def reconcile_deletes(sync, page_size):
+    """按ID分页扫描整个集合（不取payload和向量），删除images表中已不存在的point"""
+    ids = []
+    for point in sync.client.scroll_points(batch_size=page_size, with_vector=False, with_payload=False):
+        ids.append(point['id'])
+        if len(ids) >= page_size:
+            sync.delete_ids(sorted(set(ids) - sync.catalog.existing_ids(ids)))
+            ids = []
+    if ids:
+        sync.delete_ids(sorted(set(ids) - sync.catalog.existing_ids(ids)))
+
+
+def run(args, catalog=None, client=None, encoder=None):
+    """执行一次增量同步，返回统计（catalog/client/encoder默认按配置创建）"""
+    started = time.perf_counter()
+    state = empty_state() if args.reset else load_state(args.state_file)
+    initial = state['images']['updated_at'] is None and state['images']['id'] == 0
+    catalog = catalog or ImageCatalog.connect(args.database_url or None)
+    client = client or QdrantRest()
+    if not args.dry_run:
+        client.ensure_collection()
+    sync = VectorSync(catalog, client, workers=args.workers, dry_run=args.dry_run, encoder=encoder)
+
+    def save():
+        if not args.dry_run:
+            state['retry_ids'] = sorted(sync.failed_ids)
+            save_state(args.state_file, state)
+
+    try:
+        # 上次失败的图片先重试；已删除的直接删除对应point
+        retry_ids = list(state.get('retry_ids') or [])
+        sync.failed_ids.update(retry_ids)
+        for start in range(0, len(retry_ids), args.page_size):
+            chunk = retry_ids[start:start + args.page_size]
+            rows = catalog.images_by_ids(chunk)
+            sync.sync_rows(rows)
+            missing = set(chunk) - {row['id'] for row in rows}
+            sync.failed_ids.difference_update(missing)
+            sync.delete_ids(sorted(missing))
+
+        sync_images(sync, state, args, save)
+        sync_related(sync, state, args, save, initial)
+        sync_deletions(sync, state, args, save)
+        if args.reconcile_deletes:
+            reconcile_deletes(sync, max(args.page_size, 1000))
+        save()
+    finally:
+        sync.close()
+        catalog.close()
+
+    sync.stats['failed'] = len(sync.failed_ids)
+    report = {
+        **sync.stats,
+        'dry_run': args.dry_run,
+        'watermark': {'images': state['images'], 'models': state['models'], 'brands': state['brands'],
+                      'deletions': state['deletions']},
+        'seconds': round(time.perf_counter() - started, 2)
+    }
+    logger.info(f"✅ 增量同步完成: {json.dumps(report, ensure_ascii=False)}")
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='MySQL -> Qdrant 向量增量同步（水位线）')
+    parser.add_argument('--database-url', default=VECTOR_SYNC_CONFIG['database_url'],
+                        help='mysql://用户:密码@主机:端口/库名 或 sqlite:///路径，默认使用DB_*环境变量')
+    parser.add_argument('--state-file', default=VECTOR_SYNC_CONFIG['state_file'], help='水位线文件')
+    parser.add_argument('--page-size', type=int, default=VECTOR_SYNC_CONFIG['page_size'], help='每页处理的行数')
+    parser.add_argument('--overlap', type=int, default=VECTOR_SYNC_CONFIG['overlap_seconds'],
+                        help='从水位线往前回退重新检查的秒数，默认VECTOR_SYNC_OVERLAP')
+    parser.add_argument('--workers', type=int, default=VECTOR_SYNC_CONFIG['workers'], help='下载/解码线程数')
+    parser.add_argument('--reconcile-deletes', action='store_true',
+                        help='另外按ID扫描整个集合，删除数据库中不存在的point（开销与集合大小成正比）')
+    parser.add_argument('--reset', action='store_true', help='忽略水位线，重新检查全部行')
+    parser.add_argument('--dry-run', action='store_true', help='只统计，不写入Qdrant和水位线')
+    return parser.parse_args(argv)
+
+
+def main():
+    """主函数"""
+    args = parse_args()
+
+    # 同一水位线文件同时只允许一个同步进程
+    os.makedirs(os.path.dirname(os.path.abspath(args.state_file)), exist_ok=True)
+    with open(f"{args.state_file}.lock", 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.error(f"❌ 已有同步进程在运行（{args.state_file}.lock）")
+            sys.exit(1)
+        try:
+            report = run(args)
+        except Exception as e:
+            logger.error(f"❌ 增量同步中断（已完成的页面水位线已保存，重新运行会继续）: {e}")
+            sys.exit(1)
+    # 最终统计输出到stdout，便于脚本解析
+    print(json.dumps(report, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+零样本批量打标签工具
+用已计算的图片向量（clip_bulk_vectorize.py 的JSONL输出、Qdrant集合或本地向量索引）给整个图库打标签：
+每批图片向量与标签矩阵（tag_vocabulary.json 全部标签的提示词向量）做一次矩阵乘，不再逐张逐标签调用模型
+标签矩阵按词表内容缓存（TAGGING_CONFIG['cache_dir']），词表未改变时不加载文本塔
+
+用法:
+  python3 clip_tag_images.py --build-labels                          # 只计算/刷新标签矩阵（修改词表后运行）
+  python3 clip_tag_images.py vectors.jsonl -o tags.jsonl            # 使用批量向量化的输出
+  python3 clip_tag_images.py --from-index -o tags.jsonl --groups body_type,view --top-k 1
+  python3 clip_tag_images.py --from-qdrant -o tags.jsonl --min-confidence 0.3
+
+输出格式（JSONL，每行一条）:
+  {"image_id": 123, "tags": {"body_type": [{"label": "SUV", "confidence": 0.82, "similarity": 0.27}], ...}}
+还没有向量的图片先用 clip_bulk_vectorize.py 计算（每张图片一次前向计算），之后修改词表只需重新运行本工具
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    stream=sys.stderr
+)
+logger = logging.getLogger('clip_tag_images')
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(CURRENT_DIR, 'clip_utils'))
+
+import numpy as np  # noqa: E402
+
+from config import TAGGING_CONFIG, INDEX_CONFIG  # noqa: E402
+from zero_shot import load_label_matrix, LabelMatrixUnavailable  # noqa: E402
+from clip_build_index import read_jsonl_records, read_qdrant_records  # noqa: E402
+
+
+def read_index_records(directory, chunk_size):
+    """按块读取本地向量索引目录中的向量（内存映射，不一次性载入）"""
+    ids = np.load(os.path.join(directory, 'ids.npy'), allow_pickle=False)
+    matrix = np.load(os.path.join(directory, 'vectors.npy'), mmap_mode='r')
+    for start in range(0, len(ids), chunk_size):
+        for point_id, vector in zip(ids[start:start + chunk_size].tolist(),
+                                    np.asarray(matrix[start:start + chunk_size])):
+            yield point_id, vector, None
+
+
+def text_encoder():
+    """延迟加载文本塔：标签矩阵已缓存时不需要"""
+    encoder = None
+
+    def encode(texts):
+        nonlocal encoder
+        if encoder is None:
+            from clip_encoder import get_clip_encoder
+            encoder = get_clip_encoder('text')
+        return encoder.encode_texts_batch(texts)
+    return encode
+
+
+def tag_records(records, labels, output, chunk_size, options):
+    """每chunk_size条向量做一次打分，结果逐行写入output，返回统计"""
+    stats = {'tagged': 0, 'skipped': 0, 'chunks': 0, 'score_seconds': 0.0}
+    chunk = []
+
+    def flush():
+        started = time.perf_counter()
+        tags = labels.score(np.asarray([vector for _, vector in chunk], dtype=np.float32), **options)
+        stats['score_seconds'] += time.perf_counter() - started
+        for (point_id, _), item in zip(chunk, tags):
+            output.write(json.dumps({'image_id': point_id, 'tags': item}, ensure_ascii=False) + '\n')
+        stats['tagged'] += len(chunk)
+        stats['chunks'] += 1
+        chunk.clear()
+
+    for point_id, vector, _ in records:
+        if vector is None or len(vector) != labels.dimension:
+            stats['skipped'] += 1
+            continue
+        chunk.append((point_id, vector))
+        if len(chunk) >= chunk_size:
+            flush()
+            logger.info(f"已打标签 {stats['tagged']} 张")
+    if chunk:
+        flush()
+    stats['score_seconds'] = round(stats['score_seconds'], 3)
+    return stats
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='用图片向量和标签矩阵批量零样本打标签')
+    parser.add_argument('inputs', nargs='*', help='JSONL向量文件（clip_bulk_vectorize.py 的输出）')
+    parser.add_argument('--from-qdrant', action='store_true', help='从QDRANT_CONFIG配置的集合导出向量')
+    parser.add_argument('--from-index', action='store_true', help='使用本地向量索引目录（VECTOR_INDEX_DIR）中的向量')
+    parser.add_argument('-o', '--output', help='输出JSONL文件')
+    parser.add_argument('--vocabulary', default=TAGGING_CONFIG['vocabulary'], help='标签词表，默认CLIP_TAG_VOCABULARY')
+    parser.add_argument('--build-labels', action='store_true', help='只计算标签矩阵（词表未改变时直接使用缓存）')
+    parser.add_argument('--rebuild', action='store_true', help='忽略缓存，重新计算标签矩阵')
+    parser.add_argument('--groups', default='', help='只输出这些标签组，逗号分隔，默认全部')
+    parser.add_argument('--top-k', type=int, default=None, help='每组输出的标签数，默认使用词表中各组的top_k')
+    parser.add_argument('--min-confidence', type=float, default=TAGGING_CONFIG['min_confidence'],
+                        help='低于该置信度的标签不输出，默认CLIP_TAG_MIN_CONFIDENCE')
+    parser.add_argument('--chunk-size', type=int, default=4096, help='每次矩阵乘的图片数，默认4096')
+    parser.add_argument('--scroll-size', type=int, default=1000, help='从Qdrant导出时每页的point数，默认1000')
+    args = parser.parse_args()
+
+    sources = [bool(args.inputs), args.from_qdrant, args.from_index]
+    if not args.build_labels and (sum(sources) != 1 or not args.output):
+        parser.error('需要指定 -o 输出文件，以及JSONL文件、--from-qdrant、--from-index 之一')
+
+    started = time.perf_counter()
+    try:
+        labels = load_label_matrix(args.vocabulary, text_encoder(), rebuild=args.rebuild)
+    except LabelMatrixUnavailable as e:
+        logger.error(f"❌ {e}")
+        sys.exit(1)
+    report = {'labels': labels.stats(), 'labels_seconds': round(time.perf_counter() - started, 3)}
+
+    if not args.build_labels:
+        if args.from_qdrant:
+            records = read_qdrant_records(args.scroll_size)
+        elif args.from_index:
+            records = read_index_records(INDEX_CONFIG['directory'], args.chunk_size)
+        else:
+            records = read_jsonl_records(args.inputs)
+        options = {
+            'groups': [name.strip() for name in args.groups.split(',') if name.strip()] or None,
+            'top_k': args.top_k,
+            'min_confidence': args.min_confidence,
+            'logit_scale': TAGGING_CONFIG['logit_scale']
+        }
+        unknown = [name for name in options['groups'] or [] if name not in labels.spans]
+        if unknown:
+            parser.error(f"未知的标签组: {unknown}，可选: {list(labels.spans)}")
+        started = time.perf_counter()
+        with open(args.output, 'w', encoding='utf-8') as output:
+            report.update(tag_records(records, labels, output, args.chunk_size, options))
+        report['seconds'] = round(time.perf_counter() - started, 3)
+        report['output'] = args.output
+    # 最终统计输出到stdout，便于脚本解析
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,167 +8,394 @@ from PIL import Image
 import numpy as np
 from typing import List, Union
 from config import CLIP_CONFIG, IMAGE_CONFIG
+from image_preprocess import ImagePreprocessor
+from metrics import BATCH_SIZE, stage
 import logging
 import time
+import json
 import os
+import re
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+WEIGHT_FILES = ('model.safetensors', 'pytorch_model.bin')
+
+# 编码器模式 -> 支持的编码类型
+ENCODER_MODES = {
+    'both': ('text', 'vision'),
+    'text': ('text',),
+    'vision': ('vision',),
+}
+
+# 推理后端: torch（fp32）、torch-int8（Linear层动态量化，仅CPU）、onnx（ONNX Runtime，需先导出）
+BACKENDS = ('torch', 'torch-int8', 'onnx')
+
+# CLIP文本塔的位置编码长度：超过的文本（含起止符）只保留前77个token再编码。
+# 不截断时超长文本在前向计算中报错（/encode-text 返回500），截断后返回前77个token的向量；
+# 部分tokenizer配置缺少model_max_length（为1e30），不能只依赖truncation=True
+TEXT_MAX_TOKENS = 77
+
+
+# 推理线程数（None表示使用库的默认值）
+_num_threads = None
+
+
+def set_num_threads(num_threads: int):
+    """设置torch intra-op线程数，之后创建的ONNX Runtime会话也使用该值（多worker部署时避免线程超额订阅）"""
+    global _num_threads
+    _num_threads = max(1, int(num_threads))
+    torch.set_num_threads(_num_threads)
+
+
+def resolve_model_name(model_name: str) -> str:
+    """支持多种CLIP模型名称：将简写转换为transformers格式"""
+    if model_name == 'ViT-B/32' or model_name == 'ViT-B/16':
+        return 'openai/clip-vit-base-patch32' if '32' in model_name else 'openai/clip-vit-base-patch16'
+    return model_name
+
+
+def backend_id(backend: str = None, device: str = None) -> str:
+    """
+    实际生效的推理后端，作为图片向量存储和文本缓存命名空间的一部分：
+    不同后端的输出有细微差异，切换后端后不能复用旧向量（torch-int8在非CPU设备上回退为fp32，记为torch）
+    """
+    backend = (backend or CLIP_CONFIG['backend']).lower()
+    device = device or CLIP_CONFIG['device']
+    if backend == 'torch-int8' and device != 'cpu':
+        return 'torch'
+    return backend
+
+
+def onnx_model_path(model_name: str, tower: str) -> str:
+    """导出的ONNX图路径: <onnx_dir>/<模型名>/<text|vision>.onnx"""
+    slug = re.sub(r'[^A-Za-z0-9._-]+', '_', resolve_model_name(model_name)).strip('_')
+    return os.path.join(CLIP_CONFIG['onnx_dir'], slug, f"{tower}.onnx")
+
+
+def _weights_file(path: str):
+    """返回目录中的权重文件（优先safetensors），没有则返回None"""
+    for name in WEIGHT_FILES:
+        candidate = os.path.join(path, name)
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def _has_weights(path: str) -> bool:
+    return bool(path) and os.path.isdir(path) and _weights_file(path) is not None
+
+
+def _has_accelerate() -> bool:
+    import importlib.util
+    return importlib.util.find_spec('accelerate') is not None
+
+
+def _read_path_cache(cache_file) -> dict:
+    """读取模型路径缓存文件"""
+    if not cache_file or not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def _write_path_cache(cache_file, model_name: str, path: str):
+    """记录解析到的模型路径（写失败不影响加载）"""
+    if not cache_file:
+        return
+    try:
+        cache = _read_path_cache(cache_file)
+        cache[model_name] = path
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, 'w') as f:
+            json.dump(cache, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        logger.warning(f"记录模型路径失败: {e}")
+
 
 class CLIPEncoder:
     """CLIP编码器封装类"""
     
-    def __init__(self):
+    def __init__(self, mode: str = None, backend: str = None):
         self.config = CLIP_CONFIG
         self.image_config = IMAGE_CONFIG
         self.device = self.config['device']
+        self.mode = (mode or self.config['encoder_mode']).lower()
+        if self.mode not in ENCODER_MODES:
+            raise ValueError(f"不支持的编码器模式: {self.mode}（可选: {', '.join(ENCODER_MODES)}）")
+        self.backend = (backend or self.config['backend']).lower()
+        if self.backend not in BACKENDS:
+            raise ValueError(f"不支持的推理后端: {self.backend}（可选: {', '.join(BACKENDS)}）")
+        if self.backend == 'onnx':
+            self.device = 'cpu'
+        self._sessions = {}
+        self.preprocessor = None
         self.model = None
         self.processor = None
+        self.load_timings = {}
         self._load_model()
     
+    def _resolve_model_path(self, model_name: str):
+        """
+        解析本地模型目录（不联网）
+        顺序: CLIP_MODEL_PATH环境变量 -> 上次记录的路径 -> 逐个探测候选目录
+        探测到的路径写入缓存文件，下次启动不再逐个探测
+        """
+        explicit = self.config.get('model_path')
+        if explicit:
+            if _has_weights(explicit):
+                return os.path.abspath(explicit)
+            logger.warning(f"CLIP_MODEL_PATH 指定的目录没有模型权重: {explicit}")
+
+        if os.path.isdir(model_name) and _has_weights(model_name):
+            return os.path.abspath(model_name)
+
+        cache_file = self.config.get('model_path_cache')
+        cached = _read_path_cache(cache_file).get(model_name)
+        if cached and _has_weights(cached):
+            logger.info(f"使用已记录的模型路径: {cached}")
+            return cached
+
+        # 检查多个可能的模型路径
+        dir_name = model_name.rstrip('/').split('/')[-1]
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        service_dir = os.path.dirname(current_dir)  # backend/services
+        project_root = os.path.dirname(os.path.dirname(service_dir))  # 项目根目录
+        possible_paths = [
+            os.path.join(current_dir, dir_name),  # clip_utils/clip-vit-base-patch32
+            os.path.join(service_dir, dir_name),  # services/clip-vit-base-patch32
+            os.path.join(project_root, dir_name),  # 项目根目录
+            os.path.join('.', dir_name),  # 当前工作目录
+            os.path.expanduser(os.path.join('~', dir_name)),  # 用户目录
+        ]
+        # 如果设置了外部参考项目路径，也检查那里
+        ref_project = os.getenv('CLIP_REFERENCE_PROJECT')
+        if ref_project:
+            possible_paths.append(os.path.join(ref_project, dir_name))
+
+        logger.info("检查本地模型路径...")
+        for path in possible_paths:
+            if _has_weights(path):
+                local_model_path = os.path.abspath(path)
+                logger.info(f"✅ 发现本地模型: {local_model_path}")
+                _write_path_cache(cache_file, model_name, local_model_path)
+                return local_model_path
+        return None
+
     def _load_model(self):
-        """加载CLIP模型（使用transformers库）"""
+        """加载CLIP模型（使用transformers库，优先使用内存映射的safetensors权重）"""
         try:
-            import os
-            from transformers import CLIPProcessor, CLIPModel
+            from transformers import CLIPProcessor, CLIPModel, CLIPTextModelWithProjection, CLIPVisionModelWithProjection
+            # 只需要一个塔时只加载对应子模型，另一个塔的权重不会被读入内存
+            model_class = {
+                'both': CLIPModel,
+                'text': CLIPTextModelWithProjection,
+                'vision': CLIPVisionModelWithProjection,
+            }[self.mode]
             
-            model_name = self.config['model_name']
-            # 支持多种CLIP模型名称
-            if model_name == 'ViT-B/32' or model_name == 'ViT-B/16':
-                # 将简写转换为transformers格式
-                model_name = f'openai/clip-vit-base-patch32' if '32' in model_name else f'openai/clip-vit-base-patch16'
+            model_name = resolve_model_name(self.config['model_name'])
             
             logger.info(f"准备加载CLIP模型: {model_name}")
-            logger.info(f"设备: {self.device}")
+            logger.info(f"设备: {self.device}，编码器模式: {self.mode}（{model_class.__name__}），推理后端: {self.backend}")
+            timings = {}
+            started = time.perf_counter()
             
             # 检查本地是否有模型文件（优先使用本地）
-            local_model_path = None
-            if 'clip-vit-base-patch32' in model_name:
-                # 检查多个可能的模型路径
-                current_dir = os.path.dirname(os.path.abspath(__file__))
-                service_dir = os.path.dirname(current_dir)  # backend/services
-                project_root = os.path.dirname(os.path.dirname(service_dir))  # 项目根目录
-                
-                possible_paths = [
-                    os.path.join(current_dir, 'clip-vit-base-patch32'),  # clip_utils/clip-vit-base-patch32
-                    os.path.join(service_dir, 'clip-vit-base-patch32'),  # services/clip-vit-base-patch32
-                    os.path.join(project_root, 'clip-vit-base-patch32'),  # 项目根目录
-                    './clip-vit-base-patch32',  # 当前工作目录
-                    os.path.expanduser('~/clip-vit-base-patch32'),  # 用户目录
-                    # 也检查外部参考项目路径（如果设置了环境变量）
-                ]
-                
-                # 如果设置了外部参考项目路径，也检查那里
-                ref_project = os.getenv('CLIP_REFERENCE_PROJECT')
-                if ref_project:
-                    possible_paths.append(os.path.join(ref_project, 'clip-vit-base-patch32'))
-                
-                logger.info("检查本地模型路径...")
-                for path in possible_paths:
-                    abs_path = os.path.abspath(path)
-                    model_file = os.path.join(path, 'pytorch_model.bin')
-                    if os.path.exists(path) and os.path.exists(model_file):
-                        local_model_path = abs_path
-                        logger.info(f"✅ 发现本地模型: {local_model_path}")
-                        logger.info(f"   模型文件大小: {os.path.getsize(model_file) / 1024 / 1024:.1f} MB")
-                        break
+            local_model_path = self._resolve_model_path(model_name)
+            timings['resolve'] = time.perf_counter() - started
             
             if local_model_path:
+                source = local_model_path
+                load_kwargs = {'local_files_only': True}
+                weights_file = _weights_file(local_model_path)
                 logger.info(f"从本地加载CLIP模型（不联网）...")
                 logger.info(f"路径: {local_model_path}")
-                
-                # 先加载处理器（通常很快）
-                logger.info("步骤1/3: 加载处理器（tokenizer）...")
-                try:
-                    self.processor = CLIPProcessor.from_pretrained(
-                        local_model_path,
-                        local_files_only=True
-                    )
-                    logger.info("✅ 处理器加载完成")
-                except Exception as e:
-                    logger.error(f"处理器加载失败: {e}")
-                    raise
-                
-                # 加载模型权重（这一步可能较慢，特别是CPU）
-                logger.info("步骤2/3: 加载模型权重（577MB，可能需要1-2分钟）...")
-                try:
-                    # 不使用 device_map，直接用 .to() 方法指定设备
-                    self.model = CLIPModel.from_pretrained(
-                        local_model_path,
-                        local_files_only=True,
-                        torch_dtype=torch.float32  # 明确指定数据类型
-                    )
-                    self.model = self.model.to(self.device)  # 明确移动到指定设备
-                    logger.info(f"✅ 模型权重加载完成（已在 {self.device} 上）")
-                except Exception as e:
-                    logger.error(f"模型权重加载失败: {e}")
-                    raise
+                logger.info(f"   模型文件: {os.path.basename(weights_file)}，{os.path.getsize(weights_file) / 1024 / 1024:.1f} MB")
+                if not weights_file.endswith('.safetensors'):
+                    logger.warning("   只有pytorch_model.bin，需要完整反序列化；"
+                                   "可运行 python3 clip_model_tools.py convert-safetensors 转换为safetensors以加快加载")
             else:
                 logger.warning("未找到本地模型，将从网络下载（可能需要较长时间）...")
                 logger.info(f"从网络加载CLIP模型: {model_name}")
-                # 不使用 device_map，直接用 .to() 方法指定设备
-                self.model = CLIPModel.from_pretrained(model_name)
-                self.model = self.model.to(self.device)  # 明确移动到指定设备
-                self.processor = CLIPProcessor.from_pretrained(model_name)
+                source = model_name
+                load_kwargs = {}
+            
+            # 先加载处理器（通常很快）
+            logger.info("步骤1/4: 加载处理器（tokenizer）...")
+            phase = time.perf_counter()
+            self.processor = CLIPProcessor.from_pretrained(source, **load_kwargs)
+            timings['processor'] = time.perf_counter() - phase
+            logger.info("✅ 处理器加载完成")
+            if self.image_config['fast_preprocess'] and self.supports('vision'):
+                self.preprocessor = ImagePreprocessor.from_processor(self.processor.image_processor)
             
-            logger.info("设置模型为评估模式...")
+            if self.backend == 'onnx':
+                # ONNX Runtime直接加载导出的图，不需要PyTorch模型
+                phase = time.perf_counter()
+                self._load_onnx_sessions(model_name)
+                timings['weights'] = time.perf_counter() - phase
+                timings['total'] = time.perf_counter() - started
+                self.load_timings = {k: round(v, 3) for k, v in timings.items()}
+                logger.info(f"✅ CLIP ONNX模型加载成功！耗时(秒): {self.load_timings}")
+                return
+            
+            # 加载模型权重：safetensors通过内存映射读取，多个进程共享页缓存
+            logger.info("步骤2/4: 加载模型权重...")
+            phase = time.perf_counter()
+            weight_kwargs = dict(load_kwargs, torch_dtype=torch.float32)  # 明确指定数据类型
+            if _has_accelerate():
+                # 跳过随机初始化，直接把权重放进空模型，避免内存中出现两份权重
+                weight_kwargs['low_cpu_mem_usage'] = True
+            self.model = model_class.from_pretrained(source, **weight_kwargs)
+            timings['weights'] = time.perf_counter() - phase
+            logger.info("✅ 模型权重加载完成")
+            
+            # 不使用 device_map，直接用 .to() 方法指定设备
+            logger.info(f"步骤3/4: 移动到设备 {self.device}...")
+            phase = time.perf_counter()
+            self.model = self.model.to(self.device)
+            timings['device'] = time.perf_counter() - phase
+            
+            logger.info("步骤4/4: 设置模型为评估模式...")
+            phase = time.perf_counter()
             self.model.eval()
-            logger.info(f"✅ CLIP模型加载成功！设备: {self.device}")
+            timings['eval'] = time.perf_counter() - phase
+            
+            if self.backend == 'torch-int8':
+                phase = time.perf_counter()
+                self._quantize()
+                timings['quantize'] = time.perf_counter() - phase
+            
+            timings['total'] = time.perf_counter() - started
+            self.load_timings = {k: round(v, 3) for k, v in timings.items()}
+            logger.info(f"✅ CLIP模型加载成功！设备: {self.device}，耗时(秒): {self.load_timings}")
         except Exception as e:
             logger.error(f"加载CLIP模型失败: {e}")
             import traceback
             logger.error(traceback.format_exc())
             raise
     
+    def _quantize(self):
+        """Linear层动态量化为int8（权重int8，激活在运行时量化），只在CPU上有效"""
+        if self.device != 'cpu':
+            logger.warning(f"⚠️ int8动态量化只支持CPU，设备为 {self.device}，继续使用fp32")
+            return
+        logger.info("对Linear层做int8动态量化...")
+        self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+    
+    def _load_onnx_sessions(self, model_name: str):
+        """为当前模式需要的塔创建ONNX Runtime会话"""
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if _num_threads:
+            options.intra_op_num_threads = _num_threads
+        for tower in ENCODER_MODES[self.mode]:
+            path = onnx_model_path(model_name, tower)
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"没有找到ONNX模型 {path}，请先运行 python3 clip_model_tools.py export-onnx")
+            logger.info(f"加载ONNX模型: {path}")
+            self._sessions[tower] = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+    
+    def supports(self, kind: str) -> bool:
+        """当前模式是否支持该编码类型（text / vision）"""
+        return kind in ENCODER_MODES[self.mode]
+    
+    def _require(self, kind: str):
+        if not self.supports(kind):
+            raise RuntimeError(f"编码器模式为 {self.mode}，未加载{'文本' if kind == 'text' else '视觉'}模型（CLIP_ENCODER_MODE）")
+    
+    def pixel_values(self, images) -> np.ndarray:
+        """图片预处理为 (N, 3, H, W) float32；开启快速预处理时不经过CLIPProcessor"""
+        if self.preprocessor is not None:
+            return self.preprocessor(images)
+        return self.processor(images=images, return_tensors="np")['pixel_values'].astype(np.float32)
+    
+    def _image_features(self, images) -> np.ndarray:
+        """图片 -> 归一化向量矩阵（预处理、前向计算、转NumPy分别计时）"""
+        BATCH_SIZE.observe(len(images) if isinstance(images, list) else 1, kind='image')
+        with stage('preprocess', 'image'):
+            pixel_values = self.pixel_values(images)
+        if self.backend == 'onnx':
+            with stage('forward', 'image'):
+                features = self._sessions['vision'].run(None, {'pixel_values': pixel_values})[0]
+            with stage('to_numpy', 'image'):
+                return features / np.linalg.norm(features, axis=-1, keepdims=True)
+        pixel_values = torch.from_numpy(pixel_values).to(self.device)
+        with torch.no_grad():
+            with stage('forward', 'image'):
+                if self.mode == 'both':
+                    features = self.model.get_image_features(pixel_values=pixel_values)
+                else:
+                    features = self.model(pixel_values=pixel_values).image_embeds
+                # 归一化
+                features = features / features.norm(dim=-1, keepdim=True)
+            with stage('to_numpy', 'image'):
+                return features.cpu().numpy()
+    
+    def _text_features(self, texts) -> np.ndarray:
+        """文本 -> 归一化向量矩阵（分词、前向计算、转NumPy分别计时；超过TEXT_MAX_TOKENS个token的文本截断）"""
+        BATCH_SIZE.observe(len(texts) if isinstance(texts, list) else 1, kind='text')
+        if self.backend == 'onnx':
+            with stage('tokenize', 'text'):
+                inputs = self.processor(text=texts, return_tensors="np", padding=True, truncation=True,
+                                        max_length=TEXT_MAX_TOKENS)
+            with stage('forward', 'text'):
+                features = self._sessions['text'].run(None, {
+                    'input_ids': inputs['input_ids'].astype(np.int64),
+                    'attention_mask': inputs['attention_mask'].astype(np.int64)
+                })[0]
+            with stage('to_numpy', 'text'):
+                return features / np.linalg.norm(features, axis=-1, keepdims=True)
+        with stage('tokenize', 'text'):
+            inputs = self.processor(text=texts, return_tensors="pt", padding=True, truncation=True,
+                                    max_length=TEXT_MAX_TOKENS).to(self.device)
+        with torch.no_grad():
+            with stage('forward', 'text'):
+                if self.mode == 'both':
+                    features = self.model.get_text_features(**inputs)
+                else:
+                    features = self.model(**inputs).text_embeds
+                # 归一化
+                features = features / features.norm(dim=-1, keepdim=True)
+            with stage('to_numpy', 'text'):
+                return features.cpu().numpy()
+    
     def encode_image(self, image: Image.Image) -> np.ndarray:
         """将单张图片编码为向量"""
+        self._require('vision')
         try:
-            inputs = self.processor(images=image, return_tensors="pt").to(self.device)
-            with torch.no_grad():
-                image_features = self.model.get_image_features(**inputs)
-                # 归一化
-                image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-                return image_features.cpu().numpy()[0]
+            return self._image_features(image)[0]
         except Exception as e:
             logger.error(f"图片编码失败: {e}")
             return None
     
     def encode_images_batch(self, images: List[Image.Image]) -> np.ndarray:
         """批量编码图片"""
+        self._require('vision')
         try:
-            inputs = self.processor(images=images, return_tensors="pt", padding=True).to(self.device)
-            with torch.no_grad():
-                image_features = self.model.get_image_features(**inputs)
-                # 归一化
-                image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-                return image_features.cpu().numpy()
+            return self._image_features(images)
         except Exception as e:
             logger.error(f"批量图片编码失败: {e}")
             return None
     
     def encode_text(self, text: str) -> np.ndarray:
         """将文本编码为向量"""
+        self._require('text')
         try:
-            inputs = self.processor(text=text, return_tensors="pt", padding=True).to(self.device)
-            with torch.no_grad():
-                text_features = self.model.get_text_features(**inputs)
-                # 归一化
-                text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-                return text_features.cpu().numpy()[0]
+            return self._text_features(text)[0]
         except Exception as e:
             logger.error(f"文本编码失败: {e}")
             return None
     
     def encode_texts_batch(self, texts: List[str]) -> np.ndarray:
         """批量编码文本"""
+        self._require('text')
         try:
-            inputs = self.processor(text=texts, return_tensors="pt", padding=True).to(self.device)
-            with torch.no_grad():
-                text_features = self.model.get_text_features(**inputs)
-                # 归一化
-                text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-                return text_features.cpu().numpy()
+            return self._text_features(texts)
         except Exception as e:
             logger.error(f"批量文本编码失败: {e}")
             return None
@@ -177,11 +404,16 @@ class CLIPEncoder:
 # 全局CLIP编码器实例（延迟初始化）
 _clip_encoder_instance = None
 
-def get_clip_encoder():
-    """获取CLIP编码器实例（单例模式）"""
+def get_clip_encoder(mode: str = None):
+    """
+    获取CLIP编码器实例（单例模式）
+    mode: text / vision / both，默认使用 CLIP_ENCODER_MODE；只做文本或只做图片的脚本传入对应模式即可少加载一个塔
+    """
     global _clip_encoder_instance
     if _clip_encoder_instance is None:
-        _clip_encoder_instance = CLIPEncoder()
+        _clip_encoder_instance = CLIPEncoder(mode)
+    elif mode and not all(_clip_encoder_instance.supports(kind) for kind in ENCODER_MODES[mode]):
+        raise RuntimeError(f"CLIP编码器已按 {_clip_encoder_instance.mode} 模式加载，不能用于 {mode} 模式")
     return _clip_encoder_instance
 
 # 为了向后兼容
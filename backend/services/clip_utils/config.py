@@ -8,15 +8,28 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # 注意：此配置文件仅用于CLIP向量化服务
-# MySQL和COS配置已移除，因为当前项目不需要
+# COS配置已移除，因为当前项目不需要；MySQL配置只有向量增量同步（clip_sync_vectors.py）使用
 
 # Qdrant向量数据库配置
 QDRANT_CONFIG = {
     'host': os.getenv('QDRANT_HOST', 'localhost'),
     'port': int(os.getenv('QDRANT_PORT', 6333)),
     'api_key': os.getenv('QDRANT_API_KEY', None),
-    'collection_name': os.getenv('QDRANT_COLLECTION_NAME', 'car_images')
+    # 与Node端一致：Node读取QDRANT_COLLECTION，这里两者都接受（QDRANT_COLLECTION_NAME优先）
+    'collection_name': os.getenv('QDRANT_COLLECTION_NAME') or os.getenv('QDRANT_COLLECTION', 'car_images')
 }
+# 完整地址（与Node端的QDRANT_URL一致），未设置时由host和port拼接
+QDRANT_CONFIG['url'] = os.getenv('QDRANT_URL') or f"http://{QDRANT_CONFIG['host']}:{QDRANT_CONFIG['port']}"
+
+# MySQL配置（与Node端相同的DB_*环境变量）
+MYSQL_CONFIG = {
+    'host': os.getenv('DB_HOST', 'localhost'),
+    'port': int(os.getenv('DB_PORT', 3306)),
+    'user': os.getenv('DB_USER', 'root'),
+    'password': os.getenv('DB_PASSWORD', ''),
+    'database': os.getenv('DB_NAME', '')
+}
+
 
 # CLIP模型配置
 def _get_device():
@@ -33,8 +46,123 @@ def _get_device():
 
 CLIP_CONFIG = {
     'model_name': os.getenv('CLIP_MODEL', 'openai/clip-vit-base-patch32'),
+    # 显式指定本地模型目录（跳过路径探测）
+    'model_path': os.getenv('CLIP_MODEL_PATH') or None,
+    # 记录探测到的本地模型路径，下次启动不再逐个探测
+    'model_path_cache': os.getenv('CLIP_MODEL_PATH_CACHE', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'model_path.json')),
     'device': _get_device(),
-    'batch_size': int(os.getenv('BATCH_SIZE', 32))
+    # 编码器模式: both（完整CLIPModel）、text（只加载文本塔）、vision（只加载视觉塔）
+    'encoder_mode': os.getenv('CLIP_ENCODER_MODE', 'both').lower(),
+    # 推理后端: torch（fp32，默认）、torch-int8（CPU上Linear层动态量化）、onnx（ONNX Runtime，需先运行 clip_model_tools.py export-onnx）
+    'backend': os.getenv('CLIP_BACKEND', 'torch').lower(),
+    'onnx_dir': os.getenv('CLIP_ONNX_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'onnx')),
+    'batch_size': int(os.getenv('BATCH_SIZE', 32)),
+    # 动态微批处理：把窗口内并发到达的单条请求合并成一次批量前向计算
+    'micro_batching': os.getenv('MICRO_BATCHING', 'true').lower() in ['1', 'true', 'yes'],
+    'batch_window_ms': float(os.getenv('BATCH_WINDOW_MS', 10)),
+    # 启动预热: background（后台加载模型并跑一次前向，默认）、blocking（预热完成后才开始监听）、off（首次请求时加载）
+    'warmup': os.getenv('CLIP_WARMUP', 'background').lower()
+}
+
+# 生产模式（gunicorn pre-fork，见 gunicorn.conf.py）配置
+_workers = max(1, int(os.getenv('CLIP_WORKERS', 1)))
+SERVER_CONFIG = {
+    'workers': _workers,
+    # 每个worker的torch intra-op线程数，默认按CPU核数平分给各worker（workers x 线程数 ≈ 核数）
+    'torch_threads': int(os.getenv('CLIP_TORCH_THREADS', 0)) or max(1, (os.cpu_count() or 1) // _workers),
+    # 每个worker同时处理的请求数（gthread线程），并发请求由微批处理合并
+    'request_threads': int(os.getenv('CLIP_REQUEST_THREADS', 4)),
+    'timeout': int(os.getenv('CLIP_WORKER_TIMEOUT', 120))
+}
+
+# 异步模式（ASGI，见 clip_async_service.py）的准入控制
+ASYNC_CONFIG = {
+    # 每个推理队列（文本/图片）最多排队的条数，超过时返回429
+    'max_queue': int(os.getenv('CLIP_MAX_QUEUE', 256)),
+    # 请求未带截止时间时使用的默认值（毫秒），0表示不设截止时间
+    'default_deadline_ms': float(os.getenv('CLIP_DEFAULT_DEADLINE_MS', 0)),
+    # 下载/读取/解码图片的线程数
+    'io_workers': int(os.getenv('CLIP_IO_WORKERS', 16))
+}
+
+# 文本查询向量缓存配置（LRU + TTL）
+TEXT_CACHE_CONFIG = {
+    'enabled': os.getenv('TEXT_CACHE_ENABLED', 'true').lower() in ['1', 'true', 'yes'],
+    'max_size': int(os.getenv('TEXT_CACHE_SIZE', 10000)),
+    'ttl_seconds': float(os.getenv('TEXT_CACHE_TTL', 86400)),
+    # 持久化文件路径（.npz），留空则只缓存在内存中
+    'persist_path': os.getenv('TEXT_CACHE_FILE') or None
+}
+
+# 图片向量内容寻址存储配置（按图片内容SHA-256 + 模型ID缓存已计算的向量）
+IMAGE_CACHE_CONFIG = {
+    'enabled': os.getenv('IMAGE_CACHE_ENABLED', 'true').lower() in ['1', 'true', 'yes'],
+    'directory': os.getenv('IMAGE_CACHE_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'image_embeddings')),
+    'dtype': os.getenv('IMAGE_CACHE_DTYPE', 'float32')  # float32 或 float16（省一半磁盘）
+}
+
+# 近重复图片检测（image_dedup.py：感知哈希预筛 + 向量余弦相似度，/encode-images 的 dedup 参数与 clip_bulk_vectorize.py --dedup）
+DEDUP_CONFIG = {
+    # 64位dHash的汉明距离不超过该值时直接判为重复（不做前向计算），0表示只认哈希完全相同
+    'hash_distance': int(os.getenv('IMAGE_DEDUP_HASH_DISTANCE', 4)),
+    # 哈希未命中时，编码后的向量与已登记向量的余弦相似度不低于该值判为重复
+    'cosine_threshold': float(os.getenv('IMAGE_DEDUP_COSINE', 0.97)),
+    # 内存中保留的最近登记向量数（更早入库的图片由本地向量索引覆盖）
+    'recent_size': int(os.getenv('IMAGE_DEDUP_RECENT', 20000)),
+    # 是否同时在本地向量索引（VECTOR_INDEX_DIR）中查找
+    'use_index': os.getenv('IMAGE_DEDUP_USE_INDEX', 'true').lower() in ['1', 'true', 'yes'],
+    # 哈希表持久化文件，设为空字符串时只保存在内存中
+    'hash_file': os.getenv('IMAGE_DEDUP_HASH_FILE', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'image_hashes.npz')) or None
+}
+
+# 本地向量索引配置（vector_index.py，由 clip_build_index.py 从导出的向量构建，/search 使用）
+INDEX_CONFIG = {
+    'directory': os.getenv('VECTOR_INDEX_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'vector_index')),
+    # 支持过滤的payload字段（构建时存为列，过滤时整列向量化比较）
+    'filter_fields': [f.strip() for f in os.getenv('VECTOR_INDEX_FILTER_FIELDS', 'brand_id,model_id').split(',') if f.strip()],
+    # 向量数不超过该值时精确搜索（矩阵乘 + argpartition），超过时构建并使用IVF近似索引
+    'ann_threshold': int(os.getenv('VECTOR_INDEX_ANN_THRESHOLD', 50000)),
+    # IVF搜索时扫描的倒排列表数，越大召回率越高、越慢
+    'nprobe': int(os.getenv('VECTOR_INDEX_NPROBE', 32)),
+    # 压缩方式（vector_compression.py）: none | float16 | int8 | pq，压缩后先扫描压缩码粗排，再用原始向量精排
+    'compression': os.getenv('VECTOR_INDEX_COMPRESSION', 'none').lower(),
+    # PQ分段数（每条向量的字节数），64为32倍压缩，128为16倍
+    'pq_subspaces': int(os.getenv('VECTOR_INDEX_PQ_SUBSPACES', 64)),
+    # 精排候选数 = top-k x 该倍数
+    'rerank_factor': int(os.getenv('VECTOR_INDEX_RERANK_FACTOR', 8))
+}
+
+# 文本搜索（/search-text：编码查询并直接搜索，结果不经Node转发向量）
+SEARCH_CONFIG = {
+    # 搜索后端: qdrant（QDRANT_CONFIG配置的集合）、local（本地向量索引）、auto（本地索引已构建时用local，否则qdrant）
+    'backend': os.getenv('CLIP_SEARCH_BACKEND', 'qdrant').lower(),
+    'qdrant_timeout': float(os.getenv('CLIP_SEARCH_QDRANT_TIMEOUT', 10)),
+    'qdrant_retries': int(os.getenv('CLIP_SEARCH_QDRANT_RETRIES', 1)),
+    # 单次请求最多返回的结果数（limit上限）
+    'max_limit': int(os.getenv('CLIP_SEARCH_MAX_LIMIT', 1000))
+}
+
+# 零样本打标签（zero_shot.py，/tag-images 与 clip_tag_images.py）
+TAGGING_CONFIG = {
+    # 标签词表（分组 -> 标签 -> 提示词），修改后自动重新计算标签矩阵
+    'vocabulary': os.getenv('CLIP_TAG_VOCABULARY', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tag_vocabulary.json')),
+    # 标签矩阵缓存目录（按词表内容 + 模型名的摘要命名）
+    'cache_dir': os.getenv('CLIP_TAG_CACHE_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'labels')),
+    # 相似度乘以该系数后做softmax（CLIP训练得到的logit_scale约为100）
+    'logit_scale': float(os.getenv('CLIP_TAG_LOGIT_SCALE', 100)),
+    # 低于该置信度的标签不返回
+    'min_confidence': float(os.getenv('CLIP_TAG_MIN_CONFIDENCE', 0))
+}
+
+# 服务指标（/metrics，Prometheus文本格式）与分阶段耗时
+METRICS_CONFIG = {
+    'enabled': os.getenv('CLIP_METRICS', 'true').lower() in ['1', 'true', 'yes'],
+    # 允许客户端带 X-Debug-Timing: 1 请求头，在响应的 Server-Timing 头中获取该请求各阶段的耗时
+    'debug_timing': os.getenv('CLIP_DEBUG_TIMING', 'true').lower() in ['1', 'true', 'yes'],
+    # pre-fork模式下各worker写指标快照的共享目录，/metrics 返回所有worker的汇总（同一台机器上的多个服务实例需各用一个目录）
+    'multiprocess_dir': os.getenv('CLIP_METRICS_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'metrics')),
+    # worker写快照的间隔（秒），其他worker的指标最多滞后这么久
+    'multiprocess_interval': float(os.getenv('CLIP_METRICS_INTERVAL', 5))
 }
 
 # 向量维度（CLIP ViT-B/32 是 512 维）
@@ -43,6 +171,42 @@ VECTOR_DIMENSION = 512
 # 图片处理配置
 IMAGE_CONFIG = {
     'max_size': (224, 224),  # CLIP输入尺寸
-    'supported_formats': ['.jpg', '.jpeg', '.png', '.webp']
+    'supported_formats': ['.jpg', '.jpeg', '.png', '.webp'],
+    # 快速预处理：缩放+中心裁剪合并、整批NumPy归一化（image_preprocess.py），关闭时使用CLIPProcessor
+    'fast_preprocess': os.getenv('IMAGE_FAST_PREPROCESS', 'true').lower() in ['1', 'true', 'yes'],
+    # JPEG draft解码的目标尺寸倍数：解码时缩小到不小于 max_size x 该倍数（0表示全分辨率解码）
+    'draft_factor': float(os.getenv('IMAGE_DRAFT_FACTOR', 2))
+}
+
+
+# 图片URL下载配置（image_fetcher.py：按主机复用连接池、流式读取、条件请求缓存）
+FETCH_CONFIG = {
+    # 每个主机（COS/CDN域名）保持的连接数，应不小于并发下载数
+    'pool_size': int(os.getenv('IMAGE_FETCH_POOL_SIZE', 32)),
+    # 批量下载（fetch_many）的并发数
+    'concurrency': int(os.getenv('IMAGE_FETCH_CONCURRENCY', 16)),
+    'connect_timeout': float(os.getenv('IMAGE_FETCH_CONNECT_TIMEOUT', 3)),
+    'read_timeout': float(os.getenv('IMAGE_FETCH_READ_TIMEOUT', 10)),
+    # 单张图片最大字节数，超过时中止下载
+    'max_bytes': int(os.getenv('IMAGE_FETCH_MAX_BYTES', 20 * 1024 * 1024)),
+    # 网络错误、429和5xx的重试次数（指数退避 + 抖动）
+    'max_retries': int(os.getenv('IMAGE_FETCH_RETRIES', 3)),
+    # 条件请求缓存目录（按ETag/Last-Modified重新验证，304时直接用本地内容），设为空字符串关闭
+    'cache_dir': os.getenv('IMAGE_FETCH_CACHE_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'http')),
+    # 缓存目录容量上限（MB），超过时删除最久未使用的条目
+    'cache_max_mb': float(os.getenv('IMAGE_FETCH_CACHE_MAX_MB', 1024))
 }
 
+# MySQL -> Qdrant 增量同步（clip_sync_vectors.py）
+VECTOR_SYNC_CONFIG = {
+    # 数据库地址，默认使用MYSQL_CONFIG；也可以是 mysql://用户:密码@主机:端口/库名 或 sqlite:///路径（本地测试用）
+    'database_url': os.getenv('VECTOR_SYNC_DATABASE_URL', ''),
+    # 水位线（各表已同步到的updatedAt/id）和待重试ID的保存位置
+    'state_file': os.getenv('VECTOR_SYNC_STATE_FILE', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'vector_sync_state.json')),
+    # 每页处理的行数（每页一次查询、一次Qdrant读取和最多各一次upsert/payload更新）
+    'page_size': int(os.getenv('VECTOR_SYNC_PAGE_SIZE', 256)),
+    # 每次从水位线往前回退的秒数：重新检查这段时间内的行，避免漏掉提交较晚的事务（未变化的行不会写入）
+    'overlap_seconds': int(os.getenv('VECTOR_SYNC_OVERLAP', 300)),
+    # 下载/解码线程数
+    'workers': int(os.getenv('VECTOR_SYNC_WORKERS', 8))
+}
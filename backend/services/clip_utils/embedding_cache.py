@@ -0,0 +1,159 @@
+"""
+文本向量缓存模块
+热门搜索词（"SUV"、"红色跑车"、品牌名等）反复请求时直接返回已计算的向量
+LRU + TTL 淘汰，可选持久化到磁盘文件以便重启后保留
+"""
+import os
+import re
+import time
+import atexit
+import threading
+import unicodedata
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """规范化查询文本：全角转半角、统一小写、合并空白"""
+    text = unicodedata.normalize('NFKC', text)
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+
+class EmbeddingCache:
+    """线程安全的 LRU + TTL 向量缓存"""
+
+    def __init__(self, model_name: str, max_size: int = 10000, ttl_seconds: float = 86400,
+                 persist_path: Optional[str] = None, persist_interval: float = 300):
+        """
+        Args:
+            model_name: 模型名称（可带推理后端，如 name@torch-int8），作为缓存键的一部分，换模型或后端后旧向量自动失效
+            max_size: 最多缓存的条目数
+            ttl_seconds: 条目有效期（秒），<=0 表示不过期
+            persist_path: 持久化文件路径（.npz），None 表示不持久化
+            persist_interval: 有新条目时最短的自动保存间隔（秒）
+        """
+        self.model_name = model_name
+        self.max_size = max(1, int(max_size))
+        self.ttl = float(ttl_seconds)
+        self.persist_path = persist_path
+        self.persist_interval = persist_interval
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._last_saved = time.time()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+        if self.persist_path:
+            self.load()
+            atexit.register(self.save)
+
+    def _key(self, text: str) -> str:
+        return f"{self.model_name}\t{normalize_text(text)}"
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        """查询缓存，未命中或已过期返回None"""
+        key = self._key(text)
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            vector, expires_at = entry
+            if expires_at is not None and expires_at <= now:
+                del self._data[key]
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._data.move_to_end(key)
+            self._stats['hits'] += 1
+            return vector
+
+    def put(self, text: str, vector: np.ndarray, expires_at: Optional[float] = None):
+        """写入缓存，超过容量时淘汰最久未使用的条目"""
+        if vector is None:
+            return
+        key = self._key(text)
+        if expires_at is None and self.ttl > 0:
+            expires_at = time.time() + self.ttl
+        with self._lock:
+            self._data[key] = (np.asarray(vector, dtype=np.float32), expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self._stats['evictions'] += 1
+            self._dirty = True
+
+        if self.persist_path and time.time() - self._last_saved >= self.persist_interval:
+            self.save()
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._data.clear()
+            self._dirty = True
+
+    def stats(self) -> dict:
+        """命中率等统计"""
+        with self._lock:
+            stats = dict(self._stats)
+            size = len(self._data)
+        lookups = stats['hits'] + stats['misses']
+        stats.update({
+            'size': size,
+            'max_size': self.max_size,
+            'ttl_seconds': self.ttl,
+            'hit_rate': round(stats['hits'] / lookups, 4) if lookups else 0.0,
+            'persist_path': self.persist_path
+        })
+        return stats
+
+    def save(self):
+        """持久化到磁盘（先写临时文件再替换，避免中途退出留下损坏文件）"""
+        if not self.persist_path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            keys = list(self._data.keys())
+            entries = list(self._data.values())
+            self._dirty = False
+            self._last_saved = time.time()
+        try:
+            vectors = np.stack([v for v, _ in entries]) if entries else np.zeros((0, 0), dtype=np.float32)
+            expires = np.array([e if e is not None else np.inf for _, e in entries], dtype=np.float64)
+            tmp_path = f"{self.persist_path}.{os.getpid()}.tmp"  # 多个worker进程可能同时保存
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, keys=np.array(keys, dtype=str), vectors=vectors, expires=expires)
+            os.replace(tmp_path, self.persist_path)
+            logger.info(f"💾 文本向量缓存已保存: {len(keys)} 条 -> {self.persist_path}")
+        except Exception as e:
+            logger.warning(f"保存文本向量缓存失败: {e}")
+
+    def load(self):
+        """从磁盘加载未过期的条目"""
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+        try:
+            with np.load(self.persist_path, allow_pickle=False) as data:
+                keys, vectors, expires = data['keys'], data['vectors'], data['expires']
+            now = time.time()
+            prefix = f"{self.model_name}\t"
+            loaded = 0
+            with self._lock:
+                for key, vector, expires_at in zip(keys, vectors, expires):
+                    key = str(key)
+                    if not key.startswith(prefix) or expires_at <= now:
+                        continue
+                    self._data[key] = (vector, None if np.isinf(expires_at) else float(expires_at))
+                    loaded += 1
+                while len(self._data) > self.max_size:
+                    self._data.popitem(last=False)
+            logger.info(f"✅ 已加载文本向量缓存: {loaded} 条 <- {self.persist_path}")
+        except Exception as e:
+            logger.warning(f"加载文本向量缓存失败，将使用空缓存: {e}")
@@ -0,0 +1,175 @@
+"""
+图片目录（MySQL的images/models/brands表）只读访问，供向量增量同步（clip_sync_vectors.py）使用
+变化的行按 (updatedAt, id) 键集分页读取，删除的行从触发器写入的 image_deletions 表按自增id读取
+（索引、删除记录表和触发器见 backend/migrations/add_image_vector_sync.sql，建好索引后每页是一次索引范围查询）
+本地测试可以用结构相同的SQLite文件代替MySQL（sqlite:///路径），两者使用同一套SQL
+"""
+import sqlite3
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set
+from urllib.parse import urlparse, unquote
+
+from config import MYSQL_CONFIG
+
+logger = logging.getLogger(__name__)
+
+_IMAGE_COLUMNS = ('i.id, i.url, i.title, i.description, i.category, i.modelId, i.uploadDate, i.updatedAt, '
+                  'm.name, b.id, b.name, b.chineseName')
+_IMAGE_FIELDS = ('id', 'url', 'title', 'description', 'category', 'model_id', 'upload_date', 'updated_at',
+                 'model_name', 'brand_id', 'brand_name', 'brand_chinese_name')
+_IMAGE_FROM = 'images i LEFT JOIN models m ON m.id = i.modelId LEFT JOIN brands b ON b.id = m.brandId'
+
+
+def format_timestamp(value) -> Optional[str]:
+    """数据库时间值转为可保存、可再作为查询参数的字符串（MySQL返回datetime，SQLite返回原字符串）"""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    return str(value)
+
+
+def shift_timestamp(value: str, seconds: int) -> str:
+    """把保存的时间往前回退seconds秒；无法解析时原样返回（不回退）"""
+    try:
+        return (datetime.fromisoformat(value) - timedelta(seconds=seconds)).isoformat(sep=' ')
+    except ValueError:
+        logger.warning(f"无法解析时间 {value!r}，不做回退")
+        return value
+
+
+def _iso_utc(value) -> Optional[str]:
+    """与Node端 Date.toISOString() 相同的格式（毫秒 + Z），避免同一时间因格式不同被当作payload变化"""
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        try:
+            value = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        except ValueError:
+            return str(value)
+    if value.utcoffset() is not None:
+        value = (value - value.utcoffset()).replace(tzinfo=None)
+    return value.strftime('%Y-%m-%dT%H:%M:%S.') + f"{value.microsecond // 1000:03d}Z"
+
+
+def image_payload(row: Dict) -> Dict:
+    """图片行对应的point payload（字段与Node端 autoVectorizeService 写入的一致，另加 image_url 用于判断图片是否更换）"""
+    return {
+        'image_id': row['id'],
+        'image_url': row['url'] or '',
+        'title': row['title'] or '',
+        'description': row['description'] or '',
+        'category': row['category'] or '',
+        'model_id': row['model_id'],
+        'model_name': row['model_name'] or '',
+        'brand_id': row['brand_id'],
+        'brand_name': row['brand_name'] or '',
+        'brand_chinese_name': row['brand_chinese_name'] or '',
+        'upload_date': _iso_utc(row['upload_date'])
+    }
+
+
+class ImageCatalog:
+    """images/models/brands三张表的查询（SQL统一用%s占位符，SQLite执行时替换为?）"""
+
+    def __init__(self, connection, dialect: str):
+        self.connection = connection
+        self.dialect = dialect
+
+    @classmethod
+    def connect(cls, url: Optional[str] = None) -> 'ImageCatalog':
+        """
+        连接数据库: sqlite:///路径、mysql://用户:密码@主机:端口/库名，为空时使用MYSQL_CONFIG
+        MySQL需要安装pymysql（可选依赖）
+        """
+        if url and url.startswith('sqlite:///'):
+            return cls(sqlite3.connect(url[len('sqlite:///'):]), 'sqlite')
+
+        options = dict(MYSQL_CONFIG)
+        if url:
+            parsed = urlparse(url)
+            if parsed.scheme not in ['mysql', 'mysql+pymysql']:
+                raise ValueError(f"不支持的数据库地址: {url}（应为 mysql://... 或 sqlite:///...）")
+            options.update({
+                'host': parsed.hostname or options['host'],
+                'port': parsed.port or options['port'],
+                'user': unquote(parsed.username) if parsed.username else options['user'],
+                'password': unquote(parsed.password) if parsed.password else options['password'],
+                'database': parsed.path.lstrip('/') or options['database']
+            })
+        try:
+            import pymysql
+        except ImportError:
+            raise RuntimeError('连接MySQL需要安装pymysql: pip install pymysql')
+        # autocommit: 每次查询都读取最新提交的数据，而不是同一个事务快照
+        connection = pymysql.connect(charset='utf8mb4', autocommit=True, **options)
+        return cls(connection, 'mysql')
+
+    def _query(self, sql: str, params: Iterable = ()) -> List[tuple]:
+        if self.dialect == 'sqlite':
+            sql = sql.replace('%s', '?')
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(sql, tuple(params))
+            return list(cursor.fetchall())
+        finally:
+            cursor.close()
+
+    def _image_rows(self, where: str, params: Iterable, order: str, limit: Optional[int] = None) -> List[Dict]:
+        sql = f"SELECT {_IMAGE_COLUMNS} FROM {_IMAGE_FROM} WHERE {where} ORDER BY {order}"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return [dict(zip(_IMAGE_FIELDS, row)) for row in self._query(sql, params)]
+
+    def changed_images(self, since: Optional[str], after_id: int, limit: int) -> List[Dict]:
+        """updatedAt在 (since, after_id) 之后的一页图片（按updatedAt, id升序，NULL在最前），since为None时从头开始"""
+        if since is None:
+            return self._image_rows('(i.updatedAt IS NULL AND i.id > %s) OR i.updatedAt IS NOT NULL',
+                                    [after_id], 'i.updatedAt, i.id', limit)
+        return self._image_rows('i.updatedAt > %s OR (i.updatedAt = %s AND i.id > %s)',
+                                [since, since, after_id], 'i.updatedAt, i.id', limit)
+
+    def images_by_models(self, model_ids: List[int], after_id: int, limit: int) -> List[Dict]:
+        """属于这些车型的一页图片（按id升序）"""
+        marks = ', '.join(['%s'] * len(model_ids))
+        return self._image_rows(f"i.modelId IN ({marks}) AND i.id > %s", [*model_ids, after_id], 'i.id', limit)
+
+    def images_by_ids(self, ids: List[int]) -> List[Dict]:
+        marks = ', '.join(['%s'] * len(ids))
+        return self._image_rows(f"i.id IN ({marks})", ids, 'i.id')
+
+    def existing_ids(self, ids: List[int]) -> Set[int]:
+        """这些图片ID中仍存在于images表的部分"""
+        if not ids:
+            return set()
+        marks = ', '.join(['%s'] * len(ids))
+        return {row[0] for row in self._query(f"SELECT id FROM images WHERE id IN ({marks})", ids)}
+
+    def has_table(self, table: str) -> bool:
+        if self.dialect == 'sqlite':
+            return bool(self._query("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [table]))
+        return bool(self._query('SELECT 1 FROM information_schema.tables WHERE table_schema = DATABASE() '
+                                'AND table_name = %s', [table]))
+
+    def deleted_images(self, after_id: int, limit: int) -> List[tuple]:
+        """image_deletions表中自增id大于after_id的一页删除记录 (记录id, 图片id)"""
+        return self._query(f"SELECT id, imageId FROM image_deletions WHERE id > %s ORDER BY id LIMIT {int(limit)}",
+                           [after_id])
+
+    def changed_rows(self, table: str, since: Optional[str]) -> List[tuple]:
+        """models或brands表中updatedAt晚于since的 (id, updatedAt)"""
+        if table not in ['models', 'brands']:
+            raise ValueError(f"未知的表: {table}")
+        if since is None:
+            return self._query(f"SELECT id, updatedAt FROM {table}")
+        return self._query(f"SELECT id, updatedAt FROM {table} WHERE updatedAt > %s", [since])
+
+    def model_ids_for_brands(self, brand_ids: List[int]) -> List[int]:
+        if not brand_ids:
+            return []
+        marks = ', '.join(['%s'] * len(brand_ids))
+        return [row[0] for row in self._query(f"SELECT id FROM models WHERE brandId IN ({marks})", brand_ids)]
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,312 @@
+"""
+近重复图片检测模块
+入库前两级检查，命中时报告"是哪张图片（image_id）的重复"，由调用方决定跳过或关联：
+  1. 感知哈希（dHash，64位）：解码时顺带计算，与已登记图片的哈希比较汉明距离，距离不超过阈值直接判为重复，不做前向计算
+  2. 向量余弦相似度：哈希未命中的图片编码后，与最近登记的向量（内存环形缓冲）和本地向量索引中的向量比较
+哈希表可持久化到磁盘（多个进程保存时合并），向量不单独保存（已入库的向量由本地向量索引提供）
+一批图片的两级检查由 DedupBatch 完成（服务的 /encode-images 和 clip_bulk_vectorize.py 共用），
+通过检查的图片在写入成功后才调用 register() 登记，写入失败的图片不会让之后的重新提交被误判为重复
+"""
+import os
+import json
+import time
+import atexit
+import threading
+import logging
+from typing import Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from config import DEDUP_CONFIG
+
+logger = logging.getLogger(__name__)
+
+HASH_INFO_KEY = 'dhash'
+
+# 每个字节的置位数，用于按字节查表计算汉明距离（兼容没有np.bitwise_count的NumPy版本）
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# 纯色、大面积留白等缺少细节的图片哈希几乎全为0（或全为1），互相之间不能说明是重复，这类哈希不参与比较
+MIN_HASH_BITS = 4
+
+
+def dhash(image: Image.Image, size: int = 8) -> int:
+    """差值哈希：缩小为 (size+1) x size 的灰度图，比较每行相邻像素的明暗，得到 size*size 位整数"""
+    small = image.convert('L').resize((size + 1, size), Image.BILINEAR)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = np.packbits((pixels[:, 1:] > pixels[:, :-1]).ravel())
+    return int.from_bytes(bits.tobytes(), 'big')
+
+
+def perceptual_hash(image: Image.Image) -> int:
+    """图片的感知哈希：优先使用解码时已计算的值（image.info），否则现算并记下"""
+    value = image.info.get(HASH_INFO_KEY)
+    if value is None:
+        value = image.info[HASH_INFO_KEY] = dhash(image)
+    return value
+
+
+def is_informative(value: int) -> bool:
+    """哈希中0和1都不少于MIN_HASH_BITS位时才用于近重复判断"""
+    return MIN_HASH_BITS <= bin(value).count('1') <= 64 - MIN_HASH_BITS
+
+
+def hamming_distances(hashes: np.ndarray, value: int) -> np.ndarray:
+    """一组64位哈希与value的汉明距离（整列异或后按字节查表求和）"""
+    diff = np.bitwise_xor(hashes, np.uint64(value))
+    return _POPCOUNT[diff.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class DuplicateDetector:
+    """线程安全的近重复检测：感知哈希表 + 最近向量的环形缓冲 + 本地向量索引"""
+
+    def __init__(self, hash_distance: int = 4, cosine_threshold: float = 0.97, recent_size: int = 20000,
+                 use_index: bool = True, persist_path: Optional[str] = None, persist_interval: float = 300):
+        """
+        Args:
+            hash_distance: 汉明距离不超过该值时判为重复（64位dHash，0表示只认哈希完全相同）
+            cosine_threshold: 向量余弦相似度不低于该值时判为重复
+            recent_size: 内存中保留的最近登记向量数
+            use_index: 是否同时在本地向量索引（已入库的图片）中查找
+            persist_path: 哈希表持久化文件（.npz），None 表示只保存在内存中
+            persist_interval: 有新条目时最短的自动保存间隔（秒）
+        """
+        self.hash_distance = int(hash_distance)
+        self.cosine_threshold = float(cosine_threshold)
+        self.recent_size = max(1, int(recent_size))
+        self.use_index = use_index
+        self.persist_path = persist_path
+        self.persist_interval = persist_interval
+        self._lock = threading.Lock()
+        # 哈希表：按行存放，同一image_id再次登记时覆盖原行
+        self._hash_ids = []
+        self._hash_rows = {}
+        self._hashes = np.zeros(1024, dtype=np.uint64)
+        # 最近向量的环形缓冲（首次登记向量时按维度分配）
+        self._recent = None
+        self._recent_ids = [None] * self.recent_size
+        self._recent_next = 0
+        self._recent_count = 0
+        self._dirty = False
+        self._last_saved = time.time()
+        self._stats = {'hash_checks': 0, 'vector_checks': 0, 'hash_duplicates': 0, 'cosine_duplicates': 0}
+
+        if self.persist_path:
+            self.load()
+            atexit.register(self.save)
+
+    def _add_hash_locked(self, image_id, value: int):
+        row = self._hash_rows.get(image_id)
+        if row is None:
+            row = len(self._hash_ids)
+            if row >= len(self._hashes):
+                self._hashes = np.concatenate([self._hashes, np.zeros(len(self._hashes), dtype=np.uint64)])
+            self._hash_ids.append(image_id)
+            self._hash_rows[image_id] = row
+        self._hashes[row] = np.uint64(value)
+        self._dirty = True
+
+    def match_hash(self, value: int, image_id=None) -> Optional[Dict]:
+        """按感知哈希查找已登记的近重复图片（忽略同一image_id），未命中或哈希缺少细节时返回None"""
+        if not is_informative(value):
+            return None
+        with self._lock:
+            self._stats['hash_checks'] += 1
+            count = len(self._hash_ids)
+            if count == 0:
+                return None
+            distances = hamming_distances(self._hashes[:count], value)
+            if image_id is not None and image_id in self._hash_rows:
+                # 同一张图片重新提交时不算重复
+                distances[self._hash_rows[image_id]] = self.hash_distance + 1
+            row = int(np.argmin(distances))
+            if distances[row] > self.hash_distance:
+                return None
+            self._stats['hash_duplicates'] += 1
+            return {'duplicate_of': self._hash_ids[row], 'method': 'phash', 'distance': int(distances[row])}
+
+    def match_vector(self, vector, image_id=None) -> Optional[Dict]:
+        """按向量余弦相似度在最近登记的向量和本地向量索引中查找近重复图片，未命中返回None"""
+        vector = np.asarray(vector, dtype=np.float32)
+        vector = vector / max(float(np.linalg.norm(vector)), 1e-12)
+        best = None
+        with self._lock:
+            self._stats['vector_checks'] += 1
+            if self._recent is not None and self._recent_count and len(vector) == self._recent.shape[1]:
+                scores = self._recent[:self._recent_count] @ vector
+                for row in np.flatnonzero(scores >= self.cosine_threshold):
+                    if self._recent_ids[row] != image_id and (best is None or scores[row] > best['score']):
+                        best = {'duplicate_of': self._recent_ids[row], 'method': 'cosine',
+                                'score': round(float(scores[row]), 4)}
+        if self.use_index:
+            from vector_index import get_vector_index
+            index = get_vector_index()
+            if index is not None and index.matrix.shape[1] == len(vector):
+                results, _ = index.search(vector, limit=2, score_threshold=self.cosine_threshold)
+                for result in results:
+                    if result['id'] != image_id and (best is None or result['score'] > best['score']):
+                        best = {'duplicate_of': result['id'], 'method': 'cosine', 'score': round(result['score'], 4)}
+                        break
+        if best is not None:
+            with self._lock:
+                self._stats['cosine_duplicates'] += 1
+        return best
+
+    def add(self, image_id, phash: Optional[int] = None, vector=None):
+        """登记一张非重复图片（哈希和向量可以分别登记）"""
+        if phash is not None and is_informative(phash):
+            with self._lock:
+                self._add_hash_locked(image_id, phash)
+        if vector is not None:
+            vector = np.asarray(vector, dtype=np.float32)
+            vector = vector / max(float(np.linalg.norm(vector)), 1e-12)
+            with self._lock:
+                if self._recent is None or self._recent.shape[1] != len(vector):
+                    self._recent = np.zeros((self.recent_size, len(vector)), dtype=np.float32)
+                    self._recent_next = self._recent_count = 0
+                self._recent[self._recent_next] = vector
+                self._recent_ids[self._recent_next] = image_id
+                self._recent_next = (self._recent_next + 1) % self.recent_size
+                self._recent_count = min(self._recent_count + 1, self.recent_size)
+
+        if phash is not None and self.persist_path and time.time() - self._last_saved >= self.persist_interval:
+            self.save()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._stats,
+                'hashes': len(self._hash_ids),
+                'recent_vectors': self._recent_count,
+                'hash_distance': self.hash_distance,
+                'cosine_threshold': self.cosine_threshold,
+                'persist_path': self.persist_path
+            }
+
+    def _read_file(self):
+        with np.load(self.persist_path) as data:
+            return json.loads(str(data['ids'])), data['hashes']
+
+    def save(self):
+        """持久化哈希表（先与磁盘上其他进程保存的条目合并，再写临时文件替换）"""
+        if not self.persist_path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            ids = list(self._hash_ids)
+            hashes = self._hashes[:len(ids)].copy()
+            self._dirty = False
+            self._last_saved = time.time()
+        try:
+            if os.path.exists(self.persist_path):
+                known = set(ids)
+                saved_ids, saved_hashes = self._read_file()
+                extra = [row for row, image_id in enumerate(saved_ids) if image_id not in known]
+                ids += [saved_ids[row] for row in extra]
+                hashes = np.concatenate([hashes, saved_hashes[extra]])
+            os.makedirs(os.path.dirname(os.path.abspath(self.persist_path)), exist_ok=True)
+            tmp_path = f"{self.persist_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, ids=np.array(json.dumps(ids)), hashes=hashes)
+            os.replace(tmp_path, self.persist_path)
+            logger.info(f"💾 图片哈希表已保存: {len(ids)} 条 -> {self.persist_path}")
+        except Exception as e:
+            logger.warning(f"保存图片哈希表失败: {e}")
+
+    def load(self):
+        """从磁盘加载哈希表"""
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+        try:
+            ids, hashes = self._read_file()
+            with self._lock:
+                for image_id, value in zip(ids, hashes.tolist()):
+                    self._add_hash_locked(image_id, value)
+                self._dirty = False
+            logger.info(f"✅ 已加载图片哈希表: {len(ids)} 条")
+        except Exception as e:
+            logger.warning(f"加载图片哈希表失败，将从空表开始: {e}")
+
+
+class DedupBatch:
+    """
+    一批待入库图片的两级近重复检查，image_ids与图片一一对应（按下标引用）
+    filter_hashes() 在编码前剔除感知哈希命中的图片，check_vectors() 在编码后按余弦相似度标记重复，
+    两级都会与已登记的图片和本批中靠前的图片比较；结果在duplicates中: {下标: {duplicate_of, method, ...}}
+    """
+
+    def __init__(self, detector: DuplicateDetector, image_ids: List):
+        self.detector = detector
+        self.image_ids = list(image_ids)
+        self.duplicates = {}
+        self.hashes = {}
+        self.vectors = {}
+        # 本批内部的比较不经过（也不写入）检测器
+        self._batch = DuplicateDetector(hash_distance=detector.hash_distance,
+                                        cosine_threshold=detector.cosine_threshold,
+                                        recent_size=len(self.image_ids), use_index=False)
+
+    def filter_hashes(self, hashes: Dict[int, int]) -> List[int]:
+        """hashes为 {下标: 感知哈希}，命中的写入duplicates，返回未命中（需要编码）的下标"""
+        kept = []
+        for index, value in hashes.items():
+            image_id = self.image_ids[index]
+            match = self.detector.match_hash(value, image_id) or self._batch.match_hash(value, image_id)
+            if match is not None:
+                self.duplicates[index] = match
+            else:
+                self._batch.add(image_id, phash=value)
+                self.hashes[index] = value
+                kept.append(index)
+        return kept
+
+    def check_vectors(self, vectors: List) -> Dict[int, Dict]:
+        """按顺序检查已编码的向量（None跳过），余弦相似度命中的写入duplicates（向量仍然有效），返回duplicates"""
+        for index, vector in enumerate(vectors):
+            if vector is None or index in self.duplicates:
+                continue
+            image_id = self.image_ids[index]
+            match = self.detector.match_vector(vector, image_id) or self._batch.match_vector(vector, image_id)
+            if match is not None:
+                self.duplicates[index] = match
+            else:
+                self._batch.add(image_id, vector=vector)
+                self.vectors[index] = vector
+        return self.duplicates
+
+    def accepted(self) -> List[int]:
+        """通过两级检查的下标"""
+        return sorted(self.vectors)
+
+    def register(self, indices: Optional[List[int]] = None):
+        """把通过检查的图片（感知哈希和向量）登记到检测器；indices为写入成功的下标，默认全部"""
+        for index in self.accepted() if indices is None else indices:
+            if index in self.vectors:
+                self.detector.add(self.image_ids[index], self.hashes.get(index), self.vectors[index])
+
+
+# 全局检测器实例（延迟初始化）
+_detector_instance = None
+_detector_lock = threading.Lock()
+
+
+def get_duplicate_detector() -> DuplicateDetector:
+    """获取近重复检测器（单例模式）"""
+    global _detector_instance
+    with _detector_lock:
+        if _detector_instance is None:
+            _detector_instance = DuplicateDetector(
+                hash_distance=DEDUP_CONFIG['hash_distance'],
+                cosine_threshold=DEDUP_CONFIG['cosine_threshold'],
+                recent_size=DEDUP_CONFIG['recent_size'],
+                use_index=DEDUP_CONFIG['use_index'],
+                persist_path=DEDUP_CONFIG['hash_file']
+            )
+    return _detector_instance
+
+
+def detector_stats() -> Optional[dict]:
+    """已创建的检测器统计（未使用过时返回None）"""
+    return _detector_instance.stats() if _detector_instance is not None else None
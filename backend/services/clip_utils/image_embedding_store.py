@@ -0,0 +1,214 @@
+"""
+图片向量内容寻址存储
+以图片字节的SHA-256 + 模型ID + 推理后端 + 预处理路径为键，把已经计算过的图片向量保存在本地磁盘
+向量文件是定长行的float32/float16矩阵，通过内存映射读取；键文件是定长32字节摘要，启动时一次性载入
+重新爬取、重复上传同一COS对象、批量回填时，相同内容的图片不再经过模型
+"""
+import os
+import re
+import json
+import fcntl
+import hashlib
+import threading
+import logging
+from typing import List, Optional
+
+import numpy as np
+
+from config import CLIP_CONFIG, IMAGE_CACHE_CONFIG, VECTOR_DIMENSION
+from clip_encoder import backend_id
+from image_loader import preprocess_id
+
+logger = logging.getLogger(__name__)
+
+DIGEST_SIZE = 32
+
+
+def content_digest(data: bytes) -> bytes:
+    """计算图片内容摘要（SHA-256）"""
+    return hashlib.sha256(data).digest()
+
+
+class ImageEmbeddingStore:
+    """
+    追加写入的向量存储（可被多个进程共享）
+
+    目录结构: <directory>/<模型ID>-<推理后端>-<预处理路径>-<dtype>/（未指定的部分省略）
+        keys.bin     每行32字节摘要
+        vectors.bin  每行 dimension 个 float32/float16
+        meta.json    模型、推理后端、预处理路径、维度、数据类型说明
+    """
+
+    def __init__(self, directory: str, model_id: str, dimension: int = VECTOR_DIMENSION,
+                 dtype: str = 'float32', preprocess: str = '', backend: str = ''):
+        if dtype not in ('float32', 'float16'):
+            raise ValueError(f"不支持的存储类型: {dtype}")
+        self.model_id = model_id
+        self.preprocess = preprocess
+        self.backend = backend
+        self.dimension = dimension
+        self.dtype = np.dtype(dtype)
+        self.row_bytes = self.dimension * self.dtype.itemsize
+        slug = re.sub(r'[^A-Za-z0-9._-]+', '_', model_id).strip('_')
+        self.path = os.path.join(directory, '-'.join(part for part in (slug, backend, preprocess, dtype) if part))
+        os.makedirs(self.path, exist_ok=True)
+
+        self.keys_path = os.path.join(self.path, 'keys.bin')
+        self.vectors_path = os.path.join(self.path, 'vectors.bin')
+        self.lock_path = os.path.join(self.path, '.lock')
+        meta_path = os.path.join(self.path, 'meta.json')
+        if not os.path.exists(meta_path):
+            with open(meta_path, 'w') as f:
+                json.dump({'model_id': model_id, 'backend': backend, 'preprocess': preprocess, 'dimension': dimension, 'dtype': dtype}, f)
+
+        self._lock = threading.Lock()
+        self._index = {}
+        self._rows = 0
+        self._mmap = None
+        self._stats = {'hits': 0, 'misses': 0, 'writes': 0}
+
+        with self._file_lock():
+            self._repair()
+            self._refresh()
+        logger.info(f"✅ 图片向量存储已打开: {self.path}（{self._rows} 条）")
+
+    def _file_lock(self):
+        """跨进程文件锁（追加写和读取新增键时使用）"""
+        store = self
+
+        class _FileLock:
+            def __enter__(self):
+                self.fd = open(store.lock_path, 'a')
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+                return self
+
+            def __exit__(self, *exc):
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+                self.fd.close()
+
+        return _FileLock()
+
+    def _repair(self):
+        """进程中途退出可能导致两个文件行数不一致，截断到完整的行数"""
+        key_rows = os.path.getsize(self.keys_path) // DIGEST_SIZE if os.path.exists(self.keys_path) else 0
+        vector_rows = os.path.getsize(self.vectors_path) // self.row_bytes if os.path.exists(self.vectors_path) else 0
+        rows = min(key_rows, vector_rows)
+        for path, size in ((self.keys_path, rows * DIGEST_SIZE), (self.vectors_path, rows * self.row_bytes)):
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+            elif os.path.getsize(path) != size:
+                logger.warning(f"图片向量存储文件不完整，截断到 {rows} 行: {path}")
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+
+    def _refresh(self):
+        """读取其他进程新追加的键（只读增量部分）"""
+        total = os.path.getsize(self.keys_path) // DIGEST_SIZE
+        if total <= self._rows:
+            return
+        with open(self.keys_path, 'rb') as f:
+            f.seek(self._rows * DIGEST_SIZE)
+            data = f.read((total - self._rows) * DIGEST_SIZE)
+        for offset in range(0, len(data), DIGEST_SIZE):
+            self._index[data[offset:offset + DIGEST_SIZE]] = self._rows + offset // DIGEST_SIZE
+        self._rows = total
+        self._mmap = None
+
+    def _matrix(self):
+        """内存映射的向量矩阵（行数变化后重新映射）"""
+        if self._mmap is None and self._rows > 0:
+            self._mmap = np.memmap(self.vectors_path, dtype=self.dtype, mode='r',
+                                   shape=(self._rows, self.dimension))
+        return self._mmap
+
+    def __len__(self):
+        return self._rows
+
+    def get(self, digest: bytes) -> Optional[np.ndarray]:
+        """按摘要查询向量，未命中返回None"""
+        return self.get_many([digest])[0]
+
+    def get_many(self, digests: List[bytes]) -> List[Optional[np.ndarray]]:
+        """批量查询，未命中的位置为None"""
+        with self._lock:
+            if any(d not in self._index for d in digests):
+                with self._file_lock():
+                    self._refresh()
+            matrix = self._matrix()
+            results = []
+            for digest in digests:
+                row = self._index.get(digest)
+                if row is None:
+                    self._stats['misses'] += 1
+                    results.append(None)
+                else:
+                    self._stats['hits'] += 1
+                    results.append(np.array(matrix[row], dtype=np.float32))
+            return results
+
+    def put(self, digest: bytes, vector: np.ndarray):
+        """写入单条向量"""
+        self.put_many([digest], [vector])
+
+    def put_many(self, digests: List[bytes], vectors):
+        """追加写入多条向量（已存在的摘要会被跳过）"""
+        with self._lock, self._file_lock():
+            self._refresh()
+            keys, rows = [], []
+            for digest, vector in zip(digests, vectors):
+                if vector is None or digest in self._index or digest in keys:
+                    continue
+                vector = np.asarray(vector, dtype=self.dtype).reshape(-1)
+                if vector.shape[0] != self.dimension:
+                    raise ValueError(f"向量维度错误: 期望{self.dimension}维，实际{vector.shape[0]}维")
+                keys.append(digest)
+                rows.append(vector)
+            if not keys:
+                return
+            # 先写向量再写键：键存在时对应的向量一定完整
+            with open(self.vectors_path, 'ab') as f:
+                f.write(np.stack(rows).tobytes())
+            with open(self.keys_path, 'ab') as f:
+                f.write(b''.join(keys))
+            self._refresh()
+            self._stats['writes'] += len(keys)
+
+    def stats(self) -> dict:
+        """存储统计"""
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats.update({
+            'size': self._rows,
+            'path': self.path,
+            'dtype': self.dtype.name,
+            'hit_rate': round(stats['hits'] / lookups, 4) if lookups else 0.0
+        })
+        return stats
+
+
+# 全局存储实例（延迟初始化）
+_store_instance = None
+_store_lock = threading.Lock()
+
+
+def get_image_embedding_store() -> Optional[ImageEmbeddingStore]:
+    """获取图片向量存储实例（单例模式），未启用或打开失败时返回None"""
+    global _store_instance
+    if not IMAGE_CACHE_CONFIG['enabled']:
+        return None
+    with _store_lock:
+        if _store_instance is None:
+            try:
+                _store_instance = ImageEmbeddingStore(
+                    IMAGE_CACHE_CONFIG['directory'],
+                    CLIP_CONFIG['model_name'],
+                    dtype=IMAGE_CACHE_CONFIG['dtype'],
+                    preprocess=preprocess_id(),
+                    backend=backend_id()
+                )
+            except Exception as e:
+                logger.warning(f"图片向量存储不可用，将直接计算: {e}")
+                IMAGE_CACHE_CONFIG['enabled'] = False
+                return None
+    return _store_instance
@@ -0,0 +1,322 @@
+"""
+图片URL下载模块
+所有图片URL下载共用一个requests.Session：每个主机（COS/CDN域名）保持一个连接池，避免每张图片重新建立TCP/TLS连接
+响应按块流式读取，超过字节上限立即中止；网络错误、429和5xx按指数退避（带抖动）重试
+可选的本地条件请求缓存：带ETag/Last-Modified的响应保存到磁盘，再次下载时发送If-None-Match/If-Modified-Since，
+服务端返回304时直接使用本地内容（重新爬取、批量回填时省去重复传输）
+"""
+import os
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Sequence, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import FETCH_CONFIG
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+}
+
+CHUNK_SIZE = 64 * 1024
+
+
+class FetchError(Exception):
+    """图片下载失败"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class ImageFetcher:
+    """带连接池、字节上限、重试和条件请求缓存的图片下载器（线程安全）"""
+
+    def __init__(self, pool_size: int = 32, concurrency: int = 16, connect_timeout: float = 3,
+                 read_timeout: float = 10, max_bytes: int = 20 * 1024 * 1024, max_retries: int = 3,
+                 cache_dir: Optional[str] = None, cache_max_mb: float = 1024):
+        """
+        Args:
+            pool_size: 每个主机保持的连接数
+            concurrency: fetch_many/map 的并发数
+            connect_timeout/read_timeout: 连接超时和两次读取之间的超时（秒）
+            max_bytes: 单个响应的最大字节数
+            max_retries: 网络错误、429和5xx的重试次数
+            cache_dir: 条件请求缓存目录，None表示不缓存
+            cache_max_mb: 缓存目录容量上限（MB）
+        """
+        self.concurrency = max(1, int(concurrency))
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_bytes = int(max_bytes)
+        self.max_retries = max(0, int(max_retries))
+        self.cache_dir = cache_dir or None
+        self.cache_max_bytes = int(cache_max_mb * 1024 * 1024)
+
+        self.session = requests.Session()
+        self.session.headers.update(DEFAULT_HEADERS)
+        # urllib3按(协议, 主机, 端口)分池；pool_maxsize是每个主机保留的连接数
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max(1, int(pool_size)), max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._executor = None
+        self._lock = threading.Lock()
+        self._stats = {
+            'requests': 0,
+            'downloaded': 0,
+            'not_modified': 0,
+            'bytes': 0,
+            'retries': 0,
+            'failures': 0,
+            'too_large': 0
+        }
+        self._cache_bytes = 0
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._cache_bytes = sum(size for _, size, _ in self._cache_entries())
+
+    def _count(self, key: str, value: int = 1):
+        with self._lock:
+            self._stats[key] += value
+
+    # ---------- 条件请求缓存 ----------
+
+    def _cache_path(self, url: str) -> str:
+        """缓存文件路径（按URL的SHA-256分两级目录），元数据为同名.json"""
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _cache_load(self, url: str) -> Tuple[Optional[dict], Optional[str]]:
+        """读取缓存元数据（etag、last_modified、size），没有缓存或不完整时返回(None, None)"""
+        if not self.cache_dir:
+            return None, None
+        path = self._cache_path(url)
+        try:
+            with open(path + '.json', 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('url') != url or os.path.getsize(path) != meta.get('size'):
+                return None, None
+            return meta, path
+        except (OSError, ValueError):
+            return None, None
+
+    def _cache_read(self, path: str) -> Optional[bytes]:
+        """读取缓存内容，并刷新修改时间（容量清理按最久未使用淘汰）"""
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def _cache_store(self, url: str, response: requests.Response, data: bytes):
+        """响应带ETag或Last-Modified时写入缓存（先写临时文件再替换，多进程共享目录时不会读到半个文件）"""
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not self.cache_dir or not (etag or last_modified) or len(data) > self.cache_max_bytes:
+            return
+        path = self._cache_path(url)
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + suffix, 'wb') as f:
+                f.write(data)
+            with open(path + '.json' + suffix, 'w', encoding='utf-8') as f:
+                json.dump({'url': url, 'etag': etag, 'last_modified': last_modified,
+                           'size': len(data), 'stored_at': time.time()}, f)
+            os.replace(path + suffix, path)
+            os.replace(path + '.json' + suffix, path + '.json')
+        except OSError as e:
+            logger.warning(f"⚠️ 写入下载缓存失败: {e}")
+            return
+        with self._lock:
+            self._cache_bytes += len(data)
+            over = self._cache_bytes > self.cache_max_bytes
+        if over:
+            self._cache_prune()
+
+    def _cache_entries(self):
+        """遍历缓存目录，返回 (路径, 大小, 修改时间) 列表"""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.json') or name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _cache_prune(self):
+        """缓存超过容量上限时删除最久未使用的条目，直到降到上限的90%"""
+        entries = sorted(self._cache_entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.cache_max_bytes * 0.9
+        removed = 0
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            for stale in (path + '.json', path):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+            total -= size
+            removed += 1
+        with self._lock:
+            self._cache_bytes = total
+        logger.info(f"🧹 下载缓存清理: 删除 {removed} 条，剩余 {total / 1024 / 1024:.1f}MB")
+
+    # ---------- 下载 ----------
+
+    def _read_body(self, url: str, response: requests.Response) -> bytes:
+        """流式读取响应体，声明长度或实际读取超过max_bytes时中止"""
+        length = response.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > self.max_bytes:
+            self._count('too_large')
+            raise FetchError(f"图片过大（{int(length)} 字节，上限 {self.max_bytes}）: {url}", status_code=413)
+        body = bytearray()
+        for chunk in response.iter_content(CHUNK_SIZE):
+            body.extend(chunk)
+            if len(body) > self.max_bytes:
+                self._count('too_large')
+                raise FetchError(f"图片过大（超过 {self.max_bytes} 字节）: {url}", status_code=413)
+        return bytes(body)
+
+    @staticmethod
+    def _retry_delay(attempt: int, response: Optional[requests.Response] = None) -> float:
+        """指数退避 + 抖动；429/503带Retry-After（秒数）时按其等待"""
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return min(30.0, float(retry_after))
+        return min(10.0, 0.25 * (2 ** attempt)) * (0.5 + random.random())
+
+    def fetch(self, url: str, timeout=None) -> bytes:
+        """下载单个URL的内容（失败抛出FetchError）"""
+        timeout = timeout or self.timeout
+        meta, cache_path = self._cache_load(url)
+        headers = {}
+        if meta:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        for attempt in range(self.max_retries + 1):
+            response = None
+            try:
+                self._count('requests')
+                with self.session.get(url, headers=headers, timeout=timeout, stream=True) as response:
+                    status = response.status_code
+                    if status == 304 and cache_path:
+                        data = self._cache_read(cache_path)
+                        if data is not None:
+                            self._count('not_modified')
+                            return data
+                        # 缓存文件在验证期间被清理，去掉条件头重新下载
+                        headers, cache_path = {}, None
+                        retryable = True
+                        error = FetchError(f"缓存已失效，重新下载: {url}", status_code=status)
+                    elif status < 400 and status != 304:
+                        data = self._read_body(url, response)
+                        self._count('downloaded')
+                        self._count('bytes', len(data))
+                        self._cache_store(url, response, data)
+                        return data
+                    else:
+                        retryable = status == 429 or status >= 500
+                        error = FetchError(f"下载图片失败，HTTP {status}: {url}", status_code=status)
+            except FetchError:
+                self._count('failures')
+                raise
+            except requests.RequestException as e:
+                retryable = True
+                error = FetchError(f"下载图片失败: {url}: {e}")
+
+            if not retryable or attempt == self.max_retries:
+                self._count('failures')
+                raise error
+            delay = self._retry_delay(attempt, response)
+            self._count('retries')
+            logger.warning(f"{error}，{delay:.2f}秒后重试（{attempt + 1}/{self.max_retries}）")
+            time.sleep(delay)
+        raise FetchError(f"下载图片重试次数已用完: {url}")
+
+    def _pool(self) -> ThreadPoolExecutor:
+        """共享的下载线程池（所有请求共用，总并发不超过concurrency）"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='image-fetch')
+            return self._executor
+
+    def map(self, fn: Callable, items: Sequence) -> List[Union[object, Exception]]:
+        """在共享线程池中并发执行fn，按输入顺序返回结果，失败的位置为异常对象"""
+        if len(items) <= 1:
+            futures = None
+        else:
+            futures = [self._pool().submit(fn, item) for item in items]
+        results = []
+        for index, item in enumerate(items):
+            try:
+                results.append(futures[index].result() if futures else fn(item))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def fetch_many(self, urls: Sequence[str]) -> List[Union[bytes, Exception]]:
+        """并发下载多个URL，失败的位置为异常对象"""
+        return self.map(self.fetch, urls)
+
+    def stats(self) -> dict:
+        """下载统计"""
+        with self._lock:
+            stats = dict(self._stats)
+            cache_bytes = self._cache_bytes
+        stats.update({
+            'concurrency': self.concurrency,
+            'max_bytes': self.max_bytes,
+            'cache_dir': self.cache_dir,
+            'cache_mb': round(cache_bytes / 1024 / 1024, 2)
+        })
+        return stats
+
+
+# 全局下载器实例（延迟初始化）
+_fetcher_instance = None
+_fetcher_lock = threading.Lock()
+
+
+def get_image_fetcher() -> ImageFetcher:
+    """获取图片下载器实例（单例模式）"""
+    global _fetcher_instance
+    with _fetcher_lock:
+        if _fetcher_instance is None:
+            _fetcher_instance = ImageFetcher(
+                pool_size=FETCH_CONFIG['pool_size'],
+                concurrency=FETCH_CONFIG['concurrency'],
+                connect_timeout=FETCH_CONFIG['connect_timeout'],
+                read_timeout=FETCH_CONFIG['read_timeout'],
+                max_bytes=FETCH_CONFIG['max_bytes'],
+                max_retries=FETCH_CONFIG['max_retries'],
+                cache_dir=FETCH_CONFIG['cache_dir'] or None,
+                cache_max_mb=FETCH_CONFIG['cache_max_mb']
+            )
+        return _fetcher_instance
+
+
+def fetcher_stats() -> Optional[dict]:
+    """已创建的下载器的统计（尚未下载过任何URL时返回None）"""
+    return _fetcher_instance.stats() if _fetcher_instance is not None else None
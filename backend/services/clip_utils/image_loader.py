@@ -0,0 +1,137 @@
+"""
+图片加载模块
+从URL、本地路径或原始字节加载图片，供独立脚本和HTTP服务共用
+"""
+import os
+import logging
+from io import BytesIO
+from typing import List, Sequence, Union
+
+from PIL import Image
+
+from config import IMAGE_CONFIG
+from image_fetcher import get_image_fetcher
+from image_preprocess import apply_draft, PREPROCESS_VERSION
+from image_dedup import dhash, HASH_INFO_KEY
+
+logger = logging.getLogger(__name__)
+
+
+def _to_rgb(image: Image.Image) -> Image.Image:
+    """转换为RGB模式（CLIP要求）"""
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image
+
+
+def draft_size():
+    """JPEG draft解码的目标尺寸（快速预处理关闭或倍数为0时返回None，按全分辨率解码）"""
+    factor = IMAGE_CONFIG['draft_factor']
+    if not IMAGE_CONFIG['fast_preprocess'] or factor <= 0:
+        return None
+    return tuple(int(v * factor) for v in IMAGE_CONFIG['max_size'])
+
+
+def preprocess_id() -> str:
+    """
+    图片预处理路径的标识，作为图片向量存储命名空间的一部分：
+    快速预处理与CLIPProcessor、不同的draft解码尺寸得到的向量略有差异，不能共用同一份存储
+    """
+    if not IMAGE_CONFIG['fast_preprocess']:
+        return 'hf'
+    size = draft_size()
+    return f"fast{PREPROCESS_VERSION}-" + (f"draft{size[0]}x{size[1]}" if size else 'full')
+
+
+def _open(fp, with_hash: bool = False) -> Image.Image:
+    """
+    打开图片；JPEG在解码前按draft_size缩小，再转换为RGB
+    with_hash: 解码后顺带计算感知哈希（近重复检测用），记在 image.info['dhash']
+    """
+    image = _to_rgb(apply_draft(Image.open(fp), draft_size()))
+    if with_hash:
+        image.info[HASH_INFO_KEY] = dhash(image)
+    return image
+
+
+def is_url(source: str) -> bool:
+    """判断图片来源是否为URL"""
+    return source.startswith('http://') or source.startswith('https://')
+
+
+def fetch_image_bytes(url, timeout=None) -> bytes:
+    """从URL下载图片原始字节（共享连接池，timeout为None时使用FETCH_CONFIG的连接/读取超时）"""
+    return get_image_fetcher().fetch(url, timeout=timeout)
+
+
+def read_image_file(path) -> bytes:
+    """读取本地图片原始字节"""
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"图片文件不存在: {path}")
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def read_image_bytes(source: str) -> bytes:
+    """根据来源读取图片原始字节（URL或本地路径），用于按内容查缓存"""
+    try:
+        if is_url(source):
+            logger.info(f"从URL下载图片: {source}")
+            return fetch_image_bytes(source)
+        logger.info(f"读取本地图片: {source}")
+        return read_image_file(source)
+    except Exception as e:
+        logger.error(f"读取图片失败: {e}")
+        raise
+
+
+def read_image_bytes_many(sources: Sequence[str]) -> List[Union[bytes, Exception]]:
+    """并发读取多张图片的原始字节（共享下载线程池），按输入顺序返回，失败的位置为异常对象"""
+    return get_image_fetcher().map(read_image_bytes, list(sources))
+
+
+def load_image_from_url(url, timeout=None, with_hash=False):
+    """从URL加载图片（with_hash: 同时计算感知哈希）"""
+    try:
+        logger.info(f"从URL加载图片: {url}")
+        image = _open(BytesIO(fetch_image_bytes(url, timeout=timeout)), with_hash)
+        logger.info(f"图片加载成功: {image.size}, 模式: {image.mode}")
+        return image
+    except Exception as e:
+        logger.error(f"从URL加载图片失败: {e}")
+        raise
+
+
+def load_image_from_path(path, with_hash=False):
+    """从本地路径加载图片（with_hash: 同时计算感知哈希）"""
+    try:
+        logger.info(f"从本地加载图片: {path}")
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"图片文件不存在: {path}")
+
+        image = _open(path, with_hash)
+        logger.info(f"图片加载成功: {image.size}, 模式: {image.mode}")
+        return image
+    except Exception as e:
+        logger.error(f"从本地加载图片失败: {e}")
+        raise
+
+
+def load_image_from_bytes(data: bytes, with_hash: bool = False):
+    """从原始字节加载图片（上传的文件内容；with_hash: 同时计算感知哈希）"""
+    try:
+        if not data:
+            raise ValueError("图片内容为空")
+        image = _open(BytesIO(data), with_hash)
+        logger.info(f"图片加载成功: {image.size}, 模式: {image.mode}")
+        return image
+    except Exception as e:
+        logger.error(f"从字节加载图片失败: {e}")
+        raise
+
+
+def load_image(source: str, with_hash: bool = False):
+    """根据来源自动选择加载方式（URL或本地路径）"""
+    if is_url(source):
+        return load_image_from_url(source, with_hash=with_hash)
+    return load_image_from_path(source, with_hash)
@@ -0,0 +1,95 @@
+"""
+图片预处理快速路径
+CLIPProcessor对每张图片先缩放整张图、再裁剪、再逐张归一化；这里把缩放和中心裁剪合并为一次PIL resize（只采样裁剪区域），
+整批图片写入预分配的uint8缓冲区，再用一次NumPy运算完成rescale + normalize，输出与CLIPProcessor相同布局的pixel_values
+配合 image_loader 的JPEG draft解码（DCT域直接缩小）使用，大图的解码和预处理开销都大幅下降
+"""
+import logging
+from typing import Optional, Sequence
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# 快速预处理的版本号：改变缩放、裁剪或归一化的结果时加1，图片向量存储随之换用新的命名空间
+PREPROCESS_VERSION = 1
+
+
+class ImagePreprocessor:
+    """与CLIPImageProcessor（shortest_edge缩放 + 中心裁剪 + 归一化）等价的批量预处理"""
+
+    def __init__(self, shortest_edge: int = 224, crop_size: Sequence[int] = (224, 224),
+                 mean: Sequence[float] = (0.48145466, 0.4578275, 0.40821073),
+                 std: Sequence[float] = (0.26862954, 0.26130258, 0.27577711),
+                 resample: int = Image.BICUBIC, rescale_factor: float = 1 / 255):
+        self.shortest_edge = int(shortest_edge)
+        self.crop_height, self.crop_width = int(crop_size[0]), int(crop_size[1])
+        self.resample = resample
+        # (x * rescale - mean) / std  ==  x * scale - offset
+        std = np.asarray(std, dtype=np.float32)
+        self.scale = (np.float32(rescale_factor) / std).reshape(1, 3, 1, 1)
+        self.offset = (np.asarray(mean, dtype=np.float32) / std).reshape(1, 3, 1, 1)
+
+    @classmethod
+    def from_processor(cls, image_processor) -> Optional['ImagePreprocessor']:
+        """按CLIPImageProcessor的配置创建；配置不是标准的缩放+裁剪+归一化流程时返回None（继续使用原处理器）"""
+        try:
+            size = image_processor.size
+            crop = image_processor.crop_size
+            if not (image_processor.do_resize and image_processor.do_center_crop and image_processor.do_rescale
+                    and image_processor.do_normalize and 'shortest_edge' in size):
+                return None
+            return cls(
+                shortest_edge=size['shortest_edge'],
+                crop_size=(crop['height'], crop['width']),
+                mean=image_processor.image_mean,
+                std=image_processor.image_std,
+                resample=image_processor.resample,
+                rescale_factor=image_processor.rescale_factor
+            )
+        except (AttributeError, KeyError, TypeError) as e:
+            logger.warning(f"⚠️ 无法按处理器配置创建快速预处理，使用CLIPProcessor: {e}")
+            return None
+
+    def _crop_box(self, width: int, height: int):
+        """先按短边缩放、再中心裁剪时，裁剪区域在原图坐标中的位置"""
+        if width <= height:
+            resized_w, resized_h = self.shortest_edge, int(self.shortest_edge * height / width)
+        else:
+            resized_w, resized_h = int(self.shortest_edge * width / height), self.shortest_edge
+        top = (resized_h - self.crop_height) // 2
+        left = (resized_w - self.crop_width) // 2
+        scale_x, scale_y = width / resized_w, height / resized_h
+        return (left * scale_x, top * scale_y,
+                (left + self.crop_width) * scale_x, (top + self.crop_height) * scale_y)
+
+    def resize_crop(self, image: Image.Image) -> Image.Image:
+        """缩放与中心裁剪合并为一次resize，只对裁剪区域采样"""
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        box = self._crop_box(*image.size)
+        return image.resize((self.crop_width, self.crop_height), self.resample, box=box)
+
+    def __call__(self, images) -> np.ndarray:
+        """单张或一组PIL图片 -> (N, 3, H, W) float32 pixel_values"""
+        if isinstance(images, Image.Image):
+            images = [images]
+        count = len(images)
+        pixels = np.empty((count, self.crop_height, self.crop_width, 3), dtype=np.uint8)
+        for index, image in enumerate(images):
+            pixels[index] = np.asarray(self.resize_crop(image))
+        output = np.empty((count, 3, self.crop_height, self.crop_width), dtype=np.float32)
+        np.multiply(pixels.transpose(0, 3, 1, 2), self.scale, out=output)
+        np.subtract(output, self.offset, out=output)
+        return output
+
+
+def apply_draft(image: Image.Image, target_size) -> Image.Image:
+    """
+    JPEG在解码前用draft()按2的幂缩小（DCT域完成，不解码全分辨率像素），结果尺寸不小于target_size
+    其他格式原样返回
+    """
+    if target_size and image.format == 'JPEG':
+        image.draft('RGB', tuple(int(v) for v in target_size))
+    return image
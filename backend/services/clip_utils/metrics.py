@@ -0,0 +1,455 @@
+"""
+服务指标模块（Prometheus文本格式，不依赖prometheus_client）
+- 计数器、仪表、直方图，以及在抓取时才读取当前值的采集函数（队列深度、进程内存、模型加载耗时）
+- 分阶段计时：stage() / record_stage() 把耗时记入 clip_stage_seconds 直方图，同时累加到当前请求的阶段明细
+  （contextvars保存，请求开始时 begin_trace()；微批处理线程里的计时经 Future 带回请求线程后 merge_stages()）
+- 多进程（gunicorn pre-fork）：enable_multiprocess() 后各worker定期把自己的指标快照写到共享目录的 <pid>.json，
+  render() 合并所有worker的快照：计数器和直方图按标签求和，仪表加上pid标签分别列出（已退出的worker的仪表不再输出）
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 请求头: 客户端带 X-Debug-Timing: 1 时，响应的 Server-Timing 头给出各阶段耗时
+DEBUG_HEADER = 'X-Debug-Timing'
+
+# 阶段耗时的直方图分桶（秒）：从0.1ms到10s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+# 无法从/proc读取进程启动时间时（非Linux）使用模块导入时间
+_IMPORTED_AT = time.time()
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+class _Metric:
+    """带标签的指标基类，每组标签值一个序列"""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """只增不减的计数"""
+
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            series = dict(self._series)
+        return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in sorted(series.items())]
+
+
+class Gauge(_Metric):
+    """可增可减的当前值"""
+
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._series[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    samples = Counter.samples
+
+
+class Histogram(_Metric):
+    """分桶计数 + 总和 + 次数"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][index] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def samples(self):
+        with self._lock:
+            series = {key: {'counts': list(s['counts']), 'sum': s['sum'], 'count': s['count']}
+                      for key, s in self._series.items()}
+        samples = []
+        for key, s in sorted(series.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, s['counts']):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', {**labels, 'le': _format_value(bound)}, cumulative))
+            samples.append((f'{self.name}_bucket', {**labels, 'le': '+Inf'}, s['count']))
+            samples.append((f'{self.name}_sum', labels, s['sum']))
+            samples.append((f'{self.name}_count', labels, s['count']))
+        return samples
+
+
+# 采集函数返回: [(指标名, 类型, 说明, [(标签, 值), ...]), ...]
+Collector = Callable[[], Iterable[Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]]]
+
+
+class Registry:
+    """指标注册表，render() 输出Prometheus文本格式"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: Collector):
+        """注册在抓取时调用的采集函数（用于读取队列深度、内存等当前状态）"""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def collect(self) -> List[Tuple[str, str, str, List[Tuple[str, Dict[str, str], float]]]]:
+        """全部指标族: [(指标名, 类型, 说明, [(样本名, 标签, 值), ...]), ...]，采集函数出错时跳过"""
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        families = [(metric.name, metric.kind, metric.documentation, metric.samples()) for metric in metrics]
+        for collector in collectors:
+            try:
+                collected = list(collector())
+            except Exception as e:
+                logger.warning(f"指标采集函数出错: {e}")
+                continue
+            for name, kind, documentation, samples in collected:
+                families.append((name, kind, documentation,
+                                 [(name, labels, value) for labels, value in samples if value is not None]))
+        return families
+
+    def render(self) -> str:
+        return _render_families(self.collect())
+
+
+def _render_families(families) -> str:
+    lines = []
+    for name, kind, documentation, samples in families:
+        lines.append(f'# HELP {name} {documentation}')
+        lines.append(f'# TYPE {name} {kind}')
+        for sample_name, labels, value in samples:
+            lines.append(f'{sample_name}{_format_labels(labels)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'clip_stage_seconds', 'Time spent per request stage (parse, queue_wait, tokenize, forward, to_numpy, serialize, ...)',
+    ('stage', 'kind')))
+BATCH_SIZE = REGISTRY.register(Histogram(
+    'clip_batch_size', 'Number of items per model forward pass', ('kind',), buckets=BATCH_SIZE_BUCKETS))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'clip_request_seconds', 'End-to-end request handling time', ('endpoint',)))
+REQUESTS_TOTAL = REGISTRY.register(Counter(
+    'clip_requests_total', 'Handled requests by endpoint and HTTP status', ('endpoint', 'status')))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    'clip_requests_in_flight', 'Requests currently being handled', ('endpoint',)))
+
+
+# ---------- 分阶段计时 ----------
+
+_trace = contextvars.ContextVar('clip_stage_trace', default=None)
+
+
+def begin_trace() -> Dict[str, float]:
+    """开始记录当前请求（或当前批次）的阶段明细，返回累加耗时（秒）的字典"""
+    stages = {}
+    _trace.set(stages)
+    return stages
+
+
+def current_trace() -> Optional[Dict[str, float]]:
+    return _trace.get()
+
+
+def record_stage(stage: str, seconds: float, kind: str = ''):
+    """记入阶段耗时直方图，并累加到当前请求的明细"""
+    STAGE_SECONDS.observe(seconds, stage=stage, kind=kind)
+    stages = _trace.get()
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def stage(name: str, kind: str = ''):
+    """计时一个阶段: with stage('forward', 'text'): ..."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started, kind)
+
+
+def merge_stages(stages: Optional[Dict[str, float]]):
+    """把其他线程记录的阶段明细（如微批处理线程中的推理耗时）并入当前请求（直方图已在记录时更新）"""
+    current = _trace.get()
+    if current is None or not stages:
+        return
+    for name, seconds in stages.items():
+        current[name] = current.get(name, 0.0) + seconds
+
+
+def server_timing(stages: Dict[str, float], total: Optional[float] = None) -> str:
+    """阶段明细 -> Server-Timing 响应头（毫秒）"""
+    parts = [f'{name};dur={seconds * 1000:.3f}' for name, seconds in stages.items()]
+    if total is not None:
+        parts.append(f'total;dur={total * 1000:.3f}')
+    return ', '.join(parts)
+
+
+def debug_requested(value: Optional[str]) -> bool:
+    """X-Debug-Timing 请求头是否开启"""
+    return str(value or '').lower() in ['1', 'true', 'yes']
+
+
+# ---------- 推理队列 ----------
+
+_queues = []
+_queues_lock = threading.Lock()
+
+
+def track_queue(batcher):
+    """登记推理队列（MicroBatcher），抓取时读取其排队数、拒绝数和过期丢弃数"""
+    with _queues_lock:
+        _queues.append(batcher)
+
+
+def _queue_collector():
+    with _queues_lock:
+        queues = list(_queues)
+    stats = [(batcher.name, batcher.stats()) for batcher in queues]
+    return [
+        ('clip_queue_depth', 'gauge', 'Requests waiting in the inference queue',
+         [({'queue': name}, s['queue_depth']) for name, s in stats]),
+        ('clip_queue_rejected_total', 'counter', 'Requests rejected because the queue was full',
+         [({'queue': name}, s['rejected']) for name, s in stats]),
+        ('clip_queue_expired_total', 'counter', 'Requests dropped after their deadline passed while queued',
+         [({'queue': name}, s['expired']) for name, s in stats])
+    ]
+
+
+REGISTRY.register_collector(_queue_collector)
+
+
+# ---------- 进程指标 ----------
+
+def _rss_bytes() -> Optional[int]:
+    """当前常驻内存（Linux读/proc，其他平台返回None）"""
+    try:
+        with open('/proc/self/statm', encoding='utf-8') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _peak_rss_bytes() -> Optional[int]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux单位为KB，macOS为字节
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _process_start_time() -> float:
+    """
+    进程启动时间（unix时间戳）：Linux从/proc/self/stat的starttime（开机后的时钟滴答数）加上/proc/stat的btime计算，
+    pre-fork的worker得到的是fork时间而不是master导入模块的时间；其他平台退回模块导入时间
+    """
+    try:
+        with open('/proc/self/stat', encoding='utf-8') as f:
+            # 第2个字段（进程名）可能包含空格，从最后一个')'之后开始数，starttime是第22个字段
+            fields = f.read().rsplit(')', 1)[1].split()
+        started_ticks = int(fields[19])
+        with open('/proc/stat', encoding='utf-8') as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith('btime '))
+        return boot_time + started_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, StopIteration):
+        return _IMPORTED_AT
+
+
+def _process_collector():
+    times = os.times()
+    return [
+        ('process_resident_memory_bytes', 'gauge', 'Resident memory size in bytes', [({}, _rss_bytes())]),
+        ('process_peak_resident_memory_bytes', 'gauge', 'Peak resident memory size in bytes',
+         [({}, _peak_rss_bytes())]),
+        ('process_cpu_seconds_total', 'counter', 'Total user and system CPU time spent in seconds',
+         [({}, round(times.user + times.system, 3))]),
+        ('process_start_time_seconds', 'gauge', 'Start time of the process since unix epoch in seconds',
+         [({}, round(_process_start_time(), 3))])
+    ]
+
+
+REGISTRY.register_collector(_process_collector)
+
+
+# ---------- 多进程汇总 ----------
+
+_multiprocess = {'dir': None}
+_multiprocess_lock = threading.Lock()
+
+
+def reset_multiprocess_dir(directory: str):
+    """master进程启动时调用：清空共享目录中上次运行留下的快照"""
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith('.json') or name.endswith('.tmp'):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+def enable_multiprocess(directory: str, interval: float = 5.0):
+    """
+    worker进程（fork之后）调用：每interval秒把本进程的指标快照写到 directory/<pid>.json，退出时再写一次；
+    之后 render() 输出所有worker的汇总（其他worker的数据最多滞后interval秒）
+    """
+    os.makedirs(directory, exist_ok=True)
+    with _multiprocess_lock:
+        if _multiprocess['dir'] is not None:
+            return
+        _multiprocess['dir'] = directory
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            _write_snapshot()
+
+    threading.Thread(target=loop, name='metrics-snapshot', daemon=True).start()
+    atexit.register(_write_snapshot)
+    _write_snapshot()
+
+
+def _write_snapshot():
+    """本进程的指标快照写入共享目录（先写临时文件再替换，读取方不会读到半个文件）"""
+    directory = _multiprocess['dir']
+    path = os.path.join(directory, f'{os.getpid()}.json')
+    try:
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(REGISTRY.collect(), f)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        pass
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_snapshots(directory: str):
+    """读取共享目录中的全部快照: [(pid, 指标族)]；本进程的数据直接取当前值"""
+    snapshots = [(os.getpid(), REGISTRY.collect())]
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.json') or name[:-5] == str(os.getpid()) or not name[:-5].isdigit():
+            continue
+        try:
+            with open(os.path.join(directory, name), encoding='utf-8') as f:
+                snapshots.append((int(name[:-5]), json.load(f)))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _merge_snapshots(snapshots):
+    """计数器和直方图按(样本名, 标签)求和（包括已退出的worker，总数不回退）；仪表加pid标签，只保留存活的worker"""
+    families = {}
+    for pid, collected in snapshots:
+        alive = pid == os.getpid() or _pid_alive(pid)
+        for name, kind, documentation, samples in collected:
+            family = families.setdefault(name, (kind, documentation, {}))
+            merged = family[2]
+            for sample_name, labels, value in samples:
+                if kind == 'gauge':
+                    if alive:
+                        merged[(sample_name, tuple(labels.items()) + (('pid', str(pid)),))] = value
+                    continue
+                key = (sample_name, tuple(labels.items()))
+                merged[key] = merged.get(key, 0) + value
+    return [(name, kind, documentation, [(sample_name, dict(labels), value)
+                                         for (sample_name, labels), value in merged.items()])
+            for name, (kind, documentation, merged) in families.items()]
+
+
+def render() -> str:
+    """/metrics 响应：未开启多进程汇总时只有本进程的指标"""
+    directory = _multiprocess['dir']
+    if directory is None:
+        return REGISTRY.render()
+    return _render_families(_merge_snapshots(_read_snapshots(directory)))
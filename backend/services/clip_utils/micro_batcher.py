@@ -0,0 +1,237 @@
+"""
+动态微批处理模块
+把在一个短时间窗口内到达的单条编码请求合并成一次批量前向计算，再把每一行结果分发给各自的调用方
+可选的准入控制：排队数达到上限时直接拒绝（QueueFullError），一次提交的条数超过上限时无论何时都无法准入（BatchTooLargeError），排队期间已过截止时间的请求在计算前丢弃（DeadlineExceeded）
+每批计算的阶段耗时（分词、前向计算等）和每条请求的排队时间记在Future上，调用方用 merge_future_stages() 并入请求的阶段明细
+"""
+import math
+import threading
+import queue
+import time
+import logging
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional
+
+from metrics import STAGE_SECONDS, begin_trace, merge_stages, track_queue
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """排队数已达上限，请求被拒绝"""
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class BatchTooLargeError(Exception):
+    """一次提交的条数超过排队上限，即使队列为空也无法准入（重试没有意义）"""
+
+    def __init__(self, message: str, max_queue: int):
+        super().__init__(message)
+        self.max_queue = max_queue
+
+
+class DeadlineExceeded(Exception):
+    """请求在计算前已超过截止时间"""
+
+
+class MicroBatcher:
+    """请求合并器：单个后台线程收集请求，按窗口/批大小触发批量计算"""
+
+    def __init__(self, batch_fn: Callable[[List[Any]], Any], max_batch_size: int = 32,
+                 window_ms: float = 10.0, name: str = 'batcher', max_queue: int = 0, kind: Optional[str] = None):
+        """
+        Args:
+            batch_fn: 批量计算函数，输入列表，返回按行对应的结果（如numpy矩阵），失败返回None
+            max_batch_size: 单批最多合并的请求数
+            window_ms: 收到第一条请求后最多再等待的毫秒数
+            name: 名称（用于日志和线程名）
+            max_queue: 最多排队的请求数，超过时submit抛出QueueFullError（0表示不限制）
+            kind: 指标中的类型标签（text / image），默认同name
+        """
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.window = max(0.0, float(window_ms)) / 1000.0
+        self.name = name
+        self.max_queue = max(0, int(max_queue))
+        self.kind = kind or name
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._admit_lock = threading.Lock()
+        self._stats = {
+            'batches': 0,
+            'items': 0,
+            'max_batch': 0,
+            'total_wait_ms': 0.0,
+            'total_compute_ms': 0.0,
+            'rejected': 0,
+            'expired': 0
+        }
+        self._thread = threading.Thread(target=self._run, name=f'micro-{name}', daemon=True)
+        self._thread.start()
+        track_queue(self)
+
+    def submit(self, item: Any, deadline: Optional[float] = None) -> Future:
+        """
+        提交单条请求，返回Future，结果为批量结果中对应的一行
+        deadline: 截止时间（time.monotonic()），排队到计算前已超过时Future抛出DeadlineExceeded
+        """
+        return self.submit_many([item], deadline)[0]
+
+    def submit_many(self, items: List[Any], deadline: Optional[float] = None) -> List[Future]:
+        """一次提交多条请求（整体准入：剩余排队容量不足时全部拒绝）"""
+        with self._admit_lock:
+            self.ensure_capacity(len(items))
+            futures = []
+            enqueued = time.perf_counter()
+            for item in items:
+                future = Future()
+                self._queue.put((item, future, enqueued, deadline))
+                futures.append(future)
+        return futures
+
+    def ensure_capacity(self, count: int = 1):
+        """
+        剩余排队容量不足count条时抛出QueueFullError（用于在读取/解码等准备工作之前提前拒绝）；
+        count本身超过排队上限时抛出BatchTooLargeError
+        """
+        if self.max_queue and count > self.max_queue:
+            with self._lock:
+                self._stats['rejected'] += count
+            raise BatchTooLargeError(f"[{self.name}] 一次提交 {count} 条，超过排队上限 {self.max_queue}", self.max_queue)
+        if self.max_queue and self._queue.qsize() + count > self.max_queue:
+            with self._lock:
+                self._stats['rejected'] += count
+            raise QueueFullError(f"[{self.name}] 排队请求已达上限 {self.max_queue}", self.retry_after())
+
+    def encode(self, item: Any, timeout: Optional[float] = None) -> Any:
+        """同步提交并等待结果（该批的阶段耗时并入当前请求）"""
+        future = self.submit(item)
+        result = future.result(timeout=timeout)
+        merge_future_stages([future])
+        return result
+
+    def queue_depth(self) -> int:
+        """当前排队等待的请求数"""
+        return self._queue.qsize()
+
+    def retry_after(self) -> float:
+        """按当前排队数和平均每批计算耗时估算排空队列需要的秒数（至少1秒）"""
+        with self._lock:
+            batches = self._stats['batches']
+            compute_ms = self._stats['total_compute_ms']
+        avg_compute = compute_ms / batches / 1000.0 if batches else 0.1
+        return max(1.0, math.ceil(self.queue_depth() / self.max_batch_size * avg_compute))
+
+    def stats(self) -> dict:
+        """返回批处理统计（批次数、平均批大小、平均排队等待时间等）"""
+        with self._lock:
+            stats = dict(self._stats)
+        batches = stats['batches'] or 1
+        items = stats['items'] or 1
+        return {
+            'window_ms': self.window * 1000.0,
+            'max_batch_size': self.max_batch_size,
+            'batches': stats['batches'],
+            'items': stats['items'],
+            'max_batch': stats['max_batch'],
+            'avg_batch_size': round(stats['items'] / batches, 2) if stats['batches'] else 0,
+            'avg_wait_ms': round(stats['total_wait_ms'] / items, 3) if stats['items'] else 0,
+            'avg_compute_ms': round(stats['total_compute_ms'] / batches, 3) if stats['batches'] else 0,
+            'queue_depth': self.queue_depth(),
+            'max_queue': self.max_queue,
+            'rejected': stats['rejected'],
+            'expired': stats['expired']
+        }
+
+    def _collect(self):
+        """阻塞等待第一条请求，然后在窗口内尽量凑满一批"""
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                # 窗口已过，只取已经在排队的请求
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _admit(self, batch):
+        """丢弃调用方已取消或已过截止时间的请求，其余标记为运行中"""
+        now = time.monotonic()
+        live = []
+        expired = 0
+        for item, future, enqueued, deadline in batch:
+            if not future.set_running_or_notify_cancel():
+                expired += 1
+                continue
+            if deadline is not None and now >= deadline:
+                future.set_exception(DeadlineExceeded(f"[{self.name}] 请求排队期间已超过截止时间"))
+                expired += 1
+                continue
+            live.append((item, future, enqueued))
+        if expired:
+            with self._lock:
+                self._stats['expired'] += expired
+        return live
+
+    def _run(self):
+        """后台线程主循环"""
+        while True:
+            batch = self._admit(self._collect())
+            if not batch:
+                continue
+            items = [item for item, _, _ in batch]
+            started = time.perf_counter()
+            stages = begin_trace()
+            try:
+                results = self.batch_fn(items)
+                error = None
+            except Exception as e:
+                logger.error(f"[{self.name}] 批量计算失败: {e}")
+                results, error = None, e
+            finished = time.perf_counter()
+            for _, future, enqueued in batch:
+                future.batch_stages = stages
+                future.queue_wait = started - enqueued
+                STAGE_SECONDS.observe(future.queue_wait, stage='queue_wait', kind=self.kind)
+
+            with self._lock:
+                self._stats['batches'] += 1
+                self._stats['items'] += len(batch)
+                self._stats['max_batch'] = max(self._stats['max_batch'], len(batch))
+                self._stats['total_wait_ms'] += sum((started - enqueued) * 1000.0 for _, _, enqueued in batch)
+                self._stats['total_compute_ms'] += (finished - started) * 1000.0
+
+            for index, (_, future, _) in enumerate(batch):
+                if error is not None:
+                    future.set_exception(error)
+                elif results is None:
+                    future.set_result(None)
+                else:
+                    future.set_result(results[index])
+
+
+def merge_future_stages(futures: List[Future]):
+    """把一组已完成Future的阶段耗时并入当前请求：同一批只计一次，排队时间取最长的一条"""
+    seen = set()
+    queue_wait = None
+    for future in futures:
+        stages = getattr(future, 'batch_stages', None)
+        if stages is not None and id(stages) not in seen:
+            seen.add(id(stages))
+            merge_stages(stages)
+        wait = getattr(future, 'queue_wait', None)
+        if wait is not None:
+            queue_wait = wait if queue_wait is None else max(queue_wait, wait)
+    if queue_wait is not None:
+        merge_stages({'queue_wait': queue_wait})
@@ -0,0 +1,216 @@
+"""
+Qdrant REST客户端
+直接从Python流水线批量写入向量，省去把向量以JSON传回Node再逐条upsert的开销
+只依赖requests，使用Qdrant HTTP API（与 backend/src/config/qdrant.js 写入的point格式一致）
+"""
+import time
+import random
+import logging
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional
+
+import requests
+
+from config import QDRANT_CONFIG, VECTOR_DIMENSION
+
+logger = logging.getLogger(__name__)
+
+
+class QdrantError(Exception):
+    """Qdrant请求失败"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class QdrantRest:
+    """Qdrant HTTP API的最小封装，带连接复用和重试"""
+
+    def __init__(self, url: Optional[str] = None, api_key: Optional[str] = None,
+                 collection: Optional[str] = None, timeout: float = 30, max_retries: int = 5):
+        self.url = (url or QDRANT_CONFIG['url']).rstrip('/')
+        self.collection = collection or QDRANT_CONFIG['collection_name']
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        api_key = api_key if api_key is not None else QDRANT_CONFIG['api_key']
+        if api_key:
+            self.session.headers['api-key'] = api_key
+
+    def request(self, method: str, path: str, **kwargs) -> Dict:
+        """发送请求；网络错误、429和5xx按指数退避（带抖动）重试"""
+        url = f"{self.url}{path}"
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+                if response.status_code < 400:
+                    return response.json() if response.content else {}
+                retryable = response.status_code == 429 or response.status_code >= 500
+                error = QdrantError(f"{method} {path} 返回 {response.status_code}: {response.text[:200]}",
+                                    status_code=response.status_code)
+            except requests.RequestException as e:
+                retryable = True
+                error = QdrantError(f"{method} {path} 请求失败: {e}")
+
+            if not retryable or attempt == self.max_retries:
+                raise error
+            delay = min(30.0, 0.5 * (2 ** attempt)) * (0.5 + random.random())
+            logger.warning(f"{error}，{delay:.1f}秒后重试（{attempt + 1}/{self.max_retries}）")
+            time.sleep(delay)
+        raise QdrantError(f"{method} {path} 重试次数已用完")
+
+    def collection_exists(self) -> bool:
+        """检查集合是否存在"""
+        try:
+            self.request('GET', f"/collections/{self.collection}")
+            return True
+        except QdrantError as e:
+            if e.status_code == 404:
+                return False
+            raise
+
+    def ensure_collection(self, dimension: int = VECTOR_DIMENSION, distance: str = 'Cosine'):
+        """集合不存在时创建"""
+        if self.collection_exists():
+            return
+        logger.info(f"创建Qdrant集合: {self.collection}（{dimension}维, {distance}）")
+        self.request('PUT', f"/collections/{self.collection}",
+                     json={'vectors': {'size': dimension, 'distance': distance}})
+
+    def upsert_points(self, points: List[Dict], wait: bool = True) -> Dict:
+        """插入或更新一批point"""
+        return self.request('PUT', f"/collections/{self.collection}/points",
+                            params={'wait': str(wait).lower()}, json={'points': points})
+
+    def retrieve_points(self, ids: List, with_payload=True, with_vector: bool = False) -> List[Dict]:
+        """按ID批量读取point（不存在的ID不出现在结果中）"""
+        body = {'ids': list(ids), 'with_payload': with_payload, 'with_vector': with_vector}
+        return self.request('POST', f"/collections/{self.collection}/points", json=body).get('result') or []
+
+    def set_payloads(self, payloads: Dict, wait: bool = True) -> Dict:
+        """只更新payload（不重写向量）: {point_id: {字段: 值}}，一次batch请求合并到各point已有的payload中"""
+        operations = [{'set_payload': {'payload': payload, 'points': [point_id]}}
+                      for point_id, payload in payloads.items()]
+        return self.request('POST', f"/collections/{self.collection}/points/batch",
+                            params={'wait': str(wait).lower()}, json={'operations': operations})
+
+    def delete_points(self, ids: List, wait: bool = True) -> Dict:
+        """按ID删除point"""
+        return self.request('POST', f"/collections/{self.collection}/points/delete",
+                            params={'wait': str(wait).lower()}, json={'points': list(ids)})
+
+    def search_points(self, vector, limit: int = 10, offset: int = 0, score_threshold: Optional[float] = None,
+                      query_filter: Optional[Dict] = None, with_payload=True, exact: bool = False) -> List[Dict]:
+        """向量搜索，返回 [{'id', 'version', 'score', 'payload'}]（按分数降序）"""
+        body = {
+            'vector': vector.tolist() if hasattr(vector, 'tolist') else list(vector),
+            'limit': limit,
+            'offset': offset,
+            'with_payload': with_payload,
+            'with_vector': False
+        }
+        if score_threshold is not None:
+            body['score_threshold'] = score_threshold
+        if query_filter:
+            body['filter'] = query_filter
+        if exact:
+            body['params'] = {'exact': True}
+        return self.request('POST', f"/collections/{self.collection}/points/search", json=body).get('result') or []
+
+    def scroll_points(self, batch_size: int = 1000, with_vector: bool = True, with_payload=True) -> Iterator[Dict]:
+        """分页遍历集合中的所有point（用于导出向量、构建本地索引；只要ID时两者都传False）"""
+        offset = None
+        while True:
+            body = {'limit': batch_size, 'with_payload': with_payload, 'with_vector': with_vector}
+            if offset is not None:
+                body['offset'] = offset
+            result = self.request('POST', f"/collections/{self.collection}/points/scroll", json=body).get('result') or {}
+            yield from result.get('points') or []
+            offset = result.get('next_page_offset')
+            if offset is None:
+                return
+
+
+def build_point(image_id, vector, payload: Optional[Dict] = None) -> Dict:
+    """构建point（与Node端upsertImageVector的payload格式一致）"""
+    vector = vector.tolist() if hasattr(vector, 'tolist') else list(vector)
+    if len(vector) != VECTOR_DIMENSION:
+        raise ValueError(f"向量维度错误: 期望{VECTOR_DIMENSION}维，实际{len(vector)}维")
+    return {
+        'id': image_id,
+        'vector': vector,
+        'payload': {
+            'image_id': image_id,
+            **(payload or {}),
+            'updated_at': datetime.now(timezone.utc).isoformat()
+        }
+    }
+
+
+class QdrantBatchWriter:
+    """
+    批量写入器：累积point到chunk_size后提交，在途请求数不超过max_in_flight
+    写入成功/失败通过回调通知（用于断点续跑记录）
+    """
+
+    def __init__(self, client: Optional[QdrantRest] = None, chunk_size: int = 256, max_in_flight: int = 4,
+                 on_success: Optional[Callable[[List[Dict]], None]] = None,
+                 on_error: Optional[Callable[[List[Dict], Exception], None]] = None):
+        self.client = client or QdrantRest()
+        self.chunk_size = max(1, chunk_size)
+        self.on_success = on_success
+        self.on_error = on_error
+        self._buffer = []
+        self._slots = threading.BoundedSemaphore(max(1, max_in_flight))
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_in_flight))
+        self._futures = []
+        self._lock = threading.Lock()
+        self.stats = {'points': 0, 'requests': 0, 'failed_points': 0, 'seconds': 0.0}
+
+    def add(self, points: List[Dict]):
+        """加入待写入的point，满一个chunk就提交（在途请求已满时阻塞，形成背压）"""
+        self._buffer.extend(points)
+        while len(self._buffer) >= self.chunk_size:
+            chunk, self._buffer = self._buffer[:self.chunk_size], self._buffer[self.chunk_size:]
+            self._submit(chunk)
+
+    def _submit(self, chunk: List[Dict]):
+        self._slots.acquire()
+        self._futures = [f for f in self._futures if not f.done()]
+        self._futures.append(self._executor.submit(self._send, chunk))
+
+    def _send(self, chunk: List[Dict]):
+        started = time.perf_counter()
+        try:
+            self.client.upsert_points(chunk)
+            with self._lock:
+                self.stats['points'] += len(chunk)
+                self.stats['requests'] += 1
+                self.stats['seconds'] += time.perf_counter() - started
+            if self.on_success:
+                self.on_success(chunk)
+        except Exception as e:
+            logger.error(f"❌ Qdrant批量upsert失败（{len(chunk)}个point）: {e}")
+            with self._lock:
+                self.stats['failed_points'] += len(chunk)
+            if self.on_error:
+                self.on_error(chunk, e)
+        finally:
+            self._slots.release()
+
+    def flush(self):
+        """提交剩余的point并等待所有在途请求完成"""
+        if self._buffer:
+            chunk, self._buffer = self._buffer, []
+            self._submit(chunk)
+        for future in self._futures:
+            future.result()
+        self._futures = []
+
+    def close(self):
+        """刷新并关闭线程池"""
+        self.flush()
+        self._executor.shutdown(wait=True)
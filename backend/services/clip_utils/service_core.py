@@ -0,0 +1,723 @@
+"""
+CLIP向量化服务的公共部分，同步服务（clip_vectorize_service.py，Flask）和异步服务（clip_async_service.py，ASGI）共用
+- 模型加载与预热、文本向量缓存、图片向量存储、近重复检测
+- 请求解析：参数错误抛出ValueError（对应400），需要其他状态码的错误抛出ServiceError
+- 响应体构建：返回字典，由各入口按自己的框架输出
+两个入口只保留传输层（路由、读取请求、错误转换为HTTP响应）和各自的推理调度（微批处理 / 有界队列和截止时间）
+"""
+import os
+import time
+import logging
+import threading
+
+import numpy as np
+
+from clip_encoder import get_clip_encoder, backend_id, ENCODER_MODES
+from config import VECTOR_DIMENSION, CLIP_CONFIG, TEXT_CACHE_CONFIG, SEARCH_CONFIG, TAGGING_CONFIG
+from image_loader import load_image_from_bytes, read_image_bytes_many
+from image_fetcher import fetcher_stats
+from vector_index import get_vector_index, index_stats
+from qdrant_rest import QdrantRest, QdrantError
+from image_embedding_store import get_image_embedding_store, content_digest
+from embedding_cache import EmbeddingCache
+from zero_shot import get_label_matrix, label_matrix_stats, LabelMatrixUnavailable
+from image_dedup import DedupBatch, get_duplicate_detector, perceptual_hash, detector_stats
+import vector_codec
+import metrics
+
+logger = logging.getLogger(__name__)
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+class ServiceError(Exception):
+    """请求无法完成：携带HTTP状态码、可选的Retry-After秒数和附加的响应字段"""
+
+    def __init__(self, message, status_code=500, retry_after=None, details=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.details = details or {}
+
+    def body(self):
+        return {'error': str(self), **self.details}
+
+
+class SearchBackendError(ServiceError):
+    """搜索后端不可用（本地索引未构建、Qdrant请求失败）"""
+
+    def __init__(self, message, status_code=503):
+        super().__init__(message, status_code)
+
+
+def is_true(value):
+    return str(value).lower() in ['1', 'true', 'yes']
+
+
+# 全局CLIP编码器实例
+clip_encoder = None
+_encoder_lock = threading.Lock()
+
+
+def init_clip_encoder():
+    """初始化CLIP编码器（加锁，预热线程和请求线程同时调用时只加载一次）"""
+    global clip_encoder
+    if clip_encoder is None:
+        with _encoder_lock:
+            if clip_encoder is None:
+                try:
+                    logger.info("正在初始化CLIP编码器...")
+                    clip_encoder = get_clip_encoder()
+                    logger.info("✅ CLIP编码器初始化成功")
+                except Exception as e:
+                    logger.error(f"❌ CLIP编码器初始化失败: {e}")
+                    raise
+    return clip_encoder
+
+
+def encoder_supports(kind):
+    """按CLIP_ENCODER_MODE判断是否提供该类编码（text / vision），不需要加载模型"""
+    return kind in ENCODER_MODES.get(CLIP_CONFIG['encoder_mode'], ())
+
+
+def require_encoder(kind, hint=''):
+    """当前编码器模式没有加载对应的塔时抛出ServiceError(501)"""
+    if not encoder_supports(kind):
+        raise ServiceError(
+            f"{'Text' if kind == 'text' else 'Image'} encoding is disabled (CLIP_ENCODER_MODE={CLIP_CONFIG['encoder_mode']}){hint}",
+            501)
+
+
+# 预热状态: not_started / warming / ready / failed
+warmup_state = {
+    'status': 'not_started',
+    'error': None,
+    'seconds': None
+}
+
+
+def warmup():
+    """加载模型并跑一次文本和图片的前向计算，触发算子和内存分配器的初始化"""
+    warmup_state['status'] = 'warming'
+    started = time.perf_counter()
+    try:
+        encoder = init_clip_encoder()
+        if encoder.supports('text') and encoder.encode_text('warmup') is None:
+            raise RuntimeError('文本预热前向计算失败')
+        from PIL import Image
+        if encoder.supports('vision') and encoder.encode_image(Image.new('RGB', (224, 224))) is None:
+            raise RuntimeError('图片预热前向计算失败')
+        warmup_state['seconds'] = round(time.perf_counter() - started, 2)
+        warmup_state['status'] = 'ready'
+        logger.info(f"✅ CLIP模型预热完成，耗时 {warmup_state['seconds']} 秒")
+    except Exception as e:
+        warmup_state['status'] = 'failed'
+        warmup_state['error'] = str(e)
+        logger.error(f"❌ CLIP模型预热失败: {e}")
+
+
+def start_warmup(mode=None):
+    """按配置启动预热：background在后台线程执行，blocking在当前线程执行，off不预热"""
+    mode = mode or CLIP_CONFIG['warmup']
+    if mode == 'off':
+        logger.info("提示: 预热已关闭，首次调用/encode-text时会自动加载模型（需要1-2分钟）")
+        return
+    if mode == 'blocking':
+        warmup()
+        return
+    threading.Thread(target=warmup, name='clip-warmup', daemon=True).start()
+
+
+def is_ready():
+    """是否可以接收流量：预热关闭时沿用延迟加载，始终就绪"""
+    if CLIP_CONFIG['warmup'] == 'off':
+        return True
+    return warmup_state['status'] == 'ready'
+
+
+def ready_body():
+    """/ready 响应体"""
+    return {
+        'ready': is_ready(),
+        'warmup': CLIP_CONFIG['warmup'],
+        **warmup_state
+    }
+
+
+# 文本查询向量缓存（按模型和推理后端区分，切换CLIP_BACKEND后不复用旧向量）
+text_cache = None
+if TEXT_CACHE_CONFIG['enabled']:
+    text_cache = EmbeddingCache(
+        f"{CLIP_CONFIG['model_name']}@{backend_id()}",
+        max_size=TEXT_CACHE_CONFIG['max_size'],
+        ttl_seconds=TEXT_CACHE_CONFIG['ttl_seconds'],
+        persist_path=TEXT_CACHE_CONFIG['persist_path']
+    )
+
+
+def cached_text_vectors(texts):
+    """查文本缓存，未命中的位置为None"""
+    with metrics.stage('cache_lookup', 'text'):
+        return [text_cache.get(t) if text_cache is not None else None for t in texts]
+
+
+def cache_text_vectors(texts, vectors):
+    """计算出的文本向量写回缓存"""
+    if text_cache is not None:
+        for text, vector in zip(texts, vectors):
+            if vector is not None:
+                text_cache.put(text, vector)
+
+
+def cache_stats():
+    """文本向量缓存统计"""
+    if text_cache is None:
+        return {'enabled': False}
+    return {'enabled': True, **text_cache.stats()}
+
+
+def image_store_stats():
+    """图片向量存储统计"""
+    store = get_image_embedding_store()
+    if store is None:
+        return {'enabled': False}
+    return {'enabled': True, **store.stats()}
+
+
+def health_body(**extra):
+    """/health 响应体（存活探针，不依赖模型是否加载完成），extra为各入口自己的调度统计"""
+    return {
+        'status': 'ok',
+        'service': 'clip-vectorize',
+        'pid': os.getpid(),
+        'clip_loaded': clip_encoder is not None,
+        'encoder_mode': CLIP_CONFIG['encoder_mode'],
+        'encoder_backend': CLIP_CONFIG['backend'],
+        'warmup': warmup_state['status'],
+        **extra,
+        'text_cache': cache_stats(),
+        'image_store': image_store_stats(),
+        'image_fetch': fetcher_stats(),
+        'search_backend': SEARCH_CONFIG['backend'],
+        'vector_index': index_stats(),
+        'tag_labels': label_matrix_stats(),
+        'image_dedup': detector_stats()
+    }
+
+
+def model_metrics():
+    """抓取时读取的模型状态：是否已加载、各加载阶段耗时、预热耗时"""
+    timings = clip_encoder.load_timings if clip_encoder is not None else {}
+    return [
+        ('clip_model_loaded', 'gauge', 'Whether the CLIP model is loaded in this process',
+         [({}, 1 if clip_encoder is not None else 0)]),
+        ('clip_model_load_seconds', 'gauge', 'Model load time by phase (resolve, processor, weights, ..., total)',
+         [({'phase': phase}, seconds) for phase, seconds in timings.items()]),
+        ('clip_warmup_seconds', 'gauge', 'Time spent loading and warming up the model at startup',
+         [({}, warmup_state['seconds'])])
+    ]
+
+
+metrics.REGISTRY.register_collector(model_metrics)
+
+# 端点 -> 阶段指标的类型标签
+ENDPOINT_KINDS = {
+    '/encode-text': 'text',
+    '/encode-texts': 'text',
+    '/search-text': 'text',
+    '/encode-image': 'image',
+    '/encode-images': 'image',
+    '/tag-images': 'image'
+}
+
+
+def negotiate_vector_format(params, accept, data=None):
+    """
+    确定向量响应格式和数据类型（params为查询参数）
+    格式: 查询参数/请求体的format（json|base64|binary），否则 Accept: application/octet-stream 时为binary，默认json
+    数据类型: dtype（float32|float16），只对base64和binary生效
+    """
+    data = data if isinstance(data, dict) else {}
+    fmt = vector_codec.resolve_format(params.get('format') or data.get('format'), accept)
+    dtype = vector_codec.resolve_dtype(params.get('dtype') or data.get('dtype'))
+    return fmt, dtype
+
+
+# ---------- 文本 ----------
+
+def parse_text(data):
+    """/encode-text 请求体中的文本"""
+    if not data or 'text' not in data:
+        raise ValueError('Missing "text" field in request body')
+    text = data['text']
+    if not text or not str(text).strip():
+        raise ValueError('Text cannot be empty')
+    return text
+
+
+def parse_texts(data):
+    """/encode-texts 请求体中的文本列表"""
+    if not data or 'texts' not in data:
+        raise ValueError('Missing "texts" field in request body')
+    texts = data['texts']
+    if not isinstance(texts, list) or len(texts) == 0:
+        raise ValueError('Texts must be a non-empty list')
+    return texts
+
+
+def text_body(text, vector):
+    """/encode-text 响应体（向量由 vector_codec.pack_vectors 按协商的格式加入）"""
+    if vector is None:
+        raise ServiceError('Failed to encode text')
+    return {
+        'status': 'success',
+        'text': text,
+        'dimension': len(vector)
+    }
+
+
+def texts_body(data, texts, vectors):
+    """/encode-texts 响应体，echo=false 时不回显输入文本"""
+    if not vectors:
+        raise ServiceError('Failed to encode texts')
+    body = {
+        'status': 'success',
+        'count': len(vectors),
+        'dimension': len(vectors[0])
+    }
+    if is_true(data.get('echo', 'true')):
+        body['texts'] = texts
+    return body
+
+
+# ---------- 图片 ----------
+
+def parse_image_source(data):
+    """JSON请求体中的单张图片（URL或本地路径）"""
+    source = data.get('image') or data.get('url') or data.get('path')
+    if not source or not str(source).strip():
+        raise ValueError('Missing "image" field in request body')
+    return str(source).strip()
+
+
+def parse_image_sources(data):
+    """JSON请求体中的图片列表"""
+    if not data or 'images' not in data:
+        raise ValueError('Missing "images" field in request body')
+    if not isinstance(data['images'], list) or len(data['images']) == 0:
+        raise ValueError('Images must be a non-empty list')
+    return data['images']
+
+
+def fetch_contents(images):
+    """
+    读取 [(来源, 字节或None)] 中尚未读取的图片（URL并发下载，共用连接池）
+    返回 (contents, errors)，读取失败的位置为None并在errors中说明
+    """
+    contents = [content for _, content in images]
+    errors = {}
+    pending = [index for index, content in enumerate(contents) if content is None]
+    if pending:
+        with metrics.stage('fetch', 'image'):
+            fetched = read_image_bytes_many([str(images[index][0]).strip() for index in pending])
+        for index, result in zip(pending, fetched):
+            if isinstance(result, Exception):
+                errors[index] = str(result)
+            else:
+                contents[index] = result
+    return contents, errors
+
+
+def lookup_images(contents):
+    """按内容摘要批量查图片向量存储，返回 (digests, vectors)；读取失败（None）和未命中的位置为None"""
+    digests = [content_digest(c) if c is not None else None for c in contents]
+    vectors = [None] * len(contents)
+    store = get_image_embedding_store()
+    if store is not None:
+        valid = [i for i, d in enumerate(digests) if d is not None]
+        for i, vector in zip(valid, store.get_many([digests[i] for i in valid])):
+            vectors[i] = vector
+    return digests, vectors
+
+
+def decode_image(content, with_hash=False):
+    """解码图片字节（with_hash: 同时计算感知哈希），无法解码时抛出ValueError"""
+    try:
+        with metrics.stage('decode', 'image'):
+            return load_image_from_bytes(content, with_hash=with_hash)
+    except Exception as e:
+        raise ValueError(str(e))
+
+
+def store_images(digests, vectors):
+    """计算出的图片向量写回存储"""
+    store = get_image_embedding_store()
+    if store is not None and digests:
+        store.put_many(digests, vectors)
+
+
+def parse_dedup(data, count):
+    """
+    近重复检测参数: dedup为真时需要与图片一一对应的image_ids（报告重复的是哪张图片、写入后按此登记），
+    返回 DedupBatch，未开启时返回None；multipart上传时image_ids为逗号分隔的字符串
+    """
+    if not is_true(data.get('dedup', 'false')):
+        return None
+    image_ids = data.get('image_ids')
+    if isinstance(image_ids, str):
+        image_ids = [int(v) if v.strip().isdigit() else v.strip() for v in image_ids.split(',')]
+    if not isinstance(image_ids, list) or len(image_ids) != count:
+        raise ValueError('"dedup" requires "image_ids" with one id per image')
+    return DedupBatch(get_duplicate_detector(), image_ids)
+
+
+def images_format(fmt, dedup):
+    """binary响应体只能携带向量矩阵，开启近重复检测时duplicates、hashes要放在响应体中，改用json"""
+    if dedup is not None and fmt == vector_codec.FORMAT_BINARY:
+        return vector_codec.FORMAT_JSON
+    return fmt
+
+
+def filter_hash_duplicates(dedup, decoded, vectors):
+    """
+    近重复检测第一级：decoded为[(index, 图片)]，包含命中图片向量存储的图片（内容相同的图片同样要判重）
+    命中的图片向量置为None，返回未命中且还没有向量（需要编码）的部分
+    """
+    with metrics.stage('dedup', 'image'):
+        kept = set(dedup.filter_hashes({index: perceptual_hash(image) for index, image in decoded}))
+    for index in dedup.duplicates:
+        vectors[index] = None
+    return [(index, image) for index, image in decoded if index in kept and vectors[index] is None]
+
+
+def flag_vector_duplicates(dedup, vectors):
+    """近重复检测第二级：余弦相似度命中的写入dedup.duplicates（向量仍然返回）"""
+    with metrics.stage('dedup', 'image'):
+        dedup.check_vectors(vectors)
+
+
+def parse_register_request(data):
+    """
+    /register-images 请求体: {"image_ids": [...], "vectors": [[...]]（或vectors_b64）, "hashes": ["16位十六进制" 或 null]}
+    vectors和hashes与image_ids一一对应（来自 /encode-images 的dedup结果），返回 [(image_id, 感知哈希, 向量)]
+    """
+    image_ids = data.get('image_ids') if data else None
+    if not isinstance(image_ids, list) or len(image_ids) == 0:
+        raise ValueError('"image_ids" must be a non-empty list')
+    vectors = parse_tag_vectors(data, VECTOR_DIMENSION)
+    hashes = data.get('hashes') or [None] * len(image_ids)
+    if vectors is None or len(vectors) != len(image_ids) or len(hashes) != len(image_ids):
+        raise ValueError('"vectors" and "hashes" must have one entry per image id')
+    try:
+        hashes = [int(value, 16) if value else None for value in hashes]
+    except (TypeError, ValueError):
+        raise ValueError('"hashes" must be hexadecimal strings')
+    try:
+        vectors = np.asarray(vectors, dtype=np.float32)
+    except (TypeError, ValueError):
+        raise ValueError('"vectors" must be numeric')
+    if vectors.ndim != 2 or vectors.shape[1] != VECTOR_DIMENSION:
+        raise ValueError(f'Vector dimension must be {VECTOR_DIMENSION}')
+    return list(zip(image_ids, hashes, vectors))
+
+
+def register_images(entries):
+    """把写入成功的图片登记到近重复检测器，返回 /register-images 响应体"""
+    detector = get_duplicate_detector()
+    for image_id, value, vector in entries:
+        detector.add(image_id, value, vector)
+    return {
+        'status': 'success',
+        'registered': len(entries)
+    }
+
+
+def image_error(errors):
+    """单张图片编码失败时的ServiceError：解码/读取失败为400，前向计算失败为500"""
+    if errors[0] == 'Failed to encode image':
+        return ServiceError(errors[0], 500)
+    return ServiceError(f'Failed to load image: {errors[0]}', 400)
+
+
+def images_body(vectors, errors, dedup=None):
+    """
+    /encode-images 响应体，返回 (body, vectors)：vectors需要按协商的格式加入；
+    全部是感知哈希命中的重复图片时向量已放入body（全为null），返回的vectors为None
+    开启近重复检测时，hashes给出通过检查的图片的感知哈希，写入成功后连同向量提交到 /register-images
+    """
+    encoded = [v for v in vectors if v is not None]
+    body = {
+        'status': 'success',
+        'count': len(encoded),
+        'errors': {str(k): v for k, v in errors.items()}
+    }
+    if dedup is not None:
+        body['duplicates'] = {str(k): v for k, v in dedup.duplicates.items()}
+        body['hashes'] = {str(k): format(dedup.hashes[k], '016x') for k in dedup.accepted() if k in dedup.hashes}
+    if len(encoded) == 0:
+        if dedup is not None and dedup.duplicates:
+            # 全部是感知哈希命中的重复图片，没有计算向量
+            body['vectors'] = vectors
+            return body, None
+        raise ServiceError('Failed to encode images', 500, details={'errors': body['errors']})
+    body['dimension'] = len(encoded[0])
+    return body, vectors
+
+
+# ---------- 零样本打标签 ----------
+
+def get_labels():
+    """
+    标签矩阵：可以编码文本时词表变化后当场重新计算，否则（vision模式）只加载已缓存的矩阵
+    词表缺失、格式错误或标签矩阵无法计算都属于服务端配置问题，抛出ServiceError(503)
+    """
+    encode_texts = None
+    if encoder_supports('text'):
+        encode_texts = lambda texts: init_clip_encoder().encode_texts_batch(texts)
+    try:
+        return get_label_matrix(encode_texts)
+    except (LabelMatrixUnavailable, OSError, ValueError) as e:
+        raise ServiceError(f'Tag labels are unavailable: {e}', 503)
+
+
+def parse_tag_options(data):
+    """解析打标签参数（groups、top_k、min_confidence），参数错误抛出ValueError"""
+    groups = data.get('groups')
+    if isinstance(groups, str):
+        groups = [name.strip() for name in groups.split(',') if name.strip()]
+    if groups is not None and not (isinstance(groups, list) and all(isinstance(name, str) for name in groups)):
+        raise ValueError('"groups" must be a list of group names')
+    top_k = data.get('top_k')
+    if top_k is not None:
+        top_k = int(top_k)
+        if top_k <= 0:
+            raise ValueError('"top_k" must be positive')
+    return {
+        'groups': groups or None,
+        'top_k': top_k,
+        'min_confidence': float(data.get('min_confidence', TAGGING_CONFIG['min_confidence'])),
+        'logit_scale': TAGGING_CONFIG['logit_scale']
+    }
+
+
+def parse_tag_vectors(data, dimension):
+    """已计算的图片向量: vectors（数组）或 vectors_b64（base64，dtype默认float32）；都没有时返回None"""
+    if isinstance(data.get('vectors'), list):
+        if not data['vectors']:
+            raise ValueError('Vectors must be a non-empty list')
+        return data['vectors']
+    if data.get('vectors_b64'):
+        return vector_codec.from_base64(data['vectors_b64'], dimension, vector_codec.resolve_dtype(data.get('dtype')))
+    return None
+
+
+def tag_body(labels, vectors, errors, options):
+    """对已有向量打分（一次矩阵乘），返回 /tag-images 响应体；没有可用向量时抛出ServiceError(500)"""
+    rows = [index for index, vector in enumerate(vectors) if vector is not None]
+    if len(rows) == 0:
+        raise ServiceError('Failed to encode images', 500,
+                           details={'errors': {str(k): v for k, v in errors.items()}})
+
+    started = time.perf_counter()
+    with metrics.stage('score', 'image'):
+        tags = labels.score([vectors[index] for index in rows], **options)
+    results = [None] * len(vectors)
+    for index, item in zip(rows, tags):
+        results[index] = item
+
+    return {
+        'status': 'success',
+        'count': len(rows),
+        'labels': labels.digest[:16],
+        'took_ms': {
+            'score': round((time.perf_counter() - started) * 1000, 3)
+        },
+        'results': results,
+        'errors': {str(k): v for k, v in errors.items()}
+    }
+
+
+# ---------- 搜索 ----------
+
+SEARCH_BACKENDS = ('qdrant', 'local', 'auto')
+
+
+def parse_search_options(data):
+    """
+    解析搜索参数（/search 与 /search-text 共用），返回VectorIndex.search参数，参数错误抛出ValueError
+    过滤: filter {字段: 值或[值]} 与 image_ids（同Node端searchVectors的imageIds）
+    """
+    conditions = data.get('filter') or {}
+    if not isinstance(conditions, dict):
+        raise ValueError('"filter" must be an object')
+    conditions = dict(conditions)
+    if data.get('image_ids'):
+        conditions['image_id'] = data['image_ids']
+    limit = int(data.get('limit', 10))
+    offset = int(data.get('offset', 0))
+    if limit <= 0 or offset < 0:
+        raise ValueError('"limit" must be positive and "offset" must not be negative')
+    if limit > SEARCH_CONFIG['max_limit']:
+        raise ValueError(f'"limit" must not exceed {SEARCH_CONFIG["max_limit"]}')
+    threshold = data.get('score_threshold')
+    return {
+        'limit': limit,
+        'offset': offset,
+        'score_threshold': float(threshold) if threshold is not None else None,
+        'conditions': conditions,
+        'exact': bool(data.get('exact', False))
+    }
+
+
+def parse_with_payload(data, default):
+    """with_payload: true（全部字段）、false（不返回）或字段名列表"""
+    with_payload = data.get('with_payload', default)
+    if isinstance(with_payload, bool):
+        return with_payload
+    if isinstance(with_payload, list) and all(isinstance(field, str) for field in with_payload):
+        return with_payload
+    raise ValueError('"with_payload" must be a boolean or a list of field names')
+
+
+def parse_search_request(data):
+    """
+    解析 /search 请求体，返回 (查询向量, VectorIndex.search参数)，参数错误抛出ValueError
+    查询向量: vector（数组）或 vector_b64（base64，dtype默认float32）
+    """
+    if isinstance(data.get('vector'), list):
+        vector = data['vector']
+    elif data.get('vector_b64'):
+        vector = vector_codec.from_base64(data['vector_b64'], VECTOR_DIMENSION,
+                                          vector_codec.resolve_dtype(data.get('dtype')))[0]
+    else:
+        raise ValueError('Missing "vector" field in request body')
+    return vector, parse_search_options(data)
+
+
+def search_local_index(data):
+    """在本地向量索引中搜索，返回 /search 响应体；索引尚未构建时抛出SearchBackendError(503)，参数错误抛出ValueError"""
+    if not data:
+        raise ValueError('Missing "vector" field in request body')
+    index = get_vector_index()
+    if index is None:
+        raise SearchBackendError('Local vector index is not built, run clip_build_index.py first')
+    vector, options = parse_search_request(data)
+    with_payload = parse_with_payload(data, True)
+    started = time.perf_counter()
+    results, method = index.search(vector, **options)
+    return {
+        'status': 'success',
+        'count': len(results),
+        'method': method,
+        'took_ms': round((time.perf_counter() - started) * 1000, 3),
+        'results': [select_payload(result, with_payload) for result in results]
+    }
+
+
+def select_payload(result, with_payload):
+    """按with_payload裁剪单条结果的payload"""
+    item = {'id': result['id'], 'score': result['score']}
+    if with_payload is True:
+        item['payload'] = result.get('payload') or {}
+    elif with_payload:
+        payload = result.get('payload') or {}
+        item['payload'] = {field: payload[field] for field in with_payload if field in payload}
+    return item
+
+
+_search_client = None
+_search_client_lock = threading.Lock()
+
+
+def get_search_client():
+    """搜索用的Qdrant客户端（连接复用；超时和重试比批量写入更短）"""
+    global _search_client
+    with _search_client_lock:
+        if _search_client is None:
+            _search_client = QdrantRest(timeout=SEARCH_CONFIG['qdrant_timeout'],
+                                        max_retries=SEARCH_CONFIG['qdrant_retries'])
+    return _search_client
+
+
+def qdrant_filter(conditions):
+    """{字段: 值或[值]} -> Qdrant filter（字段之间为must，列表为match any）"""
+    must = []
+    for field, values in conditions.items():
+        if isinstance(values, (list, tuple)):
+            must.append({'key': field, 'match': {'any': list(values)}})
+        else:
+            must.append({'key': field, 'match': {'value': values}})
+    return {'must': must} if must else None
+
+
+def resolve_search_backend(requested=None):
+    """确定搜索后端（auto: 本地索引已构建时用local，否则qdrant）"""
+    backend = (requested or SEARCH_CONFIG['backend']).lower()
+    if backend not in SEARCH_BACKENDS:
+        raise ValueError(f'Unsupported search backend: {backend}, expected one of {list(SEARCH_BACKENDS)}')
+    if backend == 'auto':
+        return 'local' if get_vector_index() is not None else 'qdrant'
+    return backend
+
+
+def parse_text_search(data):
+    """解析 /search-text 请求体（在编码查询之前完成校验），参数错误抛出ValueError"""
+    if not data or 'text' not in data:
+        raise ValueError('Missing "text" field in request body')
+    text = data.get('text')
+    if not isinstance(text, str) or not text.strip():
+        raise ValueError('Text cannot be empty')
+    # 调用方指定集合时必须与本服务搜索的集合一致，避免配置不一致时静默搜索另一个集合
+    collection = data.get('collection')
+    served = get_search_client().collection
+    if collection is not None and collection != served:
+        raise ValueError(f'Collection "{collection}" is not served by this service (configured: "{served}")')
+    return {
+        'text': text.strip(),
+        'options': parse_search_options(data),
+        'backend': resolve_search_backend(data.get('backend')),
+        # 默认只返回id和分数，需要的payload字段由调用方指定
+        'with_payload': parse_with_payload(data, False)
+    }
+
+
+def execute_search(vector, plan):
+    """用查询向量执行搜索，返回 (裁剪后的结果, 使用的方法)；后端不可用时抛出SearchBackendError"""
+    options, with_payload = plan['options'], plan['with_payload']
+    if plan['backend'] == 'local':
+        index = get_vector_index()
+        if index is None:
+            raise SearchBackendError('Local vector index is not built, run clip_build_index.py first')
+        results, method = index.search(vector, **options)
+        return [select_payload(result, with_payload) for result in results], method
+
+    try:
+        results = get_search_client().search_points(
+            vector, limit=options['limit'], offset=options['offset'],
+            score_threshold=options['score_threshold'], query_filter=qdrant_filter(options['conditions']),
+            with_payload=with_payload, exact=options['exact'])
+    except QdrantError as e:
+        raise SearchBackendError(str(e), 502)
+    return [select_payload(result, with_payload) for result in results], 'qdrant'
+
+
+def search_text_body(plan, vector, encode_seconds):
+    """用已编码的查询向量执行搜索，返回 /search-text 响应体"""
+    if vector is None:
+        raise ServiceError('Failed to encode text')
+    started = time.perf_counter()
+    results, method = execute_search(vector, plan)
+    return {
+        'status': 'success',
+        'text': plan['text'],
+        'backend': plan['backend'],
+        'method': method,
+        'count': len(results),
+        'limit': plan['options']['limit'],
+        'offset': plan['options']['offset'],
+        'took_ms': {
+            'encode': round(encode_seconds * 1000, 3),
+            'search': round((time.perf_counter() - started) * 1000, 3)
+        },
+        'results': results
+    }
@@ -0,0 +1,100 @@
+"""
+向量编码格式
+JSON浮点列表每个512维向量约10KB文本，格式化和解析都很耗时；
+这里提供紧凑格式：原始小端float32/float16字节，以及JSON内嵌的base64
+"""
+import base64
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+SUPPORTED_DTYPES = ('float32', 'float16')
+
+# 格式名称
+FORMAT_JSON = 'json'
+FORMAT_BASE64 = 'base64'
+FORMAT_BINARY = 'binary'
+SUPPORTED_FORMATS = (FORMAT_JSON, FORMAT_BASE64, FORMAT_BINARY)
+
+BINARY_MIMETYPE = 'application/octet-stream'
+
+
+def resolve_format(requested: Optional[str], accept: Optional[str]) -> str:
+    """确定响应格式：显式参数优先，其次看Accept头，默认JSON"""
+    if requested:
+        requested = requested.lower()
+        if requested not in SUPPORTED_FORMATS:
+            raise ValueError(f'Unsupported format "{requested}", expected one of {", ".join(SUPPORTED_FORMATS)}')
+        return requested
+    if accept and BINARY_MIMETYPE in accept:
+        return FORMAT_BINARY
+    return FORMAT_JSON
+
+
+def resolve_dtype(requested: Optional[str]) -> str:
+    """确定紧凑格式使用的数据类型，默认float32"""
+    dtype = (requested or 'float32').lower()
+    if dtype not in SUPPORTED_DTYPES:
+        raise ValueError(f'Unsupported dtype "{dtype}", expected one of {", ".join(SUPPORTED_DTYPES)}')
+    return dtype
+
+
+def to_bytes(vectors: np.ndarray, dtype: str = 'float32') -> bytes:
+    """向量矩阵（或单个向量）转为小端字节，按行连续排列"""
+    return np.ascontiguousarray(vectors, dtype=np.dtype(dtype).newbyteorder('<')).tobytes()
+
+
+def to_base64(vectors: np.ndarray, dtype: str = 'float32') -> str:
+    """向量矩阵（或单个向量）转为base64字符串"""
+    return base64.b64encode(to_bytes(vectors, dtype)).decode('ascii')
+
+
+def from_bytes(data: bytes, dimension: int, dtype: str = 'float32') -> np.ndarray:
+    """解析小端字节为 (count, dimension) 的float32矩阵"""
+    vectors = np.frombuffer(data, dtype=np.dtype(dtype).newbyteorder('<'))
+    return vectors.reshape(-1, dimension).astype(np.float32)
+
+
+def from_base64(text: str, dimension: int, dtype: str = 'float32') -> np.ndarray:
+    """解析base64字符串为 (count, dimension) 的float32矩阵"""
+    return from_bytes(base64.b64decode(text), dimension, dtype)
+
+
+def pack_vectors(body: dict, vectors: List[Optional[np.ndarray]], fmt: str, dtype: str = 'float32',
+                 single: bool = False) -> Tuple[Optional[dict], Optional[bytes], Dict[str, str]]:
+    """
+    按格式组装向量响应，返回 (JSON响应体, 二进制响应体, 响应头)，两种响应体只有一个不为None
+    json: body中加入vector/vectors浮点列表
+    base64: body中加入vector_b64/vectors_b64（按行连续的小端字节）和dtype
+    binary: 原始小端字节，维度、数量、类型放在 X-Vector-* 响应头中，body中的其余字段不输出
+    批量结果中为None的行在紧凑格式中以0填充，并通过missing（或 X-Vector-Missing 头）给出位置
+    """
+    if fmt == FORMAT_JSON:
+        if single:
+            body['vector'] = vectors[0].tolist()
+        else:
+            body['vectors'] = [v.tolist() if v is not None else None for v in vectors]
+        return body, None, {}
+
+    dimension = next(len(v) for v in vectors if v is not None)
+    missing = [i for i, v in enumerate(vectors) if v is None]
+    matrix = np.zeros((len(vectors), dimension), dtype=np.float32)
+    for i, v in enumerate(vectors):
+        if v is not None:
+            matrix[i] = v
+
+    if fmt == FORMAT_BASE64:
+        body['vector_b64' if single else 'vectors_b64'] = to_base64(matrix, dtype)
+        body['dtype'] = dtype
+        if missing:
+            body['missing'] = missing
+        return body, None, {}
+
+    headers = {
+        'X-Vector-Dimension': str(dimension),
+        'X-Vector-Count': str(len(vectors)),
+        'X-Vector-Dtype': dtype
+    }
+    if missing:
+        headers['X-Vector-Missing'] = ','.join(str(i) for i in missing)
+    return None, to_bytes(matrix, dtype), headers
@@ -0,0 +1,312 @@
+"""
+向量压缩模块
+把归一化的CLIP向量（512维float32，每条2KB）压缩存储，搜索时先在压缩码上粗排，再用原始float向量精排top-k：
+  - float16：每维2字节（2x）；NumPy的float16->float32转换很慢，扫描比float32精确搜索慢得多
+    （8192x512单核约16ms，float32精确搜索约2ms），只用于省内存
+  - int8：逐维对称标量量化，每维1字节（4x）
+  - pq：乘积量化，向量切成m段、每段用256个中心之一的编号表示，每条m字节（m=64时32x，m=128时16x）
+粗排只读压缩码（常驻内存），精排只读候选行的原始向量（内存映射，按需换页），常驻内存按压缩比下降
+"""
+import time
+import logging
+from typing import Dict, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+CHUNK_ROWS = 65536
+# 扫描时每块的行数：转换后的float32块留在CPU缓存中，比大块转换快2-3倍
+SCAN_ROWS = 2048
+QUANTIZERS = ('float16', 'int8', 'pq')
+
+
+def _scan(codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """分块把压缩码转换为float32（复用同一个缓冲区）后与查询向量做内积"""
+    scores = np.empty(len(codes), dtype=np.float32)
+    buffer = np.empty((min(SCAN_ROWS, len(codes)), codes.shape[1]), dtype=np.float32)
+    for start in range(0, len(codes), SCAN_ROWS):
+        block = codes[start:start + SCAN_ROWS]
+        converted = buffer[:len(block)]
+        converted[...] = block
+        np.dot(converted, query, out=scores[start:start + len(block)])
+    return scores
+
+
+class Float16Codec:
+    """float16存储：无需训练"""
+
+    kind = 'float16'
+
+    def __init__(self):
+        self.dimension = None
+
+    def fit(self, vectors: np.ndarray) -> 'Float16Codec':
+        self.dimension = vectors.shape[1]
+        return self
+
+    @property
+    def code_size(self) -> int:
+        """每条向量的字节数"""
+        return self.dimension * 2
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.asarray(vectors, dtype=np.float16)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return np.asarray(codes, dtype=np.float32)
+
+    def score(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """压缩码与查询向量的内积（分块转换为float32，避免float16的非BLAS矩阵乘）"""
+        return _scan(codes, np.asarray(query, dtype=np.float32))
+
+    def state(self) -> Dict[str, np.ndarray]:
+        return {'dimension': np.array(self.dimension)}
+
+    def load_state(self, state):
+        self.dimension = int(state['dimension'])
+        return self
+
+
+class ScalarQuantizer:
+    """int8逐维对称标量量化：x ≈ code * scale，scale取训练数据每一维的最大绝对值 / 127"""
+
+    kind = 'int8'
+
+    def __init__(self):
+        self.scale = None
+
+    def fit(self, vectors: np.ndarray) -> 'ScalarQuantizer':
+        peak = np.abs(np.asarray(vectors, dtype=np.float32)).max(axis=0)
+        self.scale = np.where(peak > 0, peak / 127.0, 1.0).astype(np.float32)
+        return self
+
+    @property
+    def code_size(self) -> int:
+        return len(self.scale)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.empty(vectors.shape, dtype=np.int8)
+        for start in range(0, len(vectors), CHUNK_ROWS):
+            block = np.asarray(vectors[start:start + CHUNK_ROWS], dtype=np.float32) / self.scale
+            codes[start:start + len(block)] = np.clip(np.rint(block), -127, 127)
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return np.asarray(codes, dtype=np.float32) * self.scale
+
+    def score(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """code·(query*scale)，缩放并入查询向量，逐块只做一次类型转换和内积"""
+        return _scan(codes, (query * self.scale).astype(np.float32))
+
+    def state(self) -> Dict[str, np.ndarray]:
+        return {'scale': self.scale}
+
+    def load_state(self, state):
+        self.scale = state['scale']
+        return self
+
+
+class ProductQuantizer:
+    """
+    乘积量化（内积ADC）：向量切成m段，每段用k-means训练的256个中心编码为1字节
+    查询时先算每段查询子向量与256个中心的内积表，再按编码查表求和
+    """
+
+    kind = 'pq'
+
+    def __init__(self, subspaces: int = 64, centroids: int = 256, iterations: int = 12,
+                 sample_size: int = 32768, seed: int = 0):
+        if centroids > 256:
+            raise ValueError("每段中心数不能超过256（编码为uint8）")
+        self.subspaces = int(subspaces)
+        self.centroids = int(centroids)
+        self.iterations = iterations
+        self.sample_size = sample_size
+        self.seed = seed
+        self.codebook = None  # (m, ks, d_sub)
+
+    @property
+    def code_size(self) -> int:
+        return self.subspaces
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        """(N, D) -> (m, N, d_sub)"""
+        rows, dimension = vectors.shape
+        return np.asarray(vectors, dtype=np.float32).reshape(rows, self.subspaces, dimension // self.subspaces).transpose(1, 0, 2)
+
+    @staticmethod
+    def _assign(points: np.ndarray, centers: np.ndarray) -> np.ndarray:
+        """欧氏距离最近的中心（||c||² - 2x·c，省去与中心无关的||x||²）"""
+        distances = (centers * centers).sum(axis=1) - 2.0 * (points @ centers.T)
+        return np.argmin(distances, axis=1)
+
+    def fit(self, vectors: np.ndarray) -> 'ProductQuantizer':
+        rows, dimension = vectors.shape
+        if dimension % self.subspaces:
+            raise ValueError(f"向量维度 {dimension} 不能被分段数 {self.subspaces} 整除")
+        rng = np.random.default_rng(self.seed)
+        sample = np.asarray(vectors[np.sort(rng.choice(rows, min(rows, self.sample_size), replace=False))],
+                            dtype=np.float32)
+        ks = min(self.centroids, len(sample))
+        started = time.perf_counter()
+        parts = self._split(sample)
+        codebook = np.empty((self.subspaces, ks, parts.shape[2]), dtype=np.float32)
+        for index, points in enumerate(parts):
+            centers = points[rng.choice(len(points), ks, replace=False)].copy()
+            for _ in range(self.iterations):
+                labels = self._assign(points, centers)
+                counts = np.bincount(labels, minlength=ks)
+                # 按列bincount求各簇之和（比np.add.at快一个数量级）
+                sums = np.stack([np.bincount(labels, weights=points[:, dim], minlength=ks)
+                                 for dim in range(points.shape[1])], axis=1)
+                filled = counts > 0
+                centers[filled] = sums[filled] / counts[filled, None]
+                # 空簇重新取随机样本
+                if not filled.all():
+                    centers[~filled] = points[rng.choice(len(points), int((~filled).sum()), replace=False)]
+            codebook[index] = centers
+        self.codebook = codebook
+        logger.info(f"PQ码本训练完成: {self.subspaces}段 x {ks}中心，样本 {len(sample)}，耗时 {time.perf_counter() - started:.1f}秒")
+        return self
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.empty((len(vectors), self.subspaces), dtype=np.uint8)
+        for start in range(0, len(vectors), CHUNK_ROWS):
+            parts = self._split(vectors[start:start + CHUNK_ROWS])
+            for index, points in enumerate(parts):
+                codes[start:start + points.shape[0], index] = self._assign(points, self.codebook[index])
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        parts = [self.codebook[index][codes[:, index]] for index in range(self.subspaces)]
+        return np.concatenate(parts, axis=1)
+
+    def score(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """ADC：每段查表（m x ks 内积表）后求和"""
+        table = np.einsum('mkd,md->mk', self.codebook, query.reshape(self.subspaces, -1).astype(np.float32))
+        # 展平成一维表，编码加上每段的偏移后一次take
+        flat = table.reshape(-1)
+        offsets = (np.arange(self.subspaces) * table.shape[1]).astype(np.intp)
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), SCAN_ROWS):
+            block = np.asarray(codes[start:start + SCAN_ROWS], dtype=np.intp) + offsets
+            scores[start:start + len(block)] = flat.take(block).sum(axis=1)
+        return scores
+
+    def state(self) -> Dict[str, np.ndarray]:
+        return {'codebook': self.codebook}
+
+    def load_state(self, state):
+        self.codebook = state['codebook']
+        self.subspaces, self.centroids = self.codebook.shape[0], self.codebook.shape[1]
+        return self
+
+
+def make_quantizer(kind: str, subspaces: int = 64):
+    """按名称创建量化器"""
+    if kind == 'float16':
+        return Float16Codec()
+    if kind == 'int8':
+        return ScalarQuantizer()
+    if kind == 'pq':
+        return ProductQuantizer(subspaces=subspaces)
+    raise ValueError(f"不支持的压缩方式: {kind}，可选: {list(QUANTIZERS)}")
+
+
+def save_quantizer(quantizer, path: str):
+    """保存量化器参数（.npz）"""
+    np.savez(path, kind=np.array(quantizer.kind), **quantizer.state())
+
+
+def load_quantizer(path: str):
+    """读取 save_quantizer 保存的量化器"""
+    with np.load(path) as data:
+        state = {key: data[key] for key in data.files}
+    quantizer = make_quantizer(str(state.pop('kind')))
+    return quantizer.load_state(state)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """分数最高的k个位置（按分数降序）"""
+    if k < len(scores):
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+def compression_report(vectors: np.ndarray, kinds: Sequence[str] = QUANTIZERS, queries: int = 200,
+                       k: int = 10, rerank_factor: int = 4, subspaces: Sequence[int] = (64,),
+                       train_size: int = 65536, seed: int = 0) -> Dict:
+    """
+    在给定向量上评估各压缩方式：每条字节数、压缩比、仅压缩码检索与精排后的 recall@k、单次查询耗时
+    （avg_ms只计入打分、粗排和精排，float32为精确搜索）
+    查询取自数据本身（去掉自身后求近邻），不依赖外部标注
+    """
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    rows, dimension = vectors.shape
+    query_rows = rng.choice(rows, min(queries, rows), replace=False)
+    train = vectors[np.sort(rng.choice(rows, min(rows, train_size), replace=False))]
+    k = min(k, rows - 1)
+
+    def search(scores, row, count):
+        """分数最高的count个位置（去掉查询向量自身）"""
+        candidates = top_k(scores, count + 1)
+        return candidates[candidates != row][:count]
+
+    # 耗时只计入打分和取top-k（召回率统计不计入），与压缩方式的粗排+精排可比
+    truth, exact_seconds = [], 0.0
+    for row in query_rows:
+        started = time.perf_counter()
+        found = search(vectors @ vectors[row], row, k)
+        exact_seconds += time.perf_counter() - started
+        truth.append(set(found.tolist()))
+    exact_ms = exact_seconds / len(query_rows) * 1000
+
+    report = {
+        'vectors': rows,
+        'dimension': dimension,
+        'queries': len(query_rows),
+        'k': k,
+        'rerank_factor': rerank_factor,
+        'float32': {'bytes_per_vector': dimension * 4, 'memory_mb': round(rows * dimension * 4 / 1024 / 1024, 2),
+                    'avg_ms': round(exact_ms, 3)}
+    }
+    configs = []
+    for kind in kinds:
+        if kind == 'pq':
+            configs.extend((f'pq{m}', lambda m=m: ProductQuantizer(subspaces=m)) for m in subspaces)
+        else:
+            configs.append((kind, lambda kind=kind: make_quantizer(kind)))
+
+    for name, factory in configs:
+        fit_started = time.perf_counter()
+        quantizer = factory().fit(train)
+        codes = quantizer.encode(vectors)
+        build_seconds = time.perf_counter() - fit_started
+        recall_raw, recall_rerank = [], []
+        search_seconds = 0.0
+        for row, expected in zip(query_rows, truth):
+            query = vectors[row]
+            # 计时：压缩码粗排 + 候选精排
+            started = time.perf_counter()
+            approx = quantizer.score(codes, query)
+            candidates = search(approx, row, k * rerank_factor)
+            reranked = candidates[top_k(vectors[candidates] @ query, k)]
+            search_seconds += time.perf_counter() - started
+            recall_raw.append(len(expected & set(search(approx, row, k).tolist())) / k)
+            recall_rerank.append(len(expected & set(reranked.tolist())) / k)
+        bytes_per_vector = codes.nbytes // rows
+        report[name] = {
+            'bytes_per_vector': bytes_per_vector,
+            'compression': round(dimension * 4 / bytes_per_vector, 1),
+            'memory_mb': round(codes.nbytes / 1024 / 1024, 2),
+            f'recall@{k}': round(float(np.mean(recall_raw)), 4),
+            f'recall@{k}_rerank': round(float(np.mean(recall_rerank)), 4),
+            'avg_ms': round(search_seconds / len(query_rows) * 1000, 3),
+            'build_seconds': round(build_seconds, 2)
+        }
+    return report
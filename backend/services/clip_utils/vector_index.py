@@ -0,0 +1,382 @@
+"""
+本地向量索引
+从导出的图片向量（Qdrant scroll 或 clip_bulk_vectorize.py 的JSONL输出）构建，在Python端直接做向量搜索：
+  - 小集合：精确搜索，内存映射的向量矩阵与查询向量做一次矩阵乘，argpartition取top-k
+  - 大集合：IVF（球面k-means聚类 + 倒排列表），只扫描与查询最接近的nprobe个列表
+  - payload过滤（brand_id、model_id、image_id等）：构建时把过滤字段存为列，查询时整列比较得到掩码
+  - 可选压缩（float16/int8/PQ，见 vector_compression.py）：扫描压缩码粗排，再读取候选行的原始向量精排
+结果格式与Qdrant search一致（id、score、payload），可作为Qdrant的本地替代或降级方案
+
+目录结构: <directory>/
+    meta.json          数量、维度、过滤字段、IVF参数
+    vectors.npy        (N, 512) float32，已归一化，np.load内存映射读取
+    ids.npy            point ID（整数或字符串）
+    payloads.jsonl     每行一个payload
+    col_<字段>.npy      过滤字段列
+    ivf_centroids.npy / ivf_order.npy / ivf_offsets.npy   IVF聚类中心、按列表排序的行号、各列表起止位置
+    codes.npy / quantizer.npz   压缩码和量化器参数（启用压缩时）
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from config import INDEX_CONFIG, VECTOR_DIMENSION
+from vector_compression import load_quantizer, make_quantizer, save_quantizer
+
+logger = logging.getLogger(__name__)
+
+MISSING_INT = np.iinfo(np.int64).min
+CHUNK_ROWS = 65536
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    """按行L2归一化（全零行保持不变）"""
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _column(values: List) -> np.ndarray:
+    """过滤字段值 -> 列：全部为整数时存int64（缺失为MISSING_INT），否则存字符串（缺失为空串）"""
+    present = [v for v in values if v is not None]
+    if all(isinstance(v, (int, np.integer)) and not isinstance(v, bool) for v in present):
+        return np.array([MISSING_INT if v is None else v for v in values], dtype=np.int64)
+    return np.array(['' if v is None else str(v) for v in values], dtype=str)
+
+
+def _coerce(column: np.ndarray, values) -> np.ndarray:
+    """把过滤条件的值转换为与列相同的类型（无法转换的值不会匹配任何行）"""
+    if not isinstance(values, (list, tuple, set)):
+        values = [values]
+    if column.dtype == np.int64:
+        coerced = []
+        for value in values:
+            try:
+                coerced.append(int(value))
+            except (TypeError, ValueError):
+                continue
+        return np.array(coerced, dtype=np.int64)
+    return np.array([str(value) for value in values], dtype=str)
+
+
+def train_ivf(matrix: np.ndarray, nlist: int, iterations: int = 10, sample_size: Optional[int] = None,
+              seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    球面k-means训练IVF聚类中心，并把所有行分配到最近的中心
+    Returns: (centroids (nlist, D), assignments (N,))
+    """
+    rows = matrix.shape[0]
+    nlist = max(1, min(int(nlist), rows))
+    rng = np.random.default_rng(seed)
+    sample_size = min(rows, sample_size or nlist * 64)
+    sample = np.asarray(matrix[np.sort(rng.choice(rows, sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        labels = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        counts = np.bincount(labels, minlength=nlist)
+        empty = counts == 0
+        if empty.any():
+            # 空簇用随机样本重新初始化
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()), replace=False)]
+        centroids = _normalize(sums).astype(np.float32)
+
+    assignments = np.empty(rows, dtype=np.int32)
+    for start in range(0, rows, CHUNK_ROWS):
+        block = np.asarray(matrix[start:start + CHUNK_ROWS], dtype=np.float32)
+        assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return centroids, assignments
+
+
+def build_index(records: Iterable[Tuple], directory: str, filter_fields: Sequence[str] = (),
+                ivf_lists: int = 0, ann_threshold: int = 50000, dimension: int = VECTOR_DIMENSION,
+                compression: str = 'none', pq_subspaces: int = 64) -> Dict:
+    """
+    从 (point_id, vector, payload) 记录流构建索引并原子替换directory
+
+    Args:
+        ivf_lists: IVF列表数；0表示自动（数量超过ann_threshold时取 4*sqrt(N)），-1表示不构建IVF
+        compression: none | float16 | int8 | pq（量化器在最多65536条样本上训练）
+    Returns:
+        meta.json的内容
+    """
+    started = time.perf_counter()
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    staging = f"{os.path.abspath(directory)}.building-{os.getpid()}"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    # 第一遍：向量按行追加到临时文件，payload逐行写出，过滤字段收集为列
+    ids, columns = [], {field: [] for field in filter_fields}
+    raw_path = os.path.join(staging, 'vectors.raw')
+    with open(raw_path, 'wb') as raw, open(os.path.join(staging, 'payloads.jsonl'), 'w', encoding='utf-8') as payloads:
+        for point_id, vector, payload in records:
+            vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+            if vector.shape[0] != dimension:
+                raise ValueError(f"向量维度错误: 期望{dimension}维，实际{vector.shape[0]}维（point {point_id}）")
+            payload = payload or {}
+            raw.write(vector.tobytes())
+            payloads.write(json.dumps(payload, ensure_ascii=False) + '\n')
+            ids.append(point_id)
+            for field in filter_fields:
+                columns[field].append(payload.get(field))
+    count = len(ids)
+    if count == 0:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise ValueError("没有可用于构建索引的向量")
+
+    # 第二遍：归一化写入 .npy（分块，内存占用与总数无关）
+    matrix = np.lib.format.open_memmap(os.path.join(staging, 'vectors.npy'), mode='w+',
+                                       dtype=np.float32, shape=(count, dimension))
+    raw = np.memmap(raw_path, dtype=np.float32, mode='r', shape=(count, dimension))
+    for start in range(0, count, CHUNK_ROWS):
+        matrix[start:start + CHUNK_ROWS] = _normalize(np.asarray(raw[start:start + CHUNK_ROWS]))
+    matrix.flush()
+    del raw
+    os.remove(raw_path)
+
+    np.save(os.path.join(staging, 'ids.npy'), _column(ids))
+    for field, values in columns.items():
+        np.save(os.path.join(staging, f'col_{field}.npy'), _column(values))
+
+    if ivf_lists == 0 and count > ann_threshold:
+        ivf_lists = int(4 * np.sqrt(count))
+    nlist = 0
+    if ivf_lists > 0:
+        centroids, assignments = train_ivf(matrix, ivf_lists)
+        nlist = centroids.shape[0]
+        order = np.argsort(assignments, kind='stable').astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=nlist))]).astype(np.int64)
+        np.save(os.path.join(staging, 'ivf_centroids.npy'), centroids)
+        np.save(os.path.join(staging, 'ivf_order.npy'), order)
+        np.save(os.path.join(staging, 'ivf_offsets.npy'), offsets)
+    code_bytes = 0
+    if compression != 'none':
+        rng = np.random.default_rng(0)
+        sample = matrix[np.sort(rng.choice(count, min(count, 65536), replace=False))]
+        quantizer = make_quantizer(compression, subspaces=pq_subspaces).fit(sample)
+        codes = quantizer.encode(matrix)
+        code_bytes = codes.nbytes // count
+        np.save(os.path.join(staging, 'codes.npy'), codes)
+        save_quantizer(quantizer, os.path.join(staging, 'quantizer.npz'))
+    del matrix
+
+    meta = {
+        'count': count,
+        'dimension': dimension,
+        'filter_fields': list(filter_fields),
+        'ivf_lists': nlist,
+        'compression': compression,
+        'code_bytes': code_bytes,
+        'built_at': time.time(),
+        'build_seconds': round(time.perf_counter() - started, 3)
+    }
+    with open(os.path.join(staging, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    # 先把旧索引移开再换入新目录，服务端按meta.json的修改时间重新加载
+    directory = os.path.abspath(directory)
+    retired = f"{directory}.old-{os.getpid()}"
+    if os.path.exists(directory):
+        os.rename(directory, retired)
+    os.rename(staging, directory)
+    shutil.rmtree(retired, ignore_errors=True)
+    logger.info(f"✅ 向量索引已构建: {directory}（{count} 条，IVF列表 {nlist}，耗时 {meta['build_seconds']}秒）")
+    return meta
+
+
+class VectorIndex:
+    """只读的本地向量索引（线程安全，向量矩阵内存映射，多进程共享页缓存）"""
+
+    def __init__(self, directory: str, nprobe: int = 32, ann_threshold: int = 50000, rerank_factor: int = 8):
+        self.directory = directory
+        self.nprobe = max(1, int(nprobe))
+        self.ann_threshold = int(ann_threshold)
+        self.rerank_factor = max(1, int(rerank_factor))
+        with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.matrix = np.load(os.path.join(directory, 'vectors.npy'), mmap_mode='r')
+        self.ids = np.load(os.path.join(directory, 'ids.npy'))
+        with open(os.path.join(directory, 'payloads.jsonl'), encoding='utf-8') as f:
+            self.payloads = [json.loads(line) for line in f]
+        self.columns = {field: np.load(os.path.join(directory, f'col_{field}.npy'))
+                        for field in self.meta['filter_fields']}
+        # image_id 与 point ID 相同（见 build_point），也可用于过滤
+        self.columns.setdefault('image_id', self.ids)
+        self.columns.setdefault('id', self.ids)
+
+        self.quantizer = self.codes = None
+        if self.meta.get('compression', 'none') != 'none':
+            self.quantizer = load_quantizer(os.path.join(directory, 'quantizer.npz'))
+            self.codes = np.load(os.path.join(directory, 'codes.npy'), mmap_mode='r')
+
+        self.centroids = self.order = self.offsets = None
+        if self.meta.get('ivf_lists'):
+            self.centroids = np.load(os.path.join(directory, 'ivf_centroids.npy'))
+            self.order = np.load(os.path.join(directory, 'ivf_order.npy'), mmap_mode='r')
+            self.offsets = np.load(os.path.join(directory, 'ivf_offsets.npy'))
+
+        self._lock = threading.Lock()
+        self._stats = {'searches': 0, 'exact': 0, 'ivf': 0, 'total_ms': 0.0}
+        logger.info(f"✅ 本地向量索引已加载: {directory}（{len(self)} 条，IVF列表 {self.meta.get('ivf_lists', 0)}）")
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def filter_mask(self, conditions: Optional[Dict]) -> Optional[np.ndarray]:
+        """
+        过滤条件 -> 行掩码；条件为 {字段: 值 或 [值, ...]}，多个字段之间为AND，列表内为OR
+        未构建为列的字段抛出ValueError
+        """
+        if not conditions:
+            return None
+        mask = np.ones(len(self), dtype=bool)
+        for field, values in conditions.items():
+            column = self.columns.get(field)
+            if column is None:
+                raise ValueError(f"字段 {field} 不支持过滤，可用字段: {sorted(self.columns)}")
+            mask &= np.isin(column, _coerce(column, values))
+        return mask
+
+    @staticmethod
+    def _top(rows: Optional[np.ndarray], scores: np.ndarray, k: int):
+        """argpartition取分数最高的k个，再按分数降序排列"""
+        if k < len(scores):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return (top if rows is None else rows[top]), scores[top]
+
+    def _rank(self, rows: Optional[np.ndarray], query: np.ndarray, k: int, compressed: bool = True):
+        """
+        对候选行（None表示全部）打分取top-k
+        启用压缩时两阶段：压缩码粗排取 k x rerank_factor 个候选，再用原始向量精排
+        """
+        if self.quantizer is None or not compressed:
+            matrix = self.matrix if rows is None else self.matrix[rows]
+            return self._top(rows, matrix @ query, k)
+        codes = self.codes if rows is None else self.codes[rows]
+        candidates, _ = self._top(rows, self.quantizer.score(codes, query), k * self.rerank_factor)
+        candidates = np.sort(candidates)  # 按行号顺序读取内存映射
+        return self._top(candidates, self.matrix[candidates] @ query, k)
+
+    def _exact(self, query: np.ndarray, k: int, mask: Optional[np.ndarray], compressed: bool = True):
+        """全量扫描（有过滤条件时只计算命中的行）"""
+        return self._rank(None if mask is None else np.flatnonzero(mask), query, k, compressed)
+
+    def _ivf(self, query: np.ndarray, k: int, mask: Optional[np.ndarray]):
+        """IVF近似搜索：扫描与查询最接近的nprobe个倒排列表；过滤后候选不足k条时返回None"""
+        nprobe = min(self.nprobe, self.centroids.shape[0])
+        probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        rows = np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in probe])
+        if mask is not None:
+            rows = rows[mask[rows]]
+        if len(rows) < k:
+            return None
+        rows.sort()  # 按行号顺序读取内存映射，减少随机IO
+        return self._rank(rows, query, k)
+
+    def search(self, vector, limit: int = 10, offset: int = 0, score_threshold: Optional[float] = None,
+               conditions: Optional[Dict] = None, exact: bool = False) -> Tuple[List[Dict], str]:
+        """
+        搜索最相似的向量
+
+        Returns:
+            (结果列表 [{'id', 'score', 'payload'}]（与Qdrant search一致）, 使用的方法 'exact' 或 'ivf'，启用压缩时带 '+float16' 等后缀)
+        exact=True 时不使用IVF和压缩码，直接用原始向量全量计算
+        """
+        started = time.perf_counter()
+        query = _normalize(np.asarray(vector, dtype=np.float32).reshape(-1))
+        if query.shape[0] != self.matrix.shape[1]:
+            raise ValueError(f"向量维度错误: 期望{self.matrix.shape[1]}维，实际{query.shape[0]}维")
+        k = max(0, int(offset)) + max(1, int(limit))
+        mask = self.filter_mask(conditions)
+        candidates = len(self) if mask is None else int(mask.sum())
+
+        found, method = None, 'exact'
+        # 过滤后剩余行数不多时精确搜索更快，也不会因候选不足漏掉结果
+        if not exact and self.centroids is not None and candidates > self.ann_threshold:
+            found, method = self._ivf(query, k, mask), 'ivf'
+        if found is None:
+            found, method = self._exact(query, k, mask, compressed=not exact), 'exact'
+
+        rows, scores = found
+        if self.quantizer is not None and not exact:
+            method = f"{method}+{self.quantizer.kind}"
+        results = []
+        for row, score in zip(rows[offset:], scores[offset:]):
+            if score_threshold is not None and score < score_threshold:
+                break
+            point_id = self.ids[row]
+            results.append({
+                'id': point_id.item() if hasattr(point_id, 'item') else point_id,
+                'score': float(score),
+                'payload': self.payloads[row]
+            })
+
+        with self._lock:
+            self._stats['searches'] += 1
+            self._stats[method.split('+')[0]] += 1
+            self._stats['total_ms'] += (time.perf_counter() - started) * 1000.0
+        return results, method
+
+    def stats(self) -> dict:
+        """索引与搜索统计"""
+        with self._lock:
+            stats = dict(self._stats)
+        searches = stats.pop('total_ms')
+        stats.update({
+            'size': len(self),
+            'ivf_lists': self.meta.get('ivf_lists', 0),
+            'nprobe': self.nprobe,
+            'compression': self.meta.get('compression', 'none'),
+            'code_bytes': self.meta.get('code_bytes', 0),
+            'filter_fields': self.meta['filter_fields'],
+            'built_at': self.meta.get('built_at'),
+            'avg_ms': round(searches / stats['searches'], 3) if stats['searches'] else 0
+        })
+        return stats
+
+
+# 全局索引实例（延迟加载，索引目录被重新构建后自动重新加载）
+_index_instance = None
+_index_mtime = None
+_index_lock = threading.Lock()
+
+
+def get_vector_index() -> Optional[VectorIndex]:
+    """获取本地向量索引（单例模式），尚未构建时返回None"""
+    global _index_instance, _index_mtime
+    meta_path = os.path.join(INDEX_CONFIG['directory'], 'meta.json')
+    try:
+        mtime = os.stat(meta_path).st_mtime
+    except OSError:
+        return _index_instance
+    if mtime == _index_mtime:
+        return _index_instance
+    with _index_lock:
+        if mtime != _index_mtime:
+            # 加载失败时同样记录修改时间，直到索引再次被构建前不重复尝试
+            _index_mtime = mtime
+            try:
+                _index_instance = VectorIndex(INDEX_CONFIG['directory'], nprobe=INDEX_CONFIG['nprobe'],
+                                              ann_threshold=INDEX_CONFIG['ann_threshold'],
+                                              rerank_factor=INDEX_CONFIG['rerank_factor'])
+            except Exception as e:
+                logger.error(f"❌ 加载本地向量索引失败: {e}")
+        return _index_instance
+
+
+def index_stats() -> Optional[dict]:
+    """已加载的索引统计（未加载时返回None）"""
+    return _index_instance.stats() if _index_instance is not None else None
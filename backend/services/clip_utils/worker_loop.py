@@ -0,0 +1,63 @@
+"""
+常驻worker模式
+从stdin逐行读取JSON请求，每个请求向stdout写一行JSON结果，模型在请求之间保持加载
+供Node.js保持少量常驻子进程，避免每次搜索/上传都重新加载模型
+"""
+import sys
+import json
+import logging
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+def _write(result: Dict):
+    """写一行JSON结果并立即刷新（Node按行读取）"""
+    sys.stdout.write(json.dumps(result, ensure_ascii=False) + '\n')
+    sys.stdout.flush()
+
+
+def run_worker(handler: Callable[[Dict], Dict], warmup: Callable[[], None] = None):
+    """
+    运行worker主循环
+
+    Args:
+        handler: 处理单个请求的函数，接收请求dict，返回结果dict
+        warmup: 启动时调用的预加载函数（例如加载CLIP模型）
+
+    请求格式: {"id": "请求ID", ...}，每行一个
+    结果格式: {"id": "请求ID", "status": "success"|"error", ...}，每行一个
+    启动完成后先输出 {"status": "ready"}；stdin关闭时退出
+    """
+    if warmup is not None:
+        try:
+            warmup()
+        except Exception as e:
+            logger.error(f"worker预加载失败: {e}")
+            _write({'status': 'error', 'error': f'预加载失败: {str(e)}'})
+            return 1
+
+    _write({'status': 'ready'})
+    logger.info("✅ worker已就绪，等待stdin请求...")
+
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+
+        request_id = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('请求必须是JSON对象')
+            request_id = request.get('id')
+            result = handler(request)
+        except Exception as e:
+            logger.error(f"处理请求失败 (id={request_id}): {e}")
+            result = {'status': 'error', 'error': str(e)}
+
+        result['id'] = request_id
+        _write(result)
+
+    logger.info("stdin已关闭，worker退出")
+    return 0
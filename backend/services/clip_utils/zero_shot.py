@@ -0,0 +1,228 @@
+"""
+零样本打标签模块
+把标签词表（tag_vocabulary.json）中所有标签的提示词一次批量编码为标签向量矩阵并持久化（.npz），
+之后给图片打标签只需 图片向量矩阵 x 标签矩阵 一次矩阵乘，再按组做softmax得到置信度，没有逐标签的模型调用
+标签矩阵按 词表内容 + 模型名 的摘要缓存：词表未改变时直接加载（不需要文本塔），改变后才重新编码
+"""
+import os
+import json
+import hashlib
+import threading
+import logging
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from config import TAGGING_CONFIG, CLIP_CONFIG
+
+logger = logging.getLogger(__name__)
+
+
+class LabelMatrixUnavailable(RuntimeError):
+    """标签矩阵尚未计算且当前进程无法编码文本（如 CLIP_ENCODER_MODE=vision）"""
+
+
+def load_vocabulary(path: str) -> List[dict]:
+    """
+    读取并校验标签词表，返回按文件顺序的分组列表:
+    [{"name", "template", "top_k", "labels": [标签, ...], "prompts": [[提示词, ...], ...]}]
+    """
+    with open(path, encoding='utf-8') as f:
+        vocabulary = json.load(f)
+    groups = vocabulary.get('groups') if isinstance(vocabulary, dict) else None
+    if not isinstance(groups, dict) or not groups:
+        raise ValueError(f"标签词表缺少groups: {path}")
+
+    parsed = []
+    for name, group in groups.items():
+        labels = group.get('labels') if isinstance(group, dict) else None
+        if not isinstance(labels, dict) or not labels:
+            raise ValueError(f"标签组 {name} 缺少labels")
+        template = group.get('template') or '{}'
+        prompts = []
+        for label, texts in labels.items():
+            texts = [texts] if isinstance(texts, str) else texts
+            if not isinstance(texts, list) or not texts or not all(isinstance(t, str) and t.strip() for t in texts):
+                raise ValueError(f"标签 {name}.{label} 的提示词必须是非空字符串或字符串列表")
+            prompts.append([template.replace('{}', t.strip()) for t in texts])
+        parsed.append({
+            'name': name,
+            'template': template,
+            'top_k': max(1, int(group.get('top_k', 1))),
+            'labels': list(labels),
+            'prompts': prompts
+        })
+    return parsed
+
+
+def vocabulary_digest(groups: List[dict], model_name: str) -> str:
+    """词表内容（标签、提示词、top_k）+ 模型名的摘要，作为标签矩阵缓存文件的键"""
+    canonical = json.dumps({'model': model_name, 'groups': groups}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class LabelMatrix:
+    """标签向量矩阵 (标签数, 维度)，各组标签在矩阵中连续存放"""
+
+    def __init__(self, groups: List[dict], matrix: np.ndarray, digest: str):
+        self.groups = groups
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self.digest = digest
+        self.labels = [label for group in groups for label in group['labels']]
+        # 每组在矩阵中的起止行
+        self.spans = {}
+        start = 0
+        for group in groups:
+            self.spans[group['name']] = (start, start + len(group['labels']))
+            start += len(group['labels'])
+        if start != len(self.matrix):
+            raise ValueError(f"标签数({start})与标签矩阵行数({len(self.matrix)})不一致")
+
+    @property
+    def dimension(self) -> int:
+        return self.matrix.shape[1]
+
+    @classmethod
+    def build(cls, groups: List[dict], encode_texts: Callable[[List[str]], Optional[np.ndarray]], digest: str,
+              batch_size: int = 32) -> 'LabelMatrix':
+        """批量编码全部提示词（每批batch_size条），同一标签的多个提示词取平均后归一化"""
+        prompts = [text for group in groups for texts in group['prompts'] for text in texts]
+        encoded = []
+        for start in range(0, len(prompts), batch_size):
+            vectors = encode_texts(prompts[start:start + batch_size])
+            if vectors is None:
+                raise RuntimeError('标签提示词编码失败')
+            encoded.append(np.asarray(vectors, dtype=np.float32))
+        encoded = _normalize(np.concatenate(encoded))
+        # 每个标签第一个提示词所在的行，reduceat按段求和
+        counts = [len(texts) for group in groups for texts in group['prompts']]
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        return cls(groups, _normalize(np.add.reduceat(encoded, starts, axis=0)), digest)
+
+    @classmethod
+    def load(cls, path: str) -> 'LabelMatrix':
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            return cls(meta['groups'], data['matrix'], meta['digest'])
+
+    def save(self, path: str):
+        """写入临时文件后替换，多个进程同时保存时不会读到写了一半的文件"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        meta = json.dumps({'digest': self.digest, 'groups': self.groups}, ensure_ascii=False)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, matrix=self.matrix, meta=np.array(meta))
+        os.replace(tmp_path, path)
+
+    def score(self, vectors, groups: Optional[Sequence[str]] = None, top_k: Optional[int] = None,
+              min_confidence: float = 0.0, logit_scale: float = 100.0) -> List[Dict[str, List[dict]]]:
+        """
+        给一批图片向量打标签：一次矩阵乘得到与全部标签的相似度，组内softmax（按CLIP的logit_scale缩放）得到置信度
+        Args:
+            vectors: (N, 维度) 图片向量
+            groups: 只返回这些组，默认全部
+            top_k: 每组返回的标签数，默认使用词表中各组的top_k
+            min_confidence: 低于该置信度的标签不返回
+        Returns:
+            每张图片 {组名: [{"label", "confidence", "similarity"}, ...]}（按置信度降序）
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or vectors.shape[1] != self.dimension:
+            raise ValueError(f"图片向量维度应为 {self.dimension}，实际为 {vectors.shape[-1] if vectors.ndim else 0}")
+        names = list(groups) if groups else [group['name'] for group in self.groups]
+        unknown = [name for name in names if name not in self.spans]
+        if unknown:
+            raise ValueError(f"未知的标签组: {unknown}，可选: {list(self.spans)}")
+
+        similarity = _normalize(vectors) @ self.matrix.T
+        results = [{} for _ in range(len(vectors))]
+        for group in self.groups:
+            name = group['name']
+            if name not in names:
+                continue
+            start, end = self.spans[name]
+            logits = similarity[:, start:end] * logit_scale
+            probs = np.exp(logits - logits.max(axis=1, keepdims=True))
+            probs /= probs.sum(axis=1, keepdims=True)
+            k = min(top_k or group['top_k'], end - start)
+            top = np.argsort(-probs, axis=1)[:, :k]
+            # 先整块取值、取整并转为Python列表，逐条组装结果时不再访问NumPy标量
+            confidences = np.take_along_axis(probs, top, axis=1).astype(np.float64).round(4).tolist()
+            similarities = np.take_along_axis(similarity[:, start:end], top, axis=1).astype(np.float64).round(4).tolist()
+            labels = group['labels']
+            for row, columns in enumerate(top.tolist()):
+                results[row][name] = [
+                    {'label': labels[column], 'confidence': confidence, 'similarity': sim}
+                    for column, confidence, sim in zip(columns, confidences[row], similarities[row])
+                    if confidence >= min_confidence
+                ]
+        return results
+
+    def stats(self) -> dict:
+        return {
+            'digest': self.digest[:16],
+            'labels': len(self.labels),
+            'dimension': self.dimension,
+            'groups': {group['name']: len(group['labels']) for group in self.groups}
+        }
+
+
+def label_matrix_path(digest: str, cache_dir: Optional[str] = None) -> str:
+    return os.path.join(cache_dir or TAGGING_CONFIG['cache_dir'], f"labels-{digest[:16]}.npz")
+
+
+def load_label_matrix(vocabulary_path: str, encode_texts: Optional[Callable] = None,
+                      cache_dir: Optional[str] = None, rebuild: bool = False) -> LabelMatrix:
+    """
+    按词表加载标签矩阵：缓存文件存在时直接读取，否则用encode_texts批量编码并保存
+    encode_texts为None（进程没有文本塔）且没有缓存时抛出LabelMatrixUnavailable
+    """
+    groups = load_vocabulary(vocabulary_path)
+    digest = vocabulary_digest(groups, CLIP_CONFIG['model_name'])
+    path = label_matrix_path(digest, cache_dir)
+    if not rebuild and os.path.exists(path):
+        try:
+            labels = LabelMatrix.load(path)
+            if labels.digest == digest:
+                return labels
+        except Exception as e:
+            logger.warning(f"标签矩阵缓存文件无法读取，将重新计算: {e}")
+    if encode_texts is None:
+        raise LabelMatrixUnavailable(
+            f"标签矩阵尚未计算（{path}），请在可编码文本的进程中运行 clip_tag_images.py --build-labels")
+    labels = LabelMatrix.build(groups, encode_texts, digest, batch_size=CLIP_CONFIG['batch_size'])
+    labels.save(path)
+    logger.info(f"✅ 标签矩阵已计算并保存: {len(labels.labels)} 个标签 -> {path}")
+    return labels
+
+
+# 全局标签矩阵（词表文件修改后重新检查摘要，内容变化时才重新加载/计算）
+_labels_instance = None
+_labels_mtime = None
+_labels_lock = threading.Lock()
+
+
+def get_label_matrix(encode_texts: Optional[Callable] = None) -> LabelMatrix:
+    """获取标签矩阵（单例模式），词表文件不存在时抛出FileNotFoundError"""
+    global _labels_instance, _labels_mtime
+    mtime = os.stat(TAGGING_CONFIG['vocabulary']).st_mtime
+    if mtime == _labels_mtime and _labels_instance is not None:
+        return _labels_instance
+    with _labels_lock:
+        if mtime != _labels_mtime or _labels_instance is None:
+            labels = load_label_matrix(TAGGING_CONFIG['vocabulary'], encode_texts)
+            if _labels_instance is None or labels.digest != _labels_instance.digest:
+                logger.info(f"✅ 已加载标签矩阵: {len(labels.labels)} 个标签（{labels.digest[:16]}）")
+                _labels_instance = labels
+            _labels_mtime = mtime
+        return _labels_instance
+
+
+def label_matrix_stats() -> Optional[dict]:
+    """已加载的标签矩阵统计（未加载时返回None）"""
+    return _labels_instance.stats() if _labels_instance is not None else None
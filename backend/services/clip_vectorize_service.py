@@ -3,11 +3,15 @@
 CLIP文本向量化HTTP服务
 提供RESTful API将文本转换为向量
 """
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from flask_cors import CORS
 import sys
 import os
+import json
+import time
+import functools
 import logging
+import threading
 
 # 配置日志（必须在logger使用之前）
 logging.basicConfig(level=logging.INFO)
@@ -36,41 +40,214 @@ else:
         USE_LOCAL_MODULES = False
 
 try:
-    from clip_encoder import get_clip_encoder
-    from config import VECTOR_DIMENSION
+    from clip_encoder import set_num_threads
+    from config import VECTOR_DIMENSION, CLIP_CONFIG, SERVER_CONFIG, METRICS_CONFIG
+    from image_loader import read_image_bytes
+    from micro_batcher import MicroBatcher
+    import service_core as core
+    from service_core import ServiceError, init_clip_encoder, start_warmup, cache_stats, NDJSON_MIMETYPE
+    import vector_codec
+    import metrics
     logger.info(f"✅ 成功导入CLIP模块，向量维度: {VECTOR_DIMENSION}")
 except ImportError as e:
     logger.error(f"❌ 无法导入CLIP模块: {e}")
     logger.error("请确保clip_encoder.py和config.py在clip_utils目录中")
-    VECTOR_DIMENSION = 512
+    # 缺少这些模块时所有端点都无法工作，直接退出，避免以半初始化状态对外提供服务
+    sys.exit(1)
 
 app = Flask(__name__)
 CORS(app)  # 允许跨域请求
 
 # 日志已在文件开头配置，这里不需要重复配置
+# 模型加载与预热、缓存、请求解析和响应体构建在 clip_utils/service_core.py（与异步服务共用），这里只有Flask传输层和微批处理调度
 
-# 全局CLIP编码器实例
-clip_encoder = None
+def handles_errors(action):
+    """
+    端点装饰器：参数错误（ValueError）返回400，ServiceError按其状态码返回（编码器模式不支持为501、服务端错误为500等），
+    其他异常记录日志后返回500
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                return view(*args, **kwargs)
+            except ServiceError as e:
+                headers = {'Retry-After': str(int(e.retry_after))} if e.retry_after else None
+                return jsonify(e.body()), e.status_code, headers
+            except ValueError as e:
+                return jsonify({
+                    'error': str(e)
+                }), 400
+            except Exception as e:
+                logger.error(f"{action}失败: {e}")
+                return jsonify({
+                    'error': str(e)
+                }), 500
+        return wrapper
+    return decorator
 
-def init_clip_encoder():
-    """初始化CLIP编码器"""
-    global clip_encoder
-    if clip_encoder is None:
-        try:
-            logger.info("正在初始化CLIP编码器...")
-            clip_encoder = get_clip_encoder()
-            logger.info("✅ CLIP编码器初始化成功")
-        except Exception as e:
-            logger.error(f"❌ CLIP编码器初始化失败: {e}")
-            raise
-    return clip_encoder
+def requires_encoder(kind):
+    """端点装饰器：当前编码器模式没有加载对应的塔时返回501"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not core.encoder_supports(kind):
+                return jsonify({
+                    'error': f"{'Text' if kind == 'text' else 'Image'} encoding is disabled (CLIP_ENCODER_MODE={CLIP_CONFIG['encoder_mode']})"
+                }), 501
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def preload_for_fork():
+    """
+    pre-fork模式下在master进程中调用：fork之前加载模型权重（不做前向计算），
+    各worker通过写时复制共享同一份权重；前向计算和线程数设置都留到fork后（init_worker），
+    master进程不启动推理线程池，避免线程池跨fork
+    """
+    if CLIP_CONFIG['backend'] == 'onnx':
+        # ONNX Runtime会话创建时就启动线程池，不能跨fork共享，由各worker自己加载
+        logger.info("ONNX后端: 每个worker在fork后各自创建推理会话")
+        return
+    try:
+        init_clip_encoder()
+        logger.info(f"✅ 模型权重已在master进程加载（pid {os.getpid()}），fork后各worker共享")
+    except Exception as e:
+        logger.error(f"❌ master进程加载模型失败，各worker将自行加载: {e}")
+
+def init_worker():
+    """pre-fork模式下在每个worker fork之后调用：限制推理线程数并预热"""
+    set_num_threads(SERVER_CONFIG['torch_threads'])
+    logger.info(f"worker {os.getpid()} 启动，推理线程数: {SERVER_CONFIG['torch_threads']}")
+    if METRICS_CONFIG['enabled']:
+        metrics.enable_multiprocess(METRICS_CONFIG['multiprocess_dir'], METRICS_CONFIG['multiprocess_interval'])
+    start_warmup()
+
+# 微批处理器（延迟创建；gthread的多个请求线程可能同时第一次调用，加锁保证只创建一个）
+_text_batcher = None
+_image_batcher = None
+_batcher_lock = threading.Lock()
+
+def get_text_batcher():
+    """获取文本微批处理器：并发的/encode-text请求合并为一次encode_texts_batch"""
+    global _text_batcher
+    with _batcher_lock:
+        if _text_batcher is None:
+            _text_batcher = MicroBatcher(
+                lambda texts: init_clip_encoder().encode_texts_batch(texts),
+                max_batch_size=CLIP_CONFIG['batch_size'],
+                window_ms=CLIP_CONFIG['batch_window_ms'],
+                name='text',
+                kind='text'
+            )
+    return _text_batcher
+
+def get_image_batcher():
+    """获取图片微批处理器：并发的/encode-image请求合并为一次encode_images_batch"""
+    global _image_batcher
+    with _batcher_lock:
+        if _image_batcher is None:
+            _image_batcher = MicroBatcher(
+                lambda images: init_clip_encoder().encode_images_batch(images),
+                max_batch_size=CLIP_CONFIG['batch_size'],
+                window_ms=CLIP_CONFIG['batch_window_ms'],
+                name='image',
+                kind='image'
+            )
+    return _image_batcher
+
+def encode_query_text(text):
+    """编码单条文本：先查缓存，未命中时计算（经微批处理）并写回缓存"""
+    vector = core.cached_text_vectors([text])[0]
+    if vector is not None:
+        return vector
+
+    if CLIP_CONFIG['micro_batching']:
+        vector = get_text_batcher().encode(text)
+    else:
+        vector = init_clip_encoder().encode_text(text)
+    core.cache_text_vectors([text], [vector])
+    return vector
+
+def encode_query_texts(texts):
+    """批量编码文本：只对缓存未命中的文本做一次批量计算，失败返回None"""
+    vectors = core.cached_text_vectors(texts)
+    missing = [i for i, v in enumerate(vectors) if v is None]
+    if missing:
+        computed = init_clip_encoder().encode_texts_batch([texts[i] for i in missing])
+        if computed is None:
+            return None
+        for i, vector in zip(missing, computed):
+            vectors[i] = vector
+        core.cache_text_vectors([texts[i] for i in missing], computed)
+    return vectors
+
+def batching_stats():
+    """微批处理统计"""
+    return {
+        'enabled': CLIP_CONFIG['micro_batching'],
+        'text': _text_batcher.stats() if _text_batcher is not None else None,
+        'image': _image_batcher.stats() if _image_batcher is not None else None
+    }
+
+def negotiate_vector_format(data=None):
+    """确定向量响应格式和数据类型（规则见 service_core.negotiate_vector_format）"""
+    return core.negotiate_vector_format(request.args, request.headers.get('Accept'), data)
+
+def vector_response(body, vectors, fmt, dtype, single=False):
+    """按协商的格式输出向量（json / base64 / binary，见 vector_codec.pack_vectors）"""
+    with metrics.stage('serialize', request_kind()):
+        body, payload, headers = vector_codec.pack_vectors(body, vectors, fmt, dtype, single)
+        if payload is None:
+            return jsonify(body)
+        return Response(payload, mimetype=vector_codec.BINARY_MIMETYPE, headers=headers)
+
+def request_endpoint():
+    """指标中的端点标签：使用路由规则（未匹配的路径统一为unmatched，避免标签数量无限增长）"""
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+def request_kind():
+    return core.ENDPOINT_KINDS.get(request_endpoint(), '')
+
+@app.before_request
+def start_request_metrics():
+    """请求开始：计入并发数并开始阶段计时；JSON请求体在这里解析，计入parse阶段（之后的get_json使用缓存结果）"""
+    if not METRICS_CONFIG['enabled']:
+        return
+    g.metrics_started = time.perf_counter()
+    g.metrics_endpoint = request_endpoint()
+    metrics.IN_FLIGHT.inc(endpoint=g.metrics_endpoint)
+    metrics.begin_trace()
+    if request.is_json:
+        with metrics.stage('parse', request_kind()):
+            request.get_json(silent=True)
+
+@app.after_request
+def finish_request_metrics(response):
+    """请求结束：记录耗时和状态码；请求带 X-Debug-Timing: 1 时在 Server-Timing 头中返回各阶段耗时"""
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    metrics.REQUEST_SECONDS.observe(elapsed, endpoint=g.metrics_endpoint)
+    metrics.REQUESTS_TOTAL.inc(endpoint=g.metrics_endpoint, status=response.status_code)
+    if METRICS_CONFIG['debug_timing'] and metrics.debug_requested(request.headers.get(metrics.DEBUG_HEADER)):
+        response.headers['Server-Timing'] = metrics.server_timing(metrics.current_trace() or {}, elapsed)
+    return response
+
+@app.teardown_request
+def release_request_metrics(error=None):
+    """无论是否出错都减少并发数"""
+    endpoint = g.pop('metrics_endpoint', None)
+    if endpoint is not None:
+        metrics.IN_FLIGHT.dec(endpoint=endpoint)
 
 @app.route('/', methods=['GET'])
 def index():
     """服务首页"""
     # 尝试初始化CLIP编码器（如果尚未初始化）
     try:
-        if clip_encoder is None:
+        if core.clip_encoder is None:
             init_clip_encoder()
     except Exception as e:
         logger.warning(f"CLIP编码器初始化失败: {e}")
@@ -82,99 +259,323 @@ def index():
         'endpoints': {
             'health': '/health',
             'encode_text': '/encode-text (POST)',
-            'encode_texts': '/encode-texts (POST)'
+            'encode_texts': '/encode-texts (POST)',
+            'encode_image': '/encode-image (POST)',
+            'encode_images': '/encode-images (POST)',
+            'search': '/search (POST)',
+            'search_text': '/search-text (POST)',
+            'register_images': '/register-images (POST)',
+            'tag_images': '/tag-images (POST)',
+            'cache_stats': '/cache-stats',
+            'metrics': '/metrics',
+            'ready': '/ready'
         },
-        'clip_loaded': clip_encoder is not None,
-        'note': 'CLIP模型采用延迟加载，首次调用/encode-text时会自动加载模型（需要1-2分钟）'
+        'clip_loaded': core.clip_encoder is not None,
+        'warmup': core.warmup_state['status'],
+        'note': '启动时后台预热模型（CLIP_WARMUP=off时改为首次调用/encode-text时加载，需要1-2分钟），/ready 返回200后即可接收流量'
     })
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    """就绪检查：模型加载并完成预热前返回503，供编排系统只把流量路由到已预热的实例"""
+    body = core.ready_body()
+    return jsonify(body), 200 if body['ready'] else 503
+
 @app.route('/health', methods=['GET'])
 def health():
-    """健康检查"""
-    return jsonify({
-        'status': 'ok',
-        'service': 'clip-vectorize',
-        'clip_loaded': clip_encoder is not None
-    })
+    """健康检查（存活探针，不依赖模型是否加载完成）"""
+    return jsonify(core.health_body(micro_batching=batching_stats()))
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus指标（文本格式）：各阶段耗时直方图、批大小分布、队列深度、并发请求数、模型加载耗时、进程内存"""
+    if not METRICS_CONFIG['enabled']:
+        return jsonify({
+            'error': 'Metrics are disabled (CLIP_METRICS=false)'
+        }), 404
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats_endpoint():
+    """文本向量缓存统计（命中/未命中/淘汰/过期次数和命中率）"""
+    return jsonify(cache_stats())
 
 @app.route('/encode-text', methods=['POST'])
+@requires_encoder('text')
+@handles_errors('编码文本')
 def encode_text():
     """将文本编码为向量"""
-    try:
-        data = request.get_json()
-        if not data or 'text' not in data:
-            return jsonify({
-                'error': 'Missing "text" field in request body'
-            }), 400
-        
-        text = data['text']
-        if not text or not text.strip():
-            return jsonify({
-                'error': 'Text cannot be empty'
-            }), 400
-        
-        # 初始化编码器（如果尚未初始化）
-        encoder = init_clip_encoder()
-        
-        # 编码文本
-        vector = encoder.encode_text(text)
-        
-        if vector is None:
-            return jsonify({
-                'error': 'Failed to encode text'
-            }), 500
-        
-        return jsonify({
-            'status': 'success',
-            'text': text,
-            'vector': vector.tolist(),
-            'dimension': len(vector)
-        })
-    except Exception as e:
-        logger.error(f"编码文本失败: {e}")
-        return jsonify({
-            'error': str(e)
-        }), 500
+    data = request.get_json(silent=True)
+    text = core.parse_text(data)
+    fmt, dtype = negotiate_vector_format(data)
+    
+    # 编码文本（先查缓存；开启微批处理时与并发请求合并为一批）
+    vector = encode_query_text(text)
+    return vector_response(core.text_body(text, vector), [vector], fmt, dtype, single=True)
+
+def wants_stream(data):
+    """是否以NDJSON流式返回：请求体stream=true、format=ndjson 或 Accept: application/x-ndjson"""
+    if core.is_true(data.get('stream', request.args.get('stream', ''))):
+        return True
+    if (request.args.get('format') or data.get('format') or '').lower() == 'ndjson':
+        return True
+    return NDJSON_MIMETYPE in (request.headers.get('Accept') or '')
+
+def stream_text_vectors(texts, echo, b64_dtype=None):
+    """
+    按batch_size分块编码并逐行输出NDJSON，每块完成后立即发送，内存占用与总条数无关
+    每行: {"index": i, "vector": [...]}（echo时带text；b64_dtype时为vector_b64）
+    某块失败时该块每行为 {"index": i, "error": "..."}；最后一行为 {"done": true, "count": 成功数, "failed": 失败数}
+    """
+    batch_size = CLIP_CONFIG['batch_size']
+    count = failed = 0
+    for start in range(0, len(texts), batch_size):
+        chunk = texts[start:start + batch_size]
+        try:
+            vectors = encode_query_texts(chunk)
+            error = None if vectors is not None else 'Failed to encode texts'
+        except Exception as e:
+            logger.error(f"流式编码文本失败: {e}")
+            vectors, error = None, str(e)
+
+        lines = []
+        for offset, text in enumerate(chunk):
+            line = {'index': start + offset}
+            if echo:
+                line['text'] = text
+            if error is not None:
+                line['error'] = error
+                failed += 1
+            elif b64_dtype:
+                line['vector_b64'] = vector_codec.to_base64(vectors[offset], b64_dtype)
+                count += 1
+            else:
+                line['vector'] = vectors[offset].tolist()
+                count += 1
+            lines.append(json.dumps(line, ensure_ascii=False))
+        yield '\n'.join(lines) + '\n'
+
+    summary = {'done': True, 'count': count, 'failed': failed}
+    if b64_dtype:
+        summary['dtype'] = b64_dtype
+    yield json.dumps(summary) + '\n'
 
 @app.route('/encode-texts', methods=['POST'])
+@requires_encoder('text')
+@handles_errors('批量编码文本')
 def encode_texts():
-    """批量将文本编码为向量"""
+    """
+    批量将文本编码为向量
+    stream=true（或 format=ndjson / Accept: application/x-ndjson）时按块流式返回NDJSON
+    echo=false 时响应中不回显输入文本（流式模式默认不回显）
+    """
+    data = request.get_json(silent=True)
+    texts = core.parse_texts(data)
+    
+    if wants_stream(data):
+        echo = core.is_true(data.get('echo', 'false'))
+        b64_dtype = None
+        if str(data.get('vector_format', '')).lower() == 'base64':
+            b64_dtype = vector_codec.resolve_dtype(data.get('dtype'))
+        return Response(stream_with_context(stream_text_vectors(texts, echo, b64_dtype)),
+                        mimetype=NDJSON_MIMETYPE)
+    
+    fmt, dtype = negotiate_vector_format(data)
+    
+    # 批量编码文本（只计算缓存未命中的部分）
+    vectors = encode_query_texts(texts)
+    return vector_response(core.texts_body(data, texts, vectors), vectors, fmt, dtype)
+
+def _read_image_from_request():
+    """
+    从请求中读取单张图片的原始字节
+    支持: JSON {"image": URL或本地路径}、multipart文件字段 "image"、原始图片字节请求体
+    """
+    if request.files:
+        upload = request.files.get('image') or next(iter(request.files.values()))
+        return upload.read()
+
+    if request.is_json:
+        return read_image_bytes(core.parse_image_source(request.get_json(silent=True) or {}))
+
+    data = request.get_data()
+    if not data:
+        raise ValueError('Empty request body')
+    return data
+
+def encode_image_bytes(data):
+    """编码单张图片：先按内容摘要查本地向量存储，未命中时解码并计算（经微批处理）；图片无法解码时抛出ValueError"""
+    digests, vectors = core.lookup_images([data])
+    if vectors[0] is not None:
+        return vectors[0]
+
+    image = core.decode_image(data)
+    if CLIP_CONFIG['micro_batching']:
+        vector = get_image_batcher().encode(image)
+    else:
+        vector = init_clip_encoder().encode_image(image)
+
+    if vector is not None:
+        core.store_images(digests, [vector])
+    return vector
+
+def encode_image_bytes_batch(contents, errors, dedup=None):
+    """
+    批量编码图片字节：命中存储的直接返回，其余解码后按batch_size分批计算
+    contents中为None的位置（读取失败）跳过；失败原因写入errors[index]
+    dedup（DedupBatch）不为None时做近重复检测，结果写入dedup.duplicates: 感知哈希命中的不计算（向量为None），其余编码后再按余弦相似度检查
+    """
+    digests, vectors = core.lookup_images(contents)
+
+    # 近重复检测时命中存储的图片也要解码计算感知哈希
+    loaded = []
+    for index, content in enumerate(contents):
+        if content is None or (vectors[index] is not None and dedup is None):
+            continue
+        try:
+            loaded.append((index, core.decode_image(content, with_hash=dedup is not None)))
+        except ValueError as e:
+            errors[index] = str(e)
+
+    if dedup is not None:
+        loaded = core.filter_hash_duplicates(dedup, loaded, vectors)
+
+    batch_size = CLIP_CONFIG['batch_size']
+    for start in range(0, len(loaded), batch_size):
+        chunk = loaded[start:start + batch_size]
+        batch_vectors = init_clip_encoder().encode_images_batch([image for _, image in chunk])
+        for offset, (index, _) in enumerate(chunk):
+            if batch_vectors is None:
+                errors[index] = 'Failed to encode image'
+            else:
+                vectors[index] = batch_vectors[offset]
+
+    computed = [i for i, _ in loaded if vectors[i] is not None]
+    core.store_images([digests[i] for i in computed], [vectors[i] for i in computed])
+    if dedup is not None:
+        core.flag_vector_duplicates(dedup, vectors)
+    return vectors
+
+def read_request_images():
+    """
+    读取批量请求中的全部图片字节，返回 (contents, errors)，读取失败的位置为None并在errors中说明
+    支持: JSON {"images": [URL或本地路径, ...]} 或 multipart 多文件上传（URL并发下载，共用连接池）；请求格式错误抛出ValueError
+    """
+    if request.files:
+        images = [(upload.filename, upload.read())
+                  for upload in request.files.getlist('images') or request.files.values()]
+        if len(images) == 0:
+            raise ValueError('Images must be a non-empty list')
+    else:
+        images = [(source, None) for source in core.parse_image_sources(request.get_json(silent=True))]
+    return core.fetch_contents(images)
+
+@app.route('/encode-image', methods=['POST'])
+@requires_encoder('vision')
+@handles_errors('编码图片')
+def encode_image():
+    """将单张图片编码为向量（URL、本地路径或上传的图片内容）"""
+    fmt, dtype = negotiate_vector_format(request.get_json(silent=True) if request.is_json else None)
+    
     try:
-        data = request.get_json()
-        if not data or 'texts' not in data:
-            return jsonify({
-                'error': 'Missing "texts" field in request body'
-            }), 400
-        
-        texts = data['texts']
-        if not isinstance(texts, list) or len(texts) == 0:
-            return jsonify({
-                'error': 'Texts must be a non-empty list'
-            }), 400
-        
-        # 初始化编码器（如果尚未初始化）
-        encoder = init_clip_encoder()
-        
-        # 批量编码文本
-        vectors = encoder.encode_texts_batch(texts)
-        
-        if vectors is None or len(vectors) == 0:
-            return jsonify({
-                'error': 'Failed to encode texts'
-            }), 500
-        
-        return jsonify({
-            'status': 'success',
-            'texts': texts,
-            'vectors': [v.tolist() for v in vectors],
-            'count': len(vectors),
-            'dimension': len(vectors[0]) if len(vectors) > 0 else 0
-        })
+        with metrics.stage('fetch', 'image'):
+            data = _read_image_from_request()
     except Exception as e:
-        logger.error(f"批量编码文本失败: {e}")
-        return jsonify({
-            'error': str(e)
-        }), 500
+        raise core.image_error({0: str(e)})
+    
+    # 编码图片（先查图片向量存储；开启微批处理时与并发请求合并为一批）
+    try:
+        vector = encode_image_bytes(data)
+    except ValueError as e:
+        raise core.image_error({0: str(e)})
+    if vector is None:
+        raise core.image_error({0: 'Failed to encode image'})
+    
+    return vector_response({
+        'status': 'success',
+        'dimension': len(vector)
+    }, [vector], fmt, dtype, single=True)
+
+@app.route('/encode-images', methods=['POST'])
+@requires_encoder('vision')
+@handles_errors('批量编码图片')
+def encode_images():
+    """
+    批量将图片编码为向量
+    支持: JSON {"images": [URL或本地路径, ...]} 或 multipart 多文件上传
+    单张图片加载失败不会中断整个批次，对应位置返回null并在errors中说明
+    入库时可带 "dedup": true 和一一对应的 "image_ids"：近重复图片在duplicates中给出原图image_id，感知哈希命中的不计算向量（返回null）；
+    通过检查的图片不会自动登记，写入成功后用 /register-images 登记
+    """
+    fmt, dtype = negotiate_vector_format(request.get_json(silent=True) if request.is_json else None)
+    contents, errors = read_request_images()
+    options = request.get_json(silent=True) if request.is_json else request.form.to_dict()
+    dedup = core.parse_dedup(options or {}, len(contents))
+    fmt = core.images_format(fmt, dedup)
+    
+    # 查存储 + 近重复检测（开启时） + 按batch_size分批编码
+    vectors = encode_image_bytes_batch(contents, errors, dedup)
+    body, vectors = core.images_body(vectors, errors, dedup)
+    if vectors is None:
+        return jsonify(body)
+    return vector_response(body, vectors, fmt, dtype)
+
+@app.route('/register-images', methods=['POST'])
+@handles_errors('登记图片')
+def register_images():
+    """
+    把已写入向量库的图片登记到近重复检测器（/encode-images 开启dedup时不会自动登记）
+    请求: {"image_ids": [...], "vectors": [[...]], "hashes": ["..."]}，vectors和hashes取自 /encode-images 的响应
+    """
+    return jsonify(core.register_images(core.parse_register_request(request.get_json(silent=True))))
+
+@app.route('/tag-images', methods=['POST'])
+@handles_errors('图片打标签')
+def tag_images():
+    """
+    零样本打标签：一批图片向量与标签矩阵（tag_vocabulary.json 的全部标签）做一次矩阵乘，返回每组top-k标签和置信度
+    请求: {"images": [URL或本地路径, ...]}（或multipart多文件上传），或已计算的向量 {"vectors": [[...]]} / {"vectors_b64": "...", "dtype": "float16"}
+          可选: "groups": ["body_type", "view"], "top_k": 3, "min_confidence": 0.1
+    图片先查图片向量存储，未命中时按batch_size分批计算；单张图片失败时对应位置为null并在errors中说明
+    """
+    data = (request.get_json(silent=True) if request.is_json else request.form.to_dict()) or {}
+    labels = core.get_labels()
+    options = core.parse_tag_options(data)
+    vectors = core.parse_tag_vectors(data, labels.dimension)
+
+    errors = {}
+    if vectors is None:
+        core.require_encoder('vision', ', send precomputed "vectors" instead')
+        contents, errors = read_request_images()
+        vectors = encode_image_bytes_batch(contents, errors)
+    return jsonify(core.tag_body(labels, vectors, errors, options))
+
+@app.route('/search', methods=['POST'])
+@handles_errors('本地向量搜索')
+def search():
+    """
+    在本地向量索引（clip_build_index.py 构建）中搜索最相似的图片
+    请求: {"vector": [...], "limit": 10, "offset": 0, "score_threshold": 0.2, "filter": {"brand_id": 3}, "image_ids": [...]}
+    结果格式与Qdrant search一致: [{"id", "score", "payload"}]
+    """
+    return jsonify(core.search_local_index(request.get_json(silent=True)))
+
+@app.route('/search-text', methods=['POST'])
+@requires_encoder('text')
+@handles_errors('文本搜索')
+def search_text():
+    """
+    编码查询文本并直接搜索（查询向量不离开服务进程）
+    请求: {"text": "红色跑车", "limit": 20, "offset": 0, "score_threshold": 0.0, "image_ids": [...],
+           "filter": {"brand_id": 3}, "with_payload": ["image_id"], "backend": "qdrant|local|auto",
+           "collection": "car_images"}
+    collection可选，指定时必须与服务端搜索的集合（QDRANT_COLLECTION_NAME/QDRANT_COLLECTION）一致，否则返回400
+    响应只包含id、分数和请求的payload字段
+    """
+    plan = core.parse_text_search(request.get_json(silent=True))
+    started = time.perf_counter()
+    vector = encode_query_text(plan['text'])
+    return jsonify(core.search_text_body(plan, vector, time.perf_counter() - started))
 
 if __name__ == '__main__':
     # 从环境变量读取配置
@@ -183,15 +584,9 @@ if __name__ == '__main__':
     
     logger.info(f"启动CLIP向量化服务，监听 {host}:{port}")
     logger.info(f"向量维度: {VECTOR_DIMENSION}")
-    logger.info("提示: CLIP模型采用延迟加载，首次调用/encode-text时会自动加载（需要1-2分钟）")
     
-    # 可选：启动时预加载模型（取消注释下面的代码）
-    # logger.info("正在预加载CLIP模型...")
-    # try:
-    #     init_clip_encoder()
-    #     logger.info("✅ CLIP模型预加载成功")
-    # except Exception as e:
-    #     logger.warning(f"CLIP模型预加载失败，将使用延迟加载: {e}")
+    # 启动预热（CLIP_WARMUP=background|blocking|off）
+    start_warmup()
     
     app.run(host=host, port=port, debug=False)
 
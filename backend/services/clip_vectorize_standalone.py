@@ -2,6 +2,13 @@
 """
 CLIP文本向量化独立脚本
 用于从Node.js调用，将文本转换为向量
+
+用法:
+  python3 clip_vectorize_standalone.py <text>     # 单次模式
+  python3 clip_vectorize_standalone.py --worker   # 常驻模式，stdin逐行读取请求
+
+常驻模式请求: {"id": "1", "text": "红色SUV"} 或 {"id": "2", "texts": ["SUV", "跑车"]}
+常驻模式结果: {"id": "1", "status": "success", "vector": [...], "dimension": 512}
 """
 import sys
 import os
@@ -25,12 +32,46 @@ else:
 
 try:
     from clip_encoder import get_clip_encoder
+    from worker_loop import run_worker
 except ImportError as e:
     print(json.dumps({'error': f'无法导入CLIP模块: {str(e)}'}), file=sys.stderr)
     sys.exit(1)
 
+def handle_request(request):
+    """处理常驻模式下的单个请求"""
+    encoder = get_clip_encoder('text')
+
+    if 'texts' in request:
+        texts = request['texts']
+        if not isinstance(texts, list) or len(texts) == 0:
+            return {'status': 'error', 'error': '文本列表不能为空'}
+        vectors = encoder.encode_texts_batch(texts)
+        if vectors is None:
+            return {'status': 'error', 'error': '向量化失败'}
+        return {
+            'status': 'success',
+            'vectors': [v.tolist() for v in vectors],
+            'count': len(vectors),
+            'dimension': len(vectors[0])
+        }
+
+    text = request.get('text')
+    if not text or not str(text).strip():
+        return {'status': 'error', 'error': '文本不能为空'}
+    vector = encoder.encode_text(text)
+    if vector is None:
+        return {'status': 'error', 'error': '向量化失败'}
+    return {
+        'status': 'success',
+        'vector': vector.tolist(),
+        'dimension': len(vector)
+    }
+
 def main():
     """主函数"""
+    if len(sys.argv) >= 2 and sys.argv[1] == '--worker':
+        sys.exit(run_worker(handle_request, warmup=lambda: get_clip_encoder('text')))
+
     try:
         # 从命令行参数获取文本
         if len(sys.argv) < 2:
@@ -44,7 +85,7 @@ def main():
             sys.exit(1)
         
         # 初始化编码器（延迟加载）
-        encoder = get_clip_encoder()
+        encoder = get_clip_encoder('text')
         
         # 编码文本
         vector = encoder.encode_text(text)
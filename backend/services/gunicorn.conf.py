@@ -0,0 +1,43 @@
+"""
+CLIP向量化服务的生产模式配置（gunicorn pre-fork）
+
+用法:
+  gunicorn -c gunicorn.conf.py clip_vectorize_service:app
+  或 CLIP_SERVER_MODE=prefork ./start_clip_service.sh
+
+master进程先加载模型权重再fork出 CLIP_WORKERS 个worker，权重在各worker之间写时复制共享，
+每个worker的torch线程数由 CLIP_TORCH_THREADS 控制（默认按CPU核数平分）
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'clip_utils'))
+
+from config import SERVER_CONFIG, METRICS_CONFIG  # noqa: E402
+
+bind = f"{os.getenv('CLIP_SERVICE_HOST', '0.0.0.0')}:{os.getenv('CLIP_SERVICE_PORT', 5001)}"
+workers = SERVER_CONFIG['workers']
+worker_class = 'gthread'
+threads = SERVER_CONFIG['request_threads']
+timeout = SERVER_CONFIG['timeout']
+# 在master进程导入应用，模型在fork之前加载
+preload_app = True
+
+
+def on_starting(server):
+    """master进程启动时：清空上次运行留下的worker指标快照（/metrics 汇总所有worker）"""
+    import metrics
+    if METRICS_CONFIG['enabled']:
+        metrics.reset_multiprocess_dir(METRICS_CONFIG['multiprocess_dir'])
+
+
+def when_ready(server):
+    """master进程就绪、fork worker之前：加载模型权重"""
+    import clip_vectorize_service
+    clip_vectorize_service.preload_for_fork()
+
+
+def post_fork(server, worker):
+    """worker fork之后：设置线程数并预热"""
+    import clip_vectorize_service
+    clip_vectorize_service.init_worker()
@@ -65,6 +65,10 @@ fi
 # 设置环境变量
 export CLIP_SERVICE_PORT=${CLIP_SERVICE_PORT:-5001}
 export CLIP_SERVICE_HOST=${CLIP_SERVICE_HOST:-0.0.0.0}
+export CLIP_WARMUP=${CLIP_WARMUP:-background}
+# dev: Flask开发服务器（单进程）；prefork: gunicorn多进程，模型在fork前加载、各worker共享权重；
+# async: ASGI异步服务（uvicorn），有界推理队列 + 请求截止时间
+export CLIP_SERVER_MODE=${CLIP_SERVER_MODE:-dev}
 
 echo "🌐 服务地址: http://${CLIP_SERVICE_HOST}:${CLIP_SERVICE_PORT}"
 echo ""
@@ -72,6 +76,23 @@ echo ""
 # 启动服务
 cd "$SERVICE_DIR"
 echo "正在启动服务..."
-echo "如果首次运行，CLIP模型加载可能需要1-2分钟，请耐心等待..."
+echo "CLIP模型在启动时预热（CLIP_WARMUP=${CLIP_WARMUP}），可能需要1-2分钟"
+echo "就绪检查: curl http://localhost:${CLIP_SERVICE_PORT}/ready （预热完成后返回200）"
 echo ""
+if [ "$CLIP_SERVER_MODE" = "prefork" ]; then
+    if ! python3 -c "import gunicorn" 2>/dev/null; then
+        echo "❌ 错误: prefork模式需要gunicorn，请执行 pip3 install gunicorn"
+        exit 1
+    fi
+    echo "生产模式: ${CLIP_WORKERS:-1} 个worker（CLIP_WORKERS），每个worker的推理线程数由 CLIP_TORCH_THREADS 控制"
+    exec gunicorn -c gunicorn.conf.py clip_vectorize_service:app
+fi
+if [ "$CLIP_SERVER_MODE" = "async" ]; then
+    if ! python3 -c "import starlette, uvicorn" 2>/dev/null; then
+        echo "❌ 错误: async模式需要starlette和uvicorn，请执行 pip3 install -r requirements_clip.txt"
+        exit 1
+    fi
+    echo "异步模式: 每个推理队列最多排队 ${CLIP_MAX_QUEUE:-256} 条（CLIP_MAX_QUEUE），超出时返回429"
+    exec uvicorn clip_async_service:app --host "$CLIP_SERVICE_HOST" --port "$CLIP_SERVICE_PORT"
+fi
 python3 clip_vectorize_service.py
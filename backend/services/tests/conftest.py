@@ -0,0 +1,10 @@
+"""
+测试公共配置：与服务和命令行工具一样，把 backend/services 和 clip_utils 加入模块搜索路径
+"""
+import os
+import sys
+
+SERVICES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in [SERVICES_DIR, os.path.join(SERVICES_DIR, 'clip_utils')]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
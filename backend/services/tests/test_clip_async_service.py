@@ -0,0 +1,54 @@
+"""
+clip_async_service.py 准入控制：队列满时429并带Retry-After，单个请求条数超过排队上限时直接413
+"""
+import numpy as np
+import pytest
+from starlette.testclient import TestClient
+
+import clip_async_service
+from clip_async_service import app, core
+from config import VECTOR_DIMENSION
+from micro_batcher import MicroBatcher
+
+MAX_QUEUE = 2
+
+
+def encode_batch(items):
+    return np.ones((len(items), VECTOR_DIMENSION), dtype=np.float32)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(core, 'is_ready', lambda: True)
+    monkeypatch.setattr(core, 'require_encoder', lambda kind, hint='': None)
+    monkeypatch.setattr(core, 'text_cache', None)
+    for name in ('_text_batcher', '_image_batcher'):
+        monkeypatch.setattr(clip_async_service, name,
+                            MicroBatcher(encode_batch, max_batch_size=8, window_ms=0, name=name, max_queue=MAX_QUEUE))
+    return TestClient(app)
+
+
+def test_batch_within_queue_limit_is_encoded(client):
+    response = client.post('/encode-texts', json={'texts': ['red suv', 'blue sedan']})
+    assert response.status_code == 200
+    assert len(response.json()['vectors']) == 2
+
+
+@pytest.mark.parametrize('path, body', [
+    ('/encode-texts', {'texts': ['a', 'b', 'c']}),
+    ('/encode-images', {'images': ['http://127.0.0.1:9/a.jpg', 'http://127.0.0.1:9/b.jpg', 'http://127.0.0.1:9/c.jpg']}),
+])
+def test_batch_over_queue_limit_is_rejected_with_413(client, path, body):
+    # 队列为空也永远无法准入：413且不带Retry-After，图片不会被下载
+    response = client.post(path, json=body)
+    assert response.status_code == 413
+    assert 'Retry-After' not in response.headers
+    assert response.json()['max_items'] == MAX_QUEUE
+
+
+def test_full_queue_is_rejected_with_429(client, monkeypatch):
+    batcher = clip_async_service._text_batcher
+    monkeypatch.setattr(batcher._queue, 'qsize', lambda: MAX_QUEUE)
+    response = client.post('/encode-texts', json={'texts': ['a']})
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
@@ -0,0 +1,100 @@
+"""
+clip_bulk_vectorize.py：清单读取（image_id必须是Qdrant接受的point ID：无符号整数或UUID）、--limit、续跑和 --no-resume
+"""
+import json
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import clip_bulk_vectorize
+from clip_bulk_vectorize import _parse_id, read_manifest
+from config import VECTOR_DIMENSION
+
+UUID = '5C56C793-69F3-4FBF-87E6-C4BF54C28C26'
+
+
+@pytest.mark.parametrize('value, expected', [
+    (12, 12),
+    ('12', 12),
+    (' 7 ', 7),
+    (UUID, UUID.lower()),
+])
+def test_parse_id_accepts_point_ids(value, expected):
+    assert _parse_id(value) == expected
+
+
+@pytest.mark.parametrize('value', [-1, 2 ** 64, True, 1.5, 'abc', 'img-12', '', None, '１２'])
+def test_parse_id_rejects_other_values(value):
+    with pytest.raises(ValueError):
+        _parse_id(value)
+
+
+def test_read_manifest_reports_invalid_rows(tmp_path):
+    path = tmp_path / 'manifest.jsonl'
+    rows = [{'image_id': 1, 'url': 'a.jpg'}, {'image_id': 'car-2', 'url': 'b.jpg'},
+            {'id': UUID, 'path': 'c.jpg', 'payload': {'title': 't'}}, {'image_id': -3, 'url': 'd.jpg'}]
+    path.write_text(''.join(json.dumps(row) + '\n' for row in rows), encoding='utf-8')
+
+    invalid = []
+    entries = list(read_manifest(str(path), lambda *row: invalid.append(row)))
+    assert entries == [(1, 'a.jpg', None), (UUID.lower(), 'c.jpg', {'title': 't'})]
+    assert [(image_id, source) for image_id, source, _ in invalid] == [('car-2', 'b.jpg'), (-3, 'd.jpg')]
+
+
+def test_read_manifest_csv(tmp_path):
+    path = tmp_path / 'manifest.csv'
+    path.write_text('image_id,url\n5,a.jpg\nx5,b.jpg\n', encoding='utf-8')
+    assert list(read_manifest(str(path))) == [(5, 'a.jpg', None)]
+
+
+def test_invalid_ids_are_written_to_errors(tmp_path, monkeypatch):
+    manifest = tmp_path / 'manifest.jsonl'
+    manifest.write_text(json.dumps({'image_id': 'car-2', 'url': 'b.jpg'}) + '\n', encoding='utf-8')
+    output = tmp_path / 'vectors.jsonl'
+    monkeypatch.setattr(clip_bulk_vectorize, 'get_clip_encoder', lambda mode: None)
+    monkeypatch.setattr(clip_bulk_vectorize, 'get_image_embedding_store', lambda: None)
+    report = clip_bulk_vectorize.run(clip_bulk_vectorize.parse_args([str(manifest), '-o', str(output)]))
+    assert report['failed'] == 1
+    error = json.loads((tmp_path / 'vectors.jsonl.errors.jsonl').read_text(encoding='utf-8'))
+    assert error['image_id'] == 'car-2' and 'UUID' in error['error']
+
+
+class FakeEncoder:
+    def encode_images_batch(self, images):
+        return np.ones((len(images), VECTOR_DIMENSION), dtype=np.float32)
+
+
+@pytest.fixture
+def bulk(tmp_path, monkeypatch):
+    monkeypatch.setattr(clip_bulk_vectorize, 'get_clip_encoder', lambda mode: FakeEncoder())
+    monkeypatch.setattr(clip_bulk_vectorize, 'get_image_embedding_store', lambda: None)
+    manifest = tmp_path / 'manifest.jsonl'
+    rows = []
+    for image_id in range(1, 5):
+        path = tmp_path / f"{image_id}.png"
+        Image.new('RGB', (16, 16), 'red').save(path)
+        rows.append({'image_id': image_id, 'path': str(path)})
+    rows.append({'image_id': 9, 'path': str(tmp_path / 'missing.png')})
+    manifest.write_text(''.join(json.dumps(row) + '\n' for row in rows), encoding='utf-8')
+    output = tmp_path / 'vectors.jsonl'
+
+    def run(*options):
+        clip_bulk_vectorize.run(clip_bulk_vectorize.parse_args([str(manifest), '-o', str(output), *options]))
+        lines = output.read_text(encoding='utf-8').splitlines()
+        errors = (tmp_path / 'vectors.jsonl.errors.jsonl').read_text(encoding='utf-8').splitlines()
+        return [json.loads(line)['image_id'] for line in lines], [json.loads(line)['image_id'] for line in errors]
+
+    return run
+
+
+def test_limit_and_resume(bulk):
+    assert bulk('--limit', '2') == ([1, 2], [])
+    written, errors = bulk()
+    assert (written, errors) == ([1, 2, 3, 4], [9])
+
+
+def test_no_resume_starts_over(bulk):
+    bulk()
+    written, errors = bulk('--no-resume')
+    assert (written, errors) == ([1, 2, 3, 4], [9])
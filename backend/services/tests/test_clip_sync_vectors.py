@@ -0,0 +1,218 @@
+"""
+clip_sync_vectors.py 增量同步：SQLite替身数据库 + 内存中的Qdrant替身 + 不加载模型的编码器
+"""
+import argparse
+import sqlite3
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import clip_sync_vectors
+from config import VECTOR_DIMENSION
+
+SCHEMA = '''
+CREATE TABLE brands (id INTEGER PRIMARY KEY, name TEXT, chineseName TEXT, updatedAt TEXT);
+CREATE TABLE models (id INTEGER PRIMARY KEY, name TEXT, brandId INTEGER, updatedAt TEXT);
+CREATE TABLE images (id INTEGER PRIMARY KEY, modelId INTEGER, title TEXT, description TEXT, url TEXT,
+                     category TEXT, uploadDate TEXT, updatedAt TEXT);
+CREATE INDEX idx_images_updated_id ON images(updatedAt, id);
+CREATE TABLE image_deletions (id INTEGER PRIMARY KEY AUTOINCREMENT, imageId INTEGER NOT NULL,
+                              deletedAt TEXT DEFAULT CURRENT_TIMESTAMP);
+CREATE TRIGGER trg_images_after_delete AFTER DELETE ON images
+BEGIN
+  INSERT INTO image_deletions (imageId) VALUES (OLD.id);
+END;
+'''
+
+
+class FakeQdrant:
+    """只实现同步用到的QdrantRest方法，记录每次写入"""
+
+    def __init__(self):
+        self.points = {}
+        self.calls = []
+
+    def ensure_collection(self):
+        pass
+
+    def retrieve_points(self, ids, with_payload=True, with_vector=False):
+        return [{'id': i, 'payload': dict(self.points[i]['payload'])} for i in ids if i in self.points]
+
+    def upsert_points(self, points, wait=True):
+        self.calls.append(('upsert', sorted(p['id'] for p in points)))
+        for point in points:
+            self.points[point['id']] = {'vector': point['vector'], 'payload': dict(point['payload'])}
+
+    def set_payloads(self, payloads, wait=True):
+        self.calls.append(('set_payload', sorted(payloads)))
+        for point_id, payload in payloads.items():
+            self.points[point_id]['payload'].update(payload)
+
+    def delete_points(self, ids, wait=True):
+        self.calls.append(('delete', sorted(ids)))
+        for point_id in ids:
+            self.points.pop(point_id, None)
+
+    def scroll_points(self, batch_size=1000, with_vector=True, with_payload=True):
+        return [{'id': point_id} for point_id in sorted(self.points)]
+
+
+class FakeEncoder:
+    """按图片左上角像素生成确定的向量，记录编码的图片数"""
+
+    def __init__(self):
+        self.encoded = 0
+
+    def encode_images_batch(self, images):
+        self.encoded += len(images)
+        vectors = np.zeros((len(images), VECTOR_DIMENSION), dtype=np.float32)
+        for row, image in enumerate(images):
+            vectors[row, :3] = image.convert('RGB').getpixel((0, 0))
+            vectors[row, 3] = 1.0
+        return vectors
+
+
+@pytest.fixture
+def env(tmp_path, monkeypatch):
+    monkeypatch.setattr(clip_sync_vectors, 'get_image_embedding_store', lambda: None)
+    paths = {}
+    for index, color in enumerate(['red', 'green', 'blue', 'yellow', 'white'], 1):
+        paths[index] = str(tmp_path / f"{index}.png")
+        Image.new('RGB', (16, 16), color).save(paths[index])
+
+    db_path = str(tmp_path / 'catalog.db')
+    db = sqlite3.connect(db_path)
+    db.executescript(SCHEMA)
+    db.execute("INSERT INTO brands VALUES (1, 'BMW', '宝马', '2026-01-01 00:00:00'), "
+               "(2, 'Audi', '奥迪', '2026-01-01 00:00:00')")
+    db.execute("INSERT INTO models VALUES (10, 'X5', 1, '2026-01-01 00:00:00'), "
+               "(20, 'A4', 2, '2026-01-01 00:00:00')")
+    for image_id in range(1, 5):
+        db.execute('INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                   (image_id, 10 if image_id < 3 else 20, f"t{image_id}", '', paths[image_id], '外观',
+                    '2026-01-02 10:00:00', f"2026-01-02 10:00:0{image_id}"))
+    db.commit()
+
+    qdrant = FakeQdrant()
+    encoder = FakeEncoder()
+    args = clip_sync_vectors.parse_args([
+        '--database-url', f"sqlite:///{db_path}", '--state-file', str(tmp_path / 'state.json'),
+        '--page-size', '2', '--overlap', '0', '--workers', '2'
+    ])
+
+    def run(**options):
+        qdrant.calls.clear()
+        return clip_sync_vectors.run(argparse.Namespace(**{**vars(args), **options}), client=qdrant, encoder=encoder)
+
+    yield {'db': db, 'qdrant': qdrant, 'encoder': encoder, 'paths': paths, 'run': run, 'args': args}
+    db.close()
+
+
+def test_first_sync_then_noop(env):
+    report = env['run']()
+    assert report['scanned'] == 4
+    assert report['encoded'] == 4
+    assert sorted(env['qdrant'].points) == [1, 2, 3, 4]
+    payload = env['qdrant'].points[3]['payload']
+    assert payload['image_url'] == env['paths'][3]
+    assert (payload['model_name'], payload['brand_chinese_name']) == ('A4', '奥迪')
+    assert payload['upload_date'] == '2026-01-02T10:00:00.000Z'
+
+    report = env['run']()
+    assert report['scanned'] == 0
+    assert env['qdrant'].calls == []
+    assert env['encoder'].encoded == 4
+
+
+def test_title_edit_updates_payload_only(env):
+    env['run']()
+    env['db'].execute("UPDATE images SET title = 'new', updatedAt = '2026-01-03 09:00:00' WHERE id = 2")
+    env['db'].commit()
+
+    report = env['run']()
+    assert (report['scanned'], report['payload_updates'], report['encoded']) == (1, 1, 0)
+    assert env['qdrant'].calls == [('set_payload', [2])]
+    assert env['qdrant'].points[2]['payload']['title'] == 'new'
+    assert env['encoder'].encoded == 4
+
+
+def test_url_change_reencodes(env):
+    env['run']()
+    env['db'].execute('UPDATE images SET url = ?, updatedAt = ? WHERE id = 1',
+                      (env['paths'][5], '2026-01-03 09:00:00'))
+    env['db'].commit()
+
+    report = env['run']()
+    assert report['encoded'] == 1
+    assert env['qdrant'].calls == [('upsert', [1])]
+    assert env['qdrant'].points[1]['vector'][:3] == [255.0, 255.0, 255.0]
+    assert env['qdrant'].points[1]['payload']['image_url'] == env['paths'][5]
+
+
+def test_brand_rename_updates_images_of_brand(env):
+    env['run']()
+    env['db'].execute("UPDATE brands SET chineseName = '奥迪汽车', updatedAt = '2026-01-03 09:00:00' WHERE id = 2")
+    env['db'].commit()
+
+    report = env['run']()
+    assert report['encoded'] == 0
+    assert env['qdrant'].calls == [('set_payload', [3, 4])]
+    assert env['qdrant'].points[4]['payload']['brand_chinese_name'] == '奥迪汽车'
+    assert env['qdrant'].points[1]['payload']['brand_chinese_name'] == '宝马'
+    assert report['watermark']['brands'] == '2026-01-03 09:00:00'
+
+
+def test_deleted_row_removes_point(env):
+    env['run']()
+    env['db'].execute('DELETE FROM images WHERE id = 3')
+    env['db'].commit()
+
+    report = env['run']()
+    assert report['deleted'] == 1
+    assert env['qdrant'].calls == [('delete', [3])]
+    assert sorted(env['qdrant'].points) == [1, 2, 4]
+    assert report['watermark']['deletions'] == 1
+
+    # 删除记录已处理，不会重复删除
+    assert env['run']()['deleted'] == 0
+
+
+def test_reconcile_deletes_is_opt_in(env):
+    env['run']()
+    env['qdrant'].points[99] = {'vector': [0.0] * VECTOR_DIMENSION, 'payload': {'image_id': 99}}
+
+    assert env['run']()['deleted'] == 0
+    assert 99 in env['qdrant'].points
+    assert env['run'](reconcile_deletes=True)['deleted'] == 1
+    assert 99 not in env['qdrant'].points
+
+
+def test_failed_image_is_retried(env, tmp_path):
+    missing = str(tmp_path / 'later.png')
+    env['db'].execute('INSERT INTO images VALUES (5, 20, ?, ?, ?, ?, ?, ?)',
+                      ('t5', '', missing, '外观', '2026-01-02 10:00:00', '2026-01-02 10:00:05'))
+    env['db'].commit()
+
+    report = env['run']()
+    assert report['failed'] == 1
+    assert 5 not in env['qdrant'].points
+    assert clip_sync_vectors.load_state(env['args'].state_file)['retry_ids'] == [5]
+
+    Image.new('RGB', (16, 16), 'black').save(missing)
+    report = env['run']()
+    assert report['failed'] == 0
+    assert env['qdrant'].calls == [('upsert', [5])]
+    assert clip_sync_vectors.load_state(env['args'].state_file)['retry_ids'] == []
+
+
+def test_point_without_image_url_is_backfilled(env):
+    # Node端此前写入的point没有image_url：沿用已有向量，只补写payload
+    vector = [0.5] * VECTOR_DIMENSION
+    env['qdrant'].points[1] = {'vector': vector, 'payload': {'image_id': 1, 'title': 't1'}}
+
+    report = env['run']()
+    assert report['encoded'] == 3
+    assert ('set_payload', [1]) in env['qdrant'].calls
+    assert env['qdrant'].points[1]['vector'] == vector
+    assert env['qdrant'].points[1]['payload']['image_url'] == env['paths'][1]
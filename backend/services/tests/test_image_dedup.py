@@ -0,0 +1,110 @@
+"""
+image_dedup.py：dHash对缩放/重新压缩稳定、缺少细节的哈希不参与比较、DedupBatch对本批和已登记图片的两级判重、哈希表持久化
+"""
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from image_dedup import DedupBatch, DuplicateDetector, dhash, hamming_distances, is_informative
+
+H = 0x0F0F_3C3C_5A5A_A5A5
+
+
+def car_image(seed, size=(320, 240)):
+    """确定性的随机色块图（不同seed的图片内容无关）"""
+    rng = np.random.default_rng(seed)
+    blocks = rng.integers(0, 256, size=(6, 8, 3), dtype=np.uint8)
+    return Image.fromarray(blocks).resize(size, Image.BILINEAR)
+
+
+def recompressed(image, size, quality=60):
+    buffer = io.BytesIO()
+    image.resize(size, Image.BILINEAR).save(buffer, format='JPEG', quality=quality)
+    return Image.open(io.BytesIO(buffer.getvalue()))
+
+
+def unit(*values):
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def detector(**options):
+    return DuplicateDetector(use_index=False, **options)
+
+
+def test_dhash_is_stable_under_resize_and_recompression():
+    original = car_image(1)
+    copy = dhash(recompressed(original, (160, 120)))
+    assert hamming_distances(np.array([dhash(original)], dtype=np.uint64), copy)[0] <= 4
+    assert hamming_distances(np.array([dhash(original)], dtype=np.uint64), dhash(car_image(2)))[0] > 10
+
+
+def test_hamming_distances():
+    hashes = np.array([H, H ^ 0b1011, ~H & (2 ** 64 - 1)], dtype=np.uint64)
+    assert hamming_distances(hashes, H).tolist() == [0, 3, 64]
+
+
+def test_flat_images_are_not_compared():
+    flat = dhash(Image.new('RGB', (64, 64), 'white'))
+    assert not is_informative(flat)
+    registered = detector()
+    registered.add(1, phash=flat)
+    assert registered.match_hash(flat, 2) is None
+    assert registered.stats()['hashes'] == 0
+
+
+def test_hash_duplicates_within_batch_and_against_registered():
+    registered = detector(hash_distance=4)
+    registered.add(100, phash=H)
+
+    batch = DedupBatch(registered, [1, 2, 3, 4])
+    other = 0x1234_5678_9ABC_DEF0
+    kept = batch.filter_hashes({0: H ^ 0b11, 1: other, 2: other ^ 0b1, 3: other ^ 0xFFFF})
+    assert kept == [1, 3]
+    assert batch.duplicates[0] == {'duplicate_of': 100, 'method': 'phash', 'distance': 2}
+    # 与本批中靠前的图片重复
+    assert batch.duplicates[2] == {'duplicate_of': 2, 'method': 'phash', 'distance': 1}
+    # 本批内部的比较不写入检测器
+    assert registered.stats()['hashes'] == 1
+
+
+def test_same_image_id_is_not_its_own_duplicate():
+    registered = detector()
+    registered.add(7, phash=H, vector=unit(1, 0, 0))
+    batch = DedupBatch(registered, [7])
+    assert batch.filter_hashes({0: H}) == [0]
+    batch.check_vectors([unit(1, 0, 0)])
+    assert batch.duplicates == {}
+
+
+def test_cosine_duplicates_and_registration():
+    registered = detector(cosine_threshold=0.97)
+    registered.add(100, vector=unit(1, 0, 0))
+
+    batch = DedupBatch(registered, [1, 2, 3, 4])
+    duplicates = batch.check_vectors([unit(1, 0.1, 0), unit(0, 1, 0), unit(0, 1, 0.05), None])
+    assert duplicates[0]['duplicate_of'] == 100 and duplicates[0]['method'] == 'cosine'
+    assert duplicates[2]['duplicate_of'] == 2
+    assert batch.accepted() == [1]
+
+    # 只登记写入成功的图片
+    batch.register([])
+    assert registered.match_vector(unit(0, 1, 0)) is None
+    batch.register()
+    assert registered.match_vector(unit(0, 1, 0.01), image_id=9)['duplicate_of'] == 2
+
+
+def test_hash_table_persists_and_merges(tmp_path):
+    path = str(tmp_path / 'hashes.npz')
+    first, second = detector(persist_path=path), detector(persist_path=path)
+    first.add(1, phash=H)
+    second.add(2, phash=~H & (2 ** 64 - 1))
+    first.save()
+    second.save()
+
+    reloaded = detector(persist_path=path)
+    assert reloaded.stats()['hashes'] == 2
+    assert reloaded.match_hash(H ^ 1, image_id=5)['duplicate_of'] == 1
+    assert reloaded.match_hash(~H & (2 ** 64 - 1), image_id=5)['duplicate_of'] == 2
@@ -0,0 +1,107 @@
+"""
+image_embedding_store.py：追加写入、重新打开、截断不完整的行、跳过重复摘要、float16存储、其他实例追加后的增量读取
+"""
+import json
+import os
+
+import numpy as np
+import pytest
+
+from image_embedding_store import DIGEST_SIZE, ImageEmbeddingStore, content_digest
+
+DIMENSION = 4
+
+
+def open_store(tmp_path, **options):
+    return ImageEmbeddingStore(str(tmp_path), 'openai/clip-vit-base-patch32', dimension=DIMENSION, **options)
+
+
+def vector(value):
+    return np.arange(DIMENSION, dtype=np.float32) + value
+
+
+def test_round_trip_and_reopen(tmp_path):
+    store = open_store(tmp_path)
+    digests = [content_digest(b'a'), content_digest(b'b')]
+    store.put_many(digests, [vector(1), vector(2)])
+    assert len(store) == 2
+    assert store.get(content_digest(b'missing')) is None
+
+    reopened = open_store(tmp_path)
+    found = reopened.get_many(digests)
+    np.testing.assert_array_equal(found[0], vector(1))
+    np.testing.assert_array_equal(found[1], vector(2))
+    assert reopened.stats()['hits'] == 2
+
+
+def test_put_many_skips_existing_and_repeated_digests(tmp_path):
+    store = open_store(tmp_path)
+    digest = content_digest(b'a')
+    store.put(digest, vector(1))
+    store.put_many([digest, content_digest(b'b'), content_digest(b'b'), content_digest(b'c')],
+                   [vector(9), vector(2), vector(8), None])
+    assert len(store) == 2
+    np.testing.assert_array_equal(store.get(digest), vector(1))
+    np.testing.assert_array_equal(store.get(content_digest(b'b')), vector(2))
+    assert os.path.getsize(store.keys_path) == 2 * DIGEST_SIZE
+    assert store.stats()['writes'] == 2
+
+
+def test_torn_files_are_truncated_to_complete_rows(tmp_path):
+    store = open_store(tmp_path)
+    store.put_many([content_digest(b'a'), content_digest(b'b')], [vector(1), vector(2)])
+    # 进程在写完第三行向量的一半、还没写键时退出
+    with open(store.vectors_path, 'ab') as f:
+        f.write(vector(3).tobytes()[:7])
+    with open(store.keys_path, 'ab') as f:
+        f.write(content_digest(b'c')[:5])
+
+    reopened = open_store(tmp_path)
+    assert len(reopened) == 2
+    assert os.path.getsize(reopened.keys_path) == 2 * DIGEST_SIZE
+    assert os.path.getsize(reopened.vectors_path) == 2 * DIMENSION * 4
+    np.testing.assert_array_equal(reopened.get(content_digest(b'b')), vector(2))
+
+    # 向量完整但键没写完：键文件决定行数，多出的向量被截掉
+    with open(reopened.vectors_path, 'ab') as f:
+        f.write(vector(3).tobytes())
+    assert len(open_store(tmp_path)) == 2
+    assert os.path.getsize(reopened.vectors_path) == 2 * DIMENSION * 4
+
+
+def test_float16_round_trip(tmp_path):
+    store = open_store(tmp_path, dtype='float16')
+    values = np.array([0.1, -0.25, 0.3333, 1.0], dtype=np.float32)
+    store.put(content_digest(b'a'), values)
+    assert os.path.getsize(store.vectors_path) == DIMENSION * 2
+
+    found = open_store(tmp_path, dtype='float16').get(content_digest(b'a'))
+    assert found.dtype == np.float32
+    np.testing.assert_allclose(found, values, atol=1e-3)
+
+
+def test_dimension_mismatch_is_rejected(tmp_path):
+    store = open_store(tmp_path)
+    with pytest.raises(ValueError):
+        store.put(content_digest(b'a'), np.ones(DIMENSION + 1, dtype=np.float32))
+    assert len(store) == 0
+    with pytest.raises(ValueError):
+        open_store(tmp_path, dtype='int8')
+
+
+def test_rows_appended_by_another_instance_are_visible(tmp_path):
+    reader, writer = open_store(tmp_path), open_store(tmp_path)
+    reader.put(content_digest(b'a'), vector(1))
+    writer.put(content_digest(b'b'), vector(2))
+    np.testing.assert_array_equal(reader.get(content_digest(b'b')), vector(2))
+    assert len(reader) == 2
+
+
+def test_namespace_includes_backend_and_preprocess(tmp_path):
+    fp32 = open_store(tmp_path, backend='torch', preprocess='fast1-full')
+    int8 = open_store(tmp_path, backend='torch-int8', preprocess='fast1-full')
+    fp32.put(content_digest(b'a'), vector(1))
+    assert int8.get(content_digest(b'a')) is None
+    assert os.path.basename(int8.path) == 'openai_clip-vit-base-patch32-torch-int8-fast1-full-float32'
+    with open(os.path.join(int8.path, 'meta.json')) as f:
+        assert json.load(f)['backend'] == 'torch-int8'
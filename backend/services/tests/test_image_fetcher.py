@@ -0,0 +1,120 @@
+"""
+image_fetcher.py 图片下载：本地http.server替身，覆盖条件请求缓存、字节上限、5xx重试和fetch_many的逐项错误
+"""
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from image_fetcher import FetchError, ImageFetcher
+
+BODY = b'\xff\xd8' + b'car' * 100
+
+
+class Handler(BaseHTTPRequestHandler):
+    """按路径返回不同响应，记录每个路径的请求次数和收到的条件头"""
+
+    def do_GET(self):
+        server = self.server
+        server.hits[self.path] += 1
+        server.conditional[self.path] = self.headers.get('If-None-Match')
+        if self.path == '/etag':
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.respond(304)
+            else:
+                self.respond(200, BODY, {'ETag': '"v1"'})
+        elif self.path == '/large':
+            self.respond(200, b'x' * 4096)
+        elif self.path == '/large-unsized':
+            # 不声明长度（读到连接关闭），只能边读边检查
+            self.send_response(200)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(b'x' * 4096)
+            self.close_connection = True
+        elif self.path == '/flaky':
+            if server.hits[self.path] <= 2:
+                self.respond(503, b'busy', {'Retry-After': '0'})
+            else:
+                self.respond(200, BODY)
+        elif self.path == '/ok':
+            self.respond(200, BODY)
+        else:
+            self.respond(404, b'missing')
+
+    def respond(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.hits = Counter()
+    httpd.conditional = {}
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.base = f"http://127.0.0.1:{httpd.server_address[1]}"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def make_fetcher(tmp_path, **options):
+    return ImageFetcher(cache_dir=str(tmp_path / 'http'), max_bytes=1024, max_retries=2, **options)
+
+
+def test_etag_revalidation_uses_cache(server, tmp_path):
+    fetcher = make_fetcher(tmp_path)
+    assert fetcher.fetch(server.base + '/etag') == BODY
+    assert server.conditional['/etag'] is None
+
+    # 新的下载器实例共用缓存目录（多进程场景），第二次带If-None-Match，304时返回本地内容
+    fetcher = make_fetcher(tmp_path)
+    assert fetcher.fetch(server.base + '/etag') == BODY
+    assert server.conditional['/etag'] == '"v1"'
+    stats = fetcher.stats()
+    assert (stats['not_modified'], stats['downloaded']) == (1, 0)
+
+
+@pytest.mark.parametrize('path', ['/large', '/large-unsized'])
+def test_max_bytes_raises_413(server, tmp_path, path):
+    fetcher = make_fetcher(tmp_path)
+    with pytest.raises(FetchError) as info:
+        fetcher.fetch(server.base + path)
+    assert info.value.status_code == 413
+    # 超过上限不重试
+    assert server.hits[path] == 1
+    assert fetcher.stats()['too_large'] == 1
+
+
+def test_retries_503(server, tmp_path):
+    fetcher = make_fetcher(tmp_path)
+    assert fetcher.fetch(server.base + '/flaky') == BODY
+    assert server.hits['/flaky'] == 3
+    assert fetcher.stats()['retries'] == 2
+
+
+def test_404_is_not_retried(server, tmp_path):
+    fetcher = make_fetcher(tmp_path)
+    with pytest.raises(FetchError) as info:
+        fetcher.fetch(server.base + '/gone')
+    assert info.value.status_code == 404
+    assert server.hits['/gone'] == 1
+
+
+def test_fetch_many_reports_errors_per_item(server, tmp_path):
+    fetcher = make_fetcher(tmp_path, concurrency=4)
+    urls = [server.base + path for path in ['/ok', '/gone', '/large', '/ok']]
+    results = fetcher.fetch_many(urls)
+    assert results[0] == results[3] == BODY
+    assert isinstance(results[1], FetchError) and results[1].status_code == 404
+    assert isinstance(results[2], FetchError) and results[2].status_code == 413
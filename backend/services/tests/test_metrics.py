@@ -0,0 +1,84 @@
+"""
+metrics.py 多进程汇总：共享目录中的worker快照与本进程指标合并
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    registry = metrics.Registry()
+    registry.register(metrics.Counter('t_requests_total', 'requests', ('endpoint',))).inc(2, endpoint='/a')
+    histogram = registry.register(metrics.Histogram('t_seconds', 'latency', buckets=(0.1, 1.0)))
+    histogram.observe(0.05)
+    registry.register(metrics.Gauge('t_in_flight', 'in flight')).set(1)
+    monkeypatch.setattr(metrics, 'REGISTRY', registry)
+    return registry
+
+
+def worker_snapshot(directory, pid, requests, in_flight):
+    snapshot = [
+        ['t_requests_total', 'counter', 'requests', [['t_requests_total', {'endpoint': '/a'}, requests]]],
+        ['t_seconds', 'histogram', 'latency', [['t_seconds_bucket', {'le': '0.1'}, 0],
+                                               ['t_seconds_bucket', {'le': '1'}, 1],
+                                               ['t_seconds_bucket', {'le': '+Inf'}, 1],
+                                               ['t_seconds_sum', {}, 0.5], ['t_seconds_count', {}, 1]]],
+        ['t_in_flight', 'gauge', 'in flight', [['t_in_flight', {}, in_flight]]]
+    ]
+    with open(os.path.join(directory, f'{pid}.json'), 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f)
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def test_render_merges_worker_snapshots(registry, tmp_path, monkeypatch):
+    monkeypatch.setitem(metrics._multiprocess, 'dir', str(tmp_path))
+    alive, dead = os.getppid(), dead_pid()
+    worker_snapshot(str(tmp_path), alive, requests=3, in_flight=4)
+    worker_snapshot(str(tmp_path), dead, requests=5, in_flight=7)
+
+    lines = metrics.render().splitlines()
+    assert 't_requests_total{endpoint="/a"} 10' in lines
+    assert 't_seconds_bucket{le="0.1"} 1' in lines
+    assert 't_seconds_bucket{le="1"} 3' in lines
+    assert 't_seconds_count 3' in lines
+    assert f't_in_flight{{pid="{os.getpid()}"}} 1' in lines
+    assert f't_in_flight{{pid="{alive}"}} 4' in lines
+    # 已退出的worker只保留计数，不再输出仪表
+    assert not any(f'pid="{dead}"' in line for line in lines)
+    assert sum(line.startswith('# TYPE t_requests_total') for line in lines) == 1
+
+
+def test_render_without_multiprocess_is_local(registry):
+    assert metrics.render() == registry.render()
+
+
+def test_reset_removes_old_snapshots(tmp_path):
+    (tmp_path / '123.json').write_text('[]')
+    (tmp_path / 'keep.txt').write_text('')
+    metrics.reset_multiprocess_dir(str(tmp_path))
+    assert os.listdir(tmp_path) == ['keep.txt']
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/stat'), reason='requires /proc')
+def test_process_start_time_is_read_from_proc():
+    started = metrics._process_start_time()
+    assert started <= metrics._IMPORTED_AT + 0.05
+    # 子进程启动后过一段时间才导入模块：启动时间来自/proc，而不是导入时间
+    output = subprocess.check_output([sys.executable, '-c', (
+        'import sys, time; sys.path[:0] = sys.argv[1:]; time.sleep(0.3); '
+        'import metrics; print(metrics._process_start_time(), metrics._IMPORTED_AT)'),
+        os.path.dirname(metrics.__file__)])
+    child_started, child_imported = map(float, output.split())
+    assert started <= child_started <= child_imported - 0.25
@@ -0,0 +1,134 @@
+"""
+micro_batcher.py：窗口内的请求合并为一批、排队期间过期的请求在计算前丢弃、submit_many整体准入、Retry-After估算
+"""
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from micro_batcher import BatchTooLargeError, DeadlineExceeded, MicroBatcher, QueueFullError
+
+
+class StubEncoder:
+    """记录每批的输入；gate未打开时阻塞，用来让请求在队列中堆积"""
+
+    def __init__(self):
+        self.batches = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.started = threading.Event()
+
+    def __call__(self, items):
+        self.started.set()
+        self.gate.wait(5)
+        self.batches.append(list(items))
+        return np.array([[float(item)] for item in items])
+
+
+@pytest.fixture
+def encoder():
+    encoder = StubEncoder()
+    yield encoder
+    encoder.gate.set()
+
+
+def blocked(batcher, encoder):
+    """提交一条请求并等后台线程在计算中阻塞，之后提交的请求都留在队列里"""
+    encoder.gate.clear()
+    future = batcher.submit(0)
+    assert encoder.started.wait(5)
+    return future
+
+
+def test_requests_within_window_share_a_batch(encoder):
+    batcher = MicroBatcher(encoder, max_batch_size=8, window_ms=200, name='t')
+    results = [None] * 5
+
+    def submit(i):
+        results[i] = batcher.encode(i, timeout=5)
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [float(r[0]) for r in results] == [0, 1, 2, 3, 4]
+    assert len(encoder.batches) == 1 and sorted(encoder.batches[0]) == [0, 1, 2, 3, 4]
+    assert batcher.stats()['max_batch'] == 5
+
+
+def test_batches_are_capped_at_max_batch_size(encoder):
+    batcher = MicroBatcher(encoder, max_batch_size=2, window_ms=0, name='t')
+    first = blocked(batcher, encoder)
+    futures = batcher.submit_many([1, 2, 3])
+    encoder.gate.set()
+
+    assert first.result(5)[0] == 0
+    assert [f.result(5)[0] for f in futures] == [1, 2, 3]
+    assert [len(batch) for batch in encoder.batches] == [1, 2, 1]
+
+
+def test_expired_requests_are_dropped_before_compute(encoder):
+    batcher = MicroBatcher(encoder, max_batch_size=8, window_ms=0, name='t')
+    first = blocked(batcher, encoder)
+    expired = batcher.submit(1, deadline=time.monotonic() + 0.01)
+    live = batcher.submit(2, deadline=time.monotonic() + 10)
+    time.sleep(0.05)
+    encoder.gate.set()
+
+    assert first.result(5)[0] == 0
+    with pytest.raises(DeadlineExceeded):
+        expired.result(5)
+    assert live.result(5)[0] == 2
+    assert [1 in batch for batch in encoder.batches] == [False, False]
+    assert batcher.stats()['expired'] == 1
+
+
+def test_submit_many_is_all_or_nothing(encoder):
+    batcher = MicroBatcher(encoder, max_batch_size=8, window_ms=0, name='t', max_queue=3)
+    blocked(batcher, encoder)
+    batcher.submit_many([1, 2])
+
+    # 剩余容量1条，两条一起提交时整体拒绝，不会只排进去一条
+    with pytest.raises(QueueFullError):
+        batcher.submit_many([3, 4])
+    assert batcher.queue_depth() == 2
+    batcher.submit(5)
+    assert batcher.queue_depth() == 3
+    assert batcher.stats()['rejected'] == 2
+
+
+def test_batch_larger_than_queue_is_never_admitted(encoder):
+    batcher = MicroBatcher(encoder, max_batch_size=8, window_ms=0, name='t', max_queue=3)
+    with pytest.raises(BatchTooLargeError) as info:
+        batcher.submit_many([1, 2, 3, 4])
+    assert info.value.max_queue == 3
+    assert batcher.queue_depth() == 0
+
+
+def test_failed_batch_fails_every_future():
+    def fail(items):
+        raise RuntimeError('boom')
+
+    batcher = MicroBatcher(fail, max_batch_size=8, window_ms=50, name='t')
+    futures = batcher.submit_many([1, 2])
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result(5)
+
+
+def test_retry_after_scales_with_queue_depth(encoder, monkeypatch):
+    batcher = MicroBatcher(encoder, max_batch_size=10, window_ms=0, name='t', max_queue=1000)
+    # 还没有完成的批次时按每批0.1秒估算，至少1秒
+    assert batcher.retry_after() == 1.0
+    with batcher._lock:
+        batcher._stats['batches'] = 4
+        batcher._stats['total_compute_ms'] = 4 * 500.0
+    monkeypatch.setattr(batcher._queue, 'qsize', lambda: 95)
+    # 95条 / 每批10条 x 每批0.5秒 = 4.75秒，向上取整
+    assert batcher.retry_after() == 5
+    with pytest.raises(QueueFullError) as info:
+        batcher.ensure_capacity(906)
+    assert info.value.retry_after == 5
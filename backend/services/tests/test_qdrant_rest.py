@@ -0,0 +1,195 @@
+"""
+qdrant_rest.py：本地http.server实现的Qdrant替身（只实现客户端用到的接口），检查请求格式、重试和批量写入器
+"""
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import numpy as np
+import pytest
+
+import qdrant_rest
+from config import VECTOR_DIMENSION
+from qdrant_rest import QdrantBatchWriter, QdrantError, QdrantRest, build_point
+
+COLLECTION = 'test_images'
+
+
+class QdrantHandler(BaseHTTPRequestHandler):
+    """内存中的单集合Qdrant，server.fail_next 个请求先返回503"""
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        server = self.server
+        path = urlsplit(self.path).path
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        server.requests.append((method, self.path, body, self.headers.get('api-key')))
+        if server.fail_next > 0:
+            server.fail_next -= 1
+            return self.respond(503, {'status': {'error': 'busy'}})
+
+        base = f"/collections/{COLLECTION}"
+        if path == base and method == 'GET':
+            if server.collection is None:
+                return self.respond(404, {'status': {'error': 'Not found'}})
+            return self.respond(200, {'result': server.collection})
+        if path == base and method == 'PUT':
+            server.collection = body
+            return self.respond(200, {'result': True})
+        if not path.startswith(base):
+            return self.respond(404, {'status': {'error': 'Not found'}})
+
+        points = server.points
+        action = path[len(base):]
+        if action == '/points' and method == 'PUT':
+            for point in body['points']:
+                if len(point['vector']) != server.collection['vectors']['size']:
+                    return self.respond(400, {'status': {'error': 'Wrong input: Vector dimension error'}})
+            for point in body['points']:
+                points[point['id']] = point
+            return self.respond(200, {'result': {'status': 'completed'}})
+        if action == '/points' and method == 'POST':
+            return self.respond(200, {'result': [self.view(points[i], body) for i in body['ids'] if i in points]})
+        if action == '/points/batch':
+            for operation in body['operations']:
+                for point_id in operation['set_payload']['points']:
+                    points[point_id]['payload'].update(operation['set_payload']['payload'])
+            return self.respond(200, {'result': [{'status': 'completed'}]})
+        if action == '/points/delete':
+            for point_id in body['points']:
+                points.pop(point_id, None)
+            return self.respond(200, {'result': {'status': 'completed'}})
+        if action == '/points/scroll':
+            ids = sorted(points)
+            start = ids.index(body['offset']) if 'offset' in body else 0
+            page = ids[start:start + body['limit']]
+            following = ids[start + body['limit']] if start + body['limit'] < len(ids) else None
+            return self.respond(200, {'result': {'points': [self.view(points[i], body) for i in page],
+                                                 'next_page_offset': following}})
+        return self.respond(404, {'status': {'error': 'Not found'}})
+
+    @staticmethod
+    def view(point, body):
+        result = {'id': point['id']}
+        if body.get('with_payload'):
+            result['payload'] = point['payload']
+        if body.get('with_vector'):
+            result['vector'] = point['vector']
+        return result
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # 重试不等待
+    monkeypatch.setattr(qdrant_rest.time, 'sleep', lambda seconds: None)
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), QdrantHandler)
+    httpd.collection = None
+    httpd.points = {}
+    httpd.requests = []
+    httpd.fail_next = 0
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def client(server):
+    return QdrantRest(url=f"http://127.0.0.1:{server.server_address[1]}/", api_key='secret',
+                      collection=COLLECTION, max_retries=2)
+
+
+def vector(value):
+    return np.full(VECTOR_DIMENSION, value, dtype=np.float32)
+
+
+def test_ensure_collection_creates_once(server, client):
+    client.ensure_collection()
+    assert server.collection == {'vectors': {'size': VECTOR_DIMENSION, 'distance': 'Cosine'}}
+    client.ensure_collection()
+    assert [method for method, *_ in server.requests] == ['GET', 'PUT', 'GET']
+    assert all(api_key == 'secret' for *_, api_key in server.requests)
+
+
+def test_points_round_trip(server, client):
+    client.ensure_collection()
+    client.upsert_points([build_point(i, vector(i / 10), {'title': f"t{i}"}) for i in range(1, 6)])
+    method, path, body, _ = server.requests[-1]
+    assert (method, path) == ('PUT', f"/collections/{COLLECTION}/points?wait=true")
+    assert body['points'][0]['payload']['image_id'] == 1
+    assert 'updated_at' in body['points'][0]['payload']
+
+    found = client.retrieve_points([2, 99])
+    assert [point['id'] for point in found] == [2]
+    assert found[0]['payload']['title'] == 't2'
+
+    client.set_payloads({2: {'title': 'new'}, 3: {'category': '内饰'}})
+    assert server.points[2]['payload']['title'] == 'new'
+    assert server.points[3]['payload']['title'] == 't3'
+
+    client.delete_points([4])
+    scrolled = list(client.scroll_points(batch_size=2, with_vector=False, with_payload=False))
+    assert [point['id'] for point in scrolled] == [1, 2, 3, 5]
+    assert sum(1 for _, path, *_ in server.requests if path.endswith('/scroll')) == 2
+
+
+def test_retries_5xx_but_not_4xx(server, client):
+    server.fail_next = 2
+    assert client.collection_exists() is False
+    assert len(server.requests) == 3
+
+    client.ensure_collection()
+    server.requests.clear()
+    with pytest.raises(QdrantError) as info:
+        client.upsert_points([{'id': 1, 'vector': [0.1, 0.2], 'payload': {}}])
+    assert info.value.status_code == 400
+    assert len(server.requests) == 1
+
+    server.fail_next = 3
+    with pytest.raises(QdrantError) as info:
+        client.retrieve_points([1])
+    assert info.value.status_code == 503
+
+
+def test_build_point_checks_dimension():
+    with pytest.raises(ValueError):
+        build_point(1, [0.1, 0.2])
+
+
+def test_batch_writer_chunks_and_reports(server, client):
+    client.ensure_collection()
+    written, failed = [], []
+    writer = QdrantBatchWriter(client, chunk_size=3, max_in_flight=2,
+                               on_success=lambda points: written.extend(p['id'] for p in points),
+                               on_error=lambda points, e: failed.extend(p['id'] for p in points))
+    writer.add([build_point(i, vector(0.1)) for i in range(1, 8)])
+    writer.add([{'id': 8, 'vector': [0.1], 'payload': {}}])
+    writer.close()
+
+    assert sorted(written) == [1, 2, 3, 4, 5, 6]
+    assert failed == [7, 8]
+    assert writer.stats['points'] == 6 and writer.stats['failed_points'] == 2
+    assert sorted(server.points) == [1, 2, 3, 4, 5, 6]
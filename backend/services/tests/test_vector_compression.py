@@ -0,0 +1,90 @@
+"""
+vector_compression.py：各编码的还原误差上界、打分与解码后内积一致、量化器保存/读取、compression_report
+"""
+import numpy as np
+import pytest
+
+from vector_compression import (Float16Codec, ProductQuantizer, ScalarQuantizer, compression_report,
+                                load_quantizer, make_quantizer, save_quantizer, top_k)
+
+DIMENSION = 64
+
+
+@pytest.fixture(scope='module')
+def vectors():
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(2000, DIMENSION))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def test_float16_round_trip(vectors):
+    codec = Float16Codec().fit(vectors)
+    codes = codec.encode(vectors)
+    assert codes.dtype == np.float16 and codec.code_size == DIMENSION * 2
+    # 单位向量各分量不超过1，float16相对误差不超过2^-11
+    assert np.abs(codec.decode(codes) - vectors).max() <= 2 ** -11
+    np.testing.assert_allclose(codec.score(codes, vectors[0]), codec.decode(codes) @ vectors[0], atol=1e-5)
+
+
+def test_int8_error_is_within_half_a_step(vectors):
+    quantizer = ScalarQuantizer().fit(vectors)
+    codes = quantizer.encode(vectors)
+    assert codes.dtype == np.int8 and quantizer.code_size == DIMENSION
+    error = np.abs(quantizer.decode(codes) - vectors)
+    assert (error <= quantizer.scale / 2 + 1e-7).all()
+    np.testing.assert_allclose(quantizer.score(codes, vectors[0]), quantizer.decode(codes) @ vectors[0], atol=1e-5)
+
+
+def test_int8_clips_values_outside_the_training_range(vectors):
+    quantizer = ScalarQuantizer().fit(vectors)
+    codes = quantizer.encode(vectors[:1] * 10)
+    assert np.abs(codes.astype(np.int32)).max() == 127
+
+
+def test_pq_reconstruction_and_adc_scores(vectors):
+    quantizer = ProductQuantizer(subspaces=16, centroids=64, iterations=8).fit(vectors)
+    codes = quantizer.encode(vectors)
+    assert codes.shape == (len(vectors), 16) and codes.dtype == np.uint8
+    decoded = quantizer.decode(codes)
+    # 每段64个中心，平均平方重建误差远小于单位向量本身的平方范数1
+    assert np.mean(np.sum((decoded - vectors) ** 2, axis=1)) < 0.25
+    # ADC查表求和等于解码后的内积
+    query = vectors[3]
+    np.testing.assert_allclose(quantizer.score(codes, query), decoded @ query, atol=1e-4)
+    with pytest.raises(ValueError):
+        ProductQuantizer(subspaces=7).fit(vectors)
+
+
+@pytest.mark.parametrize('kind', ['float16', 'int8', 'pq'])
+def test_save_and_load_quantizer(vectors, tmp_path, kind):
+    quantizer = make_quantizer(kind, subspaces=8).fit(vectors[:500])
+    path = str(tmp_path / 'quantizer.npz')
+    save_quantizer(quantizer, path)
+    loaded = load_quantizer(path)
+    assert loaded.kind == kind
+    if kind != 'float16':
+        codes = quantizer.encode(vectors[:50])
+        np.testing.assert_array_equal(loaded.encode(vectors[:50]), codes)
+        np.testing.assert_allclose(loaded.score(codes, vectors[0]), quantizer.score(codes, vectors[0]))
+
+
+def test_make_quantizer_rejects_unknown_kind():
+    with pytest.raises(ValueError):
+        make_quantizer('int4')
+
+
+def test_top_k_is_sorted():
+    scores = np.array([0.1, 0.9, 0.5, 0.7, 0.3], dtype=np.float32)
+    assert top_k(scores, 3).tolist() == [1, 3, 2]
+    assert top_k(scores, 10).tolist() == [1, 3, 2, 4, 0]
+
+
+def test_compression_report(vectors):
+    report = compression_report(vectors, kinds=('float16', 'int8', 'pq'), queries=20, subspaces=(16,))
+    assert report['float32']['bytes_per_vector'] == DIMENSION * 4
+    assert (report['float16']['compression'], report['int8']['compression'], report['pq16']['compression']) == (2.0, 4.0, 16.0)
+    assert report['float16']['recall@10'] >= 0.99
+    assert report['int8']['recall@10_rerank'] >= 0.95
+    # 16倍压缩的PQ单独检索召回率有限，用原始向量精排后接近精确搜索
+    assert report['pq16']['recall@10_rerank'] >= 0.9
+    assert report['pq16']['recall@10_rerank'] >= report['pq16']['recall@10']
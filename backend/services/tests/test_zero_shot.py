@@ -0,0 +1,129 @@
+"""
+zero_shot.py：词表校验、提示词编码为标签矩阵、组内softmax打分与阈值过滤、按词表摘要缓存标签矩阵
+"""
+import json
+
+import numpy as np
+import pytest
+
+from zero_shot import LabelMatrix, LabelMatrixUnavailable, load_label_matrix, load_vocabulary
+
+WORDS = ['red', 'crimson', 'blue', 'suv', 'sedan', 'coupe']
+DIMENSION = 8
+
+VOCABULARY = {
+    'groups': {
+        'color': {'template': 'a {} car', 'labels': {'red': ['red', 'crimson'], 'blue': 'blue'}},
+        'body': {'template': 'a photo of a {}', 'top_k': 2, 'labels': {'suv': 'suv', 'sedan': 'sedan', 'coupe': 'coupe'}}
+    }
+}
+
+
+class StubTextEncoder:
+    """提示词中出现的关键词 -> 该词对应的坐标轴（确定性，可以精确预期打分结果）"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        vectors = np.zeros((len(texts), DIMENSION), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for index, word in enumerate(WORDS):
+                if word in text.split():
+                    vectors[row, index] = 1.0
+        return vectors
+
+
+def axis(*weights):
+    vector = np.zeros(DIMENSION, dtype=np.float32)
+    for word, weight in weights:
+        vector[WORDS.index(word)] = weight
+    return vector
+
+
+@pytest.fixture
+def vocabulary_path(tmp_path):
+    path = tmp_path / 'tag_vocabulary.json'
+    path.write_text(json.dumps(VOCABULARY), encoding='utf-8')
+    return str(path)
+
+
+@pytest.fixture
+def labels(vocabulary_path):
+    return LabelMatrix.build(load_vocabulary(vocabulary_path), StubTextEncoder(), 'digest', batch_size=2)
+
+
+def test_load_vocabulary_applies_templates(vocabulary_path):
+    groups = load_vocabulary(vocabulary_path)
+    assert [group['name'] for group in groups] == ['color', 'body']
+    assert groups[0]['prompts'] == [['a red car', 'a crimson car'], ['a blue car']]
+    assert (groups[0]['top_k'], groups[1]['top_k']) == (1, 2)
+
+
+@pytest.mark.parametrize('vocabulary', [
+    {},
+    {'groups': {'color': {'labels': {}}}},
+    {'groups': {'color': {'labels': {'red': ['  ']}}}},
+])
+def test_load_vocabulary_rejects_invalid_files(tmp_path, vocabulary):
+    path = tmp_path / 'bad.json'
+    path.write_text(json.dumps(vocabulary), encoding='utf-8')
+    with pytest.raises(ValueError):
+        load_vocabulary(str(path))
+
+
+def test_build_averages_prompts_per_label(labels):
+    assert labels.labels == ['red', 'blue', 'suv', 'sedan', 'coupe']
+    assert labels.spans == {'color': (0, 2), 'body': (2, 5)}
+    # red的两个提示词取平均后归一化
+    np.testing.assert_allclose(labels.matrix[0], axis(('red', 1), ('crimson', 1)) / np.sqrt(2), atol=1e-6)
+    np.testing.assert_allclose(np.linalg.norm(labels.matrix, axis=1), 1.0, atol=1e-6)
+
+
+def test_score_picks_top_labels_per_group(labels):
+    image = axis(('crimson', 1.0), ('suv', 0.8), ('sedan', 0.5))
+    result = labels.score([image])[0]
+    assert [tag['label'] for tag in result['color']] == ['red']
+    assert result['color'][0]['confidence'] > 0.99
+    # body组的top_k为2，按置信度降序
+    assert [tag['label'] for tag in result['body']] == ['suv', 'sedan']
+    assert result['body'][0]['confidence'] > result['body'][1]['confidence']
+    assert result['body'][0]['similarity'] == pytest.approx(0.8 / np.linalg.norm(image), abs=1e-4)
+
+
+def test_score_thresholds_and_group_selection(labels):
+    # suv和sedan相似度接近：置信度都在0.5附近，阈值0.6时两者都不返回
+    image = axis(('suv', 1.0), ('sedan', 0.999), ('blue', 0.3))
+    result = labels.score([image], groups=['body'], top_k=3, min_confidence=0.6)[0]
+    assert list(result) == ['body']
+    assert result['body'] == []
+
+    kept = labels.score([image], groups=['body'], top_k=3, min_confidence=0.3)[0]['body']
+    assert [tag['label'] for tag in kept] == ['suv', 'sedan']
+    assert sum(tag['confidence'] for tag in kept) == pytest.approx(1.0, abs=1e-3)
+
+
+def test_score_rejects_bad_input(labels):
+    with pytest.raises(ValueError):
+        labels.score([axis(('red', 1))], groups=['wheels'])
+    with pytest.raises(ValueError):
+        labels.score([np.ones(DIMENSION + 1)])
+
+
+def test_label_matrix_is_cached_by_vocabulary_digest(vocabulary_path, tmp_path):
+    encoder = StubTextEncoder()
+    built = load_label_matrix(vocabulary_path, encoder, cache_dir=str(tmp_path / 'labels'))
+    assert sum(len(batch) for batch in encoder.calls) == 6
+
+    # 词表未变：没有文本塔也能直接加载
+    cached = load_label_matrix(vocabulary_path, None, cache_dir=str(tmp_path / 'labels'))
+    assert cached.digest == built.digest
+    np.testing.assert_array_equal(cached.matrix, built.matrix)
+
+    # 词表改变后需要重新编码
+    changed = dict(VOCABULARY, groups=dict(VOCABULARY['groups'], color={'labels': {'red': 'red'}}))
+    with open(vocabulary_path, 'w', encoding='utf-8') as f:
+        json.dump(changed, f)
+    with pytest.raises(LabelMatrixUnavailable):
+        load_label_matrix(vocabulary_path, None, cache_dir=str(tmp_path / 'labels'))
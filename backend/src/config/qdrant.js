@@ -17,6 +17,9 @@ const qdrantClient = new QdrantClient({
 // 默认集合名称
 const DEFAULT_COLLECTION = process.env.QDRANT_COLLECTION || 'car_images';
 
+// 按图片ID过滤时最多使用的ID数，避免filter过大（Qdrant直接搜索和CLIP服务端搜索一致）
+const MAX_FILTER_IMAGE_IDS = 1000;
+
 /**
  * 测试Qdrant连接
  */
@@ -88,7 +91,7 @@ async function searchVectors(queryVector, options = {}, collectionName = DEFAULT
         // Qdrant filter 格式：根据 image_id 字段过滤
         // 根据 @qdrant/js-client-rest 文档，filter 格式为：
         // { must: [{ key: 'field', match: { any: [values] } }] }
-        const limitedImageIds = imageIds.slice(0, 1000); // 限制最多 1000 个 ID，避免 filter 过大
+        const limitedImageIds = imageIds.slice(0, MAX_FILTER_IMAGE_IDS); // 限制最多 1000 个 ID，避免 filter 过大
         
         searchParams.filter = {
           must: [
@@ -182,6 +185,24 @@ async function searchByText(queryText, options = {}, collectionName = DEFAULT_CO
       return [];
     }
 
+    // 优先在CLIP服务端完成编码和搜索（/search-text），省去向量在Node与Python之间的一次往返
+    if (process.env.CLIP_FUSED_SEARCH !== 'false' && collectionName === DEFAULT_COLLECTION) {
+      try {
+        const httpClient = require('../services/clip_vectorize_client');
+        const results = await httpClient.searchText(queryText, {
+          limit: options.limit || 50,
+          offset: options.offset || 0,
+          score_threshold: options.score_threshold !== undefined ? options.score_threshold : 0.0,
+          imageIds: Array.isArray(options.imageIds) ? options.imageIds.slice(0, MAX_FILTER_IMAGE_IDS) : options.imageIds,
+          collection: collectionName
+        });
+        logger.info(`✅ 服务端文本搜索 "${queryText}" 返回 ${results.length} 个结果`);
+        return results;
+      } catch (fusedError) {
+        logger.warn(`服务端文本搜索失败: ${fusedError.message}，改为先向量化再搜索Qdrant`);
+      }
+    }
+
     // 尝试使用CLIP服务进行文本向量化
     let queryVector = null;
     try {
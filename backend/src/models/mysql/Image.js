@@ -67,7 +67,14 @@ const Image = sequelize.define('Image', {
   tableName: 'images',
   timestamps: true,
   createdAt: 'createdAt',
-  updatedAt: 'updatedAt'
+  updatedAt: 'updatedAt',
+  indexes: [
+    {
+      // 向量增量同步（clip_sync_vectors.py）按 (updatedAt, id) 分页读取变化的图片
+      name: 'idx_images_updated_id',
+      fields: ['updatedAt', 'id']
+    }
+  ]
 });
 
 // 移除循环关联
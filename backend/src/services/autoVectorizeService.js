@@ -7,6 +7,83 @@ const imageVectorizeService = require('./imageVectorizeService');
 const { upsertImageVector } = require('../config/qdrant');
 const { Image, Model, Brand } = require('../models/mysql');
 
+// 入库前做近重复检测（需要HTTP CLIP服务，服务不可达时退回普通向量化）
+const isDedupEnabled = process.env.CLIP_DEDUP_ON_UPLOAD === 'true';
+
+/**
+ * 向量化单张图片，开启近重复检测时一并检查是否与已入库图片重复
+ * @param {number} imageId - 图片ID
+ * @param {string} imageUrl - 图片URL
+ * @returns {Promise<{vector: Array<number>|null, duplicate: Object|null, hash: string|null}>}
+ */
+async function encodeForUpsert(imageId, imageUrl) {
+  if (!isDedupEnabled) {
+    return { vector: await imageVectorizeService.encodeImage(imageUrl), duplicate: null, hash: null };
+  }
+  try {
+    const { vectors, duplicates, hashes } = await imageVectorizeService.encodeImagesWithDedup([imageUrl], [imageId]);
+    if (!vectors[0] && !duplicates[0]) {
+      throw new Error('图片向量化失败');
+    }
+    return { vector: vectors[0], duplicate: duplicates[0] || null, hash: hashes[0] || null };
+  } catch (error) {
+    if (!imageVectorizeService.isServiceUnavailable(error)) {
+      throw error;
+    }
+    logger.warn(`⚠️ CLIP服务不可达，跳过近重复检测: imageId=${imageId}`);
+    return { vector: await imageVectorizeService.encodeImage(imageUrl), duplicate: null, hash: null };
+  }
+}
+
+/**
+ * 向量化并写入Qdrant：感知哈希判重的图片不写入；余弦判重的图片写入并在payload中记录duplicate_of；
+ * 其余图片写入成功后登记到近重复检测器（登记失败只记日志）
+ * @param {number} imageId - 图片ID
+ * @param {string} imageUrl - 图片URL
+ * @param {Object} payload - Qdrant payload
+ * @returns {Promise<Object>} 向量化结果
+ */
+async function encodeAndUpsert(imageId, imageUrl, payload) {
+  logger.info(`📸 开始向量化图片: ${imageUrl}`);
+  const { vector, duplicate, hash } = await encodeForUpsert(imageId, imageUrl);
+
+  if (duplicate && !vector) {
+    logger.info(`🔁 近重复图片，跳过入库: imageId=${imageId} duplicate_of=${duplicate.duplicate_of}`);
+    return {
+      success: true,
+      imageId,
+      vectorized: false,
+      upserted: false,
+      duplicateOf: duplicate.duplicate_of
+    };
+  }
+
+  logger.info(`💾 存入向量数据库: imageId=${imageId}`);
+  const result = await upsertImageVector(
+    imageId,
+    vector,
+    duplicate ? { ...payload, duplicate_of: duplicate.duplicate_of } : payload
+  );
+
+  if (isDedupEnabled && !duplicate && result.success) {
+    try {
+      await imageVectorizeService.registerImages([imageId], [vector], [hash]);
+    } catch (error) {
+      logger.warn(`⚠️ 登记近重复检测失败 (imageId=${imageId}):`, error.message);
+    }
+  }
+
+  logger.info(`✅ 图片自动向量化成功: imageId=${imageId}`);
+
+  return {
+    success: true,
+    imageId,
+    vectorized: true,
+    upserted: result.success,
+    ...(duplicate ? { duplicateOf: duplicate.duplicate_of } : {})
+  };
+}
+
 /**
  * 为单张图片生成向量并存入Qdrant
  * @param {number} imageId - 图片ID
@@ -44,6 +121,8 @@ async function vectorizeAndUpsertImage(imageId, imageUrl = null) {
       // 构建payload（包含图片的元数据，用于过滤和展示）
       const payload = {
         image_id: imageId,
+        // 增量同步（clip_sync_vectors.py）按image_url判断图片是否更换，未更换时只更新payload
+        image_url: imageUrl,
         title: image.title || '',
         description: image.description || '',
         category: image.category || '',
@@ -55,40 +134,14 @@ async function vectorizeAndUpsertImage(imageId, imageUrl = null) {
         upload_date: image.uploadDate ? image.uploadDate.toISOString() : null
       };
 
-      // 1. 向量化图片
-      logger.info(`📸 开始向量化图片: ${imageUrl}`);
-      const vector = await imageVectorizeService.encodeImage(imageUrl);
-
-      // 2. 存入Qdrant
-      logger.info(`💾 存入向量数据库: imageId=${imageId}`);
-      const result = await upsertImageVector(imageId, vector, payload);
-
-      logger.info(`✅ 图片自动向量化成功: imageId=${imageId}`);
-      
-      return {
-        success: true,
-        imageId,
-        vectorized: true,
-        upserted: result.success
-      };
+      // 向量化并存入Qdrant
+      return await encodeAndUpsert(imageId, imageUrl, payload);
     } else {
       // 如果提供了图片URL，直接使用（适用于上传时立即调用的场景）
-      logger.info(`📸 开始向量化图片: ${imageUrl}`);
-      const vector = await imageVectorizeService.encodeImage(imageUrl);
-
-      logger.info(`💾 存入向量数据库: imageId=${imageId}`);
-      const result = await upsertImageVector(imageId, vector, {
-        image_id: imageId
+      return await encodeAndUpsert(imageId, imageUrl, {
+        image_id: imageId,
+        image_url: imageUrl
       });
-
-      logger.info(`✅ 图片自动向量化成功: imageId=${imageId}`);
-      
-      return {
-        success: true,
-        imageId,
-        vectorized: true,
-        upserted: result.success
-      };
     }
   } catch (error) {
     logger.error(`❌ 图片自动向量化失败 (imageId=${imageId}):`, error.message);
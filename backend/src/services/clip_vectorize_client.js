@@ -9,6 +9,96 @@ const logger = require('../config/logger');
 const CLIP_SERVICE_URL = process.env.CLIP_SERVICE_URL || 'http://localhost:5001';
 const CLIP_SERVICE_TIMEOUT = parseInt(process.env.CLIP_SERVICE_TIMEOUT || '15000'); // 15秒超时（降低以提高响应速度）
 
+/**
+ * 半精度浮点（IEEE 754 binary16）转为number
+ * @param {number} h - 16位无符号整数
+ * @returns {number}
+ */
+function halfToFloat(h) {
+  const sign = h & 0x8000 ? -1 : 1;
+  const exponent = (h >> 10) & 0x1f;
+  const fraction = h & 0x3ff;
+  if (exponent === 0) {
+    return sign * Math.pow(2, -14) * (fraction / 1024);
+  }
+  if (exponent === 0x1f) {
+    return fraction ? NaN : sign * Infinity;
+  }
+  return sign * Math.pow(2, exponent - 15) * (1 + fraction / 1024);
+}
+
+/**
+ * 解析CLIP服务返回的二进制向量（小端float32/float16，按行连续排列）
+ * 处理失败的行在响应体中以0填充，位置由 x-vector-missing 给出，这里还原为null
+ * @param {Buffer} data - 响应体
+ * @param {Object} headers - 响应头（x-vector-dimension / x-vector-count / x-vector-dtype / x-vector-missing）
+ * @returns {Array<Array<number>|null>} 向量数组的数组
+ */
+function decodeBinaryVectors(data, headers) {
+  const dimension = parseInt(headers['x-vector-dimension']);
+  const count = parseInt(headers['x-vector-count']);
+  const dtype = (headers['x-vector-dtype'] || 'float32').toLowerCase();
+  const itemSize = { float32: 4, float16: 2 }[dtype];
+  if (!itemSize) {
+    throw new Error(`不支持的向量类型: ${dtype}`);
+  }
+  const bytes = Buffer.from(data);
+  if (bytes.length !== count * dimension * itemSize) {
+    throw new Error(`二进制向量长度不符: ${bytes.length}字节，应为 ${count} x ${dimension} x ${itemSize}`);
+  }
+  const missing = new Set(
+    (headers['x-vector-missing'] || '').split(',').filter(Boolean).map(i => parseInt(i))
+  );
+
+  const vectors = [];
+  if (dtype === 'float32') {
+    // 复制到独立的ArrayBuffer，保证Float32Array按4字节对齐
+    const floats = new Float32Array(bytes.buffer.slice(bytes.byteOffset, bytes.byteOffset + bytes.byteLength));
+    for (let i = 0; i < count; i++) {
+      vectors.push(missing.has(i) ? null : Array.from(floats.subarray(i * dimension, (i + 1) * dimension)));
+    }
+  } else {
+    for (let i = 0; i < count; i++) {
+      if (missing.has(i)) {
+        vectors.push(null);
+        continue;
+      }
+      const vector = new Array(dimension);
+      for (let j = 0; j < dimension; j++) {
+        vector[j] = halfToFloat(bytes.readUInt16LE((i * dimension + j) * 2));
+      }
+      vectors.push(vector);
+    }
+  }
+  return vectors;
+}
+
+/**
+ * 把服务返回的4xx/5xx转换为带服务端错误信息的Error
+ * responseType为arraybuffer时错误响应体是Buffer，先按UTF-8解析JSON，使 error.response.data.error 与其他接口一致
+ * @param {Error} error - axios错误（带response）
+ * @returns {Error} message为服务端的error字段，带 status、retryAfter（秒，来自Retry-After头）和原始response
+ */
+function serviceResponseError(error) {
+  const response = error.response;
+  if (Buffer.isBuffer(response.data) || response.data instanceof ArrayBuffer) {
+    const text = Buffer.from(response.data).toString('utf8');
+    try {
+      response.data = JSON.parse(text);
+    } catch (parseError) {
+      response.data = { error: text };
+    }
+  }
+  const serviceError = new Error(response.data?.error || error.message);
+  serviceError.status = response.status;
+  const retryAfter = parseInt(response.headers?.['retry-after']);
+  if (!isNaN(retryAfter)) {
+    serviceError.retryAfter = retryAfter;
+  }
+  serviceError.response = response;
+  return serviceError;
+}
+
 /**
  * 将文本编码为向量
  * @param {string} text - 要编码的文本
@@ -26,7 +116,9 @@ async function encodeText(text) {
       {
         timeout: CLIP_SERVICE_TIMEOUT,
         headers: {
-          'Content-Type': 'application/json'
+          'Content-Type': 'application/json',
+          // 异步模式的服务在超时后丢弃仍在排队的请求
+          'X-Request-Timeout-Ms': String(CLIP_SERVICE_TIMEOUT)
         }
       }
     );
@@ -58,33 +150,209 @@ async function encodeTexts(texts) {
       throw new Error('文本数组不能为空');
     }
 
+    // 请求二进制格式，避免大批量时格式化和解析浮点JSON的开销
     const response = await axios.post(
       `${CLIP_SERVICE_URL}/encode-texts`,
       { texts: texts.map(t => t.trim()).filter(t => t.length > 0) },
       {
         timeout: CLIP_SERVICE_TIMEOUT,
+        responseType: 'arraybuffer',
         headers: {
-          'Content-Type': 'application/json'
+          'Content-Type': 'application/json',
+          'Accept': 'application/octet-stream, application/json',
+          'X-Request-Timeout-Ms': String(CLIP_SERVICE_TIMEOUT)
         }
       }
     );
 
-    if (response.data.status === 'success' && response.data.vectors) {
-      logger.info(`批量文本向量化成功: ${texts.length} 个文本 -> ${response.data.vectors.length} 个向量`);
-      return response.data.vectors;
+    const contentType = response.headers['content-type'] || '';
+    if (contentType.startsWith('application/octet-stream')) {
+      const vectors = decodeBinaryVectors(response.data, response.headers);
+      logger.info(`批量文本向量化成功: ${texts.length} 个文本 -> ${vectors.length} 个向量`);
+      return vectors;
+    }
+
+    // 旧版服务不支持二进制格式，仍返回JSON
+    const result = JSON.parse(Buffer.from(response.data).toString('utf8'));
+    if (result.status === 'success' && result.vectors) {
+      logger.info(`批量文本向量化成功: ${texts.length} 个文本 -> ${result.vectors.length} 个向量`);
+      return result.vectors;
     } else {
-      throw new Error(response.data.error || '批量向量化失败');
+      throw new Error(result.error || '批量向量化失败');
     }
   } catch (error) {
     if (error.code === 'ECONNREFUSED') {
       logger.warn(`CLIP服务未启动 (${CLIP_SERVICE_URL})，无法进行文本向量化`);
       throw new Error('CLIP向量化服务未启动');
     }
+    if (error.response) {
+      const serviceError = serviceResponseError(error);
+      const retryHint = serviceError.retryAfter !== undefined ? `，${serviceError.retryAfter}秒后可重试` : '';
+      logger.error(`批量文本向量化失败: HTTP ${serviceError.status} ${serviceError.message}${retryHint}`);
+      throw serviceError;
+    }
     logger.error(`批量文本向量化失败: ${error.message}`);
     throw error;
   }
 }
 
+/**
+ * 在CLIP服务的本地向量索引中搜索（参数与 config/qdrant.js 的 searchVectors 一致，结果格式同Qdrant）
+ * @param {Array<number>} queryVector - 查询向量
+ * @param {Object} options - { limit, offset, score_threshold, filter, imageIds }
+ * @returns {Promise<Array<{id, score, payload}>>}
+ */
+async function searchLocalIndex(queryVector, options = {}) {
+  const {
+    limit = 10,
+    offset = 0,
+    score_threshold = 0.0,
+    filter = null, // payload过滤，如 { brand_id: 3, model_id: [1, 2] }
+    imageIds = null
+  } = options;
+
+  try {
+    const response = await axios.post(
+      `${CLIP_SERVICE_URL}/search`,
+      {
+        vector: queryVector,
+        limit,
+        offset,
+        score_threshold,
+        filter,
+        image_ids: Array.isArray(imageIds) && imageIds.length > 0 ? imageIds : undefined
+      },
+      {
+        timeout: CLIP_SERVICE_TIMEOUT,
+        headers: {
+          'Content-Type': 'application/json'
+        }
+      }
+    );
+
+    if (response.data.status === 'success') {
+      logger.info(`本地索引搜索成功: ${response.data.count} 个结果 (${response.data.method}, ${response.data.took_ms}ms)`);
+      return response.data.results;
+    }
+    throw new Error(response.data.error || '本地索引搜索失败');
+  } catch (error) {
+    if (error.code === 'ECONNREFUSED') {
+      logger.warn(`CLIP服务未启动 (${CLIP_SERVICE_URL})，无法进行本地索引搜索`);
+      throw new Error('CLIP向量化服务未启动');
+    }
+    logger.error(`本地索引搜索失败: ${error.response?.data?.error || error.message}`);
+    throw error;
+  }
+}
+
+/**
+ * 编码查询文本并在CLIP服务端直接搜索（/search-text），查询向量不经过Node
+ * @param {string} text - 查询文本
+ * @param {Object} options - { limit, offset, score_threshold, filter, imageIds, withPayload, backend, collection }
+ * @returns {Promise<Array<{id, score, payload}>>} 与Qdrant search格式一致的结果
+ */
+async function searchText(text, options = {}) {
+  const {
+    limit = 10,
+    offset = 0,
+    score_threshold = 0.0,
+    filter = null,
+    imageIds = null,
+    withPayload = ['image_id'], // 只取需要的payload字段，减少响应体积
+    backend = undefined, // qdrant | local | auto，默认使用服务端的 CLIP_SEARCH_BACKEND
+    collection = undefined // 期望搜索的集合，服务端配置的集合不同时返回400
+  } = options;
+
+  if (!text || !text.trim()) {
+    throw new Error('文本不能为空');
+  }
+
+  try {
+    const response = await axios.post(
+      `${CLIP_SERVICE_URL}/search-text`,
+      {
+        text: text.trim(),
+        limit,
+        offset,
+        score_threshold,
+        filter,
+        image_ids: Array.isArray(imageIds) && imageIds.length > 0 ? imageIds : undefined,
+        with_payload: withPayload,
+        backend,
+        collection
+      },
+      {
+        timeout: CLIP_SERVICE_TIMEOUT,
+        headers: {
+          'Content-Type': 'application/json',
+          'X-Request-Timeout-Ms': String(CLIP_SERVICE_TIMEOUT)
+        }
+      }
+    );
+
+    if (response.data.status === 'success') {
+      const { encode, search } = response.data.took_ms || {};
+      logger.info(`服务端文本搜索成功: "${text}" -> ${response.data.count} 个结果 (${response.data.backend}, 编码${encode}ms, 搜索${search}ms)`);
+      return response.data.results;
+    }
+    throw new Error(response.data.error || '文本搜索失败');
+  } catch (error) {
+    if (error.code === 'ECONNREFUSED') {
+      logger.warn(`CLIP服务未启动 (${CLIP_SERVICE_URL})，无法进行文本搜索`);
+      throw new Error('CLIP向量化服务未启动');
+    }
+    logger.error(`服务端文本搜索失败: ${error.response?.data?.error || error.message}`);
+    throw error;
+  }
+}
+
+/**
+ * 零样本打标签：服务端用图片向量与标签矩阵（tag_vocabulary.json）一次矩阵乘，返回每组top-k标签和置信度
+ * @param {Array<string>} images - 图片URL或服务端可访问的本地路径
+ * @param {Object} options - { groups, topK, minConfidence }
+ * @returns {Promise<Array<Object|null>>} 每张图片 {组名: [{label, confidence, similarity}]}，加载失败的位置为null
+ */
+async function tagImages(images, options = {}) {
+  const { groups = undefined, topK = undefined, minConfidence = undefined } = options;
+
+  if (!Array.isArray(images) || images.length === 0) {
+    throw new Error('图片列表不能为空');
+  }
+
+  try {
+    const response = await axios.post(
+      `${CLIP_SERVICE_URL}/tag-images`,
+      {
+        images,
+        groups,
+        top_k: topK,
+        min_confidence: minConfidence
+      },
+      {
+        timeout: CLIP_SERVICE_TIMEOUT,
+        headers: {
+          'Content-Type': 'application/json',
+          'X-Request-Timeout-Ms': String(CLIP_SERVICE_TIMEOUT)
+        }
+      }
+    );
+
+    if (response.data.status === 'success') {
+      const failed = Object.keys(response.data.errors || {}).length;
+      logger.info(`图片打标签成功: ${response.data.count}/${images.length} 张${failed ? `，${failed} 张加载失败` : ''}`);
+      return response.data.results;
+    }
+    throw new Error(response.data.error || '图片打标签失败');
+  } catch (error) {
+    if (error.code === 'ECONNREFUSED') {
+      logger.warn(`CLIP服务未启动 (${CLIP_SERVICE_URL})，无法打标签`);
+      throw new Error('CLIP向量化服务未启动');
+    }
+    logger.error(`图片打标签失败: ${error.response?.data?.error || error.message}`);
+    throw error;
+  }
+}
+
 /**
  * 检查CLIP服务是否可用
  * @returns {Promise<boolean>}
@@ -103,6 +371,9 @@ async function checkServiceHealth() {
 module.exports = {
   encodeText,
   encodeTexts,
+  searchLocalIndex,
+  searchText,
+  tagImages,
   checkServiceHealth
 };
 
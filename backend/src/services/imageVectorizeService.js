@@ -5,8 +5,13 @@
 const { spawn } = require('child_process');
 const path = require('path');
 const fs = require('fs');
+const axios = require('axios');
 const logger = require('../config/logger');
 
+// CLIP HTTP服务配置（常驻进程，模型只加载一次）
+const CLIP_SERVICE_URL = process.env.CLIP_SERVICE_URL || 'http://localhost:5001';
+const CLIP_IMAGE_SERVICE_TIMEOUT = parseInt(process.env.CLIP_IMAGE_SERVICE_TIMEOUT || '30000'); // 30秒（包含下载图片的时间）
+
 // Python脚本路径
 const CLIP_IMAGE_SCRIPT_PATH = path.join(__dirname, '../../services/clip_image_encoder_standalone.py');
 
@@ -15,6 +20,79 @@ if (!fs.existsSync(CLIP_IMAGE_SCRIPT_PATH)) {
   logger.warn(`⚠️  CLIP图片向量化脚本不存在: ${CLIP_IMAGE_SCRIPT_PATH}`);
 }
 
+// 只有这些错误说明HTTP服务不可达（没有在运行或地址解析失败），才回退到Python脚本
+const SERVICE_UNAVAILABLE_CODES = ['ECONNREFUSED', 'ECONNRESET', 'ENOTFOUND'];
+
+/**
+ * 判断HTTP服务调用失败是否应回退到Python脚本
+ * 只在连接错误时回退；服务已返回的4xx/5xx（图片无法加载、参数错误、服务端错误）和超时原样抛出：
+ * 超时通常说明服务过载，每次回退都会启动一个Python进程并重新加载模型，只会加重负载
+ * @param {Error} error - axios错误
+ * @returns {boolean}
+ */
+function isServiceUnavailable(error) {
+  if (error.response) {
+    return false;
+  }
+  return SERVICE_UNAVAILABLE_CODES.includes(error.code);
+}
+
+/**
+ * 调用常驻的CLIP HTTP服务进行图片向量化
+ * @param {string} imageSource - 图片URL或本地路径
+ * @returns {Promise<Array<number>>} 向量数组
+ */
+async function encodeImageWithService(imageSource) {
+  const response = await axios.post(
+    `${CLIP_SERVICE_URL}/encode-image`,
+    { image: imageSource.trim() },
+    {
+      timeout: CLIP_IMAGE_SERVICE_TIMEOUT,
+      headers: {
+        'Content-Type': 'application/json',
+        // 异步模式的服务在超时后丢弃仍在排队的请求
+        'X-Request-Timeout-Ms': String(CLIP_IMAGE_SERVICE_TIMEOUT)
+      }
+    }
+  );
+
+  if (response.data.status === 'success' && response.data.vector) {
+    logger.info(`✅ 图片向量化成功(HTTP服务): ${imageSource.substring(0, 100)} -> ${response.data.dimension}维向量`);
+    return response.data.vector;
+  }
+  throw new Error(response.data.error || '向量化失败');
+}
+
+/**
+ * 调用CLIP HTTP服务批量向量化图片（一次请求，服务端按batch_size批量推理）
+ * @param {Array<string>} imageSources - 图片URL或路径数组
+ * @returns {Promise<Array<Array<number>|null>>} 向量数组，失败的位置为null
+ */
+async function encodeImagesWithService(imageSources) {
+  const timeout = CLIP_IMAGE_SERVICE_TIMEOUT * Math.max(1, Math.ceil(imageSources.length / 8));
+  const response = await axios.post(
+    `${CLIP_SERVICE_URL}/encode-images`,
+    { images: imageSources.map(s => s.trim()) },
+    {
+      timeout,
+      headers: {
+        'Content-Type': 'application/json',
+        'X-Request-Timeout-Ms': String(timeout)
+      }
+    }
+  );
+
+  if (response.data.status === 'success' && Array.isArray(response.data.vectors)) {
+    const errors = response.data.errors || {};
+    Object.keys(errors).forEach(index => {
+      logger.error(`图片向量化失败 (${imageSources[index]}): ${errors[index]}`);
+    });
+    logger.info(`✅ 批量图片向量化成功(HTTP服务): ${response.data.count}/${imageSources.length}`);
+    return response.data.vectors;
+  }
+  throw new Error(response.data.error || '批量向量化失败');
+}
+
 /**
  * 调用Python脚本进行图片向量化
  * @param {string} imageSource - 图片URL或本地路径
@@ -112,7 +190,17 @@ async function encodeImageWithPython(imageSource) {
 async function encodeImage(imageSource) {
   try {
     logger.info(`🖼️  开始图片向量化: ${imageSource.substring(0, 100)}`);
-    const vector = await encodeImageWithPython(imageSource);
+    let vector;
+    try {
+      // 优先使用常驻HTTP服务，避免每张图片都启动Python进程并重新加载模型
+      vector = await encodeImageWithService(imageSource);
+    } catch (serviceError) {
+      if (!isServiceUnavailable(serviceError)) {
+        throw serviceError.response?.data?.error ? new Error(serviceError.response.data.error) : serviceError;
+      }
+      logger.warn(`CLIP HTTP服务不可用 (${serviceError.code || serviceError.message})，回退到Python脚本`);
+      vector = await encodeImageWithPython(imageSource);
+    }
     
     // 验证向量格式
     if (!Array.isArray(vector)) {
@@ -139,6 +227,16 @@ async function encodeImages(imageSources) {
     throw new Error('图片源数组不能为空');
   }
 
+  // 优先一次性交给HTTP服务批量推理
+  try {
+    return await encodeImagesWithService(imageSources);
+  } catch (serviceError) {
+    if (!isServiceUnavailable(serviceError)) {
+      throw serviceError.response?.data?.error ? new Error(serviceError.response.data.error) : serviceError;
+    }
+    logger.warn(`CLIP HTTP服务批量向量化不可用 (${serviceError.code || serviceError.message})，回退到逐张处理`);
+  }
+
   // 串行处理，避免同时启动多个Python进程
   const vectors = [];
   for (const imageSource of imageSources) {
@@ -155,6 +253,71 @@ async function encodeImages(imageSources) {
   return vectors;
 }
 
+/**
+ * 批量向量化并做近重复检测（仅HTTP服务支持，入库前调用）
+ * 感知哈希命中的图片不计算向量（对应位置为null），余弦相似度命中的仍返回向量，由调用方决定跳过或关联
+ * 通过检查的图片不会自动登记，写入Qdrant成功后调用 registerImages 登记
+ * @param {Array<string>} imageSources - 图片URL或路径数组
+ * @param {Array<number|string>} imageIds - 与图片一一对应的image_id
+ * @returns {Promise<{vectors: Array<Array<number>|null>, duplicates: Object, hashes: Object}>}
+ *   duplicates: { 下标: { duplicate_of, method: 'phash'|'cosine', distance|score } }
+ *   hashes: { 下标: 感知哈希（16位十六进制） }，只包含通过检查的图片
+ */
+async function encodeImagesWithDedup(imageSources, imageIds) {
+  if (!Array.isArray(imageSources) || imageSources.length === 0) {
+    throw new Error('图片源数组不能为空');
+  }
+  if (!Array.isArray(imageIds) || imageIds.length !== imageSources.length) {
+    throw new Error('imageIds必须与图片源一一对应');
+  }
+
+  const timeout = CLIP_IMAGE_SERVICE_TIMEOUT * Math.max(1, Math.ceil(imageSources.length / 8));
+  const response = await axios.post(
+    `${CLIP_SERVICE_URL}/encode-images`,
+    { images: imageSources.map(s => s.trim()), dedup: true, image_ids: imageIds },
+    {
+      timeout,
+      headers: {
+        'Content-Type': 'application/json',
+        'X-Request-Timeout-Ms': String(timeout)
+      }
+    }
+  );
+
+  if (response.data.status === 'success' && Array.isArray(response.data.vectors)) {
+    const errors = response.data.errors || {};
+    Object.keys(errors).forEach(index => {
+      logger.error(`图片向量化失败 (${imageSources[index]}): ${errors[index]}`);
+    });
+    const duplicates = response.data.duplicates || {};
+    Object.keys(duplicates).forEach(index => {
+      logger.info(`🔁 近重复图片: ${imageIds[index]} -> ${duplicates[index].duplicate_of} (${duplicates[index].method})`);
+    });
+    logger.info(`✅ 批量图片向量化成功(HTTP服务): ${response.data.count}/${imageSources.length}，近重复 ${Object.keys(duplicates).length} 张`);
+    return { vectors: response.data.vectors, duplicates, hashes: response.data.hashes || {} };
+  }
+  throw new Error(response.data.error || '批量向量化失败');
+}
+
+/**
+ * 把已写入Qdrant的图片登记到服务端的近重复检测器（之后提交的近重复图片才会命中）
+ * @param {Array<number|string>} imageIds - 图片ID
+ * @param {Array<Array<number>>} vectors - 与imageIds一一对应的向量
+ * @param {Array<string|null>} hashes - 与imageIds一一对应的感知哈希（encodeImagesWithDedup 返回的 hashes）
+ * @returns {Promise<number>} 登记的数量
+ */
+async function registerImages(imageIds, vectors, hashes) {
+  const response = await axios.post(
+    `${CLIP_SERVICE_URL}/register-images`,
+    { image_ids: imageIds, vectors, hashes },
+    {
+      timeout: CLIP_IMAGE_SERVICE_TIMEOUT,
+      headers: { 'Content-Type': 'application/json' }
+    }
+  );
+  return response.data.registered;
+}
+
 /**
  * 检查图片向量化服务是否可用
  * @returns {Promise<boolean>}
@@ -189,6 +352,9 @@ async function checkServiceHealth() {
 module.exports = {
   encodeImage,
   encodeImages,
+  encodeImagesWithDedup,
+  registerImages,
+  isServiceUnavailable,
   checkServiceHealth
 };
 